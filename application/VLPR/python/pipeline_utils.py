@@ -0,0 +1,113 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+import time
+import threading
+import collections
+import numpy as np
+
+from chars import CHARS
+
+BLANK = len(CHARS) - 1
+# 每个字符一个utf-32编码单元, 整个batch的结果可以一次解码成字符串
+CHARS_ARRAY = np.array(CHARS, dtype='<U1')
+
+
+def ctc_greedy_decode(output, blank=BLANK):
+    """lprnet的greedy CTC解码, 去掉重复字符和blank, 整个batch一次完成
+
+    Args:
+        output (np.ndarray): lprnet输出, shape为(batch, len(CHARS), T)
+        blank (int): blank字符的序号
+
+    Returns:
+        list: batch个车牌字符串
+    """
+    labels = np.argmax(output, axis=1)
+    keep = labels != blank
+    keep[:, 1:] &= labels[:, 1:] != labels[:, :-1]
+    text = CHARS_ARRAY[labels[keep]].tobytes().decode('utf-32-le')
+    ends = np.cumsum(keep.sum(axis=1)).tolist()
+    return [text[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+
+class PlateFilter(object):
+    """车牌去重: 每路视频单独记录最近识别到的车牌, 同一车牌在一路视频中被识别到in_threshold次时输出一次;
+    一个车牌在该路之后的out_threshold次识别中都没有出现时被遗忘, 再次出现会重新计数.
+
+    每路视频的记录是按最近识别顺序排列的OrderedDict, 最多保存out_threshold个车牌,
+    每次识别只需更新当前车牌并从头部淘汰过期的车牌, 不再遍历所有已知车牌.
+    """
+    def __init__(self, in_threshold=4, out_threshold=4):
+        self.in_threshold = in_threshold
+        self.out_threshold = out_threshold
+        self.channels = {}
+        self.counts = {}
+
+    def update(self, channel, plate):
+        """记录一次识别结果
+
+        Args:
+            channel (int): 视频通道号
+            plate (str): 识别到的车牌
+
+        Returns:
+            bool: 该车牌是否需要输出
+        """
+        if not plate:
+            return False
+        plates = self.channels.setdefault(channel, collections.OrderedDict())
+        count = self.counts[channel] = self.counts.get(channel, 0) + 1
+        hits = plates.pop(plate, (0, count))[0] + 1
+        plates[plate] = (hits, count)
+        for oldest, (_, last) in list(plates.items()):
+            if count - last < self.out_threshold:
+                break
+            del plates[oldest]
+        return hits == self.in_threshold
+
+
+class StageStats(object):
+    """流水线各阶段的计数: 处理次数, 平均/最大耗时, 阶段输入队列的平均/最大深度.
+    每个阶段由各自的线程调用add更新, report输出上一次report之后的统计.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()
+        self.start_time = time.time()
+
+    def add(self, stage, latency, depth=None):
+        """
+        Args:
+            stage (str): 阶段名
+            latency (float): 本次处理耗时, 单位s
+            depth (int): 本次处理时输入队列中的数据个数, 没有队列时为None
+        """
+        with self.lock:
+            s = self.stages.get(stage)
+            if s is None:
+                s = self.stages[stage] = {"count": 0, "time": 0.0, "max_time": 0.0, "depth": 0, "max_depth": 0}
+            s["count"] += 1
+            s["time"] += latency
+            s["max_time"] = max(s["max_time"], latency)
+            if depth is not None:
+                s["depth"] += depth
+                s["max_depth"] = max(s["max_depth"], depth)
+
+    def report(self):
+        with self.lock:
+            duration = max(time.time() - self.start_time, 1e-6)
+            lines = []
+            for stage, s in self.stages.items():
+                count = max(s["count"], 1)
+                lines.append("{}: {:.1f}/s, latency avg {:.2f} ms max {:.2f} ms, queue depth avg {:.1f} max {}".format(
+                    stage, s["count"] / duration, s["time"] / count * 1000, s["max_time"] * 1000,
+                    s["depth"] / count, s["max_depth"]))
+                s.update(count=0, time=0.0, max_time=0.0, depth=0, max_depth=0)
+            self.start_time = time.time()
+        return lines
@@ -19,13 +19,14 @@ import argparse
 import logging
 from logging.handlers import RotatingFileHandler
 
-from chars import CHARS,CHARS_DICT
+from pipeline_utils import ctc_greedy_decode, PlateFilter, StageStats
 
 class MultiDecoderThread(object):
-    def __init__(self, draw_images:bool, stress_test:bool, tpu_id:int, video_list:list, resize_type:sail.sail_resize_type, max_que_size:int, loop_count:int,process_id:int):
+    def __init__(self, draw_images:bool, stress_test:bool, tpu_id:int, video_list:list, resize_type:sail.sail_resize_type, max_que_size:int, loop_count:int,process_id:int,stats_interval:float=10):
         self.draw_images = draw_images
         self.stress_test = stress_test
         self.loop_count = loop_count
+        self.stats_interval = stats_interval
         self.video_list = video_list
         self.channel_list = {}
         self.tpu_id = tpu_id
@@ -41,9 +42,11 @@ class MultiDecoderThread(object):
         self.image_que = queue.Queue(max_que_size)
         self.max_que_size = max_que_size
 
-        self.exit_flag = False
-        self.flag_lock = threading.Lock()
-        
+        # 各线程在队列上阻塞等待, 每隔poll_interval检查一次退出标志
+        self.exit_event = threading.Event()
+        self.poll_interval = 0.1
+        self.stats = StageStats()
+
         for video_name in video_list:
             channel_index = self.multiDecoder.add_channel(video_name,0)
             logging.info("Process {}  Add Channel[{}]: {}".format(process_id,channel_index,video_name))
@@ -63,13 +66,29 @@ class MultiDecoderThread(object):
     def restart_multidecoder(self):
         for key in self.channel_list:
             self.multiDecoder.reconnect(int(key))
-            logging.info("reconnect:",int(key))
+            logging.info("reconnect: {}".format(int(key)))
 
     def get_exit_flag(self):
-        self.flag_lock.acquire()
-        flag_temp = self.exit_flag
-        self.flag_lock.release()
-        return flag_temp
+        return self.exit_event.is_set()
+
+    def put_queue(self, que:queue.Queue, item):
+        """阻塞地把数据放入下一阶段的队列, 退出时返回False"""
+        while not self.exit_event.is_set():
+            try:
+                que.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get_queue(self, que:queue.Queue):
+        """阻塞地从队列取数据, 退出时返回None"""
+        while not self.exit_event.is_set():
+            try:
+                return que.get(timeout=self.poll_interval)
+            except queue.Empty:
+                pass
+        return None
 
     def InitProcess(self, yolo_bmodel:str,lprnet_bmodel:str,dete_threshold:float,nms_threshold:float):
         """通过sail.EngineImagePreProcess, 初始化yolov5、lprnet的预处理和推理接口;
@@ -130,16 +149,21 @@ class MultiDecoderThread(object):
         while True:
             if self.get_exit_flag():
                 break
+            decoded = False
             for key in channel_list:
                 if self.get_exit_flag():
                     break
+                start_time = time.time()
                 bmimg = sail.BMImage()
                 ret = multi_decoder.read(int(key),bmimg)
                 if ret == 0:
                     image_index += 1
                     PreProcessAndInference.PushImage(int(key),image_index, bmimg)
-                else:
-                    time.sleep(0.01)
+                    self.stats.add("decode", time.time() - start_time)
+                    decoded = True
+            # 所有通道都没有新的帧时才等待, 而不是每个通道读失败都sleep
+            if not decoded:
+                self.exit_event.wait(0.01)
 
         print("decoder_and_pushdata thread exit!")
 
@@ -171,30 +195,24 @@ class MultiDecoderThread(object):
                 width_list.append(ost_images[index].width())
                 height_list.append(ost_images[index].height())
 
-            while post_queue.full():
-                time.sleep(0.01)
-                if self.get_exit_flag():
-                    break
-                continue
-            post_queue.put([output_tensor_map,
-                            channel_list,
-                            imageidx_list,
-                            width_list, 
-                            height_list, 
-                            padding_atrr],False)
-            
+            self.stats.add("yolov5_inference", time.time() - start_time)
+
+            if not self.put_queue(post_queue, [output_tensor_map,
+                                               channel_list,
+                                               imageidx_list,
+                                               width_list,
+                                               height_list,
+                                               padding_atrr]):
+                break
+
             for index, channel in enumerate(channel_list):
-                while img_queue.full():
-                    time.sleep(0.01)
-                    if self.get_exit_flag():
-                        break
-                    continue 
-                img_queue.put({(channel,imageidx_list[index]):ost_images[index]}) 
+                if not self.put_queue(img_queue, {(channel,imageidx_list[index]):ost_images[index]}):
+                    break
 
                 logging.debug("put ost img to queue, cid is {}, frameid is{}".format(channel,imageidx_list[index]))
 
             end_time = time.time()
-            logging.info("Engine_image_pre_process GetBatchData time use: {:.2f} ms".format((end_time-start_time)*1000))
+            logging.debug("Engine_image_pre_process GetBatchData time use: {:.2f} ms".format((end_time-start_time)*1000))
         
         print("Inferences_thread thread exit!")
 
@@ -209,10 +227,12 @@ class MultiDecoderThread(object):
         while (True):
             if self.get_exit_flag():
                 break
-            # if post_quque.empty():
-            #     time.sleep(0.01)
-            #     continue
-            output_tensor_map, channels ,imageidxs, ost_ws, ost_hs, padding_atrrs = post_quque.get(True)
+            depth = post_quque.qsize()
+            data = self.get_queue(post_quque)
+            if data is None:
+                break
+            start_time = time.time()
+            output_tensor_map, channels ,imageidxs, ost_ws, ost_hs, padding_atrrs = data
 
             dete_thresholds = np.ones(len(channels),dtype=np.float32)
             nms_thresholds = np.ones(len(channels),dtype=np.float32)
@@ -226,9 +246,10 @@ class MultiDecoderThread(object):
                 if ret == 0:
                     break
                 else:
-                    print("push_data failed, ret: {}".format(ret))
-                    time.sleep(0.01)
-                    # break
+                    # 后处理的输入队列已满
+                    logging.debug("push_data failed, ret: {}".format(ret))
+                    self.exit_event.wait(0.01)
+            self.stats.add("yolov5_post", time.time() - start_time, depth)
         print("post_process thread exit!")
     
     def lprnet_pre_and_process(self, img_queue:queue.Queue):
@@ -245,12 +266,12 @@ class MultiDecoderThread(object):
         while (True):
             if self.get_exit_flag():
                 break
-            if img_queue.empty():
-                time.sleep(0.01)
-                continue
-
-            ocv_image = img_queue.get(True) 
+            depth = img_queue.qsize()
+            ocv_image = self.get_queue(img_queue)
+            if ocv_image is None:
+                break
             objs, channel, image_idx = self.yolov5_post_async.get_result_npy() 
+            start_time = time.time()
 
             # print("lprnet_pre_and_process: yolo post id and ocv id is ",(channel,image_idx),ocv_image.keys()) 
 
@@ -283,9 +304,10 @@ class MultiDecoderThread(object):
                     image = sail.BMImage(self.handle,img.height(),img.width(),sail.Format.FORMAT_YUV420P,sail.ImgDtype.DATA_TYPE_EXT_1N_BYTE)
                     self.bmcv.convert_format(img,image)
                     self.bmcv.imwrite("c{}_f{}__P{}.jpg".format(channel,image_idx,self.process_id),image)
+                self.stats.add("lprnet_crop", time.time() - start_time, depth)
             else:
-                logging.error("lprnet_pre_and_process: yolo post result idx, is not equal to origin images idx:")
-                logging.error((channel,image_idx) ,list(ocv_image.keys())[0])
+                logging.error("lprnet_pre_and_process: yolo post result idx {}, is not equal to origin images idx {}".format(
+                    (channel,image_idx), list(ocv_image.keys())[0]))
 
         print("Lprnet_pre_and_process thread exit!")
 
@@ -293,69 +315,35 @@ class MultiDecoderThread(object):
         """通过self.lprnet_engine_image_pre_process获取lprnet后处理的数据;
         
         """
-        file = open('lp_result.txt', 'w')
-        template_infos = {}
-        template_in_threshold = 4
-        template_out_thresh = 4
+        # 每个进程写自己的结果文件, 避免多个进程互相覆盖
+        file = open('lp_result_p{}.txt'.format(self.process_id), 'w')
+        plate_filter = PlateFilter(in_threshold=4, out_threshold=4)
 
         start_time = time.time()
+        stats_time = start_time
         while (True):
-            rm_list = []
             # 1 get lprnet process res
             if self.get_exit_flag():
                 break
             output, _, channel_list, image_idx_list,_ = self.lprnet_engine_image_pre_process.GetBatchData_Npy() 
+            decode_start = time.time()
             logging.debug("Lprnet_post:Process {},channel_idx is {} image_idx is {}".format(self.process_id,channel_list, image_idx_list))
 
-            output_array = output[self.lprnet_output_names][:4]
-
-            res = list() # lprnet的batch=4时res长度为4
-            for temp in np.argmax(output_array, axis=1):
-                no_repeat_blank_label = list()
-                pre_c = temp[0]
-                if pre_c != len(CHARS) - 1:
-                    no_repeat_blank_label.append(CHARS_DICT[pre_c])
-                for c in temp:
-                    if (pre_c == c) or (c == len(CHARS) - 1):
-                        if c == len(CHARS) - 1:
-                            pre_c = c
-                        continue
-                    no_repeat_blank_label.append(CHARS_DICT[c])
-                    pre_c = c
-                res.append("".join(no_repeat_blank_label))
-            print(res)
+            output_array = output[self.lprnet_output_names][:len(channel_list)]
+
+            res = ctc_greedy_decode(output_array) # lprnet的batch=4时res长度为4
             logging.info('Process {}, LPRNET POSTPROCESS DONE,res{}'.format(self.process_id, res))
 
-            # remove repeat lp 
-            for i  in range(len(res)):
-                lp_name = res[i]
-                cid = channel_list[i] 
-                fid = image_idx_list[i]
-                if lp_name in template_infos.keys():
-                    template_infos[lp_name]["in"]+=1
-                    if template_infos[lp_name]["in"]==template_in_threshold:
-                        # up_list.append(lp_res)      
-                        file.write(f"process{self.process_id}:cid {cid},fid {fid},recongized license plates {lp_name} \n")
-                else:
-                    template_infos[lp_name]={}
-                    template_infos[lp_name]["in"]=1
-                    if template_infos[lp_name]["in"]==template_in_threshold:
-                        # up_list.append(lp_res)
-                        file.write(f"process{self.process_id}:cid {cid},fid {fid},recongized license plates {lp_name} \n")
-                        
-                for key in template_infos.keys():
-                    if key != lp_name:
-                        if "out" in template_infos[key].keys():
-                            template_infos[key]["out"]+=1
-                            if template_infos[key]["out"]>=template_out_thresh:
-                                rm_list.append(key)       
-                        else:
-                            template_infos[key]["out"]=1
-                if len(rm_list) :
-                    for key in rm_list:
-                        # print(key,rm_list,template_infos)
-                        if key in template_infos:
-                            del template_infos[key]
+            # remove repeat lp, 每路视频单独去重
+            for lp_name, cid, fid in zip(res, channel_list, image_idx_list):
+                if plate_filter.update(cid, lp_name):
+                    file.write(f"process{self.process_id}:cid {cid},fid {fid},recongized license plates {lp_name} \n")
+            self.stats.add("lprnet_post", time.time() - decode_start)
+
+            if time.time() - stats_time >= self.stats_interval:
+                stats_time = time.time()
+                for line in self.stats.report():
+                    logging.info("Process {}, {}".format(self.process_id, line))
 
             if self.loop_count <=  image_idx_list[-1]: 
                 file.close()
@@ -373,10 +361,11 @@ class MultiDecoderThread(object):
                 logging.info("Process {}:Loops{},Total time use: {} ms, avg_time{}, this process is{} FPS".format(self.process_id, self.loop_count,time_use,avg_time,1000/avg_time))
                 print("Process {}:Loops{},Total time use: {} ms, avg_time{}, this process is {} FPS".format(self.process_id, self.loop_count,time_use,avg_time,1000/avg_time))
 
+                for line in self.stats.report():
+                    logging.info("Process {}, {}".format(self.process_id, line))
+
                 if not self.stress_test:
-                    self.flag_lock.acquire()
-                    self.exit_flag = True
-                    self.flag_lock.release()
+                    self.exit_event.set()
                     os._exit(1)
                     break
                 elif self.stress_test:
@@ -388,8 +377,8 @@ class MultiDecoderThread(object):
 
         
 
-def process_demo(draw_images,stress_test,tpu_id, max_que_size, video_name_list, yolo_bmodel,lprnet_bmodel, loop_count, process_id,dete_threshold,nms_threshold):
-    process =  MultiDecoderThread(draw_images,stress_test,tpu_id, video_name_list, sail.sail_resize_type.BM_PADDING_TPU_LINEAR, max_que_size, loop_count,process_id)
+def process_demo(draw_images,stress_test,tpu_id, max_que_size, video_name_list, yolo_bmodel,lprnet_bmodel, loop_count, process_id,dete_threshold,nms_threshold,stats_interval):
+    process =  MultiDecoderThread(draw_images,stress_test,tpu_id, video_name_list, sail.sail_resize_type.BM_PADDING_TPU_LINEAR, max_que_size, loop_count,process_id,stats_interval)
     process.InitProcess(yolo_bmodel,lprnet_bmodel,dete_threshold,nms_threshold)
 
 
@@ -399,12 +388,13 @@ def argsparser():
     parser.add_argument('--video_nums', type=int, default=16, help='procress nums of input')
     parser.add_argument('--batch_size', type=int, default=4, help='video_nums/batch_size is procress nums of process and postprocess')
     parser.add_argument('--loops', type=int, default=2000, help='process loops for one process')
-    parser.add_argument('--input', type=str, default='../datasets/1080_1920_30s_512kb.mp4', help='path of input, must be video path') 
+    parser.add_argument('--input', type=str, default='../datasets/1080_1920_30s_512kb.mp4', help='path of input, must be video path, several inputs are separated by commas') 
     parser.add_argument('--yolo_bmodel', type=str, default='../models/yolov5s-licensePlate/BM1684X/yolov5s_v6.1_license_3output_int8_4b.bmodel', help='path of bmodel')
     parser.add_argument('--lprnet_bmodel', type=str, default='../models/lprnet/BM1684X/lprnet_int8_4b.bmodel', help='path of bmodel')
     parser.add_argument('--dev_id', type=int, default=0, help='tpu id')
     parser.add_argument('--draw_images', type=bool, default=False, help='draw images or not')
     parser.add_argument('--stress_test', type=bool, default=False, help='stress test or not')
+    parser.add_argument('--stats_interval', type=float, default=10, help='seconds between two logs of the stage counters')
     args = parser.parse_args()
     return args
 
@@ -427,10 +417,13 @@ if __name__ == '__main__':
     loop_count = args.loops # 每个进程处理图片的数量，处理完毕之后会退出
     
     process_nums = int(args.video_nums/args.batch_size)
-    input_videos = [args.input for _ in range(int(args.video_nums/process_nums))] # 初始化多路本地视频流
+    inputs = args.input.split(',')
+    input_videos = [inputs[i % len(inputs)] for i in range(args.video_nums)] # 初始化多路本地视频流
+    # 各路视频轮流分配给各个进程, 每个进程处理自己的一组通道
+    shards = [input_videos[i::process_nums] for i in range(process_nums)]
 
 
-    decode_yolo_processes = [Process(target=process_demo,args=(args.draw_images,args.stress_test,args.dev_id, max_que_size, input_videos, args.yolo_bmodel,args.lprnet_bmodel, loop_count, i,dete_threshold,nms_threshold)) for i in range(process_nums) ]
+    decode_yolo_processes = [Process(target=process_demo,args=(args.draw_images,args.stress_test,args.dev_id, max_que_size, shards[i], args.yolo_bmodel,args.lprnet_bmodel, loop_count, i,dete_threshold,nms_threshold,args.stats_interval)) for i in range(process_nums) ]
     for i in decode_yolo_processes:
         i.start()
         logging.debug('start decode and yolo process')
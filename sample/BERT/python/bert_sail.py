@@ -7,13 +7,15 @@
 #
 #===----------------------------------------------------------------------===#
 import os
+import re
+import subprocess
 import sophon.sail as sail
 import torch
 import argparse
 import time
 
 from utils.dataset import MyDataset
-from bert4torch.snippets import sequence_padding, Callback, ListDataset, seed_everything
+from bert4torch.snippets import Callback, ListDataset, seed_everything
 import numpy as np
 from bert4torch.layers import CRF
 from bert4torch.tokenizers import Tokenizer
@@ -30,8 +32,28 @@ categories_id2label = {i: k for i, k in enumerate(categories)}
 categories_label2id = {k: i for i, k in enumerate(categories)}
 dataset=MyDataset()
 
+def bmodel_stage_shapes(model_path):
+    '''input shapes of every stage, {net name: {input name: [shape, ...]}}, parsed from `model_tool --info`.
+    sail.Engine only reports the max shape of a graph; empty if model_tool of libsophon is not installed
+    '''
+    try:
+        info = subprocess.run(['model_tool', '--info', model_path], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    shapes = {}
+    net = None
+    for line in info.splitlines():
+        match = re.match(r'net \d+: \[(.+?)\]', line.strip())
+        if match:
+            net = shapes.setdefault(match.group(1), {})
+            continue
+        match = re.match(r'input: (.+?), \[([\d, ]+)\]', line.strip())
+        if match and net is not None:
+            net.setdefault(match.group(1), []).append([int(dim) for dim in match.group(2).split(',')])
+    return shapes
+
 class BERT:
-    def __init__(self,model_path,dict_path,if_crf=True):
+    def __init__(self,model_path,dict_path,if_crf=True,seq_lens=None):
         self.io_mode = sail.IOMode.SYSIO
         self.device=0
         self.engine=sail.Engine(model_path,self.device,self.io_mode)
@@ -96,16 +118,49 @@ class BERT:
         suppoort_batch_size = [1, 8]
         if self.batch_size not in suppoort_batch_size:
             raise ValueError('batch_size must be {} for bmcv, but got {}'.format(suppoort_batch_size, self.batch_size))
-        
+        # sequence lengths of the bmodel graphs and stages with this batch size and the graph running each of them,
+        # a batch is padded to the shortest one that holds its longest sentence; seq_lens overrides them
+        stage_shapes = bmodel_stage_shapes(model_path)
+        self.seq_graphs = {}
+        for graph_name in self.graph_names:
+            input_name = self.input_names[graph_name][0]
+            shapes = [self.input_shapes[graph_name][input_name]] + stage_shapes.get(graph_name, {}).get(input_name, [])
+            for shape in shapes:
+                if shape[0] == self.batch_size:
+                    self.seq_graphs.setdefault(shape[1], graph_name)
+        self.seq_lens = sorted(set(seq_lens)) if seq_lens else sorted(self.seq_graphs)
+        self.max_seq_len = self.seq_lens[-1]
+
+    def bucket_len(self,length):
+        for seq_len in self.seq_lens:
+            if length <= seq_len:
+                return seq_len
+        return self.seq_lens[-1]
+    def pad_batch(self,token_ids,seq_len):
+        """pad a batch of token id lists to seq_len in one step, the rows after them are empty [CLS][SEP] sentences"""
+        token_ids = [ids[:seq_len] for ids in token_ids]
+        lengths = np.array([len(ids) for ids in token_ids])
+        batch_ids = np.zeros((self.batch_size, seq_len), dtype=np.int64)
+        batch_ids[len(token_ids):, 0] = 101
+        batch_ids[len(token_ids):, 1] = 102
+        valid = np.arange(seq_len) < lengths[:, None]
+        batch_ids[:len(token_ids)][valid] = np.concatenate(token_ids)
+        return batch_ids
+    def make_batches(self,token_ids):
+        """sort sentences by length and cut them into batches, return (sentence indexes, seq_len) of every batch"""
+        lengths = np.array([len(ids) for ids in token_ids])
+        order = np.argsort(lengths, kind='stable')
+        batches = []
+        for i in range(0, len(order), self.batch_size):
+            idx = order[i:i+self.batch_size]
+            batches.append((idx, self.bucket_len(lengths[idx].max())))
+        return batches
     def pre_process_text(self,input):#pre_process_dev test
 
         tokenizer=self.tokenizer
      
         tokens = tokenizer.tokenize(input, maxlen=maxlen)
         token_ids = tokenizer.tokens_to_ids(tokens)#tokenize
-       
-        for i in range(maxlen-len(token_ids)):
-            token_ids.append(0)#padding
         return tokens,token_ids
     def pre_process_dataset(self,inputs):#pre_process_dataset test
 
@@ -128,8 +183,7 @@ class BERT:
                  
             token_ids_.append(token_ids)
             labels_.append(labels)
-        token_ids_ =sequence_padding(token_ids_)
- 
+        # padded per batch in test_dataset
         return token_ids_,labels_
     def post_postprocess(self,out_infer):#post_postprocess
         emission_score, attention_mask=out_infer
@@ -159,11 +213,12 @@ class BERT:
 
         """
         # logger.debug("input_data shape: {}".format(input_data.shape))
-        inputs_feed = self.get_input_feed_numpy(self.input_names[self.graph_names[0]], input_data)
+        graph_name = self.seq_graphs.get(input_data[0].shape[1], self.graph_names[0])
+        inputs_feed = self.get_input_feed_numpy(self.input_names[graph_name], input_data)
         # print(inputs_feed['token_ids.1'].shape,"----------")
-        outputs = self.engine.process(self.graph_names[0], inputs_feed)
+        outputs = self.engine.process(graph_name, inputs_feed)
         outputs_dict = OrderedDict()
-        for name in self.output_names[self.graph_names[0]]:
+        for name in self.output_names[graph_name]:
             outputs_dict[name] = outputs[name]
         # logger.debug(outputs.keys())
         return outputs_dict
@@ -171,19 +226,14 @@ class BERT:
     
     def softmax(self,x):
         """ softmax function """
-        x = np.exp(x) / np.sum(np.exp(x), axis = 2, keepdims = True)
-        return x
+        x = np.exp(x - np.max(x, axis = 2, keepdims = True))
+        return x / np.sum(x, axis = 2, keepdims = True)
     def test_text(self,text):#one test
         
         tokens,token_ids=self.pre_process_text(text)
         token_ids=[token_ids]
-        token_ids_b=[token_ids[i:i+self.batch_size] for i in range(0,len(token_ids),self.batch_size)]
-        if(len(token_ids_b[-1])%self.batch_size):
-            zero=np.zeros((self.batch_size-len(token_ids_b[-1]),256))
-            zero[:,0]=101
-            zero[:,0]=102
-            token_ids_b[-1]=np.concatenate((token_ids_b[-1],zero))
-        out=self.infer_numpy([token_ids_b[0]])
+        batch_ids=self.pad_batch(token_ids,self.bucket_len(len(token_ids[0])))
+        out=self.infer_numpy([batch_ids])
         lis=[]
         for i in out.keys():
             lis.append(out[i])
@@ -191,30 +241,24 @@ class BERT:
 
         ans=self.post_postprocess(lis)
         
-        ans=self.trans_entity2tuple(ans,tokens,token_ids)
+        ans=self.trans_entity2tuple(ans[:len(token_ids)],tokens,token_ids)
         return ans
     def test_dataset(self,texts):#dataset test
         global tot_pre,tot_infer,tot_post,tot_time
-        y_trues=[]
-        y_preds=[]
         s=time.time()
         ss=time.time()
         token_ids,labels=self.pre_process_dataset(texts)
-        
-        token_ids_b=[token_ids[i:i+self.batch_size] for i in range(0,len(token_ids),self.batch_size)]
-        labels_b=[labels[i:i+self.batch_size] for i in range(0,len(labels),self.batch_size)]
-        if(len(token_ids_b[-1])%self.batch_size):
-            zero=np.zeros((self.batch_size-len(token_ids_b[-1]),256))
-            zero[:,0]=101
-            zero[:,0]=102
-            token_ids_b[-1]=np.concatenate((token_ids_b[-1],zero))
+        # batches of similar lengths, the results are put back in dataset order
+        batches=self.make_batches(token_ids)
         tot_pre=time.time()-s
-        count = 0
-        for token_id,label in zip(token_ids_b,labels_b):
+        y_preds=[None]*len(token_ids)
+        for count,(idx,seq_len) in enumerate(batches):
             print("processed: {}/{}".format(count * self.batch_size, len(token_ids)))
-            count += 1
             s=time.time()
-            out=self.infer_numpy([token_id])
+            batch_ids=self.pad_batch([token_ids[i] for i in idx],seq_len)
+            tot_pre+=time.time()-s
+            s=time.time()
+            out=self.infer_numpy([batch_ids])
             tot_infer+=time.time()-s
             s=time.time()
            
@@ -224,32 +268,20 @@ class BERT:
             
             lis[0]=self.softmax(lis[0])
             ans=self.post_postprocess(lis)
-            ans=self.trans_entity2label(ans)
-          
-            y_true=label
-            for i in range(min(len(label),self.batch_size)):
-                ans[i]=ans[i][:len(label[i])]
-            
-                y_trues.append(y_true[i])
-                y_preds.append(ans[i])
+            ans=self.trans_entity2label(ans,[len(labels[i]) for i in idx])
+            for i,pred in zip(idx,ans):
+                y_preds[i]=pred
                
             tot_post+=time.time()-s
 
         
         tot_time=time.time()-ss
         return y_preds
-    def trans_entity2label(self,scores):
-        '''translate entitys to label
+    def trans_entity2label(self,scores,lengths):
+        '''translate entitys to label, the first lengths[i] labels of row i
         '''
-        entity_ids_= []
-        for i in range(self.batch_size):
-
-            entity_ids = []
-            for j, item in enumerate(scores[i]):
-                flag_tag = categories_id2label[item.item()]
-                entity_ids.append(flag_tag)
-            entity_ids_.append(entity_ids)
-        return entity_ids_
+        labels = np.array(categories)[np.asarray(scores)]
+        return [labels[i, :length].tolist() for i, length in enumerate(lengths)]
     def trans_entity2tuple(self,scores,tokens,token_ids):
         '''translate entitys to tuple
         '''
@@ -285,6 +317,7 @@ def parse_args():
     parser.add_argument('--input', type=str, default="../datasets/china-people-daily-ner-corpus/example.test", help='test_path')
     parser.add_argument('--dict_path', type=str, default="../models/pre_train/chinese-bert-wwm/vocab.txt", help='pre_train_vab_path')
     parser.add_argument('--if_crf', type=bool, default=True, help='if using crf')
+    parser.add_argument('--seq_lens', type=str, default=None, help='sequence lengths to pad the batches to, e.g. 64,128,256, default is read from the graphs and stages of the bmodel')
     args = parser.parse_args()
     return args
 def main(args):
@@ -299,7 +332,8 @@ def main(args):
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
   
-    bert=BERT(args.bmodel,args.dict_path)
+    seq_lens = [int(seq_len) for seq_len in args.seq_lens.split(',')] if args.seq_lens else None
+    bert=BERT(args.bmodel,args.dict_path,seq_lens=seq_lens)
     if(args.input[-4:]=='test'):
         if not os.path.exists(args.input):
             raise FileNotFoundError('{} is not existed.'.format(args.input))
@@ -309,6 +343,7 @@ def main(args):
         print("avg_pre_time",tot_pre/len(D))
         print("avg_infer_time",tot_infer/len(D))
         print("avg_post_time",tot_post/len(D))
+        print("sentences_per_second",len(D)/tot_time)
         output_path="../python/results/"+args.bmodel.split('/')[-1]+"_sail_python_result.txt"
         f=open(output_path,'w+')
         for i in y_preds:
@@ -7,8 +7,13 @@
 #
 #===----------------------------------------------------------------------===#
 import sophon.sail as sail
+import os
 import argparse
 import time
+import functools
+from llm_server import serve
+from attention_mask import AttentionMask
+from prefix_cache import PrefixCache
 from transformers import AutoTokenizer
 import numpy as np
 
@@ -60,6 +65,8 @@ class Baichuan2:
         # forward_next: position_id_tensor and attention_mask_tensor
         self.next_pid = self.init_sail_tensor(self.name_blocks_cache[0], 1)
         self.next_attention = self.init_sail_tensor(self.name_blocks_cache[0], 2)
+        # position ids and attention masks of forward_first / forward_next
+        self.mask = AttentionMask(self.MAX_LEN, np.float16, self.ATTENTION_MASK, np.int32)
 
         # forward_next: present_key / present_value (for update kv_cache)
         self.present_key = self.init_sail_tensor(self.name_blocks_cache[0], 1, None, False)
@@ -91,6 +98,10 @@ class Baichuan2:
         self.lm_output = self.init_sail_tensor(self.name_lm, 0, None, False)
 
         self.token_length = 0
+        # tokens held in the kv cache, the next turn only runs the new ones
+        self.prefix_cache = PrefixCache(self)
+        # ids of every message, the turns of the history are not tokenized again
+        self.encode_message = functools.lru_cache(maxsize=1024)(lambda text: tuple(self.sp.encode(text)))
         self.round = 0
 
     def init_sail_tensor(self, name, input_idx, shape=None, input_type=True):
@@ -124,15 +135,15 @@ class Baichuan2:
         for item in history:
             content = item["content"]
             if item["role"] == "user":
-                encoded = self.sp.encode(f"{B_INST}{content.strip()}{E_INST}")
+                encoded = self.encode_message(f"{B_INST}{content.strip()}{E_INST}")
             elif item["role"] == "assistant" or item["role"] == "system":
-                encoded = self.sp.encode(content.strip())
+                encoded = self.encode_message(content.strip())
             else:
                 raise ValueError(f"role should be in {{'system', 'user', 'assistant'}} but we get {item['role']}")
             # 添加编码后的消息，移除首个token（假设为bos token）
             input_ids.extend(encoded[1:])
         if role == "user" or role == "assistant" or item["role"] == "system":
-            input_ids.extend(self.sp.encode(f"{B_INST}{input_str.strip()}{E_INST}")[1:])
+            input_ids.extend(self.encode_message(f"{B_INST}{input_str.strip()}{E_INST}")[1:])
         else:
             raise ValueError(f"role should be in {{'system', 'user', 'assistant'}} but we get {role}")
         return input_ids
@@ -140,14 +151,10 @@ class Baichuan2:
 
     def forward_first(self, token):
         input_ids = np.zeros(self.MAX_LEN, dtype=np.int32)  # Initialize input_ids with zeros
-        position_id = np.arange(self.MAX_LEN, dtype=np.int32)  # Use arange for position_id
-        attention_mask = np.full((self.MAX_LEN, self.MAX_LEN), self.ATTENTION_MASK, dtype=np.float16)  # Initialize attention_mask with self.ATTENTION_MASK
 
         self.token_length = len(token)  
         input_ids[:self.token_length] = token  # Set the first part of input_ids to the token IDs
-        position_id[self.token_length:] = 0
-        lower_tri_indices = np.tril_indices(self.token_length)
-        attention_mask[lower_tri_indices] = 0
+        position_id, attention_mask = self.mask.first(self.token_length)
 
         # embedding
         input_ids = input_ids.reshape(1, -1)
@@ -185,10 +192,8 @@ class Baichuan2:
         return int(self.lm_output["data"].asnumpy())
 
     def forward_next(self, ):
-        attention_mask = np.zeros(self.MAX_LEN+1, np.float16)
-        attention_mask[self.token_length-1:self.MAX_LEN] = self.ATTENTION_MASK
+        position_id, attention_mask = self.mask.next(self.token_length)
 
-        position_id = np.array(self.token_length - 1, dtype=np.int32)
         # embedding
         self.next_embed_input["data"] = self.lm_output["data"]
         self.next_embed_input["data"].reshape(self.next_embed_input["shape"])
@@ -227,6 +232,30 @@ class Baichuan2:
         self.net.process(self.name_lm, input_lm_tensors, output_lm_tensors)
         return int(self.lm_output["data"].asnumpy())
 
+    def new_kv_cache(self):
+        """
+        allocate the kv cache of one more conversation, swapped in by llm_server.py
+        """
+        past_key_output = []
+        past_value_output = []
+        for _ in range(self.NUM_LAYERS):
+            past_key_output.append(self.init_sail_tensor(self.name_blocks[0], 1, None, False))
+            past_value_output.append(self.init_sail_tensor(self.name_blocks[0], 2, None, False))
+        return past_key_output, past_value_output
+
+    def set_next_token(self, token):
+        """
+        make forward_next continue from token, used when switching between conversations
+        """
+        data = self.lm_output["data"]
+        data.update_data(np.array(token, dtype=np.int32).reshape(data.shape()))
+
+    def encode_messages(self, messages):
+        return self._make_context(messages[-1]["content"], history=messages[:-1], role=messages[-1]["role"])
+
+    def decode_tokens(self, tokens):
+        return self.sp.decode(tokens)
+
     def chat_stream(self, input, history):
         input_tokens = self._make_context(input, history=[], role="user")
         if (len(input_tokens) > self.MAX_LEN - 10):
@@ -238,7 +267,7 @@ class Baichuan2:
             history = history[1:]
             tokens = self._make_context(input, history=history, role="user")
         first_start = time.time()
-        pre_token = self.forward_first(tokens)
+        pre_token = self.prefix_cache.forward_first(tokens)
         first_end = time.time()
         token = pre_token
         is_emoji = False
@@ -255,9 +284,8 @@ class Baichuan2:
             else: 
                 yield self.sp.decode([token])
 
-            self.token_length += 1
             tok_num += 1
-            token = self.forward_next()
+            token = self.prefix_cache.forward_next(token)
 
         next_end = time.time()
         first_duration = first_end-first_start
@@ -273,6 +301,10 @@ def argsparser():
     parser.add_argument('--bmodel', type=str, default='../models/BM1684X/baichuan2-7b_int8_1dev.bmodel', help='path of bmodel')
     parser.add_argument('--token', type=str, default='./token_config/', help='path of tokenizer')
     parser.add_argument('--dev_ids', nargs='+', type=int, default=[0], help='dev id list, split by space')
+    parser.add_argument('--server', action='store_true', help='run an OpenAI compatible http server instead of the command line chat')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='server address, 0.0.0.0 to accept other hosts')
+    parser.add_argument('--port', type=int, default=8000, help='server port')
+    parser.add_argument('--max_sessions', type=int, default=4, help='conversations decoded together, each one owns a kv cache')
     args = parser.parse_args()
     return args
 
@@ -288,7 +320,7 @@ def app(client):
         print("\nAnswer: ")
         assistant_msg = ''
         for response in client.chat_stream(input_str, history):
-            assistant_msg = response
+            assistant_msg += response
             print(response, flush=True, end='')
         history.append({"role": "user", "content": input_str})
         history.append({"role": "assistant", "content": assistant_msg})
@@ -298,7 +330,10 @@ def main(args):
     tokenizer = AutoTokenizer.from_pretrained(args.token, trust_remote_code=True)
     engine = sail.EngineLLM(args.bmodel, args.dev_ids)
     client = Baichuan2(handle, engine, tokenizer)
-    app(client)
+    if args.server:
+        serve(client, args.host, args.port, args.max_sessions, os.path.basename(args.bmodel))
+    else:
+        app(client)
 
 if __name__ == "__main__":
     args = argsparser()
@@ -8,7 +8,6 @@
 # ===----------------------------------------------------------------------===#
 import numpy as np
 from collections import deque
-import sophon.sail as sail
 import os.path as osp
 import time
 from collections import OrderedDict
@@ -106,87 +105,92 @@ class BaseTrack(object):
         self.state = TrackState.Removed
 
 
-class STrack(BaseTrack):
-    shared_kalman = KalmanFilter()
-
-    def __init__(self, tlwh, score, cls_id):
-
-        # wait activate
-        self._tlwh = np.asarray(tlwh, dtype=np.float32)
-        self.kalman_filter = None
-        self.mean, self.covariance = None, None
-        self.is_activated = False
-
-        self.score = score
-        self.cls_id = cls_id
-        self.tracklet_len = 0
-
-    def predict(self):
-        mean_state = self.mean.copy()
-        if self.state != TrackState.Tracked:
-            mean_state[7] = 0
-        self.mean, self.covariance = self.kalman_filter.predict(
-            mean_state, self.covariance)
+def _slot_field(name):
+    def fget(self):
+        return getattr(self.store, name)[self.index]
+
+    def fset(self, value):
+        getattr(self.store, name)[self.index] = value
+    return property(fget, fset)
+
+
+class TrackStore(object):
+    """
+    Struct-of-arrays storage of the tracks: the Kalman states of all tracks live in one (N, 8)
+    mean and one (N, 8, 8) covariance array, and the bookkeeping fields in one array each, so
+    predict and update run once per frame for all tracks. Tracks are addressed by slot index;
+    the slot of a dropped track is reused by a later one.
+    """
+
+    def __init__(self, capacity=64):
+        self.capacity = 0
+        self.mean = np.zeros((0, 8))
+        self.covariance = np.zeros((0, 8, 8))
+        self.track_id = np.zeros(0, dtype=np.int64)
+        self.state = np.zeros(0, dtype=np.int8)
+        self.is_activated = np.zeros(0, dtype=bool)
+        self.score = np.zeros(0)
+        self.cls_id = np.zeros(0, dtype=np.int64)
+        self.frame_id = np.zeros(0, dtype=np.int64)
+        self.start_frame = np.zeros(0, dtype=np.int64)
+        self.tracklet_len = np.zeros(0, dtype=np.int64)
+        # the track id has been in the removed list, see BYTETracker.update
+        self.was_removed = np.zeros(0, dtype=bool)
+        self.used = np.zeros(0, dtype=bool)
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        extra = capacity - self.capacity
+        for name in ('mean', 'covariance', 'track_id', 'state', 'is_activated', 'score', 'cls_id',
+                     'frame_id', 'start_frame', 'tracklet_len', 'was_removed', 'used'):
+            arr = getattr(self, name)
+            setattr(self, name, np.concatenate([arr, np.zeros((extra,) + arr.shape[1:], dtype=arr.dtype)]))
+        self.capacity = capacity
+
+    def alloc(self, n):
+        free = np.flatnonzero(~self.used)
+        if len(free) < n:
+            self._grow(max(2 * self.capacity, self.capacity + n - len(free)))
+            free = np.flatnonzero(~self.used)
+        idx = free[:n]
+        self.used[idx] = True
+        self.was_removed[idx] = False
+        return idx
+
+    def release(self, idx):
+        self.used[idx] = False
+
+    def tlwh(self, idx):
+        ret = self.mean[idx, :4].copy()
+        ret[:, 2] *= ret[:, 3]
+        ret[:, :2] -= ret[:, 2:] / 2
+        return ret
 
-    @staticmethod
-    def multi_predict(stracks):
-        if len(stracks) > 0:
-            multi_mean = np.asarray([st.mean.copy() for st in stracks])
-            multi_covariance = np.asarray([st.covariance for st in stracks])
-            for i, st in enumerate(stracks):
-                if st.state != TrackState.Tracked:
-                    multi_mean[i][7] = 0
-            multi_mean, multi_covariance = STrack.shared_kalman.multi_predict(
-                multi_mean, multi_covariance)
-            for i, (mean, cov) in enumerate(zip(multi_mean, multi_covariance)):
-                stracks[i].mean = mean
-                stracks[i].covariance = cov
-
-    def activate(self, kalman_filter, frame_id):
-        """Start a new tracklet"""
-        self.kalman_filter = kalman_filter
-        self.track_id = self.next_id()
-        self.mean, self.covariance = self.kalman_filter.initiate(
-            self.tlwh_to_xyah(self._tlwh))
-
-        self.tracklet_len = 0
-        self.state = TrackState.Tracked
-        if frame_id == 1:
-            self.is_activated = True
-        # self.is_activated = True
-        self.frame_id = frame_id
-        self.start_frame = frame_id
-
-    def re_activate(self, new_track, frame_id, new_id=False):
-        self.mean, self.covariance = self.kalman_filter.update(
-            self.mean, self.covariance, self.tlwh_to_xyah(new_track.tlwh)
-        )
-        self.tracklet_len = 0
-        self.state = TrackState.Tracked
-        self.is_activated = True
-        self.frame_id = frame_id
-        if new_id:
-            self.track_id = self.next_id()
-        self.score = new_track.score
-
-    def update(self, new_track, frame_id):
-        """
-        Update a matched track
-        :type new_track: STrack
-        :type frame_id: int
-        :type update_feature: bool
-        :return:
-        """
-        self.frame_id = frame_id
-        self.tracklet_len += 1
+    def tlbr(self, idx):
+        ret = self.tlwh(idx)
+        ret[:, 2:] += ret[:, :2]
+        return ret
 
-        new_tlwh = new_track.tlwh
-        self.mean, self.covariance = self.kalman_filter.update(
-            self.mean, self.covariance, self.tlwh_to_xyah(new_tlwh))
-        self.state = TrackState.Tracked
-        self.is_activated = True
 
-        self.score = new_track.score
+class STrack(BaseTrack):
+    """
+    Thin view of one track in a TrackStore, kept for the STrack attribute API. A view is valid
+    until the track is dropped from the tracker, after which its slot may hold another track.
+    """
+    mean = _slot_field('mean')
+    covariance = _slot_field('covariance')
+    track_id = _slot_field('track_id')
+    state = _slot_field('state')
+    is_activated = _slot_field('is_activated')
+    score = _slot_field('score')
+    cls_id = _slot_field('cls_id')
+    frame_id = _slot_field('frame_id')
+    start_frame = _slot_field('start_frame')
+    tracklet_len = _slot_field('tracklet_len')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
 
     @property
     # @jit(nopython=True)
@@ -194,12 +198,7 @@ class STrack(BaseTrack):
         """Get current position in bounding box format `(top left x, top left y,
                 width, height)`.
         """
-        if self.mean is None:
-            return self._tlwh.copy()
-        ret = self.mean[:4].copy()
-        ret[2] *= ret[3]
-        ret[:2] -= ret[2:] / 2
-        return ret
+        return self.store.tlwh([self.index])[0]
 
     @property
     # @jit(nopython=True)
@@ -207,19 +206,18 @@ class STrack(BaseTrack):
         """Convert bounding box to format `(min x, min y, max x, max y)`, i.e.,
         `(top left, bottom right)`.
         """
-        ret = self.tlwh.copy()
-        ret[2:] += ret[:2]
-        return ret
+        return self.store.tlbr([self.index])[0]
 
     @staticmethod
     # @jit(nopython=True)
     def tlwh_to_xyah(tlwh):
         """Convert bounding box to format `(center x, center y, aspect ratio,
-        height)`, where the aspect ratio is `width / height`.
+        height)`, where the aspect ratio is `width / height`. Accepts one box
+        or an (N, 4) array.
         """
         ret = np.asarray(tlwh).copy()
-        ret[:2] += ret[2:] / 2
-        ret[2] /= ret[3]
+        ret[..., :2] += ret[..., 2:] / 2
+        ret[..., 2] /= ret[..., 3]
         return ret
 
     def to_xyah(self):
@@ -229,14 +227,14 @@ class STrack(BaseTrack):
     # @jit(nopython=True)
     def tlbr_to_tlwh(tlbr):
         ret = np.asarray(tlbr).copy()
-        ret[2:] -= ret[:2]
+        ret[..., 2:] -= ret[..., :2]
         return ret
 
     @staticmethod
     # @jit(nopython=True)
     def tlwh_to_tlbr(tlwh):
         ret = np.asarray(tlwh).copy()
-        ret[2:] += ret[:2]
+        ret[..., 2:] += ret[..., :2]
         return ret
 
     def __repr__(self):
@@ -245,9 +243,10 @@ class STrack(BaseTrack):
 
 class BYTETracker(object):
     def __init__(self, track_thresh, track_buffer, match_thresh, frame_rate=30):
-        self.tracked_stracks = []  # type: list[STrack]
-        self.lost_stracks = []  # type: list[STrack]
-        self.removed_stracks = []  # type: list[STrack]
+        self.store = TrackStore()
+        # slot indices in the order of the original track lists
+        self.tracked_idx = np.zeros(0, dtype=np.int64)
+        self.lost_idx = np.zeros(0, dtype=np.int64)
 
         self.track_thresh = track_thresh
         self.track_buffer = track_buffer
@@ -260,23 +259,64 @@ class BYTETracker(object):
         self.max_time_lost = self.buffer_size
         self.kalman_filter = KalmanFilter()
 
+    @property
+    def tracked_stracks(self):
+        return [STrack(self.store, i) for i in self.tracked_idx]
+
+    @property
+    def lost_stracks(self):
+        return [STrack(self.store, i) for i in self.lost_idx]
+
+    def _predict(self, idx):
+        if len(idx) == 0:
+            return
+        store = self.store
+        mean = store.mean[idx]
+        mean[store.state[idx] != TrackState.Tracked, 7] = 0
+        store.mean[idx], store.covariance[idx] = self.kalman_filter.multi_predict(
+            mean, store.covariance[idx])
+
+    def _apply_matches(self, idx, xyah, scores):
+        """Kalman update of the matched tracks, returns (activated, refind) slot indices"""
+        if len(idx) == 0:
+            return idx, idx
+        store = self.store
+        store.mean[idx], store.covariance[idx] = self.kalman_filter.multi_update(
+            store.mean[idx], store.covariance[idx], xyah)
+        tracked = store.state[idx] == TrackState.Tracked
+        # update() for tracked tracks, re_activate() for lost ones
+        store.tracklet_len[idx] = np.where(tracked, store.tracklet_len[idx] + 1, 0)
+        store.state[idx] = TrackState.Tracked
+        store.is_activated[idx] = True
+        store.frame_id[idx] = self.frame_id
+        store.score[idx] = scores
+        return idx[tracked], idx[~tracked]
+
+    def _activate(self, tlwh, scores, cls_id):
+        """Start new tracklets"""
+        store = self.store
+        idx = store.alloc(len(tlwh))
+        if len(idx) == 0:
+            return idx
+        store.mean[idx], store.covariance[idx] = self.kalman_filter.multi_initiate(
+            STrack.tlwh_to_xyah(tlwh))
+        store.track_id[idx] = [STrack.next_id() for _ in range(len(idx))]
+        store.tracklet_len[idx] = 0
+        store.state[idx] = TrackState.Tracked
+        store.is_activated[idx] = self.frame_id == 1
+        store.frame_id[idx] = self.frame_id
+        store.start_frame[idx] = self.frame_id
+        store.score[idx] = scores
+        store.cls_id[idx] = cls_id
+        return idx
+
     def update(self, bboxes, scores, cls_id, img_info, img_size):
         self.frame_id += 1
-        activated_starcks = []
-        refind_stracks = []
-        lost_stracks = []
-        removed_stracks = []
+        store = self.store
         scores = np.array(scores)
-        bboxes = np.array(bboxes)
+        bboxes = np.array(bboxes).reshape(-1, 4)
         cls_id = np.array(cls_id)
 
-        # if output_results.shape[1] == 5:
-        #     scores = output_results[:, 4]
-        #     bboxes = output_results[:, :4]
-        # else:
-        #     output_results = output_results.cpu().numpy()
-        #     scores = output_results[:, 4] * output_results[:, 5]
-        #     bboxes = output_results[:, :4]  # x1y1x2y2
         img_h, img_w = img_info[0], img_info[1]
         scale = min(img_size[0] / float(img_h), img_size[1] / float(img_w))
         bboxes /= scale
@@ -286,165 +326,114 @@ class BYTETracker(object):
         inds_high = scores < self.track_thresh
 
         inds_second = np.logical_and(inds_low, inds_high)
-        dets_second = bboxes[inds_second]
-        dets = bboxes[remain_inds]
+        # detections as arrays: tlwh in float32 like the original STrack, tlbr derived from it
+        dets_tlwh = STrack.tlbr_to_tlwh(bboxes[remain_inds]).astype(np.float32)
+        dets_tlbr = STrack.tlwh_to_tlbr(dets_tlwh)
         scores_keep = scores[remain_inds]
-        scores_second = scores[inds_second]
         cls_keep = cls_id[remain_inds]
-        cls_second = cls_id[inds_second]
-
-        if len(dets) > 0:
-            '''Detections'''
-            detections = [STrack(STrack.tlbr_to_tlwh(tlbr), s, c) for
-                          (tlbr, s, c) in zip(dets, scores_keep, cls_keep)]
-        else:
-            detections = []
+        dets_second_tlwh = STrack.tlbr_to_tlwh(bboxes[inds_second]).astype(np.float32)
+        scores_second = scores[inds_second]
 
         ''' Add newly detected tracklets to tracked_stracks'''
-        unconfirmed = []
-        tracked_stracks = []  # type: list[STrack]
-        for track in self.tracked_stracks:
-            if not track.is_activated:
-                unconfirmed.append(track)
-            else:
-                tracked_stracks.append(track)
+        activated = store.is_activated[self.tracked_idx]
+        unconfirmed = self.tracked_idx[~activated]
+        tracked_stracks = self.tracked_idx[activated]
 
         ''' Step 2: First association, with high score detection boxes'''
-        strack_pool = joint_stracks(tracked_stracks, self.lost_stracks)
+        # tracked and lost tracks are disjoint, joint_stracks is a concatenation
+        strack_pool = np.concatenate([tracked_stracks, self.lost_idx])
         # Predict the current location with KF
-        STrack.multi_predict(strack_pool)
-        dists = matching.iou_distance(strack_pool, detections)
+        self._predict(strack_pool)
+        dists = matching.iou_distance(store.tlbr(strack_pool), dets_tlbr)
 
-        dists = matching.fuse_score(dists, detections)
+        dists = matching.fuse_score(dists, scores_keep)
         matches, u_track, u_detection = matching.linear_assignment(
             dists, thresh=self.match_thresh)
-
-        for itracked, idet in matches:
-            track = strack_pool[itracked]
-            det = detections[idet]
-            if track.state == TrackState.Tracked:
-                track.update(detections[idet], self.frame_id)
-                activated_starcks.append(track)
-            else:
-                track.re_activate(det, self.frame_id, new_id=False)
-                refind_stracks.append(track)
+        matches = np.asarray(matches, dtype=np.int64).reshape(-1, 2)
+        activated_starcks, refind_stracks = self._apply_matches(
+            strack_pool[matches[:, 0]], STrack.tlwh_to_xyah(dets_tlwh[matches[:, 1]]), scores_keep[matches[:, 1]])
 
         ''' Step 3: Second association, with low score detection boxes'''
         # association the untrack to the low score detections
-        if len(dets_second) > 0:
-            '''Detections'''
-            detections_second = [STrack(STrack.tlbr_to_tlwh(tlbr), s, c) for
-                                 (tlbr, s, c) in zip(dets_second, scores_second, cls_second)]
-        else:
-            detections_second = []
-        r_tracked_stracks = [strack_pool[i]
-                             for i in u_track if strack_pool[i].state == TrackState.Tracked]
-        dists = matching.iou_distance(r_tracked_stracks, detections_second)
+        r_tracked_stracks = strack_pool[np.asarray(u_track, dtype=np.int64)]
+        r_tracked_stracks = r_tracked_stracks[store.state[r_tracked_stracks] == TrackState.Tracked]
+        dists = matching.iou_distance(store.tlbr(r_tracked_stracks), STrack.tlwh_to_tlbr(dets_second_tlwh))
         matches, u_track, u_detection_second = matching.linear_assignment(
             dists, thresh=0.5)
-        for itracked, idet in matches:
-            track = r_tracked_stracks[itracked]
-            det = detections_second[idet]
-            if track.state == TrackState.Tracked:
-                track.update(det, self.frame_id)
-                activated_starcks.append(track)
-            else:
-                track.re_activate(det, self.frame_id, new_id=False)
-                refind_stracks.append(track)
-
-        for it in u_track:
-            track = r_tracked_stracks[it]
-            if not track.state == TrackState.Lost:
-                track.mark_lost()
-                lost_stracks.append(track)
+        matches = np.asarray(matches, dtype=np.int64).reshape(-1, 2)
+        activated_second, refind_second = self._apply_matches(
+            r_tracked_stracks[matches[:, 0]], STrack.tlwh_to_xyah(dets_second_tlwh[matches[:, 1]]),
+            scores_second[matches[:, 1]])
+
+        lost_stracks = r_tracked_stracks[np.asarray(u_track, dtype=np.int64)]
+        lost_stracks = lost_stracks[store.state[lost_stracks] != TrackState.Lost]
+        store.state[lost_stracks] = TrackState.Lost
 
         '''Deal with unconfirmed tracks, usually tracks with only one beginning frame'''
-        detections = [detections[i] for i in u_detection]
-        dists = matching.iou_distance(unconfirmed, detections)
+        u_detection = np.asarray(u_detection, dtype=np.int64)
+        dets_tlwh, dets_tlbr = dets_tlwh[u_detection], dets_tlbr[u_detection]
+        scores_keep, cls_keep = scores_keep[u_detection], cls_keep[u_detection]
+        dists = matching.iou_distance(store.tlbr(unconfirmed), dets_tlbr)
 
-        dists = matching.fuse_score(dists, detections)
+        dists = matching.fuse_score(dists, scores_keep)
         matches, u_unconfirmed, u_detection = matching.linear_assignment(
             dists, thresh=0.7)
-        for itracked, idet in matches:
-            unconfirmed[itracked].update(detections[idet], self.frame_id)
-            activated_starcks.append(unconfirmed[itracked])
-        for it in u_unconfirmed:
-            track = unconfirmed[it]
-            track.mark_removed()
-            removed_stracks.append(track)
+        matches = np.asarray(matches, dtype=np.int64).reshape(-1, 2)
+        activated_unconfirmed, _ = self._apply_matches(
+            unconfirmed[matches[:, 0]], STrack.tlwh_to_xyah(dets_tlwh[matches[:, 1]]), scores_keep[matches[:, 1]])
+        removed_stracks = unconfirmed[np.asarray(u_unconfirmed, dtype=np.int64)]
+        store.state[removed_stracks] = TrackState.Removed
 
         """ Step 4: Init new stracks"""
-        for inew in u_detection:
-            track = detections[inew]
-            if track.score < self.det_thresh:
-                continue
-            track.activate(self.kalman_filter, self.frame_id)
-            activated_starcks.append(track)
+        u_detection = np.asarray(u_detection, dtype=np.int64)
+        u_detection = u_detection[scores_keep[u_detection] >= self.det_thresh]
+        activated_new = self._activate(dets_tlwh[u_detection], scores_keep[u_detection], cls_keep[u_detection])
         """ Step 5: Update state"""
-        for track in self.lost_stracks:
-            if self.frame_id - track.end_frame > self.max_time_lost:
-                track.mark_removed()
-                removed_stracks.append(track)
-
-        # print('Ramained match {} s'.format(t4-t3))
-
-        self.tracked_stracks = [
-            t for t in self.tracked_stracks if t.state == TrackState.Tracked]
-        self.tracked_stracks = joint_stracks(
-            self.tracked_stracks, activated_starcks)
-        self.tracked_stracks = joint_stracks(
-            self.tracked_stracks, refind_stracks)
-        self.lost_stracks = sub_stracks(
-            self.lost_stracks, self.tracked_stracks)
-        self.lost_stracks.extend(lost_stracks)
-        self.lost_stracks = sub_stracks(
-            self.lost_stracks, self.removed_stracks)
-        self.removed_stracks.extend(removed_stracks)
-        self.tracked_stracks, self.lost_stracks = remove_duplicate_stracks(
-            self.tracked_stracks, self.lost_stracks)
+        expired = self.lost_idx[self.frame_id - store.frame_id[self.lost_idx] > self.max_time_lost]
+        store.state[expired] = TrackState.Removed
+        removed_stracks = np.concatenate([removed_stracks, expired])
+
+        activated_starcks = np.concatenate([activated_starcks, activated_second, activated_unconfirmed, activated_new])
+        refind_stracks = np.concatenate([refind_stracks, refind_second])
+        self.tracked_idx = self.tracked_idx[store.state[self.tracked_idx] == TrackState.Tracked]
+        self.tracked_idx = joint_stracks(self.tracked_idx, activated_starcks)
+        self.tracked_idx = joint_stracks(self.tracked_idx, refind_stracks)
+        self.lost_idx = sub_stracks(self.lost_idx, self.tracked_idx)
+        self.lost_idx = np.concatenate([self.lost_idx, lost_stracks])
+        # tracks removed in an earlier frame; the ones removed in this frame stay in the lost
+        # list until the next frame, as in the original ByteTrack
+        self.lost_idx = self.lost_idx[~store.was_removed[self.lost_idx]]
+        store.was_removed[removed_stracks] = True
+        self.tracked_idx, self.lost_idx = remove_duplicate_stracks(
+            store, self.tracked_idx, self.lost_idx)
+
+        # free the slots of the tracks that are neither tracked nor lost any more
+        live = np.zeros(store.capacity, dtype=bool)
+        live[self.tracked_idx] = True
+        live[self.lost_idx] = True
+        store.release(np.flatnonzero(store.used & ~live))
+
         # get scores of lost tracks
-        output_stracks = [
-            track for track in self.tracked_stracks if track.is_activated]
+        output_stracks = [STrack(store, i) for i in self.tracked_idx[store.is_activated[self.tracked_idx]]]
 
         return output_stracks
 
 
 def joint_stracks(tlista, tlistb):
-    exists = {}
-    res = []
-    for t in tlista:
-        exists[t.track_id] = 1
-        res.append(t)
-    for t in tlistb:
-        tid = t.track_id
-        if not exists.get(tid, 0):
-            exists[tid] = 1
-            res.append(t)
-    return res
+    """slot indices of tlista followed by the ones of tlistb not in tlista"""
+    return np.concatenate([tlista, tlistb[~np.isin(tlistb, tlista)]])
 
 
 def sub_stracks(tlista, tlistb):
-    stracks = {}
-    for t in tlista:
-        stracks[t.track_id] = t
-    for t in tlistb:
-        tid = t.track_id
-        if stracks.get(tid, 0):
-            del stracks[tid]
-    return list(stracks.values())
-
-
-def remove_duplicate_stracks(stracksa, stracksb):
-    pdist = matching.iou_distance(stracksa, stracksb)
-    pairs = np.where(pdist < 0.15)
-    dupa, dupb = list(), list()
-    for p, q in zip(*pairs):
-        timep = stracksa[p].frame_id - stracksa[p].start_frame
-        timeq = stracksb[q].frame_id - stracksb[q].start_frame
-        if timep > timeq:
-            dupb.append(q)
-        else:
-            dupa.append(p)
-    resa = [t for i, t in enumerate(stracksa) if not i in dupa]
-    resb = [t for i, t in enumerate(stracksb) if not i in dupb]
+    """slot indices of tlista not in tlistb"""
+    return tlista[~np.isin(tlista, tlistb)]
+
+
+def remove_duplicate_stracks(store, stracksa, stracksb):
+    pdist = matching.iou_distance(store.tlbr(stracksa), store.tlbr(stracksb))
+    p, q = np.where(pdist < 0.15)
+    timep = store.frame_id[stracksa[p]] - store.start_frame[stracksa[p]]
+    timeq = store.frame_id[stracksb[q]] - store.start_frame[stracksb[q]]
+    resa = np.delete(stracksa, p[timep <= timeq])
+    resb = np.delete(stracksb, q[timep > timeq])
     return resa, resb
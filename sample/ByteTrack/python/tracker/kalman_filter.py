@@ -188,10 +188,8 @@ class KalmanFilter(object):
             self._std_weight_velocity * mean[:, 3]]
         sqr = np.square(np.r_[std_pos, std_vel]).T
 
-        motion_cov = []
-        for i in range(len(mean)):
-            motion_cov.append(np.diag(sqr[i]))
-        motion_cov = np.asarray(motion_cov)
+        motion_cov = np.zeros((len(mean), 8, 8))
+        motion_cov[:, np.arange(8), np.arange(8)] = sqr
 
         mean = np.dot(mean, self._motion_mat.T)
         left = np.dot(self._motion_mat, covariance).transpose((1, 0, 2))
@@ -199,6 +197,81 @@ class KalmanFilter(object):
 
         return mean, covariance
 
+    def multi_initiate(self, measurements):
+        """Create tracks from unassociated measurements (Vectorized version).
+        Parameters
+        ----------
+        measurements : ndarray
+            The Nx4 dimensional matrix of bounding box coordinates (x, y, a, h).
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the Nx8 mean matrix and Nx8x8 covariance matrices of the
+            new tracks.
+        """
+        n = len(measurements)
+        mean = np.zeros((n, 8))
+        mean[:, :4] = measurements
+        h = measurements[:, 3]
+        std = np.empty((n, 8))
+        std[:, 0] = 2 * self._std_weight_position * h
+        std[:, 1] = 2 * self._std_weight_position * h
+        std[:, 2] = 1e-2
+        std[:, 3] = 2 * self._std_weight_position * h
+        std[:, 4] = 10 * self._std_weight_velocity * h
+        std[:, 5] = 10 * self._std_weight_velocity * h
+        std[:, 6] = 1e-5
+        std[:, 7] = 10 * self._std_weight_velocity * h
+        covariance = np.zeros((n, 8, 8))
+        covariance[:, np.arange(8), np.arange(8)] = np.square(std)
+        return mean, covariance
+
+    def multi_project(self, mean, covariance):
+        """Project state distributions to measurement space (Vectorized version).
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the Nx4 projected means and Nx4x4 projected covariances.
+        """
+        std = np.empty((len(mean), 4))
+        std[:, 0] = self._std_weight_position * mean[:, 3]
+        std[:, 1] = self._std_weight_position * mean[:, 3]
+        std[:, 2] = 1e-1
+        std[:, 3] = self._std_weight_position * mean[:, 3]
+
+        # the observation matrix selects the first 4 state dimensions
+        projected_mean = mean[:, :4].copy()
+        projected_cov = covariance[:, :4, :4].copy()
+        projected_cov[:, np.arange(4), np.arange(4)] += np.square(std)
+        return projected_mean, projected_cov
+
+    def multi_update(self, mean, covariance, measurements):
+        """Run Kalman filter correction step (Vectorized version).
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional predicted means.
+        covariance : ndarray
+            The Nx8x8 dimensional predicted covariances.
+        measurements : ndarray
+            The Nx4 dimensional measurements (x, y, a, h).
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the measurement-corrected state distributions.
+        """
+        projected_mean, projected_cov = self.multi_project(mean, covariance)
+
+        # K = P H^T S^-1, solved for all tracks at once; S is symmetric
+        kalman_gain = np.linalg.solve(
+            projected_cov, covariance[:, :, :4].transpose((0, 2, 1))).transpose((0, 2, 1))
+        innovation = measurements - projected_mean
+
+        new_mean = mean + np.matmul(kalman_gain, innovation[:, :, None])[:, :, 0]
+        new_covariance = covariance - np.matmul(
+            np.matmul(kalman_gain, projected_cov), kalman_gain.transpose((0, 2, 1)))
+        return new_mean, new_covariance
+
     def update(self, mean, covariance, measurement):
         """Run Kalman filter correction step.
 
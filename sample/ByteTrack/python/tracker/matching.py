@@ -190,7 +190,10 @@ def fuse_score(cost_matrix, detections):
     if cost_matrix.size == 0:
         return cost_matrix
     iou_sim = 1 - cost_matrix
-    det_scores = np.array([det.score for det in detections])
+    if isinstance(detections, np.ndarray):
+        det_scores = detections
+    else:
+        det_scores = np.array([det.score for det in detections])
     det_scores = np.expand_dims(det_scores, axis=0).repeat(
         cost_matrix.shape[0], axis=0)
     fuse_sim = iou_sim * det_scores
@@ -0,0 +1,73 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+import os
+import sys
+import time
+import argparse
+import logging
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../python'))
+from tracker.byte_tracker import BYTETracker
+logging.basicConfig(level=logging.INFO)
+
+
+def argsparser():
+    parser = argparse.ArgumentParser(prog=__file__)
+    parser.add_argument('--num_tracks', type=str, default='10,100,1000', help='comma separated numbers of objects in the scene')
+    parser.add_argument('--frames', type=int, default=100, help='frames per scene')
+    parser.add_argument('--track_thresh', type=float, default=0.7, help='track thresh')
+    parser.add_argument('--match_thresh', type=float, default=0.8, help='match thresh')
+    parser.add_argument('--track_buffer', type=int, default=30, help='track buffer')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    return args
+
+
+def make_scene(num_objects, frames, rng, width=1920, height=1080):
+    # objects moving with constant velocity, 10% missed detections and a few false positives per frame
+    pos = rng.uniform(0, [width, height], (num_objects, 2))
+    vel = rng.normal(0, 3, (num_objects, 2))
+    size = rng.uniform(20, 120, (num_objects, 2))
+    scene = []
+    for _ in range(frames):
+        pos += vel
+        keep = rng.random(num_objects) > 0.1
+        center = pos[keep] + rng.normal(0, 1.5, (keep.sum(), 2))
+        wh = size[keep] * rng.uniform(0.95, 1.05, (keep.sum(), 2))
+        boxes = np.concatenate([center - wh / 2, center + wh / 2], 1)
+        num_fp = rng.integers(0, num_objects // 10 + 2)
+        fp = rng.uniform(0, [width, height], (num_fp, 2))
+        fp_wh = rng.uniform(20, 80, (num_fp, 2))
+        boxes = np.concatenate([boxes, np.concatenate([fp, fp + fp_wh], 1)]).astype(np.float32)
+        scores = rng.uniform(0.15, 1.0, len(boxes))
+        cls_id = rng.integers(0, 3, len(boxes))
+        scene.append((boxes, scores, cls_id))
+    return scene
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    for num_objects in [int(n) for n in args.num_tracks.split(',')]:
+        scene = make_scene(num_objects, args.frames, rng)
+        tracker = BYTETracker(args.track_thresh, args.track_buffer, args.match_thresh, frame_rate=30)
+        track_time = 0.0
+        num_outputs = 0
+        for boxes, scores, cls_id in scene:
+            start_time = time.time()
+            outputs = tracker.update(boxes, scores, cls_id, [1080, 1920], [1080, 1920])
+            track_time += time.time() - start_time
+            num_outputs += len(outputs)
+        logging.info("objects: {}, live tracks: {}, output tracks/frame: {:.1f}, track_time(ms): {:.2f}".format(
+            num_objects, len(tracker.tracked_idx) + len(tracker.lost_idx), num_outputs / args.frames,
+            track_time / args.frames * 1000))
+
+
+if __name__ == '__main__':
+    args = argsparser()
+    main(args)
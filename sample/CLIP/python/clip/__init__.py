@@ -8,6 +8,7 @@
 #===----------------------------------------------------------------------===#
 from .simple_tokenizer import tokenize
 from .clip import CLIP
+from .index import TextEmbeddingCache, ImageBatcher, EmbeddingStore
 
 
 def load(image_model, text_model, dev_id):
@@ -0,0 +1,234 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+import os
+import json
+import time
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+from .simple_tokenizer import tokenize
+
+
+def normalize(x):
+    return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+
+class TextEmbeddingCache:
+    """
+    归一化后的文本embedding的LRU缓存, 以tokenize后的token序列为键;
+    一次调用中未命中的文本合并为一批送入text bmodel
+    """
+    def __init__(self, model, capacity=4096):
+        self.model = model
+        self.capacity = capacity
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, texts):
+        tokens = np.asarray(tokenize(texts))
+        keys = [row.tobytes() for row in tokens]
+        features = [None] * len(keys)
+        missing = collections.OrderedDict()
+        for i, key in enumerate(keys):
+            feature = self.cache.get(key)
+            if feature is None:
+                missing.setdefault(key, []).append(i)
+            else:
+                self.cache.move_to_end(key)
+                features[i] = feature
+        self.hits += len(keys) - sum(len(idx) for idx in missing.values())
+        self.misses += len(missing)
+
+        if missing:
+            rows = [idx[0] for idx in missing.values()]
+            encoded = normalize(self.model.encode_text(tokens[rows]).astype(np.float32))
+            for (key, idx), feature in zip(missing.items(), encoded):
+                for i in idx:
+                    features[i] = feature
+                self.cache[key] = feature
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+        return np.stack(features)
+
+
+class ImageBatcher:
+    """
+    图片在线程池中解码和预处理, 预取若干batch; 预处理结果直接写入复用的batch输入, 凑满image bmodel的batch再推理
+    """
+    def __init__(self, model, num_workers=4, prefetch_batches=4):
+        self.model = model
+        self.batch_size = model.image_net_batch_size
+        self.pool = ThreadPoolExecutor(max_workers=max(1, num_workers))
+        self.prefetch = max(1, prefetch_batches) * self.batch_size
+        self.batch_input = np.zeros((self.batch_size, 3, model.image_resolution, model.image_resolution), dtype=np.float32)
+        self.preprocess_time = 0.0
+        self.batch_count = 0
+        self.skipped = []
+
+    def load(self, path):
+        image = cv2.imread(path)
+        if image is None:
+            return None, 0.0
+        # 与CLIP.preprocess一致, 只统计预处理的时间, 不含解码
+        start_time = time.time()
+        image = self.model.preprocess_cpu(image)
+        return image, time.time() - start_time
+
+    def run_batch(self, paths):
+        num = len(paths)
+        # 不满的batch只推理一次, 多余的行是上一个batch的数据
+        features = self.model.encode_image(self.batch_input)[:num]
+        self.batch_count += 1
+        return paths, normalize(features.astype(np.float32))
+
+    def __call__(self, paths):
+        """按输入顺序产生(图片路径列表, 归一化后的embedding), 无法读取的图片记录在skipped中"""
+        futures = collections.deque()
+        paths = iter(paths)
+        batch_paths = []
+        while True:
+            while len(futures) < self.prefetch:
+                path = next(paths, None)
+                if path is None:
+                    break
+                futures.append((path, self.pool.submit(self.load, path)))
+            if not futures:
+                break
+            path, future = futures.popleft()
+            image, load_time = future.result()
+            self.preprocess_time += load_time
+            if image is None:
+                logging.warning("{} imread is None, skipped.".format(path))
+                self.skipped.append(path)
+                continue
+            self.batch_input[len(batch_paths)] = image
+            batch_paths.append(path)
+            if len(batch_paths) == self.batch_size:
+                yield self.run_batch(batch_paths)
+                batch_paths = []
+        if batch_paths:
+            yield self.run_batch(batch_paths)
+
+
+class EmbeddingStore:
+    """
+    磁盘上的embedding库, 向量按行追加, 检索时以内存映射方式分块读取:
+        <root>/meta.json       向量维度和数据类型
+        <root>/embeddings.bin  每行一个归一化的向量, 行号即id
+        <root>/manifest.tsv    每行为 id<TAB>图片路径
+    """
+    def __init__(self, root, dim=None, dtype="float16"):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.meta_path = os.path.join(root, "meta.json")
+        self.data_path = os.path.join(root, "embeddings.bin")
+        self.manifest_path = os.path.join(root, "manifest.tsv")
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            if dim is not None and dim != meta["dim"]:
+                raise ValueError("{} stores {}-d embeddings, got {}".format(root, meta["dim"], dim))
+        else:
+            if dim is None:
+                raise ValueError("{} is not an embedding store, dim is needed to create one".format(root))
+            meta = {"dim": int(dim), "dtype": dtype}
+            with open(self.meta_path, "w") as f:
+                json.dump(meta, f)
+        self.dim = meta["dim"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.row_bytes = self.dim * self.dtype.itemsize
+
+        self.paths = []
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding="utf-8") as f:
+                self.paths = [line.rstrip("\n").split("\t", 1)[1] for line in f if line.strip()]
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        num_rows = data_size // self.row_bytes
+        # 追加被中断时, 向量和清单截断到两者都写完的行
+        if data_size != len(self.paths) * self.row_bytes:
+            logging.warning("{}: {} embeddings and {} manifest rows, truncated to {}".format(
+                root, data_size / self.row_bytes, len(self.paths), min(num_rows, len(self.paths))))
+            self.paths = self.paths[:num_rows]
+            with open(self.data_path, "ab") as f:
+                f.truncate(len(self.paths) * self.row_bytes)
+            self.rewrite_manifest()
+        self.path_ids = {path: i for i, path in enumerate(self.paths)}
+        self._vectors = None
+
+    def rewrite_manifest(self):
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            f.writelines("{}\t{}\n".format(i, path) for i, path in enumerate(self.paths))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.path_ids
+
+    def add(self, paths, embeddings):
+        """追加一批向量, 返回它们的id; 先写向量再写清单"""
+        embeddings = np.ascontiguousarray(embeddings, dtype=self.dtype).reshape(-1, self.dim)
+        assert len(paths) == len(embeddings), "paths and embeddings must have the same length"
+        ids = np.arange(len(self.paths), len(self.paths) + len(paths))
+        with open(self.data_path, "ab") as f:
+            f.write(embeddings.tobytes())
+        with open(self.manifest_path, "a", encoding="utf-8") as f:
+            f.writelines("{}\t{}\n".format(i, path) for i, path in zip(ids, paths))
+        for i, path in zip(ids, paths):
+            self.path_ids[path] = i
+        self.paths.extend(paths)
+        self._vectors = None
+        return ids
+
+    @property
+    def vectors(self):
+        if self._vectors is None or len(self._vectors) != len(self):
+            if len(self) == 0:
+                return np.zeros((0, self.dim), dtype=self.dtype)
+            self._vectors = np.memmap(self.data_path, dtype=self.dtype, mode="r", shape=(len(self), self.dim))
+        return self._vectors
+
+    def search(self, queries, k=5, block_size=65536):
+        """
+        内积top-k检索, 向量库按block_size行分块读取, 每块与所有查询做一次矩阵乘, 与已有的top-k合并
+
+        Args:
+            queries: (Q, dim)或(dim,)的归一化查询向量
+            k: 每个查询返回的结果数
+            block_size: 每块的行数
+
+        Returns:
+            scores, ids: (Q, k), 按得分从高到低排列
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        vectors = self.vectors
+        k = min(k, len(vectors))
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        for beg in range(0, len(vectors), block_size):
+            block = np.asarray(vectors[beg:beg + block_size], dtype=np.float32)
+            scores = queries @ block.T
+            if scores.shape[1] > k:
+                top = np.argpartition(scores, -k, axis=1)[:, -k:]
+                scores = np.take_along_axis(scores, top, axis=1)
+            else:
+                top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            ids = np.concatenate([best_ids, top + beg], axis=1)
+            if scores.shape[1] > k:
+                top = np.argpartition(scores, -k, axis=1)[:, -k:]
+                scores = np.take_along_axis(scores, top, axis=1)
+                ids = np.take_along_axis(ids, top, axis=1)
+            best_scores, best_ids = scores, ids
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_ids, order, axis=1)
@@ -0,0 +1,89 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+import os
+import time
+import argparse
+import logging
+import clip
+
+logging.basicConfig(level=logging.INFO)
+
+
+def list_images(image_path):
+    if os.path.isfile(image_path):
+        return [image_path]
+    image_paths = []
+    for root, dirs, files in os.walk(image_path):
+        dirs.sort()
+        image_paths.extend(os.path.join(root, fname) for fname in sorted(files)
+                           if os.path.splitext(fname)[1].lower() in ('.jpg', '.jpeg', '.png', '.bmp', '.webp'))
+    return image_paths
+
+
+def build_index(model, store, args):
+    image_paths = [path for path in list_images(args.image_path) if path not in store]
+    logging.info("{} images to index, {} already in {}".format(len(image_paths), len(store), args.index_dir))
+    image_batcher = clip.ImageBatcher(model, num_workers=args.decode_workers)
+    start_time = time.time()
+    num = 0
+    for paths, features in image_batcher(image_paths):
+        store.add(paths, features)
+        num += len(paths)
+    total_time = time.time() - start_time
+    logging.info("indexed {} images ({} skipped) in {:.2f}s, {:.2f} images/s, {} image batches".format(
+        num, len(image_batcher.skipped), total_time, num / max(total_time, 1e-9), image_batcher.batch_count))
+    logging.info("preprocess(ms): {:.2f}, image_encode(ms): {:.2f}".format(
+        image_batcher.preprocess_time / max(num, 1) * 1000, model.encode_image_time / max(num, 1) * 1000))
+
+
+def query_index(model, store, args):
+    text_cache = clip.TextEmbeddingCache(model, capacity=args.text_cache_size)
+    start_time = time.time()
+    text_features = text_cache(args.query)
+    encode_time = time.time() - start_time
+    start_time = time.time()
+    scores, ids = store.search(text_features, k=args.topk, block_size=args.block_size)
+    search_time = time.time() - start_time
+    for text, text_scores, text_ids in zip(args.query, scores, ids):
+        logging.info("Query: {}".format(text))
+        for score, idx in zip(text_scores, text_ids):
+            logging.info("    {:.4f}  {}".format(score, store.paths[idx]))
+    logging.info("{} queries over {} embeddings, text_encode(ms): {:.2f}, search(ms): {:.2f}".format(
+        len(args.query), len(store), encode_time * 1000, search_time * 1000))
+
+
+def main(args):
+    model, preprocess = clip.load(args.image_model, args.text_model, args.dev_id)
+    store = clip.EmbeddingStore(args.index_dir, dim=model.embed_dim, dtype=args.dtype)
+    if args.image_path:
+        build_index(model, store, args)
+    if args.query:
+        query_index(model, store, args)
+
+
+def argsparser():
+    parser = argparse.ArgumentParser(prog=__file__)
+    parser.add_argument('--index_dir', type=str, default='./results/clip_index', help='directory of the embedding store')
+    parser.add_argument('--image_path', type=str, default=None, help='image or image directory to add to the store, searched recursively')
+    parser.add_argument('--query', nargs='+', default=None, help='text queries')
+    parser.add_argument('--topk', type=int, default=5, help='results per query')
+    parser.add_argument('--block_size', type=int, default=65536, help='embeddings per block of the top-k search')
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'float32'], help='storage type of a new store')
+    parser.add_argument('--text_cache_size', type=int, default=4096, help='text embeddings kept in the LRU cache')
+    parser.add_argument('--decode_workers', type=int, default=4, help='threads of image decoding and preprocessing')
+    parser.add_argument('--image_model', type=str, default='./models/BM1684X/clip_image_vitb32_bm1684x_f16_1b.bmodel', help='path of image bmodel')
+    parser.add_argument('--text_model', type=str, default='./models/BM1684X/clip_text_vitb32_bm1684x_f16_1b.bmodel', help='path of text bmodel')
+    parser.add_argument('--dev_id', type=int, default=0, help='dev id')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = argsparser()
+    main(args)
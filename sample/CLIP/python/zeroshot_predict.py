@@ -1,5 +1,4 @@
 import os
-import cv2
 import clip
 import argparse
 import logging
@@ -21,41 +20,39 @@ def main(args):
     # Load bmodel
     text = args.text
     model, preprocess = clip.load(args.image_model, args.text_model, args.dev_id)
-    
-    # Tokenize 
-    text_inputs = clip.tokenize(text)
+
+    # 提示词的embedding只计算一次, 之后每张图片都命中缓存
+    text_cache = clip.TextEmbeddingCache(model)
+    # 图片在线程池中解码和预处理, 凑满image bmodel的batch再推理
+    image_batcher = clip.ImageBatcher(model, num_workers=args.decode_workers)
 
     if os.path.isfile(args.image_path):
         image_paths = [args.image_path]
     else:
-        image_paths = [os.path.join(args.image_path, fname) for fname in os.listdir(args.image_path)]
-    
-    for filename in image_paths:
-        image = cv2.imread(filename)
-        image_input = np.expand_dims(preprocess(image), axis=0)
-
-
-        image_features = model.encode_image(image_input)
-        text_features = model.encode_text(text_inputs)
-
-        image_features /= np.linalg.norm(image_features,axis=-1, keepdims=True)
-        text_features /= np.linalg.norm(text_features,axis=-1, keepdims=True)
-
-        similarity = softmax((100.0 * np.dot(image_features , text_features.T)),axis=-1) #计算相似度，并转换为概率分布  
-        values, indices = topk(similarity[0],min(len(text), 5))
-
-        for i in range(len(text)):
-            logging.info(f"Text: {text[indices[i]]}, Similarity: {values[i].item()}")
+        image_paths = [os.path.join(args.image_path, fname) for fname in sorted(os.listdir(args.image_path))]
 
+    image_num = 0
+    for filenames, image_features in image_batcher(image_paths):
+        text_features = text_cache(text)
+        similarity = softmax((100.0 * np.dot(image_features, text_features.T)), axis=-1) #计算相似度，并转换为概率分布
+        for filename, image_similarity in zip(filenames, similarity):
+            image_num += 1
+            values, indices = topk(image_similarity, min(len(text), 5))
+            logging.info(f"Image: {filename}")
+            for i in range(len(values)):
+                logging.info(f"Text: {text[indices[i]]}, Similarity: {values[i].item()}")
 
-    logging.info(("-------------------Image num {}, Preprocess average time ------------------------").format(image_input.shape[0]))
-    logging.info("preprocess(ms): {:.2f}".format(model.preprocess_time / image_input.shape[0] * 1000))
+    image_num = max(image_num, 1)
+    logging.info(("-------------------Image num {}, Preprocess average time ------------------------").format(image_num))
+    logging.info("preprocess(ms): {:.2f}".format(image_batcher.preprocess_time / image_num * 1000))
 
-    logging.info(("------------------ Image num {}, Image Encoding average time ----------------------").format(image_input.shape[0]))
-    logging.info("image_encode(ms): {:.2f}".format(model.encode_image_time / image_input.shape[0] * 1000))
+    logging.info(("------------------ Image num {}, Image Encoding average time ----------------------").format(image_num))
+    logging.info("image_encode(ms): {:.2f}".format(model.encode_image_time / image_num * 1000))
 
-    logging.info(("------------------ Image num {}, Text Encoding average time ----------------------").format(image_input.shape[0]))
-    logging.info("text_encode(ms): {:.2f}".format(model.encode_text_time / image_input.shape[0] * 1000))
+    logging.info(("------------------ Image num {}, Text Encoding average time ----------------------").format(image_num))
+    logging.info("text_encode(ms): {:.2f}".format(model.encode_text_time / image_num * 1000))
+    logging.info("text cache hits: {}, misses: {}, image batches: {}".format(
+        text_cache.hits, text_cache.misses, image_batcher.batch_count))
 
 
 
@@ -66,6 +63,7 @@ def argsparser():
     parser.add_argument('--image_model', type=str, default='./models/BM1684X/clip_image_vitb32_bm1684x_f16_1b.bmodel', help='path of image bmodel')
     parser.add_argument('--text_model', type=str, default='./models/BM1684X/clip_text_vitb32_bm1684x_f16_1b.bmodel', help='path of text bmodel')
     parser.add_argument('--dev_id', type=int, default=0, help='dev id')
+    parser.add_argument('--decode_workers', type=int, default=4, help='threads of image decoding and preprocessing')
     args = parser.parse_args()
     return args
 
@@ -0,0 +1,128 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import logging
+import cv2
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../python'))
+import clip
+from clip_index import list_images
+logging.basicConfig(level=logging.INFO)
+
+
+def argsparser():
+    parser = argparse.ArgumentParser(prog=__file__)
+    parser.add_argument('--image_path', type=str, default='./datasets', help='image or image directory')
+    parser.add_argument('--num_images', type=int, default=256, help='images of the zero-shot and indexing tests, the images are repeated')
+    parser.add_argument('--text', nargs='+', default=['a diagram', 'a dog', 'a cat'], help='zero-shot prompts')
+    parser.add_argument('--num_vectors', type=int, default=1000000, help='synthetic embeddings of the search test')
+    parser.add_argument('--num_queries', type=int, default=16, help='queries of the search test')
+    parser.add_argument('--topk', type=int, default=5)
+    parser.add_argument('--block_size', type=int, default=65536)
+    parser.add_argument('--decode_workers', type=int, default=4)
+    parser.add_argument('--skip_models', action='store_true', help='only run the search test, no bmodel needed')
+    parser.add_argument('--image_model', type=str, default='./models/BM1684X/clip_image_vitb32_bm1684x_f16_1b.bmodel', help='path of image bmodel')
+    parser.add_argument('--text_model', type=str, default='./models/BM1684X/clip_text_vitb32_bm1684x_f16_1b.bmodel', help='path of text bmodel')
+    parser.add_argument('--dev_id', type=int, default=0, help='dev id')
+    return parser.parse_args()
+
+
+def zeroshot_per_image(model, image_paths, text):
+    """zeroshot_predict.py before the text cache: one image per encode_image, the prompts encoded for every image"""
+    text_inputs = clip.tokenize(text)
+    top1 = []
+    for filename in image_paths:
+        image = cv2.imread(filename)
+        if image is None:
+            continue
+        image_input = np.expand_dims(model.preprocess(image), axis=0)
+        image_features = model.encode_image(image_input)
+        text_features = model.encode_text(text_inputs)
+        image_features /= np.linalg.norm(image_features, axis=-1, keepdims=True)
+        text_features /= np.linalg.norm(text_features, axis=-1, keepdims=True)
+        top1.append(int(np.argmax(np.dot(image_features, text_features.T)[0])))
+    return top1
+
+
+def zeroshot_batched(model, image_paths, text, decode_workers):
+    text_cache = clip.TextEmbeddingCache(model)
+    image_batcher = clip.ImageBatcher(model, num_workers=decode_workers)
+    top1 = []
+    for paths, image_features in image_batcher(image_paths):
+        top1.extend(np.argmax(np.dot(image_features, text_cache(text).T), axis=-1).tolist())
+    return top1
+
+
+def benchmark_models(args):
+    model, preprocess = clip.load(args.image_model, args.text_model, args.dev_id)
+    image_paths = list_images(args.image_path)
+    image_paths = (image_paths * (args.num_images // max(len(image_paths), 1) + 1))[:args.num_images]
+
+    results = {}
+    for name, run in [("per_image", lambda: zeroshot_per_image(model, image_paths, args.text)),
+                      ("batched", lambda: zeroshot_batched(model, image_paths, args.text, args.decode_workers))]:
+        model.encode_image_time = model.encode_text_time = model.preprocess_time = 0.0
+        start_time = time.time()
+        results[name] = run()
+        total_time = time.time() - start_time
+        logging.info("zero-shot {:<9} images: {}, ms/image: {:.2f}, image_encode(ms): {:.2f}, text_encode(ms): {:.2f}".format(
+            name, len(image_paths), total_time / len(image_paths) * 1000,
+            model.encode_image_time / len(image_paths) * 1000, model.encode_text_time / len(image_paths) * 1000))
+    logging.info("zero-shot top1 agreement: {:.2%}".format(np.mean(np.array(results["per_image"]) == np.array(results["batched"]))))
+
+    index_dir = tempfile.mkdtemp(prefix="clip_index_")
+    try:
+        store = clip.EmbeddingStore(index_dir, dim=model.embed_dim)
+        image_batcher = clip.ImageBatcher(model, num_workers=args.decode_workers)
+        start_time = time.time()
+        for paths, features in image_batcher(image_paths):
+            store.add(paths, features)
+        total_time = time.time() - start_time
+        logging.info("indexing images: {}, images/s: {:.2f}".format(len(store), len(store) / max(total_time, 1e-9)))
+    finally:
+        shutil.rmtree(index_dir)
+
+
+def benchmark_search(args, dim=512):
+    index_dir = tempfile.mkdtemp(prefix="clip_index_")
+    try:
+        rng = np.random.default_rng(0)
+        store = clip.EmbeddingStore(index_dir, dim=dim)
+        chunk = 100000
+        for beg in range(0, args.num_vectors, chunk):
+            num = min(chunk, args.num_vectors - beg)
+            vectors = clip.index.normalize(rng.standard_normal((num, dim)).astype(np.float32))
+            store.add(["synthetic/{}".format(i) for i in range(beg, beg + num)], vectors)
+        queries = clip.index.normalize(rng.standard_normal((args.num_queries, dim)).astype(np.float32))
+
+        start_time = time.time()
+        scores, ids = store.search(queries, k=args.topk, block_size=args.block_size)
+        search_time = time.time() - start_time
+        logging.info("search vectors: {}, queries: {}, blocked top-{} (ms/query): {:.2f}".format(
+            len(store), args.num_queries, args.topk, search_time / args.num_queries * 1000))
+
+        # 与整库所有得分全排序的结果对比, 只检查前16个查询
+        ref_scores = np.concatenate([queries[:16] @ np.asarray(store.vectors[beg:beg + chunk], dtype=np.float32).T
+                                     for beg in range(0, len(store), chunk)], axis=1)
+        ref_ids = np.argsort(-ref_scores, axis=1)[:, :args.topk]
+        logging.info("same top-{} as brute force: {}".format(args.topk, np.array_equal(np.sort(ids[:16], axis=1), np.sort(ref_ids, axis=1))))
+    finally:
+        shutil.rmtree(index_dir)
+
+
+if __name__ == '__main__':
+    args = argsparser()
+    if not args.skip_models:
+        benchmark_models(args)
+    benchmark_search(args)
@@ -9,6 +9,7 @@
 import sophon.sail as sail
 import argparse
 import time
+from attention_mask import AttentionMask
 import sentencepiece as spm
 import numpy as np
 
@@ -103,6 +104,9 @@ class ChatGLM2:
         self.next_attention_dtype = self.net.get_input_dtype(self.name_blocks_cache[0], self.next_attention_name)
         self.next_attention_tensor = sail.Tensor(self.handle, self.next_attention_shape, self.next_attention_dtype, False, True)
 
+        # position ids and attention masks of forward_first / forward_next, 1 masks a position and the kv cache is kept at the end
+        self.mask = AttentionMask(self.MAX_LEN, np.float32, 1, np.int32, kv_align='right')
+
         # forward_first: key_tensor 和 value_tensor
         self.past_key_tensor = []
         self.past_key_name = []
@@ -169,16 +173,9 @@ class ChatGLM2:
     def forward_first(self, token):
         input_ids = np.zeros(self.MAX_LEN, np.int32)
         input_ids[0], input_ids[1] = 64790, 64792
-        position_id = np.zeros(self.MAX_LEN, np.int32)
-        attention_mask = np.zeros(self.MAX_LEN*self.MAX_LEN, np.float32)
         input_ids[2:len(token)+2] = token
         self.token_length = len(token)+2
-        for i in range(self.token_length):
-            position_id[i] = i
-        for i in range(self.MAX_LEN):
-            for j in range(self.MAX_LEN):
-                if not (j <= i and i < self.token_length):
-                    attention_mask[i*self.MAX_LEN + j] = 1
+        position_id, attention_mask = self.mask.first(self.token_length)
         
 
         # embedding
@@ -225,10 +222,8 @@ class ChatGLM2:
 
 
     def forward_next(self, ):
-        attention_mask = np.zeros(self.MAX_LEN+1, np.float32)
-        for i in range(self.MAX_LEN - self.token_length):
-            attention_mask[i] = 1
-        position_id = np.array(self.token_length - 1, dtype=np.int32)
+        # chatglm2 unmasks token_length cache entries, one more than the other runners
+        position_id, attention_mask = self.mask.next(self.token_length, self.token_length)
 
         # embedding
         self.next_embed_input_tensor = self.lm_output_tensor
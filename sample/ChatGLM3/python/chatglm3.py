@@ -7,8 +7,11 @@
 #
 #===----------------------------------------------------------------------===#
 import sophon.sail as sail
+import os
 import time
 import argparse
+from llm_server import serve
+from attention_mask import AttentionMask
 from transformers import AutoTokenizer
 import numpy as np
 
@@ -82,6 +85,9 @@ class ChatGLM3:
         # forward_next: position_id_tensor and attention_mask_tensor
         self.next_pid = self.init_sail_tensor(self.name_blocks_cache[0], 1)
         self.next_attention = self.init_sail_tensor(self.name_blocks_cache[0], 2)
+        # position ids and attention masks of forward_first / forward_next, the kv cache is kept at the end
+        self.mask = AttentionMask(self.SEQLEN, type_convert(self.first_attention["dtype"]), -10000.0,
+                                  type_convert(self.first_pid["dtype"]), kv_align='right')
 
         # forward_next: present_key / present_value (for update kv_cache)
         self.present_key = self.init_sail_tensor(self.name_blocks_cache[0], 1, None, False)
@@ -151,15 +157,7 @@ class ChatGLM3:
         self.token_length = len(token)
         input_ids = input_ids.reshape(1, -1)
 
-        position_id = np.zeros(self.SEQLEN, type_convert(self.first_pid["dtype"])) 
-        for i in range(self.token_length):
-            position_id[i] = i
-            
-        attention_mask = np.zeros(self.SEQLEN*self.SEQLEN, type_convert(self.first_attention["dtype"])) #这里的type要从模型获取。
-        for i in range(self.SEQLEN):
-            for j in range(self.SEQLEN):
-                if not (j <= i and i < self.token_length):
-                    attention_mask[i*self.SEQLEN + j] = -10000.0
+        position_id, attention_mask = self.mask.first(self.token_length)
 
         # embedding
         self.first_embed_input["data"].update_data(fp16_cast(input_ids))
@@ -202,10 +200,7 @@ class ChatGLM3:
         return int(self.lm_output["data"].asnumpy())
 
     def forward_next(self, ):
-        attention_mask = np.zeros(self.SEQLEN+1, type_convert(self.next_attention["dtype"]))
-        for i in range(self.SEQLEN - self.token_length + 1):
-            attention_mask[i] = -10000.0
-        position_id = np.array(self.token_length - 1, type_convert(self.next_pid["dtype"]))
+        position_id, attention_mask = self.mask.next(self.token_length)
 
         # embedding
         self.next_embed_input["data"] = self.lm_output["data"]
@@ -241,6 +236,32 @@ class ChatGLM3:
         self.net.process(self.name_lm, input_lm_tensors, output_lm_tensors)
         return int(self.lm_output["data"].asnumpy()) #int32
             
+    def new_kv_cache(self):
+        """
+        allocate the kv cache of one more conversation, swapped in by llm_server.py
+        """
+        past_key_output = []
+        past_value_output = []
+        for i in range(self.NUM_LAYERS):
+            past_key_output.append(self.init_sail_tensor(self.name_blocks[0], 1, None, False))
+            past_value_output.append(self.init_sail_tensor(self.name_blocks[0], 2, None, False))
+            past_key_output[i]["data"].memory_set(0)
+            past_value_output[i]["data"].memory_set(0)
+        return past_key_output, past_value_output
+
+    def set_next_token(self, token):
+        """
+        make forward_next continue from token, used when switching between conversations
+        """
+        data = self.lm_output["data"]
+        data.update_data(np.array(token, type_convert(self.lm_output["dtype"])).reshape(data.shape()))
+
+    def encode_messages(self, messages):
+        return self.sp.build_chat_input(messages[-1]["content"], history=messages[:-1], role=messages[-1]["role"])
+
+    def decode_tokens(self, tokens):
+        return self.sp.decode(tokens)
+
     def chat_stream(self, input, history):
         input_tokens = self.sp.build_chat_input(input, history=[], role="user")
         if (len(input_tokens) > self.SEQLEN / 3):
@@ -301,13 +322,20 @@ def main(args):
     tokenizer = AutoTokenizer.from_pretrained(args.token, trust_remote_code=True)
     engine = sail.Engine(args.bmodel, args.dev_id, sail.IOMode.DEVIO)
     client = ChatGLM3(handle, engine, tokenizer)
-    app(client)
+    if args.server:
+        serve(client, args.host, args.port, args.max_sessions, os.path.basename(args.bmodel))
+    else:
+        app(client)
 
 def argsparser():
     parser = argparse.ArgumentParser(prog=__file__)
     parser.add_argument('--bmodel', type=str, default='./models/BM1684X/chatglm3-6b_int4.bmodel', help='path of bmodel')
     parser.add_argument('--token', type=str, default='./python/token_config/', help='path of tokenizer')
     parser.add_argument('--dev_id', type=int, default=0, help='dev id')
+    parser.add_argument('--server', action='store_true', help='run an OpenAI compatible http server instead of the command line chat')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='server address, 0.0.0.0 to accept other hosts')
+    parser.add_argument('--port', type=int, default=8000, help='server port')
+    parser.add_argument('--max_sessions', type=int, default=4, help='conversations decoded together, each one owns a kv cache')
     args = parser.parse_args()
     return args
 
@@ -2,105 +2,16 @@
 import numpy as np
 
 
-def _pdist(a, b):
-    """Compute pair-wise squared distance between points in `a` and `b`.
-
-    Parameters
-    ----------
-    a : array_like
-        An NxM matrix of N samples of dimensionality M.
-    b : array_like
-        An LxM matrix of L samples of dimensionality M.
-
-    Returns
-    -------
-    ndarray
-        Returns a matrix of size len(a), len(b) such that eleement (i, j)
-        contains the squared distance between `a[i]` and `b[j]`.
-
-    """
-    a, b = np.asarray(a), np.asarray(b)
-    if len(a) == 0 or len(b) == 0:
-        return np.zeros((len(a), len(b)))
-    a2, b2 = np.square(a).sum(axis=1), np.square(b).sum(axis=1)
-    r2 = -2. * np.dot(a, b.T) + a2[:, None] + b2[None, :]
-    r2 = np.clip(r2, 0., float(np.inf))
-    return r2
-
-
-def _cosine_distance(a, b, data_is_normalized=False):
-    """Compute pair-wise cosine distance between points in `a` and `b`.
-
-    Parameters
-    ----------
-    a : array_like
-        An NxM matrix of N samples of dimensionality M.
-    b : array_like
-        An LxM matrix of L samples of dimensionality M.
-    data_is_normalized : Optional[bool]
-        If True, assumes rows in a and b are unit length vectors.
-        Otherwise, a and b are explicitly normalized to lenght 1.
-
-    Returns
-    -------
-    ndarray
-        Returns a matrix of size len(a), len(b) such that eleement (i, j)
-        contains the squared distance between `a[i]` and `b[j]`.
-
-    """
-    if not data_is_normalized:
-        a = np.asarray(a) / np.linalg.norm(a, axis=1, keepdims=True)
-        b = np.asarray(b) / np.linalg.norm(b, axis=1, keepdims=True)
-    return 1. - np.dot(a, b.T)
-
-
-def _nn_euclidean_distance(x, y):
-    """ Helper function for nearest neighbor distance metric (Euclidean).
-
-    Parameters
-    ----------
-    x : ndarray
-        A matrix of N row-vectors (sample points).
-    y : ndarray
-        A matrix of M row-vectors (query points).
-
-    Returns
-    -------
-    ndarray
-        A vector of length M that contains for each entry in `y` the
-        smallest Euclidean distance to a sample in `x`.
-
-    """
-    distances = _pdist(x, y)
-    return np.maximum(0.0, distances.min(axis=0))
-
-
-def _nn_cosine_distance(x, y):
-    """ Helper function for nearest neighbor distance metric (cosine).
-
-    Parameters
-    ----------
-    x : ndarray
-        A matrix of N row-vectors (sample points).
-    y : ndarray
-        A matrix of M row-vectors (query points).
-
-    Returns
-    -------
-    ndarray
-        A vector of length M that contains for each entry in `y` the
-        smallest cosine distance to a sample in `x`.
-
-    """
-    distances = _cosine_distance(x, y)
-    return distances.min(axis=0)
-
-
 class NearestNeighborDistanceMetric(object):
     """
     A nearest neighbor distance metric that, for each target, returns
     the closest distance to any sample that has been observed so far.
 
+    The samples of all targets are kept in one preallocated gallery of shape
+    (targets, budget, dim). Every target owns a row used as a ring buffer, so
+    that the distances to all targets are computed with one matrix multiply
+    and a masked min-reduction over the samples.
+
     Parameters
     ----------
     metric : str
@@ -114,25 +25,79 @@ class NearestNeighborDistanceMetric(object):
 
     Attributes
     ----------
-    samples : Dict[int -> List[ndarray]]
-        A dictionary that maps from target identities to the list of samples
-        that have been observed so far.
+    samples : Dict[int -> ndarray]
+        A dictionary that maps from target identities to the samples that
+        have been observed so far, oldest first.
 
     """
 
     def __init__(self, metric, matching_threshold, budget=None):
 
 
-        if metric == "euclidean":
-            self._metric = _nn_euclidean_distance
-        elif metric == "cosine":
-            self._metric = _nn_cosine_distance
-        else:
+        if metric not in ("euclidean", "cosine"):
             raise ValueError(
                 "Invalid metric; must be either 'euclidean' or 'cosine'")
+        self.metric = metric
         self.matching_threshold = matching_threshold
         self.budget = budget
-        self.samples = {}
+
+        self._rows = {}  # target -> gallery row
+        self._free = []
+        self._gallery = None  # (rows, samples, dim)
+        self._sq_norms = None  # (rows, samples), squared norms for the euclidean metric
+        self._count = np.zeros(0, dtype=np.int64)  # valid samples per row
+        self._head = np.zeros(0, dtype=np.int64)  # next ring position per row
+
+    def _allocate(self, num_rows, num_samples, dim, dtype):
+        """Grow the gallery to at least num_rows rows of num_samples samples"""
+        if self._gallery is None:
+            self._gallery = np.zeros((0, num_samples, dim), dtype=dtype)
+            self._sq_norms = np.zeros((0, num_samples), dtype=dtype)
+        rows, samples, _ = self._gallery.shape
+        if num_samples > samples:
+            # only without budget: the samples of every row are in its first count positions,
+            # a full row had its head wrapped to 0 and continues after them now
+            self._head = self._count.copy()
+            self._gallery = np.concatenate([self._gallery, np.zeros(
+                (rows, num_samples - samples, dim), dtype=dtype)], axis=1)
+            self._sq_norms = np.concatenate([self._sq_norms, np.zeros(
+                (rows, num_samples - samples), dtype=dtype)], axis=1)
+            samples = num_samples
+        if num_rows > rows:
+            extra = max(num_rows, 2 * rows) - rows
+            self._gallery = np.concatenate([self._gallery, np.zeros(
+                (extra, samples, dim), dtype=self._gallery.dtype)])
+            self._sq_norms = np.concatenate([self._sq_norms, np.zeros(
+                (extra, samples), dtype=self._sq_norms.dtype)])
+            self._count = np.concatenate([self._count, np.zeros(extra, dtype=np.int64)])
+            self._head = np.concatenate([self._head, np.zeros(extra, dtype=np.int64)])
+            self._free.extend(range(rows + extra - 1, rows - 1, -1))
+
+    def _row(self, target):
+        row = self._rows.get(target)
+        if row is None:
+            if not self._free:
+                self._allocate(len(self._rows) + 1, self._gallery.shape[1],
+                               self._gallery.shape[2], self._gallery.dtype)
+            row = self._free.pop()
+            self._rows[target] = row
+            self._count[row] = 0
+            self._head[row] = 0
+        return row
+
+    def _release(self, target):
+        row = self._rows.pop(target)
+        self._count[row] = 0
+        self._free.append(row)
+
+    @property
+    def samples(self):
+        samples = {}
+        size = self._gallery.shape[1] if self._gallery is not None else 0
+        for target, row in self._rows.items():
+            order = (self._head[row] - self._count[row] + np.arange(self._count[row])) % size
+            samples[target] = self._gallery[row, order]
+        return samples
 
     def partial_fit(self, features, targets, active_targets):
         """Update the distance metric with new data.
@@ -147,11 +112,40 @@ class NearestNeighborDistanceMetric(object):
             A list of targets that are currently present in the scene.
 
         """
-        for feature, target in zip(features, targets):
-            self.samples.setdefault(target, []).append(feature)
+        features = np.asarray(features)
+        targets = np.asarray(targets)
+        if len(features):
+            if self.metric == "cosine":
+                features = features / np.linalg.norm(features, axis=1, keepdims=True)
+            uniq, inverse, counts = np.unique(
+                targets, return_inverse=True, return_counts=True)
+            # position of every feature among the new features of its target
+            order = np.argsort(inverse, kind='stable')
+            rank = np.empty(len(targets), dtype=np.int64)
+            rank[order] = np.arange(len(targets)) - np.repeat(np.cumsum(counts) - counts, counts)
             if self.budget is not None:
-                self.samples[target] = self.samples[target][-self.budget:]
-        self.samples = {k: self.samples[k] for k in active_targets}
+                size = self.budget
+            else:
+                size = max(1, self._gallery.shape[1] if self._gallery is not None else 0)
+                needed = max(self._count[self._rows[t]] if t in self._rows else 0
+                             for t in uniq) + counts.max()
+                while size < needed:
+                    size *= 2
+            self._allocate(0, size, features.shape[1], features.dtype)
+            rows = np.array([self._row(t) for t in uniq], dtype=np.int64)
+
+            # the ring keeps only the last `size` samples of every target
+            keep = rank >= counts[inverse] - size
+            feature_rows = rows[inverse[keep]]
+            pos = (self._head[feature_rows] + rank[keep]) % size
+            self._gallery[feature_rows, pos] = features[keep]
+            self._sq_norms[feature_rows, pos] = np.square(features[keep]).sum(axis=1)
+            self._head[rows] = (self._head[rows] + counts) % size
+            self._count[rows] = np.minimum(self._count[rows] + counts, size)
+
+        active_targets = set(active_targets)
+        for target in [t for t in self._rows if t not in active_targets]:
+            self._release(target)
 
     def distance(self, features, targets):
         """Compute distance between features and targets.
@@ -171,7 +165,29 @@ class NearestNeighborDistanceMetric(object):
             `targets[i]` and `features[j]`.
 
         """
-        cost_matrix = np.zeros((len(targets), len(features)))
-        for i, target in enumerate(targets):
-            cost_matrix[i, :] = self._metric(self.samples[target], features)
-        return cost_matrix
+        if len(targets) == 0 or len(features) == 0:
+            return np.zeros((len(targets), len(features)))
+        features = np.asarray(features)
+        rows = np.array([self._rows[t] for t in targets], dtype=np.int64)
+        # every row holds its samples in the first count positions of the ring
+        count = self._count[rows]
+        num_samples = max(1, count.max())
+        gallery = self._gallery[rows, :num_samples]
+        num_targets, _, dim = gallery.shape
+
+        if self.metric == "cosine":
+            features = features / np.linalg.norm(features, axis=1, keepdims=True)
+            distances = 1. - np.dot(gallery.reshape(-1, dim), features.T)
+        else:
+            b2 = np.square(features).sum(axis=1)
+            distances = -2. * np.dot(gallery.reshape(-1, dim), features.T) + \
+                self._sq_norms[rows, :num_samples].reshape(-1, 1) + b2[None, :]
+            distances = np.clip(distances, 0., float(np.inf))
+        distances = distances.reshape(num_targets, num_samples, len(features))
+
+        invalid = np.arange(num_samples)[None, :] >= count[:, None]
+        distances[invalid] = np.inf
+        cost_matrix = distances.min(axis=1)
+        if self.metric == "euclidean":
+            cost_matrix = np.maximum(0.0, cost_matrix)
+        return cost_matrix.astype(np.float64)
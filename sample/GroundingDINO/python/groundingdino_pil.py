@@ -1,5 +1,6 @@
 import argparse
 import os
+import collections
 import numpy as np
 from transformers import BertTokenizerFast
 from PostProcess import PostProcess
@@ -68,14 +69,15 @@ class GroundingDINO():
         self.mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
         self.std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
 
+        # proposals is a constant of the input size, generate it once
+        self.proposals = gen_encoder_output_proposals()
+
+        # caption -> (text inputs, postprocess), the text branch is only prepared once for a fixed prompt
+        self.caption_cache = collections.OrderedDict()
+        self.caption_cache_size = 16
+
         # init postprocess
-        self.postprocess = PostProcess(
-            caption = self.text_prompt,
-            token_spans = eval(f"{self.token_spans}"),
-            tokenizer = self.tokenizer, 
-            box_threshold = self.box_threshold, 
-            text_threshold = self.text_threshold
-        )
+        self.postprocess = self.caption_inputs(self.tokenizer, self.text_prompt)[1]
 
         # init time
         self.preprocess_time = 0.0
@@ -101,11 +103,13 @@ class GroundingDINO():
     def decode(self, img_path):
         self.img = Image.open(img_path)
     
-    def preprocess(self, tokenizer, captions):
-        self.image_pil, samples = load_image(self.img)
-        samples = samples[None, :, :, :]
+    def caption_inputs(self, tokenizer, caption):
+        entry = self.caption_cache.get(caption)
+        if entry is not None:
+            self.caption_cache.move_to_end(caption)
+            return entry
 
-        captions = captions.lower().strip()
+        captions = caption.lower().strip()
         if not captions.endswith("."):
             captions += "."
 
@@ -127,17 +131,36 @@ class GroundingDINO():
         # Extract relevant information
         text_token_mask = tokenized["attention_mask"].astype(bool)
         input_ids, token_type_ids, attention_mask = tokenized["input_ids"], tokenized["token_type_ids"], text_self_attention_masks
-        proposals = gen_encoder_output_proposals()
 
-        # Convert tensors to numpy arrays
-        data = [samples, position_ids,
+        text_data = [position_ids,
             text_self_attention_masks,
             input_ids,
             token_type_ids,
             attention_mask,
-            text_token_mask,
-            proposals
+            text_token_mask
         ]
+        postprocess = PostProcess(
+            caption = caption,
+            token_spans = eval(f"{self.token_spans}"),
+            tokenizer = tokenizer,
+            box_threshold = self.box_threshold,
+            text_threshold = self.text_threshold
+        )
+
+        entry = (text_data, postprocess)
+        self.caption_cache[caption] = entry
+        if len(self.caption_cache) > self.caption_cache_size:
+            self.caption_cache.popitem(last=False)
+        return entry
+
+    def preprocess(self, tokenizer, captions):
+        self.image_pil, samples = load_image(self.img)
+        samples = samples[None, :, :, :]
+
+        # the text inputs and the positive maps only depend on the caption
+        text_data, self.postprocess = self.caption_inputs(tokenizer, captions)
+
+        data = [samples] + text_data + [self.proposals]
 
         return data
 
@@ -165,51 +188,66 @@ def main(args):
 
     groundingdino.init()
 
-    # decode
-    decode_start = time.time()
-    groundingdino.decode(args.image_path)
-    decode_time = time.time() - decode_start
-
-    # preprocess
-    preprocess_start = time.time()
-    data = groundingdino.preprocess(groundingdino.tokenizer, groundingdino.text_prompt)
-    preprocess_time = time.time() - preprocess_start
-
-    # visualize raw image
-    groundingdino.image_pil.save(os.path.join(args.output_dir, "raw_image.jpg"))
-    
-    # Inference
-    inference_start = time.time()
-    output = groundingdino(data)
-    inference_time = time.time() - inference_start
-
-    # PostProcess
-    postprocess_start = time.time()
-    boxes_filt, pred_phrases = groundingdino.postprocess(output)
-    postprocess_time = time.time() - postprocess_start
-
-    # visualize pred
-    pred_dict = {
-        "boxes": boxes_filt,
-        "labels": pred_phrases,
-    }
-
-    # PIL format
-    image_with_box = plot_boxes_to_image(groundingdino.image_pil, pred_dict)[0]
-    image_with_box.save(os.path.join(groundingdino.output_dir, "pred_bmodel_new.jpg"))
+    if os.path.isdir(args.image_path):
+        image_paths = [os.path.join(args.image_path, fname) for fname in sorted(os.listdir(args.image_path))
+                       if fname.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.webp'))]
+    else:
+        image_paths = [args.image_path]
+
+    decode_time = 0.0
+    for img_path in image_paths:
+        # decode
+        decode_start = time.time()
+        groundingdino.decode(img_path)
+        decode_time += time.time() - decode_start
+
+        # preprocess
+        preprocess_start = time.time()
+        data = groundingdino.preprocess(groundingdino.tokenizer, groundingdino.text_prompt)
+        preprocess_time = time.time() - preprocess_start
+        groundingdino.preprocess_time += preprocess_time
+
+        # visualize raw image
+        if len(image_paths) == 1:
+            groundingdino.image_pil.save(os.path.join(args.output_dir, "raw_image.jpg"))
+
+        # Inference
+        inference_start = time.time()
+        output = groundingdino(data)
+        groundingdino.inference_time += time.time() - inference_start
+
+        # PostProcess
+        postprocess_start = time.time()
+        boxes_filt, pred_phrases = groundingdino.postprocess(output)
+        groundingdino.postprocess_time += time.time() - postprocess_start
+
+        # visualize pred
+        pred_dict = {
+            "boxes": boxes_filt,
+            "labels": pred_phrases,
+        }
+
+        # PIL format
+        image_with_box = plot_boxes_to_image(groundingdino.image_pil, pred_dict)[0]
+        save_name = "pred_bmodel_new.jpg" if len(image_paths) == 1 else os.path.basename(img_path)
+        image_with_box.save(os.path.join(groundingdino.output_dir, save_name))
+        logging.info("{}: {} boxes, preprocess_time(ms): {:.2f}".format(img_path, len(pred_phrases), preprocess_time * 1000))
     print("Image was save in {}".format(groundingdino.output_dir))
-    
-    logging.info("decode_time(ms): {:.2f}".format(decode_time * 1000))
-    logging.info("preprocess_time(ms): {:.2f}".format(preprocess_time * 1000))
-    logging.info("inference_time(ms): {:.2f}".format(inference_time * 1000))
-    logging.info("postprocess_time(ms): {:.2f}".format(postprocess_time * 1000))
+
+    # the caption is prepared once, the following frames only pay the image preprocessing
+    image_num = max(len(image_paths), 1)
+    logging.info("------------------ Image num {}, average time ----------------------".format(len(image_paths)))
+    logging.info("decode_time(ms): {:.2f}".format(decode_time / image_num * 1000))
+    logging.info("preprocess_time(ms): {:.2f}".format(groundingdino.preprocess_time / image_num * 1000))
+    logging.info("inference_time(ms): {:.2f}".format(groundingdino.inference_time / image_num * 1000))
+    logging.info("postprocess_time(ms): {:.2f}".format(groundingdino.postprocess_time / image_num * 1000))
 
 def argsparser():
     parser = argparse.ArgumentParser("Grounding DINO", add_help=True)
     parser.add_argument(
         "--bmodel", "-p", type=str, required=False, default="../models/BM1684X/groundingdino_bm1684x_fp16.bmodel",help="path to checkpoint file"
     )
-    parser.add_argument("--image_path", "-i", type=str, default="../datasets/test/zidane.jpg", help="path to image file")
+    parser.add_argument("--image_path", "-i", type=str, default="../datasets/test/zidane.jpg", help="path to image file or image directory")
     parser.add_argument("--text_prompt", "-t", type=str, default="person", help="text prompt")
     parser.add_argument(
         "--output_dir", "-o", type=str, default="./results", required=False, help="output directory"
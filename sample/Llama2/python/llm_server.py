@@ -0,0 +1,353 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+"""
+OpenAI compatible http server sharing one LLM runner between several conversations.
+
+The bmodels are compiled with batch size 1, so the conversations are not batched inside one
+forward pass. Instead every conversation owns a kv cache slot and the scheduler thread
+time-slices the device between them: a new request is prefilled as soon as a slot is free,
+then every active conversation gets one forward_next step per round. A long answer no longer
+blocks the other users until it is finished.
+
+A runner (Qwen1_5, Qwen, ChatGLM3, Llama_sophon, Baichuan2) provides:
+    SEQLEN or MAX_LEN, EOS, token_length, past_key_output, past_value_output,
+    forward_first(tokens), forward_next(),
+    new_kv_cache(): (past_key_output, past_value_output) lists for one more conversation,
+    set_next_token(token): make forward_next continue from token,
+    encode_messages(messages): prompt tokens of a list of {"role", "content"} dicts,
+    decode_tokens(tokens): text of the generated tokens.
+
+The server has no authentication and listens on 127.0.0.1 by default. Each LLM sample keeps an
+identical copy of this file.
+"""
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+logging.basicConfig(level=logging.INFO)
+
+STOP = object()
+
+
+class Session:
+    """
+    One chat completion request and the state needed to resume its decoding.
+    chunks receives the new text pieces and None once the session is finished.
+    """
+    def __init__(self, messages, tokens, max_tokens):
+        self.id = 'chatcmpl-' + uuid.uuid4().hex
+        self.messages = messages
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.output = []
+        self.text = ''
+        self.slot = None
+        self.token = None
+        self.token_length = 0
+        self.chunks = queue.Queue()
+        self.cancelled = False
+        self.finish_reason = None
+        self.error = None
+        self.submit_time = time.time()
+        self.start_time = None
+        self.first_token_time = None
+        self.finish_time = None
+
+    @property
+    def first_token_latency(self):
+        """
+        seconds from the submission to the first token, including the time spent in the queue
+        """
+        if self.first_token_time is None:
+            return None
+        return self.first_token_time - self.submit_time
+
+    @property
+    def tokens_per_second(self):
+        """
+        decoding speed after the first token, like the TPS printed by chat_stream
+        """
+        if self.finish_time is None or len(self.output) < 2:
+            return 0.0
+        duration = self.finish_time - self.first_token_time
+        return (len(self.output) - 1) / duration if duration > 0 else 0.0
+
+    def usage(self):
+        return {"prompt_tokens": len(self.tokens),
+                "completion_tokens": len(self.output),
+                "total_tokens": len(self.tokens) + len(self.output),
+                "first_token_latency": self.first_token_latency,
+                "tokens_per_second": self.tokens_per_second}
+
+
+class Scheduler:
+    """
+    Owns the runner: all the forward passes and the tokenizer calls of the decoding run in
+    one thread. max_sessions kv cache slots are allocated up front, the first one is the
+    cache the runner was created with.
+    """
+    def __init__(self, runner, max_sessions=4):
+        self.runner = runner
+        self.seqlen = getattr(runner, 'SEQLEN', None) or runner.MAX_LEN
+        self.free_slots = [(runner.past_key_output, runner.past_value_output)]
+        if hasattr(runner, 'prefix_cache'):
+            # the sessions overwrite the kv cache the runner was created with
+            runner.prefix_cache.clear()
+        for _ in range(max_sessions - 1):
+            self.free_slots.append(runner.new_kv_cache())
+        self.max_sessions = max_sessions
+        self.requests = queue.Queue()
+        self.active = collections.deque()
+        self.bound = None
+        self.tokenizer_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='llm_scheduler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.requests.put(STOP)
+        self._thread.join()
+
+    def encode(self, messages):
+        """
+        Tokenize the conversation, dropping the oldest messages while it takes more than half
+        of the sequence length like chat_stream does. Raises ValueError if the last message
+        alone is too long.
+        """
+        with self.tokenizer_lock:
+            if len(self.runner.encode_messages(messages[-1:])) > self.seqlen / 3:
+                raise ValueError('input length is too long')
+            tokens = self.runner.encode_messages(messages)
+            while len(tokens) > self.seqlen / 2 and len(messages) > 1:
+                messages = messages[1:]
+                tokens = self.runner.encode_messages(messages)
+        return tokens
+
+    def submit(self, messages, max_tokens=None):
+        """
+        Queue a conversation, called from the http threads. Returns the Session to read from.
+        """
+        tokens = self.encode(messages)
+        session = Session(messages, tokens, max_tokens or self.seqlen)
+        self.requests.put(session)
+        return session
+
+    def cancel(self, session):
+        # the client went away, the scheduler frees the slot at its next round
+        session.cancelled = True
+
+    def _run(self):
+        while True:
+            session = None
+            if self.free_slots:
+                try:
+                    # only wait for a request when there is nothing to decode
+                    session = self.requests.get(block=not self.active)
+                except queue.Empty:
+                    pass
+            if session is STOP:
+                break
+            if session is not None:
+                self._prefill(session)
+            for session in list(self.active):
+                self._step(session)
+
+    def _bind(self, session):
+        # point the runner at the kv cache and the position of this conversation
+        if self.bound is session:
+            return
+        self.runner.past_key_output, self.runner.past_value_output = session.slot
+        self.runner.token_length = session.token_length
+        if session.token is not None:
+            self.runner.set_next_token(session.token)
+        self.bound = session
+
+    def _prefill(self, session):
+        if session.cancelled:
+            self._finish(session, 'cancelled')
+            return
+        session.slot = self.free_slots.pop()
+        self.active.append(session)
+        session.start_time = time.time()
+        try:
+            self._bind(session)
+            token = self.runner.forward_first(session.tokens)
+        except Exception as e:
+            logging.error("session {} prefill failed: {}".format(session.id, e))
+            session.error = str(e)
+            self._finish(session, 'error')
+            return
+        session.first_token_time = time.time()
+        session.token_length = self.runner.token_length
+        self._emit(session, token)
+
+    def _step(self, session):
+        if session.cancelled:
+            self._finish(session, 'cancelled')
+            return
+        try:
+            self._bind(session)
+            self.runner.token_length += 1
+            token = self.runner.forward_next()
+        except Exception as e:
+            logging.error("session {} decode failed: {}".format(session.id, e))
+            session.error = str(e)
+            self._finish(session, 'error')
+            return
+        session.token_length = self.runner.token_length
+        self._emit(session, token)
+
+    def _emit(self, session, token):
+        if token == self.runner.EOS:
+            self._finish(session, 'stop')
+            return
+        session.output.append(token)
+        session.token = token
+        with self.tokenizer_lock:
+            text = self.runner.decode_tokens(session.output)
+        # hold back incomplete utf-8 sequences (emoji, chinese split over several tokens)
+        if not text.endswith('�') and len(text) > len(session.text):
+            session.chunks.put(text[len(session.text):])
+            session.text = text
+        if len(session.output) >= session.max_tokens or session.token_length >= self.seqlen:
+            self._finish(session, 'length')
+
+    def _finish(self, session, reason):
+        session.finish_reason = reason
+        session.finish_time = time.time()
+        if session.slot is not None:
+            self.active.remove(session)
+            self.free_slots.append(session.slot)
+            session.slot = None
+        if self.bound is session:
+            self.bound = None
+        session.chunks.put(None)
+        if session.first_token_time is not None:
+            logging.info("{}: {} prompt tokens, {} completion tokens, finish: {}, FTL: {:.3f} s, TPS: {:.3f} token/s".format(
+                session.id, len(session.tokens), len(session.output), reason,
+                session.first_token_latency, session.tokens_per_second))
+
+
+class LLMRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /v1/chat/completions with {"messages": [...], "stream": bool, "max_tokens": int},
+    GET /v1/models. Sampling parameters are ignored, the bmodels decode greedily.
+    """
+    def do_GET(self):
+        if self.path.rstrip('/') != '/v1/models':
+            self.send_json({"error": {"message": "not found"}}, 404)
+            return
+        self.send_json({"object": "list",
+                        "data": [{"id": self.server.model_name, "object": "model", "owned_by": "sophgo"}]})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/v1/chat/completions':
+            self.send_json({"error": {"message": "not found"}}, 404)
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            messages = [{"role": m["role"], "content": m["content"]} for m in body["messages"]]
+            if not messages:
+                raise ValueError('messages is empty')
+            session = self.server.scheduler.submit(messages, body.get("max_tokens"))
+        except KeyError as e:
+            self.send_json({"error": {"message": "missing field {}".format(e), "type": "invalid_request_error"}}, 400)
+            return
+        except (ValueError, TypeError) as e:
+            self.send_json({"error": {"message": str(e), "type": "invalid_request_error"}}, 400)
+            return
+        try:
+            if body.get("stream"):
+                self.stream(session)
+            else:
+                self.complete(session)
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.scheduler.cancel(session)
+
+    def complete(self, session):
+        while session.chunks.get() is not None:
+            pass
+        if session.finish_reason == 'error':
+            self.send_json({"error": {"message": session.error, "type": "server_error"}}, 500)
+            return
+        self.send_json({"id": session.id,
+                        "object": "chat.completion",
+                        "created": int(session.submit_time),
+                        "model": self.server.model_name,
+                        "choices": [{"index": 0,
+                                     "message": {"role": "assistant", "content": session.text},
+                                     "finish_reason": session.finish_reason}],
+                        "usage": session.usage()})
+
+    def stream(self, session):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        def send_chunk(delta, finish_reason=None, **extra):
+            chunk = {"id": session.id,
+                     "object": "chat.completion.chunk",
+                     "created": int(session.submit_time),
+                     "model": self.server.model_name,
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            chunk.update(extra)
+            self.wfile.write('data: {}\n\n'.format(json.dumps(chunk, ensure_ascii=False)).encode('utf-8'))
+            self.wfile.flush()
+
+        send_chunk({"role": "assistant"})
+        while True:
+            text = session.chunks.get()
+            if text is None:
+                break
+            send_chunk({"content": text})
+        send_chunk({}, session.finish_reason, usage=session.usage())
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+
+    def send_json(self, obj, code=200):
+        data = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+def make_server(runner, host='127.0.0.1', port=8000, max_sessions=4, model_name='sophon-llm'):
+    """
+    Returns a ThreadingHTTPServer whose scheduler is already running, call serve_forever on it.
+    """
+    server = ThreadingHTTPServer((host, port), LLMRequestHandler)
+    server.daemon_threads = True
+    server.model_name = model_name
+    server.scheduler = Scheduler(runner, max_sessions).start()
+    return server
+
+
+def serve(runner, host='127.0.0.1', port=8000, max_sessions=4, model_name='sophon-llm'):
+    server = make_server(runner, host, port, max_sessions, model_name)
+    logging.info("serving {} on http://{}:{}/v1/chat/completions with {} kv cache slots".format(
+        model_name, host, server.server_address[1], max_sessions))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.scheduler.stop()
@@ -0,0 +1,100 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+# Each LLM sample keeping its kv cache from position 0 has an identical copy of this file.
+import time
+import functools
+import numpy as np
+
+
+class PrefixCache:
+    """
+    Tracks the tokens whose key/value are held in the kv cache of a runner, so that the next turn
+    of a conversation only runs the tokens after the prefix it shares with the cache.
+
+    The bmodels have no graph prefilling several tokens on top of a kv cache, so the new tokens go
+    through forward_next one by one, while forward_first always runs the SEQLEN positions. The
+    suffix is used while len(suffix) * forward_next time < forward_first time, both measured on
+    the previous calls. Otherwise, and when the history was truncated, the whole prompt is
+    prefilled again.
+
+    Only for runners writing the kv cache from position 0 (Qwen1_5, Qwen, Llama2, Baichuan2),
+    the runner must provide set_next_token.
+    """
+    def __init__(self, runner):
+        self.runner = runner
+        self.tokens = []
+        self.first_time = None
+        self.next_time = None
+        self.reused = 0
+
+    def common_prefix(self, tokens):
+        # keep at least the last prompt token to run, its output is the first answer token
+        limit = min(len(self.tokens), len(tokens) - 1)
+        if limit <= 0:
+            return 0
+        diff = np.flatnonzero(np.asarray(self.tokens[:limit]) != np.asarray(tokens[:limit]))
+        return int(diff[0]) if diff.size else limit
+
+    def forward_first(self, tokens):
+        """
+        Replaces runner.forward_first(tokens): returns the first answer token and leaves
+        runner.token_length at len(tokens).
+        """
+        common = self.common_prefix(tokens)
+        suffix = tokens[common:]
+        if common and self.next_time is not None and len(suffix) * self.next_time < self.first_time:
+            self.reused = common
+            del self.tokens[common:]
+            self.runner.token_length = common
+            for token in suffix:
+                self.runner.set_next_token(token)
+                output = self.forward_next(token)
+            return output
+        self.reused = 0
+        start_time = time.time()
+        output = self.runner.forward_first(tokens)
+        self.first_time = time.time() - start_time
+        self.tokens = list(tokens)
+        return output
+
+    def forward_next(self, token):
+        """
+        Replaces `runner.token_length += 1; runner.forward_next()`, token is the one being fed,
+        the last output of the runner or the one given to set_next_token.
+        """
+        self.runner.token_length += 1
+        start_time = time.time()
+        output = self.runner.forward_next()
+        elapsed = time.time() - start_time
+        self.next_time = elapsed if self.next_time is None else 0.9 * self.next_time + 0.1 * elapsed
+        self.tokens.append(token)
+        return output
+
+    def clear(self):
+        # the kv cache was overwritten by someone else
+        self.tokens = []
+
+
+class SegmentTokenizer:
+    """
+    Tokenizes a rendered chat prompt turn by turn with a cache, so the unchanged turns of the
+    history are not tokenized again at every question. The text is split right before every
+    separator, a special token of the tokenizer, so no token spans two segments and the ids are
+    the ones of the whole text.
+    """
+    def __init__(self, encode, separator, maxsize=1024):
+        self.separator = separator
+        self._encode = functools.lru_cache(maxsize=maxsize)(lambda text: tuple(encode(text)))
+
+    def __call__(self, text):
+        pieces = text.split(self.separator)
+        ids = list(self._encode(pieces[0])) if pieces[0] else []
+        for piece in pieces[1:]:
+            ids.extend(self._encode(self.separator + piece))
+        return ids
@@ -123,115 +123,156 @@ class Pose(object):
                 all_peaks.append(peaks_with_score_and_id)
                 peak_counter += len(peaks)
             
-            connection_all = []
-            special_k = []
-            mid_num = 10
-            
-            for k in range(len(self.mapIdx)):
-                score_mid = output[:, :, [x for x in self.mapIdx[k]]]
-                candA = all_peaks[self.POSE_PAIRS[k][0]]
-                candB = all_peaks[self.POSE_PAIRS[k][1]]
-                nA = len(candA)
-                nB = len(candB)
-                indexA, indexB = np.array(self.POSE_PAIRS[k]) + 1
-                if (nA != 0 and nB != 0):
-                    connection_candidate = []
-                    for i in range(nA):
-                        for j in range(nB):
-                            vec = np.subtract(candB[j][:2], candA[i][:2])
-                            norm = math.sqrt(vec[0] * vec[0] + vec[1] * vec[1])
-                            norm = max(0.001, norm)
-                            vec = np.divide(vec, norm)
+            connection_all, special_k = self.connect_limbs(output, all_peaks, ori_img.shape[0])
 
-                            startend = list(zip(np.linspace(candA[i][0], candB[j][0], num=mid_num), \
-                                                np.linspace(candA[i][1], candB[j][1], num=mid_num)))
+            candidate = np.array([item for sublist in all_peaks for item in sublist])
+            # last number in each row is the total parts number of that person
+            # the second last number in each row is the score of the overall configuration
+            subset = self.assemble_persons(connection_all, special_k, candidate)
 
-                            vec_x = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 0] \
-                                            for I in range(len(startend))])
-                            vec_y = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 1] \
-                                            for I in range(len(startend))])
+            # delete some rows of subset which has few parts occur
+            subset = subset[~((subset[:, -1] < 4) | (subset[:, -2] / subset[:, -1] < 0.4))]
 
-                            score_midpts = np.multiply(vec_x, vec[0]) + np.multiply(vec_y, vec[1])
-                            score_with_dist_prior = sum(score_midpts) / len(score_midpts) + min(
-                                0.5 * ori_img.shape[0] / norm - 1, 0)
-                            criterion1 = len(np.nonzero(score_midpts > self.thre2)[0]) > 0.8 * len(score_midpts)
-                            criterion2 = score_with_dist_prior > 0
-                            if criterion1 and criterion2:
-                                connection_candidate.append(
-                                    [i, j, score_with_dist_prior, score_with_dist_prior + candA[i][2] + candB[j][2]])
+            # subset: n*20 array, 0-17 is the index in candidate, 18 is the total score, 19 is the total parts
+            # candidate: x, y, score, id
+            results.append((candidate, subset))    
 
-                    connection_candidate = sorted(connection_candidate, key=lambda x: x[2], reverse=True)
-                    connection = np.zeros((0, 5))
-                    for c in range(len(connection_candidate)):
-                        i, j, s = connection_candidate[c][0:3]
-                        if (i not in connection[:, 3] and j not in connection[:, 4]):
-                            connection = np.vstack([connection, [candA[i][3], candB[j][3], s, i, j]])
-                            if (len(connection) >= min(nA, nB)):
-                                break
+        return results
 
-                    connection_all.append(connection)
-                else:
-                    special_k.append(k)
-                    connection_all.append([])
+    def connect_limbs(self, output, all_peaks, img_h, mid_num=10):
+        """
+        Score every (partA, partB) candidate pair of a limb type at once on its PAF, then pair them greedily.
 
-            # last number in each row is the total parts number of that person
-            # the second last number in each row is the score of the overall configuration
-            subset = -1 * np.ones((0, self.point_num + 2))
-            candidate = np.array([item for sublist in all_peaks for item in sublist])
+        Returns:
+            connection_all: per limb type, [n, 5] array of (peak id A, peak id B, score, i, j), [] if a part has no peak.
+            special_k: limb types without candidates.
+        """
+        connection_all = []
+        special_k = []
+        steps = np.arange(mid_num)
+        for k in range(len(self.mapIdx)):
+            candA = all_peaks[self.POSE_PAIRS[k][0]]
+            candB = all_peaks[self.POSE_PAIRS[k][1]]
+            nA = len(candA)
+            nB = len(candB)
+            if nA == 0 or nB == 0:
+                special_k.append(k)
+                connection_all.append([])
+                continue
+            A = np.array([c[:2] for c in candA], dtype=np.int64)
+            B = np.array([c[:2] for c in candB], dtype=np.int64)
+            # all pairs, i major
+            vec = (B[None, :, :] - A[:, None, :]).reshape(-1, 2)
+            start = np.repeat(A, nB, axis=0).astype(np.float64)
+            stop = np.tile(B, (nA, 1)).astype(np.float64)
+            norm = np.maximum(0.001, np.sqrt(vec[:, 0] * vec[:, 0] + vec[:, 1] * vec[:, 1]))
+            unit = vec / norm[:, None]
 
-            for k in range(len(self.mapIdx)):
-                if k not in special_k:
-                    partAs = connection_all[k][:, 0]
-                    partBs = connection_all[k][:, 1]
-                    indexA, indexB = self.POSE_PAIRS[k]
+            # mid_num points from A to B, the same values as np.linspace for every pair
+            points = steps[None, :, None] * ((stop - start) / (mid_num - 1))[:, None, :] + start[:, None, :]
+            points[:, -1] = stop
+            points = np.rint(points).astype(np.int64)
+            vec_x = output[points[..., 1], points[..., 0], self.mapIdx[k][0]]
+            vec_y = output[points[..., 1], points[..., 0], self.mapIdx[k][1]]
+            # the type of the PAF values times a float64 scalar, as in the per pair loop
+            unit = unit.astype(np.result_type(output, unit[0, 0]))
+            score_midpts = vec_x * unit[:, 0:1] + vec_y * unit[:, 1:2]
 
-                    for i in range(len(connection_all[k])):  # = 1:size(temp,1)
-                        found = 0
-                        subset_idx = [-1, -1]
-                        for j in range(len(subset)):  # 1:size(subset,1):
-                            if subset[j][indexA] == partAs[i] or subset[j][indexB] == partBs[i]:
-                                subset_idx[found] = j
-                                found += 1
+            # summed point by point in float64 like sum() of the per pair loop
+            score_sum = np.zeros(len(vec), dtype=np.float64)
+            for t in range(mid_num):
+                score_sum += score_midpts[:, t]
+            score_with_dist_prior = score_sum / mid_num + np.minimum(0.5 * img_h / norm - 1, 0)
+            criterion1 = np.count_nonzero(score_midpts > self.thre2, axis=1) > 0.8 * mid_num
+            criterion2 = score_with_dist_prior > 0
+            valid = np.nonzero(criterion1 & criterion2)[0]
 
-                        if found == 1:
-                            j = subset_idx[0]
-                            if subset[j][indexB] != partBs[i]:
-                                subset[j][indexB] = partBs[i]
-                                subset[j][-1] += 1
-                                subset[j][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
-                        elif found == 2:  # if found 2 and disjoint, merge them
-                            j1, j2 = subset_idx
-                            membership = ((subset[j1] >= 0).astype(int) + (subset[j2] >= 0).astype(int))[:-2]
-                            if len(np.nonzero(membership == 2)[0]) == 0:  # merge
-                                subset[j1][:-2] += (subset[j2][:-2] + 1)
-                                subset[j1][-2:] += subset[j2][-2:]
-                                subset[j1][-2] += connection_all[k][i][2]
-                                subset = np.delete(subset, j2, 0)
-                            else:  # as like found == 1
-                                subset[j1][indexB] = partBs[i]
-                                subset[j1][-1] += 1
-                                subset[j1][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
+            # greedy: highest score first, every peak used once
+            order = valid[np.argsort(-score_with_dist_prior[valid], kind='stable')]
+            usedA = np.zeros(nA, dtype=bool)
+            usedB = np.zeros(nB, dtype=bool)
+            connection = []
+            for c in order:
+                i, j = divmod(int(c), nB)
+                if usedA[i] or usedB[j]:
+                    continue
+                usedA[i] = usedB[j] = True
+                connection.append([candA[i][3], candB[j][3], score_with_dist_prior[c], i, j])
+                if len(connection) >= min(nA, nB):
+                    break
+            connection_all.append(np.array(connection, dtype=np.float64).reshape(-1, 5))
+        return connection_all, special_k
 
-                        # if find no partA in the subset, create a new subset
-                        elif not found and k < self.point_num - 1:
-                            row = -1 * np.ones(self.point_num + 2)
-                            row[indexA] = partAs[i]
-                            row[indexB] = partBs[i]
-                            row[-1] = 2
-                            row[-2] = sum(candidate[connection_all[k][i, :2].astype(int), 2]) + connection_all[k][i][2]
-                            subset = np.vstack([subset, row])
-            # delete some rows of subset which has few parts occur
-            deleteIdx = []
-            for i in range(len(subset)):
-                if subset[i][-1] < 4 or subset[i][-2] / subset[i][-1] < 0.4:
-                    deleteIdx.append(i)
-            subset = np.delete(subset, deleteIdx, axis=0)
+    def assemble_persons(self, connection_all, special_k, candidate):
+        """
+        Group the limb connections into persons, the rows holding a peak are looked up in an index instead of scanning subset.
 
-            # subset: n*20 array, 0-17 is the index in candidate, 18 is the total score, 19 is the total parts
-            # candidate: x, y, score, id
-            results.append((candidate, subset))    
+        Returns:
+            subset: [n, point_num + 2] array, the peak id of every part (-1 if missing), total score, total parts.
+        """
+        rows = {}  # row key -> subset row, keys increase with creation so their order is the row order
+        peak_rows = {}  # peak id -> keys of the rows holding it
+        next_key = 0
 
-        return results
+        def link(key, peak):
+            peak_rows.setdefault(peak, set()).add(key)
+
+        def unlink(key, peak):
+            peak_rows[peak].discard(key)
+
+        for k in range(len(self.mapIdx)):
+            if k in special_k:
+                continue
+            indexA, indexB = self.POSE_PAIRS[k]
+            for i in range(len(connection_all[k])):
+                partA, partB, score = connection_all[k][i][:3]
+                # a peak id only appears in the column of its part
+                found = sorted(peak_rows.get(partA, set()) | peak_rows.get(partB, set()))
+
+                if len(found) == 1:
+                    row = rows[found[0]]
+                    if row[indexB] != partB:
+                        if row[indexB] >= 0:
+                            unlink(found[0], row[indexB])
+                        row[indexB] = partB
+                        link(found[0], partB)
+                        row[-1] += 1
+                        row[-2] += candidate[int(partB), 2] + score
+                elif len(found) >= 2:  # if found 2 and disjoint, merge them
+                    j1, j2 = found[:2]
+                    row1, row2 = rows[j1], rows[j2]
+                    membership = ((row1 >= 0).astype(int) + (row2 >= 0).astype(int))[:-2]
+                    if len(np.nonzero(membership == 2)[0]) == 0:  # merge
+                        row1[:-2] += (row2[:-2] + 1)
+                        row1[-2:] += row2[-2:]
+                        row1[-2] += score
+                        for peak in row2[:-2][row2[:-2] >= 0]:
+                            unlink(j2, peak)
+                            link(j1, peak)
+                        del rows[j2]
+                    else:  # as like found == 1
+                        if row1[indexB] >= 0:
+                            unlink(j1, row1[indexB])
+                        row1[indexB] = partB
+                        link(j1, partB)
+                        row1[-1] += 1
+                        row1[-2] += candidate[int(partB), 2] + score
+
+                # if find no partA in the subset, create a new subset
+                elif k < self.point_num - 1:
+                    row = -1 * np.ones(self.point_num + 2)
+                    row[indexA] = partA
+                    row[indexB] = partB
+                    row[-1] = 2
+                    row[-2] = sum(candidate[connection_all[k][i, :2].astype(int), 2]) + score
+                    rows[next_key] = row
+                    link(next_key, partA)
+                    link(next_key, partB)
+                    next_key += 1
+
+        if not rows:
+            return -1 * np.ones((0, self.point_num + 2))
+        return np.array([rows[key] for key in sorted(rows)])
 
     def __call__(self, img_list):
         img_num = len(img_list)
@@ -60,33 +60,34 @@ class DBPostProcess(object):
             img, contours, _ = outs[0], outs[1], outs[2]
         elif len(outs) == 2:
             contours, _ = outs[0], outs[1]
-        num_contours = min(len(contours), self.max_candidates)
-        boxes = []
-        scores = []
-        for index in range(num_contours):
-            contour = contours[index]
-            points, sside = self.get_mini_boxes(contour)
-            if sside < self.min_size:
-                continue
-            points = np.array(points)
-            if self.score_mode == "fast":
-                score = self.box_score_fast(pred, points.reshape(-1, 2))
-            else:
-                score = self.box_score_slow(pred, contour)
-            if self.box_thresh > score:
-                continue
-            box = self.unclip(points).reshape(-1, 1, 2)
-            box, sside = self.get_mini_boxes(box)
-            if sside < self.min_size + 2:
-                continue
-            box = np.array(box)
-            box[:, 0] = np.clip(
-                np.round(box[:, 0] / width * dest_width), 0, dest_width)
-            box[:, 1] = np.clip(
-                np.round(box[:, 1] / height * dest_height), 0, dest_height)
-            boxes.append(box.astype(np.int16))
-            scores.append(score)
-        return np.array(boxes, dtype=np.int16), scores
+        contours = contours[:self.max_candidates]
+        if len(contours) == 0:
+            return np.array([], dtype=np.int16), []
+        # 所有候选框的最小外接矩形一起排序, 打分
+        rects = [cv2.minAreaRect(contour) for contour in contours]
+        points = self.order_mini_boxes(np.array([cv2.boxPoints(rect) for rect in rects]))
+        sside = np.array([min(rect[1]) for rect in rects])
+        keep = np.flatnonzero(sside >= self.min_size)
+        points = points[keep]
+        if self.score_mode == "fast":
+            scores = self.box_scores_fast(pred, points)
+        else:
+            scores = np.array([self.box_score_slow(pred, contours[i]) for i in keep])
+        passed = scores >= self.box_thresh
+        points = points[passed]
+        scores = scores[passed]
+
+        rects = [cv2.minAreaRect(self.unclip(box).reshape(-1, 1, 2)) for box in points]
+        if not rects:
+            return np.array([], dtype=np.int16), []
+        keep = np.flatnonzero(np.array([min(rect[1]) for rect in rects]) >= self.min_size + 2)
+        if len(keep) == 0:
+            return np.array([], dtype=np.int16), []
+        boxes = self.order_mini_boxes(np.array([cv2.boxPoints(rects[i]) for i in keep]))
+        box_scores = scores[keep].tolist()
+        boxes[:, :, 0] = np.clip(np.round(boxes[:, :, 0] / width * dest_width), 0, dest_width)
+        boxes[:, :, 1] = np.clip(np.round(boxes[:, :, 1] / height * dest_height), 0, dest_height)
+        return boxes.astype(np.int16), box_scores
 
     def unclip(self, box):
         unclip_ratio = self.unclip_ratio
@@ -120,6 +121,49 @@ class DBPostProcess(object):
         ]
         return box, min(bounding_box[1])
 
+    def order_mini_boxes(self, points):
+        """get_mini_boxes的角点排序, points为(N, 4, 2)的cv2.boxPoints结果"""
+        points = np.take_along_axis(points, np.argsort(points[:, :, 0], axis=1, kind="stable")[:, :, None], axis=1)
+        left_down = points[:, 1, 1] > points[:, 0, 1]
+        right_down = points[:, 3, 1] > points[:, 2, 1]
+        index = np.stack([np.where(left_down, 0, 1), np.where(right_down, 2, 3),
+                          np.where(right_down, 3, 2), np.where(left_down, 1, 0)], axis=1)
+        return np.take_along_axis(points, index[:, :, None], axis=1)
+
+    def box_scores_fast(self, bitmap, boxes):
+        '''
+        box_score_fast of (N, 4, 2) boxes: the bounding boxes are computed together, the axis aligned
+        boxes (most text lines) are scored from the integral image, only the rotated ones are filled
+        '''
+        if len(boxes) == 0:
+            return np.zeros(0)
+        h, w = bitmap.shape[:2]
+        xmin = np.clip(np.floor(boxes[:, :, 0].min(axis=1)).astype(np.int32), 0, w - 1)
+        xmax = np.clip(np.ceil(boxes[:, :, 0].max(axis=1)).astype(np.int32), 0, w - 1)
+        ymin = np.clip(np.floor(boxes[:, :, 1].min(axis=1)).astype(np.int32), 0, h - 1)
+        ymax = np.clip(np.ceil(boxes[:, :, 1].max(axis=1)).astype(np.int32), 0, h - 1)
+        polys = (boxes - np.stack([xmin, ymin], axis=1)[:, None, :]).astype(np.int32)
+
+        edges = polys - np.roll(polys, -1, axis=1)
+        axis_aligned = np.all((edges[:, :, 0] == 0) | (edges[:, :, 1] == 0), axis=1)
+        # fillPoly of an axis aligned rectangle is the rectangle with its edges, clipped to the mask
+        x0 = np.maximum(polys[:, :, 0].min(axis=1), 0) + xmin
+        x1 = np.minimum(polys[:, :, 0].max(axis=1), xmax - xmin) + xmin
+        y0 = np.maximum(polys[:, :, 1].min(axis=1), 0) + ymin
+        y1 = np.minimum(polys[:, :, 1].max(axis=1), ymax - ymin) + ymin
+        x1 = np.maximum(x1, x0 - 1)
+        y1 = np.maximum(y1, y0 - 1)
+        integral = cv2.integral(np.ascontiguousarray(bitmap, dtype=np.float32), sdepth=cv2.CV_64F)
+        sums = integral[y1 + 1, x1 + 1] - integral[y0, x1 + 1] - integral[y1 + 1, x0] + integral[y0, x0]
+        areas = (x1 - x0 + 1) * (y1 - y0 + 1)
+        scores = np.where(areas > 0, sums / np.maximum(areas, 1), 0.0)
+
+        for i in np.flatnonzero(~axis_aligned):
+            mask = np.zeros((ymax[i] - ymin[i] + 1, xmax[i] - xmin[i] + 1), dtype=np.uint8)
+            cv2.fillPoly(mask, polys[i:i + 1], 1)
+            scores[i] = cv2.mean(bitmap[ymin[i]:ymax[i] + 1, xmin[i]:xmax[i] + 1], mask)[0]
+        return scores
+
     def box_score_fast(self, bitmap, _box):
         '''
         box_score_fast: use bbox mean score as the mean score
@@ -253,17 +297,25 @@ class PPOCRv2Det(object):
 
     def filter_tag_det_res(self, dt_boxes, image_shape):
         img_height, img_width = image_shape[0:2]
-        dt_boxes_new = []
-        for box in dt_boxes:
-            box = self.order_points_clockwise(box)
-            box = self.clip_det_res(box, img_height, img_width)
-            rect_width = int(np.linalg.norm(box[0] - box[1]))
-            rect_height = int(np.linalg.norm(box[0] - box[3]))
-            if rect_width <= 3 or rect_height <= 3:
-                continue
-            dt_boxes_new.append(box)
-        dt_boxes = np.array(dt_boxes_new)
-        return dt_boxes
+        if len(dt_boxes) == 0:
+            return np.array([])
+        # 所有框一起排序, 裁剪, 过滤
+        boxes = self.order_points_clockwise_batch(np.asarray(dt_boxes, dtype=np.float32))
+        boxes[:, :, 0] = np.clip(boxes[:, :, 0], 0, img_width - 1).astype(np.int32)
+        boxes[:, :, 1] = np.clip(boxes[:, :, 1], 0, img_height - 1).astype(np.int32)
+        rect_width = np.linalg.norm(boxes[:, 0] - boxes[:, 1], axis=1).astype(np.int32)
+        rect_height = np.linalg.norm(boxes[:, 0] - boxes[:, 3], axis=1).astype(np.int32)
+        boxes = boxes[(rect_width > 3) & (rect_height > 3)]
+        if len(boxes) == 0:
+            return np.array([])
+        return boxes
+
+    def order_points_clockwise_batch(self, pts):
+        """order_points_clockwise of (N, 4, 2) points"""
+        pts = np.take_along_axis(pts, np.argsort(pts[:, :, 0], axis=1, kind="stable")[:, :, None], axis=1)
+        left = np.take_along_axis(pts[:, :2], np.argsort(pts[:, :2, 1], axis=1, kind="stable")[:, :, None], axis=1)
+        right = np.take_along_axis(pts[:, 2:], np.argsort(pts[:, 2:, 1], axis=1, kind="stable")[:, :, None], axis=1)
+        return np.stack([left[:, 0], right[:, 0], right[:, 1], left[:, 1]], axis=1)
     
     def order_points_clockwise(self, pts):
         """
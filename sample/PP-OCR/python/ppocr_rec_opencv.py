@@ -16,6 +16,137 @@ import sophon.sail as sail
 import logging
 import time
 logging.basicConfig(level=logging.DEBUG)
+
+# 前缀的滚动哈希, 相同前缀的候选在每一帧合并; int64乘法溢出按2^64取模
+PREFIX_HASH_BASE = np.int64(1000003)
+
+
+class CharBigram(object):
+    """词典中出现过的字符bigram, 按prev * num_classes + cur排序保存, 用searchsorted批量查询"""
+    def __init__(self, keys, num_classes):
+        self.keys = np.unique(np.asarray(keys, dtype=np.int64))
+        self.num_classes = num_classes
+
+    @classmethod
+    def from_lexicon(cls, lexicon_path, character):
+        """词典文件每行一个词或短语, 不在字符字典中的字符被忽略"""
+        index = {c: i for i, c in enumerate(character) if i > 0}
+        keys = []
+        with open(lexicon_path, "r", encoding="utf-8") as fin:
+            for line in fin:
+                ids = [index[c] for c in line.strip("\r\n") if c in index]
+                keys.extend(a * len(character) + b for a, b in zip(ids[:-1], ids[1:]))
+        logging.info("{} char bigrams loaded from {}".format(len(set(keys)), lexicon_path))
+        return cls(keys, len(character))
+
+    def lookup(self, prev, cur):
+        """prev, cur为同形状的字符序号数组, prev < 0表示没有前一个字符; 返回bigram是否在词典中"""
+        if len(self.keys) == 0:
+            return np.zeros(np.broadcast(prev, cur).shape, dtype=bool)
+        query = prev.astype(np.int64) * self.num_classes + cur
+        pos = np.minimum(np.searchsorted(self.keys, query), len(self.keys) - 1)
+        return (self.keys[pos] == query) & (prev >= 0)
+
+
+def _log(p):
+    return np.log(np.maximum(p, 1e-30), dtype=np.float32)
+
+
+def ctc_prefix_beam_search(probs, beam_size=5, bigram=None, bigram_weight=0.0, blank=0):
+    """CTC前缀束搜索, 整个batch的所有beam一起计算
+
+    每个前缀记录以blank结尾和以字符结尾的对数概率. 每一帧只用概率最高的beam_size个非blank字符
+    扩展前缀, 扩展出的相同前缀(按前缀哈希判断)合并概率, 然后每个样本保留得分最高的beam_size个前缀.
+    bigram不为None时, 前缀每追加一个与前一字符构成词典bigram的字符, 排序得分加bigram_weight.
+
+    Args:
+        probs (np.ndarray): softmax输出, shape为(batch, T, num_classes)
+        beam_size (int): beam宽度, 同时也是每帧扩展的字符数
+        bigram (CharBigram): 字符bigram词典
+        bigram_weight (float): bigram奖励, 对数域
+
+    Returns:
+        (list, list): batch个字符序号数组, 以及每个字符被追加时所在帧的概率
+    """
+    B, T, V = probs.shape
+    K = beam_size
+    C = min(beam_size, V - 1)
+    N = K + K * C
+    rows = np.arange(B)[:, None]
+
+    tokens = np.zeros((B, K, T), dtype=np.int32)
+    confs = np.zeros((B, K, T), dtype=np.float32)
+    lengths = np.zeros((B, K), dtype=np.int64)
+    last = np.full((B, K), -1, dtype=np.int64)
+    hashes = np.zeros((B, K), dtype=np.int64)
+    bonus = np.zeros((B, K), dtype=np.float32)
+    p_b = np.full((B, K), -np.inf, dtype=np.float32)
+    p_nb = np.full((B, K), -np.inf, dtype=np.float32)
+    p_b[:, 0] = 0.0
+
+    for t in range(T):
+        # 只对用到的概率取对数
+        frame = probs[:, t].copy()
+        frame[:, blank] = -1.0
+        top = np.argpartition(-frame, C - 1, axis=1)[:, :C]
+        top_lp = _log(np.take_along_axis(frame, top, axis=1))
+        total = np.logaddexp(p_b, p_nb)
+
+        # 前缀不变: 当前帧为blank, 或重复前缀的最后一个字符
+        last_lp = np.where(last >= 0, _log(np.take_along_axis(probs[:, t], np.maximum(last, 0), axis=1)), -np.inf)
+        same_b = total + _log(probs[:, t, blank:blank + 1])
+        same_nb = p_nb + last_lp
+        # 追加字符: 与最后一个字符相同时, 中间必须有blank
+        ext_nb = np.where(top[:, None, :] == last[:, :, None], p_b[:, :, None], total[:, :, None]) + top_lp[:, None, :]
+        ext_hash = hashes[:, :, None] * PREFIX_HASH_BASE + (top[:, None, :] + 1)
+        ext_bonus = np.broadcast_to(bonus[:, :, None], (B, K, C))
+        if bigram is not None and bigram_weight:
+            ext_bonus = ext_bonus + bigram_weight * bigram.lookup(last[:, :, None], top[:, None, :])
+
+        cand_b = np.concatenate([same_b, np.full((B, K * C), -np.inf, dtype=np.float32)], axis=1)
+        cand_nb = np.concatenate([same_nb, ext_nb.reshape(B, -1)], axis=1)
+        cand_hash = np.concatenate([hashes, ext_hash.reshape(B, -1)], axis=1)
+        cand_bonus = np.concatenate([bonus, ext_bonus.reshape(B, -1)], axis=1)
+        cand_total = np.logaddexp(cand_b, cand_nb)
+
+        # 合并相同前缀: 按(哈希, 得分降序)排序, 每组第一个候选作为代表, 概率为组内之和
+        order = np.lexsort((-cand_total, cand_hash), axis=1)
+        sorted_hash = np.take_along_axis(cand_hash, order, axis=1)
+        first = np.ones((B, N), dtype=bool)
+        first[:, 1:] = sorted_hash[:, 1:] != sorted_hash[:, :-1]
+        starts = np.flatnonzero(first)
+        merged_b = np.full(B * N, -np.inf, dtype=np.float32)
+        merged_nb = np.full(B * N, -np.inf, dtype=np.float32)
+        merged_b[starts] = np.logaddexp.reduceat(np.take_along_axis(cand_b, order, axis=1).ravel(), starts)
+        merged_nb[starts] = np.logaddexp.reduceat(np.take_along_axis(cand_nb, order, axis=1).ravel(), starts)
+        merged_b = merged_b.reshape(B, N)
+        merged_nb = merged_nb.reshape(B, N)
+        score = np.logaddexp(merged_b, merged_nb) + np.take_along_axis(cand_bonus, order, axis=1)
+
+        sel = np.argpartition(-score, K - 1, axis=1)[:, :K]
+        src = np.take_along_axis(order, sel, axis=1)
+        is_ext = src >= K
+        parent = np.where(is_ext, (src - K) // C, src)
+        char = np.where(is_ext, np.take_along_axis(top, np.maximum(src - K, 0) % C, axis=1), -1)
+
+        tokens = tokens[rows, parent]
+        confs = confs[rows, parent]
+        lengths = lengths[rows, parent]
+        eb, ek = np.nonzero(is_ext)
+        tokens[eb, ek, lengths[eb, ek]] = char[eb, ek]
+        confs[eb, ek, lengths[eb, ek]] = probs[eb, t, char[eb, ek]]
+        lengths = lengths + is_ext
+        last = np.where(is_ext, char, last[rows, parent])
+        hashes = np.take_along_axis(cand_hash, src, axis=1)
+        bonus = np.take_along_axis(cand_bonus, src, axis=1)
+        p_b = np.take_along_axis(merged_b, sel, axis=1)
+        p_nb = np.take_along_axis(merged_nb, sel, axis=1)
+
+    best = np.argmax(np.logaddexp(p_b, p_nb) + bonus, axis=1)
+    best_len = lengths[np.arange(B), best]
+    return ([tokens[b, best[b], :best_len[b]] for b in range(B)],
+            [confs[b, best[b], :best_len[b]] for b in range(B)])
+
 # input: x.1, [1, 3, 32, 124], float32, scale: 1
 class PPOCRv2Rec(object):
     def __init__(self, args):
@@ -41,46 +172,58 @@ class PPOCRv2Rec(object):
                 self.character.append(line)
         if args.use_space_char:
             self.character.append(" ")
+        self.character_array = np.array(self.character, dtype=object)
         self.preprocess_time = 0.0
         self.inference_time = 0.0
         self.postprocess_time = 0.0
         self.beam_search = args.use_beam_search
         self.beam_size = args.beam_size
+        self.bigram = None
+        self.lexicon_weight = getattr(args, "lexicon_weight", 0.0)
+        if getattr(args, "lexicon_path", None):
+            self.bigram = CharBigram.from_lexicon(args.lexicon_path, self.character)
+        # 每个宽度一个复用的batch输入, 以及已写入其中的文本行标识; 凑满rec_batch_size才推理,
+        # 不同图片, 不同调用的文本行会合并到同一个batch中
+        self.batch_inputs = {}
+        self.batch_tags = {}
+        for size_w, size_h in self.img_size:
+            self.batch_inputs[size_w] = np.zeros((self.rec_batch_size, 3, size_h, size_w), dtype=np.float32)
+            self.batch_tags[size_w] = []
+        self.finished = []
+        self.batch_count = 0
     
-    def preprocess(self, img):
-        start_prep = time.time()
-        h, w, _ = img.shape
+    def resize_shape(self, h, w):
+        """返回文本行缩放后的宽, 高以及补零后的宽(即所属的输入宽度)"""
         ratio = w / float(h)
         if ratio > self.img_ratio[-1]:
             logging.debug("Warning: ratio out of range: h = %d, w = %d, ratio = %f, bmodel with larger width is recommended."%(h, w, ratio))
-            resized_w = self.img_size[-1][0]
-            resized_h = self.img_size[-1][1]
-            padding_w = resized_w
-        else:          
-            for max_ratio in self.img_ratio:
-                if ratio <= max_ratio:
-                    resized_h = self.img_size[0][1]
-                    resized_w = int(resized_h * ratio)
-                    padding_w = int(resized_h * max_ratio)
-                    break
-            
+            return self.img_size[-1][0], self.img_size[-1][1], self.img_size[-1][0]
+        for max_ratio, (size_w, _) in zip(self.img_ratio, self.img_size):
+            if ratio <= max_ratio:
+                resized_h = self.img_size[0][1]
+                return int(resized_h * ratio), resized_h, size_w
+
+    def preprocess(self, img, out=None, shape=None):
+        """缩放并归一化到[-1, 1], 写入out(3, h, 补零后的宽)中, out为None时新建; shape为已算好的resize_shape结果"""
+        start_prep = time.time()
+        h, w, _ = img.shape
+        resized_w, resized_h, padding_w = shape or self.resize_shape(h, w)
         if h != resized_h or w != resized_w:
             img = cv2.resize(img, (resized_w, resized_h))
-        img = img.astype('float32')
-        img = np.transpose(img, (2, 0, 1))
-        img -= 127.5
-        img *= 0.0078125
-
-        padding_im = np.zeros((3, resized_h, padding_w), dtype=np.float32)
-        padding_im[:, :, 0:resized_w] = img
-        
+        if out is None:
+            out = np.zeros((3, resized_h, padding_w), dtype=np.float32)
+        else:
+            out[:, :, resized_w:] = 0
+        np.subtract(img.transpose(2, 0, 1), 127.5, out=out[:, :, :resized_w], casting='unsafe')
+        out[:, :, :resized_w] *= 0.0078125
+
         self.preprocess_time += time.time() - start_prep
-        return padding_im
+        return out
 
 
     def predict(self, tensor):
         start_infer = time.time()
-        input_data = {self.input_name: np.array(tensor, dtype=np.float32)}
+        input_data = {self.input_name: np.ascontiguousarray(tensor, dtype=np.float32)}
         outputs = self.net.process(self.graph_name, input_data)
         self.inference_time += time.time() - start_infer
         return list(outputs.values())[0]
@@ -90,108 +233,95 @@ class PPOCRv2Rec(object):
         result_list = []
 
         if beam_search:
-            max_seq_len, num_classes = outputs.shape[1], outputs.shape[2]
-
-            for batch_idx in range(outputs.shape[0]):
-                beams = [{'prefix': [], 'score': 1.0, 'confs':[]}] 
-
-                for t in range(max_seq_len):
-                    new_beams = []
-
-                    for beam in beams:
-
-                        next_char_probs = outputs[batch_idx, t]
-                        top_candidates = np.argsort(-next_char_probs)[:beam_width]
-
-                        for c in top_candidates:
-                                new_prefix = beam['prefix'] + [c]
-                                new_score = beam['score'] * next_char_probs[c]
-                                new_confs = beam['confs'] + [next_char_probs[c]]
-                                new_beams.append({'prefix': new_prefix, 'score': new_score, 'confs':new_confs})
-
-                    new_beams.sort(key=lambda x: -x['score'])
-                    beams = new_beams[:beam_width]
-
-                best_beam = max(beams, key=lambda x: x['score'])
-
-                char_list = []
-                conf_list = []
-                pre_c = best_beam['prefix'][0]
-                if pre_c != 0:
-                    char_list.append(self.character[pre_c])
-                    conf_list.append(best_beam['confs'][0])
-                for idx, c in enumerate(best_beam['prefix']):
-                    if (pre_c==c) or (c==0):
-                        if c ==0:
-                            pre_c = c
-                        continue
-                    char_list.append(self.character[c])
-                    conf_list.append(best_beam['confs'][idx])
-                    pre_c = c
-                result_list.append((''.join(char_list), np.mean(conf_list)))
-
-        else:  # original postprocess
-            preds_idx = outputs.argmax(axis=2)
-            preds_prob = outputs.max(axis=2)
-            for batch_idx, pred_idx in enumerate(preds_idx):
-                char_list = []
-                conf_list = []
-                pre_c = pred_idx[0]
-                if pre_c != 0:
-                    char_list.append(self.character[pre_c])
-                    conf_list.append(preds_prob[batch_idx][0])
-                for idx, c in enumerate(pred_idx):
-                    if (pre_c == c) or (c == 0):
-                        if c == 0:
-                            pre_c = c
-                        continue
-                    char_list.append(self.character[c])
-                    conf_list.append(preds_prob[batch_idx][idx])
-                    pre_c = c
-
-                result_list.append((''.join(char_list), np.mean(conf_list)))
+            result_list = self.ctc_beam_decode(outputs, beam_width)
+        else:
+            result_list = self.ctc_greedy_decode(outputs)
 
         self.postprocess_time += time.time() - start_post
         return result_list
 
+    def ctc_greedy_decode(self, outputs):
+        """greedy CTC解码, 去掉blank和重复字符, 整个batch一次完成
+
+        Returns:
+            list: batch个(text, 保留字符的平均置信度), 没有字符时置信度为nan
+        """
+        preds_idx = outputs.argmax(axis=2)
+        preds_prob = np.take_along_axis(outputs, preds_idx[:, :, None], axis=2)[:, :, 0]
+        keep = preds_idx != 0
+        keep[:, 1:] &= preds_idx[:, 1:] != preds_idx[:, :-1]
+        counts = keep.sum(axis=1)
+        confs = np.where(keep, preds_prob, 0).sum(axis=1, dtype=np.float32)
+        chars = self.character_array[preds_idx[keep]]
+        ends = np.cumsum(counts).tolist()
+        result_list = []
+        for i, (start, end) in enumerate(zip([0] + ends[:-1], ends)):
+            score = confs[i] / counts[i] if counts[i] else np.float32(np.nan)
+            result_list.append((''.join(chars[start:end]), score))
+        return result_list
+
+    def ctc_beam_decode(self, outputs, beam_width=5):
+        """CTC前缀束搜索解码, 有词典时加上字符bigram奖励
+
+        Returns:
+            list: batch个(text, 所选字符的平均置信度), 没有字符时置信度为nan
+        """
+        tokens, confs = ctc_prefix_beam_search(outputs, beam_width, self.bigram, self.lexicon_weight)
+        result_list = []
+        for token, conf in zip(tokens, confs):
+            score = np.float32(conf.mean()) if len(conf) else np.float32(np.nan)
+            result_list.append((''.join(self.character_array[token]), score))
+        return result_list
+
+    def submit(self, img, tag):
+        """将一个文本行加入其宽度对应的batch, batch凑满时推理, 结果由collect取出
+
+        Args:
+            img (np.ndarray): BGR文本行图片
+            tag: 文本行的标识, 与识别结果一起返回
+        """
+        h, w, _ = img.shape
+        shape = self.resize_shape(h, w)
+        size_w = shape[2]
+        tags = self.batch_tags[size_w]
+        self.preprocess(img, out=self.batch_inputs[size_w][len(tags)], shape=shape)
+        tags.append(tag)
+        if len(tags) == self.rec_batch_size:
+            self.run_batch(size_w)
+
+    def run_batch(self, size_w):
+        """推理一个宽度的batch, 不满rec_batch_size时仍按整batch推理, 多余的行不取结果"""
+        tags = self.batch_tags[size_w]
+        if not tags:
+            return
+        outputs = self.predict(self.batch_inputs[size_w])
+        res = self.postprocess(outputs[:len(tags)], self.beam_search, self.beam_size)
+        self.finished.extend(zip(tags, res))
+        self.batch_tags[size_w] = []
+        self.batch_count += 1
+
+    def collect(self, flush=False):
+        """取出已完成的识别结果
+
+        Args:
+            flush (bool): 是否先推理所有未满的batch
+
+        Returns:
+            list: [(tag, (text, score)), ...]
+        """
+        if flush:
+            for size_w in self.batch_tags:
+                self.run_batch(size_w)
+        finished, self.finished = self.finished, []
+        return finished
+
     def __call__(self, img_list):
-        img_dict = {}
-        for img_size in self.img_size:
-            img_dict[img_size[0]] = {"imgs":[], "ids":[], "res":[]}
         for id, img in enumerate(img_list):
-            img = self.preprocess(img)
-            if img is None:
-                continue
-            img_dict[img.shape[2]]["imgs"].append(img)
-            img_dict[img.shape[2]]["ids"].append(id)
-
-        for size_w in img_dict.keys():
-            if size_w > 640:
-                for img_input in img_dict[size_w]["imgs"]:
-                    img_input = np.expand_dims(img_input, axis=0)
-                    outputs = self.predict(img_input)
-                    res = self.postprocess(outputs,self.beam_search,self.beam_size)
-                    img_dict[size_w]["res"].extend(res)
-            else:
-                img_num = len(img_dict[size_w]["imgs"])
-                for beg_img_no in range(0, img_num, self.rec_batch_size):
-                    end_img_no = min(img_num, beg_img_no + self.rec_batch_size)
-                    if beg_img_no + self.rec_batch_size > img_num:
-                        for ino in range(beg_img_no, end_img_no):
-                            img_input = np.expand_dims(img_dict[size_w]["imgs"][ino], axis=0)
-                            outputs = self.predict(img_input)
-                            res = self.postprocess(outputs,self.beam_search,self.beam_size)
-                            img_dict[size_w]["res"].extend(res)   
-                    else:
-                        img_input = np.stack(img_dict[size_w]["imgs"][beg_img_no:end_img_no])
-                        outputs = self.predict(img_input)
-                        res = self.postprocess(outputs,self.beam_search,self.beam_size)
-                        img_dict[size_w]["res"].extend(res)
-
+            self.submit(img, id)
         rec_res = {"res":[], "ids":[]}
-        for size_w in img_dict.keys():
-            rec_res["res"].extend(img_dict[size_w]["res"])
-            rec_res["ids"].extend(img_dict[size_w]["ids"])
+        for id, res in self.collect(flush=True):
+            rec_res["res"].append(res)
+            rec_res["ids"].append(id)
         return rec_res
 
 def main(opt):
@@ -230,6 +360,8 @@ def parse_opt():
     parser.add_argument("--use_space_char", type=bool, default=True)
     parser.add_argument('--use_beam_search', action='store_const', const=True, default=False, help='Enable beam search')
     parser.add_argument("--beam_size", type=int, default=5, choices=range(1,41), help='Only valid when using beam search, valid range 1~40')
+    parser.add_argument("--lexicon_path", type=str, default=None, help='Only valid when using beam search, one word per line, char bigrams of the words get a bonus')
+    parser.add_argument("--lexicon_weight", type=float, default=1.0, help='log domain bonus of a lexicon char bigram in beam search')
     opt = parser.parse_args()
     return opt
 
@@ -13,7 +13,8 @@ import numpy as np
 import argparse
 import sophon.sail as sail
 import math
-import copy
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageDraw, ImageFont
 import logging
 import json
@@ -34,42 +35,104 @@ class TextSystem(object):
         self.rec_thresh = args.rec_thresh
         self.crop_num = 0
         self.crop_time = 0.0
+        # 已提交但文本行还没有全部识别完的图片, 按提交顺序排列
+        self.pending = collections.OrderedDict()
+        self.image_count = 0
+        # 文本行裁剪(透视变换)在线程池中进行, 与下一批图片的检测重叠; 队列中为还没有交给识别器的裁剪任务
+        self.crop_pool = ThreadPoolExecutor(max_workers=max(1, getattr(args, "crop_workers", 4)))
+        self.crop_queue = collections.deque()
+
     def __call__(self, img_list, cls=True):
-        ori_img_list = img_list.copy()
-        results_list = [{"dt_boxes":[], "text":[], "score":[]} for i in range(len(img_list))]
-        ori_img_list = img_list.copy()
+        tags = self.submit(img_list, cls)
+        results = dict(self.collect(flush=True))
+        return [results[tag] for tag in tags]
+
+    def submit(self, img_list, cls=True, tags=None):
+        """检测一批图片并提交文本行的裁剪任务, 上一批图片的文本行在本批检测完成后交给识别器;
+        识别器按宽度凑满batch才推理, 文本行可能和之后提交的图片一起识别
+
+        Args:
+            img_list (list): BGR图片
+            cls (bool): 是否进行文本方向分类
+            tags (list): 每张图片的标识, 默认为提交序号
+
+        Returns:
+            list: 每张图片的标识, collect按提交顺序返回(标识, 结果)
+        """
+        if tags is None:
+            tags = list(range(self.image_count, self.image_count + len(img_list)))
+        self.image_count += len(img_list)
         dt_boxes_list = self.text_detector(img_list)
-            
-        img_dict = {"imgs":[], "dt_boxes":[], "pic_ids":[]}
+        # 检测期间线程池已完成上一批的裁剪
+        self.feed_crops()
+
+        futures = []
+        crop_tags = []
         for id, dt_boxes in enumerate(dt_boxes_list):
             self.crop_num += len(dt_boxes)
-            start_crop = time.time()
             for bno in range(len(dt_boxes)):
-                tmp_box = copy.deepcopy(dt_boxes[bno])
-                img_crop = get_rotate_crop_image(ori_img_list[id], tmp_box)
-                img_dict["imgs"].append(img_crop)
-                img_dict["dt_boxes"].append(dt_boxes[bno])
-                img_dict["pic_ids"].append(id)
+                # get_rotate_crop_image不修改box, 不需要拷贝
+                futures.append(self.crop_pool.submit(get_rotate_crop_image, img_list[id], dt_boxes[bno]))
+                crop_tags.append((tags[id], bno))
+            self.pending[tags[id]] = {"dt_boxes": dt_boxes, "res": [None] * len(dt_boxes), "remaining": len(dt_boxes)}
+        self.crop_queue.append((futures, crop_tags, cls))
+        return tags
+
+    def feed_crops(self):
+        """等待队列中的裁剪任务, 经方向分类后交给识别器"""
+        while self.crop_queue:
+            futures, crop_tags, cls = self.crop_queue.popleft()
+            start_crop = time.time()
+            crops = [future.result() for future in futures]
             self.crop_time += time.time() - start_crop
+            if not crops:
+                continue
+            if self.use_angle_cls and cls:
+                crops, cls_res = self.text_classifier(crops)
+            for crop, crop_tag in zip(crops, crop_tags):
+                self.text_recognizer.submit(crop, crop_tag)
 
-        if self.use_angle_cls and cls:
-            img_dict["imgs"], cls_res = self.text_classifier(img_dict["imgs"])
+    def collect(self, flush=False):
+        """取出文本行已全部识别完的图片的结果
 
-        rec_res = self.text_recognizer(img_dict["imgs"])
+        Args:
+            flush (bool): 是否等待所有裁剪任务并推理识别器中所有未满的batch, 之后所有已提交的图片都会完成
 
-        results_list = [{"dt_boxes":[], "text":[], "score":[]} for i in range(len(img_list))]
-        for i, id in enumerate(rec_res.get("ids")):
-            text, score = rec_res["res"][i]
-            if score >= self.rec_thresh:
-                pic_id = img_dict["pic_ids"][id]
-                results_list[pic_id]["dt_boxes"].append(img_dict["dt_boxes"][id])
-                results_list[pic_id]["text"].append(text)
-                results_list[pic_id]["score"].append(score)
-        
-        for i, results_list_per_img in enumerate(results_list):
-            if(len(results_list_per_img["dt_boxes"])):
-                results_list[i] = sorted_boxes_dict(results_list_per_img)
-        return results_list
+        Returns:
+            list: 按提交顺序排列的[(标识, {"dt_boxes", "text", "score"}), ...]
+        """
+        if flush:
+            self.feed_crops()
+        for (tag, bno), res in self.text_recognizer.collect(flush):
+            image = self.pending[tag]
+            image["res"][bno] = res
+            image["remaining"] -= 1
+
+        done = []
+        while self.pending:
+            tag, image = next(iter(self.pending.items()))
+            if image["remaining"]:
+                break
+            del self.pending[tag]
+            result = {"dt_boxes":[], "text":[], "score":[]}
+            for box, (text, score) in zip(image["dt_boxes"], image["res"]):
+                if score >= self.rec_thresh:
+                    result["dt_boxes"].append(box)
+                    result["text"].append(text)
+                    result["score"].append(score)
+            if len(result["dt_boxes"]):
+                result = sorted_boxes_dict(result)
+            done.append((tag, result))
+        return done
+
+    def close(self):
+        """关闭裁剪线程池, 未交给识别器的裁剪任务会先完成"""
+        self.crop_pool.shutdown(wait=True)
+
+    def __del__(self):
+        pool = getattr(self, "crop_pool", None)
+        if pool is not None:
+            pool.shutdown(wait=False)
 
 def get_rotate_crop_image(img, points):
     assert len(points) == 4, "shape of points must be 4*2"
@@ -217,6 +280,38 @@ def main(opt):
     
     decode_time = 0.0
     result_json = dict()
+    # 等待文本行识别完成的图片
+    pending_imgs = dict()
+
+    def save_result(img_name, result):
+        src_img = pending_imgs.pop(img_name)
+        logging.info(img_name)
+        logging.info(result["text"])
+        image_file = os.path.join(opt.input, img_name)
+        image = Image.fromarray(cv2.cvtColor(src_img, cv2.COLOR_BGR2RGB))
+        
+        img_name_splited = img_name.split('.')[0]
+        result_json[img_name_splited] = []
+        for j in range(0, len(result["text"])):
+            result_json_per_box = dict()
+            result_json_per_box["illegibility"] = bool(result["score"][j] < opt.rec_thresh)
+            result_json_per_box["points"] = result["dt_boxes"][j].tolist()
+            result_json_per_box["score"] = float(result["score"][j])
+            result_json_per_box["transcription"] = result["text"][j]
+            result_json[img_name_splited].append(result_json_per_box)
+        draw_img = draw_ocr_box_txt(
+                image,
+                result["dt_boxes"],
+                result["text"],
+                result["score"],
+                rec_thresh=opt.rec_thresh)
+        img_name_pure = os.path.split(image_file)[-1]
+        img_path = os.path.join(draw_img_save,
+                                "ocr_res_{}".format(img_name_pure))
+        cv2.imwrite(img_path, draw_img[:, :, ::-1])
+        logging.info("The visualized image saved in {}".format(img_path))
+
+    start_total = time.time()
     for batch_idx in range(0, len(img_file_list), batch_size):
         img_list = []
         # 不是整batch的，转化为1batch进行处理
@@ -227,36 +322,17 @@ def main(opt):
             src_img = cv2.imdecode(np.fromfile(img_file_list[batch_idx+idx], dtype=np.uint8), -1)
             decode_time += time.time() - start_time
             img_list.append(src_img)
+        img_names = file_list[batch_idx:batch_idx+batch_size]
+        pending_imgs.update(zip(img_names, img_list))
 
-        results_list = ppocrv2_sys(img_list)    
-
-        for i, result in enumerate(results_list):
-            img_name = file_list[batch_idx+i]
-            logging.info(img_name)
-            logging.info(result["text"])
-            image_file = os.path.join(opt.input, img_name)
-            image = Image.fromarray(cv2.cvtColor(img_list[i], cv2.COLOR_BGR2RGB))
-            
-            img_name_splited = img_name.split('.')[0]
-            result_json[img_name_splited] = []
-            for j in range(0, len(result["text"])):
-                result_json_per_box = dict()
-                result_json_per_box["illegibility"] = bool(result["score"][j] < opt.rec_thresh)
-                result_json_per_box["points"] = result["dt_boxes"][j].tolist()
-                result_json_per_box["score"] = float(result["score"][j])
-                result_json_per_box["transcription"] = result["text"][j]
-                result_json[img_name_splited].append(result_json_per_box)
-            draw_img = draw_ocr_box_txt(
-                    image,
-                    result["dt_boxes"],
-                    result["text"],
-                    result["score"],
-                    rec_thresh=opt.rec_thresh)
-            img_name_pure = os.path.split(image_file)[-1]
-            img_path = os.path.join(draw_img_save,
-                                    "ocr_res_{}".format(img_name_pure))
-            cv2.imwrite(img_path, draw_img[:, :, ::-1])
-            logging.info("The visualized image saved in {}".format(img_path))
+        # 文本行跨批次凑满识别batch, 已识别完的图片先输出
+        ppocrv2_sys.submit(img_list, tags=img_names)
+        for img_name, result in ppocrv2_sys.collect():
+            save_result(img_name, result)
+    for img_name, result in ppocrv2_sys.collect(flush=True):
+        save_result(img_name, result)
+    ppocrv2_sys.close()
+    total_time = time.time() - start_total
     save_json = "results/ppocr_system_results_b" + str(opt.batch_size) + ".json"
     with open(save_json, 'w') as jf:
         json.dump(result_json, jf, indent=4, ensure_ascii=False)
@@ -289,6 +365,10 @@ def main(opt):
     logging.info("preprocess_time(ms): {:.2f}".format(preprocess_time * 1000))
     logging.info("inference_time(ms): {:.2f}".format(inference_time * 1000))
     logging.info("postprocess_time(ms): {:.2f}".format(postprocess_time * 1000))
+    logging.info("rec batches: {}, text lines per second: {:.2f} (rec only), {:.2f} (end to end)".format(
+        ppocrv2_sys.text_recognizer.batch_count,
+        ppocrv2_sys.crop_num / max(ppocrv2_sys.text_recognizer.preprocess_time + ppocrv2_sys.text_recognizer.inference_time + ppocrv2_sys.text_recognizer.postprocess_time, 1e-6),
+        ppocrv2_sys.crop_num / max(total_time, 1e-6)))
 
 def img_size_type(arg):
     # 将字符串解析为列表类型
@@ -312,7 +392,10 @@ def parse_opt():
     parser.add_argument("--use_space_char", type=bool, default=True)
     parser.add_argument('--use_beam_search', action='store_const', const=True, default=False, help='Enable beam search')
     parser.add_argument("--beam_size", type=int, default=5, choices=range(1,41), help='Only valid when using beam search, valid range 1~40')
+    parser.add_argument("--lexicon_path", type=str, default=None, help='Only valid when using beam search, one word per line, char bigrams of the words get a bonus')
+    parser.add_argument("--lexicon_weight", type=float, default=1.0, help='log domain bonus of a lexicon char bigram in beam search')
     parser.add_argument("--rec_thresh", type=float, default=0.5)
+    parser.add_argument("--crop_workers", type=int, default=4, help='threads of the text line perspective crops')
     # params for text classifier
     parser.add_argument("--use_angle_cls", action='store_true')
     parser.add_argument('--bmodel_cls', type=str, default='../models/BM1684X/ch_PP-OCRv3_cls_fp32.bmodel', help='classifier bmodel path')
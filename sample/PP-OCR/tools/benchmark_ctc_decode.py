@@ -0,0 +1,111 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+import os
+import sys
+import time
+import argparse
+import logging
+import cv2
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../python'))
+from ppocr_rec_opencv import PPOCRv2Rec, img_size_type
+logging.basicConfig(level=logging.INFO)
+
+
+def argsparser():
+    parser = argparse.ArgumentParser(prog=__file__)
+    parser.add_argument('--input', type=str, default='../datasets/cali_set_rec', help='text line image directory, file names are the labels')
+    parser.add_argument('--bmodel_rec', type=str, default='../models/BM1684X/ch_PP-OCRv3_rec_fp32.bmodel', help='recognizer bmodel path')
+    parser.add_argument('--dev_id', type=int, default=0, help='tpu card id')
+    parser.add_argument('--img_size', type=img_size_type, default=[[320, 48],[640, 48]], help='inference sizes [width,height] of the bmodel stages')
+    parser.add_argument("--char_dict_path", type=str, default="../datasets/ppocr_keys_v1.txt")
+    parser.add_argument("--use_space_char", type=bool, default=True)
+    parser.add_argument("--beam_size", type=int, default=5, help='beam width of both beam searches')
+    parser.add_argument("--lexicon_path", type=str, default=None, help='lexicon of the char bigram bonus, prefix beam search only')
+    parser.add_argument("--lexicon_weight", type=float, default=1.0, help='log domain bonus of a lexicon char bigram')
+    parser.add_argument("--batch_size", type=int, default=4, help='text lines decoded together')
+    parser.add_argument("--skip_frame_beam", action='store_true', help='skip the per frame beam search, slow on large sets')
+    args = parser.parse_args()
+    args.use_beam_search = True
+    return args
+
+
+def frame_beam_search(rec, outputs, beam_width=5):
+    """the beam search used by PPOCRv2Rec.postprocess before the CTC prefix beam search: a beam search
+    over the frame labels (not over the collapsed prefixes), collapsed like the greedy decode at the end
+    """
+    result_list = []
+    max_seq_len = outputs.shape[1]
+    for batch_idx in range(outputs.shape[0]):
+        beams = [{'prefix': [], 'score': 1.0, 'confs':[]}]
+        for t in range(max_seq_len):
+            new_beams = []
+            for beam in beams:
+                next_char_probs = outputs[batch_idx, t]
+                top_candidates = np.argsort(-next_char_probs)[:beam_width]
+                for c in top_candidates:
+                    new_beams.append({'prefix': beam['prefix'] + [c],
+                                      'score': beam['score'] * next_char_probs[c],
+                                      'confs': beam['confs'] + [next_char_probs[c]]})
+            new_beams.sort(key=lambda x: -x['score'])
+            beams = new_beams[:beam_width]
+        best_beam = max(beams, key=lambda x: x['score'])
+        char_list = []
+        conf_list = []
+        pre_c = -1
+        for idx, c in enumerate(best_beam['prefix']):
+            if c != 0 and c != pre_c:
+                char_list.append(rec.character[c])
+                conf_list.append(best_beam['confs'][idx])
+            pre_c = c
+        result_list.append((''.join(char_list), np.mean(conf_list) if conf_list else np.nan))
+    return result_list
+
+
+def main(args):
+    rec = PPOCRv2Rec(args)
+    # recognizer outputs of every text line, grouped by input width (same number of frames)
+    groups = {}
+    labels = {}
+    for img_name in sorted(os.listdir(args.input)):
+        img = cv2.imdecode(np.fromfile(os.path.join(args.input, img_name), dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            continue
+        tensor = rec.preprocess(img)
+        outputs = rec.predict(tensor[None])
+        groups.setdefault(outputs.shape[1], []).append(outputs[0])
+        labels.setdefault(outputs.shape[1], []).append(os.path.splitext(img_name)[0])
+    num_lines = sum(len(v) for v in groups.values())
+    logging.info("{} text lines, frames per line: {}".format(num_lines, sorted(groups.keys())))
+
+    methods = [("greedy", lambda x: rec.ctc_greedy_decode(x)),
+               ("prefix_beam", lambda x: rec.ctc_beam_decode(x, args.beam_size))]
+    if not args.skip_frame_beam:
+        methods.insert(1, ("frame_beam", lambda x: frame_beam_search(rec, x, args.beam_size)))
+
+    texts = {}
+    for name, decode in methods:
+        start_time = time.time()
+        results = []
+        for frames in sorted(groups.keys()):
+            outputs = np.stack(groups[frames])
+            for beg in range(0, len(outputs), args.batch_size):
+                results.extend(text for text, _ in decode(outputs[beg:beg + args.batch_size]))
+        decode_time = time.time() - start_time
+        texts[name] = results
+        truth = [label for frames in sorted(groups.keys()) for label in labels[frames]]
+        accuracy = np.mean([a == b for a, b in zip(results, truth)])
+        agreement = np.mean([a == b for a, b in zip(results, texts["greedy"])])
+        logging.info("{:<12} decode_time(ms/line): {:.3f}, lines/s: {:.1f}, label match: {:.2%}, same as greedy: {:.2%}".format(
+            name, decode_time / num_lines * 1000, num_lines / max(decode_time, 1e-9), accuracy, agreement))
+
+
+if __name__ == '__main__':
+    args = argsparser()
+    main(args)
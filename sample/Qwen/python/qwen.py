@@ -7,9 +7,13 @@
 #
 #===----------------------------------------------------------------------===#
 import sophon.sail as sail
+import os
 import argparse
 import time
-from tokenization_util import make_context
+from llm_server import serve
+from attention_mask import AttentionMask
+from prefix_cache import PrefixCache
+from tokenization_util import make_context, CachedEncoder
 from transformers import AutoTokenizer
 import numpy as np
 
@@ -85,6 +89,9 @@ class Qwen:
         # forward_next: position_id_tensor and attention_mask_tensor
         self.next_pid = self.init_sail_tensor(self.name_blocks_cache[0], 1)
         self.next_attention = self.init_sail_tensor(self.name_blocks_cache[0], 2)
+        # position ids and attention masks of forward_first / forward_next
+        self.mask = AttentionMask(self.SEQLEN, type_convert(self.first_attention["dtype"]), -10000.0,
+                                  type_convert(self.first_pid["dtype"]))
 
         # forward_next: present_key / present_value (for update kv_cache)
         self.present_key = self.init_sail_tensor(self.name_blocks_cache[0], 1, None, False)
@@ -115,6 +122,10 @@ class Qwen:
         self.lm_output = self.init_sail_tensor(self.name_lm, 0, None, False)
 
         self.token_length = 0
+        # tokens held in the kv cache, the next turn only runs the new ones
+        self.prefix_cache = PrefixCache(self)
+        # ids of every message, the turns of the history are not tokenized again
+        self.encoder = CachedEncoder(self.sp)
 
     def init_sail_tensor(self, name, tensor_idx, shape=None, is_input=True):
         """
@@ -147,15 +158,7 @@ class Qwen:
         input_ids[:min(self.SEQLEN, len(token))] = token
         input_ids = input_ids.reshape(1, -1)
         self.token_length = len(token)
-        position_id = np.zeros(self.SEQLEN, type_convert(self.first_pid["dtype"])) 
-        for i in range(self.token_length):
-            position_id[i] = i
-
-        attention_mask = np.ones(self.SEQLEN*self.SEQLEN, type_convert(self.first_attention["dtype"])) * (-10000.0)
-        for i in range(self.token_length):
-            for j in range(self.SEQLEN):
-                if (j <= i):
-                    attention_mask[i*self.SEQLEN + j] = 0
+        position_id, attention_mask = self.mask.first(self.token_length)
         
         # embedding
         self.first_embed_input["data"].update_data(input_ids)
@@ -199,10 +202,7 @@ class Qwen:
 
     # The following tokens prediction
     def forward_next(self, ):
-        attention_mask = np.zeros(self.SEQLEN+1, type_convert(self.next_attention["dtype"]))
-        for i in range(self.token_length-1, self.SEQLEN):
-            attention_mask[i] = -10000.0
-        position_id = np.array(self.token_length - 1, type_convert(self.next_pid["dtype"]))
+        position_id, attention_mask = self.mask.next(self.token_length)
 
         # embedding
         self.next_embed_input["data"] = self.lm_output["data"]
@@ -247,14 +247,55 @@ class Qwen:
         self.net.process(self.name_lm, input_lm_tensors, output_lm_tensors)
         return int(self.lm_output["data"].asnumpy())
 
+    def new_kv_cache(self):
+        """
+        allocate the kv cache of one more conversation, swapped in by llm_server.py
+        """
+        past_key_output = []
+        past_value_output = []
+        for i in range(self.NUM_LAYERS):
+            past_key_output.append(self.init_sail_tensor(self.name_blocks[0], 1, None, False))
+            past_value_output.append(self.init_sail_tensor(self.name_blocks[0], 2, None, False))
+        return past_key_output, past_value_output
+
+    def set_next_token(self, token):
+        """
+        make forward_next continue from token, used when switching between conversations
+        """
+        data = self.lm_output["data"]
+        data.update_data(np.array(token, type_convert(self.lm_output["dtype"])).reshape(data.shape()))
+
+    def encode_messages(self, messages):
+        system = ''
+        history = []
+        query = None
+        for message in messages:
+            if message["role"] == "system":
+                system = message["content"]
+            elif message["role"] == "user":
+                if query is not None:
+                    history.append([query, ''])
+                query = message["content"]
+            else:
+                history.append([query or '', message["content"]])
+                query = None
+        return make_context(self.encoder, query=query or '',
+                        history=history,
+                        system=system,
+                        max_window_size=self.SEQLEN,
+                        chat_format="chatml")
+
+    def decode_tokens(self, tokens):
+        return self.sp.decode(tokens)
+
     def chat_stream(self, input, history, system=''):
-        input_tokens = make_context(self.sp, query=input, max_window_size=self.SEQLEN)
+        input_tokens = make_context(self.encoder, query=input, max_window_size=self.SEQLEN)
         if (len(input_tokens) > self.SEQLEN / 3):
             yield '##INPUT_TOO_LONG'
             return
 
         tok_num = 0
-        tokens = make_context(self.sp, query=input, 
+        tokens = make_context(self.encoder, query=input, 
                         history=history,
                         system=system,
                         max_window_size=self.SEQLEN,
@@ -264,21 +305,19 @@ class Qwen:
                 history = history[1:]
             else:
                 system = ''
-            tokens = make_context(self.sp, query=input, 
+            tokens = make_context(self.encoder, query=input, 
                             history=history,
                             system=system,
                             max_window_size=self.SEQLEN,
                             chat_format="chatml")
         first_start = time.time()
-        token = self.forward_first(tokens)
+        token = self.prefix_cache.forward_first(tokens)
         first_end = time.time()
         while token != self.EOS and self.token_length < self.SEQLEN:
             diff = self.sp.decode([token])
             yield diff
-            if self.token_length < self.SEQLEN:
-                self.token_length += 1
             tok_num += 1
-            token = self.forward_next()
+            token = self.prefix_cache.forward_next(token)
         
         if self.token_length >= self.SEQLEN:
             yield '##TOKEN_LENGTH_MAX'
@@ -301,7 +340,7 @@ def app(client):
         print("\nAnswer: ")
         assistant_msg = ''
         for response in client.chat_stream(input_str, history):
-            assistant_msg = response
+            assistant_msg += response
             print(response, flush=True, end='')
         history.append([input_str, assistant_msg])
 
@@ -310,13 +349,20 @@ def main(args):
     tokenizer = AutoTokenizer.from_pretrained(args.token, trust_remote_code=True)
     engine = sail.Engine(args.bmodel, args.dev_id, sail.IOMode.DEVIO)
     client = Qwen(handle, engine, tokenizer)
-    app(client)
+    if args.server:
+        serve(client, args.host, args.port, args.max_sessions, os.path.basename(args.bmodel))
+    else:
+        app(client)
 
 def argsparser():
     parser = argparse.ArgumentParser(prog=__file__)
     parser.add_argument('--bmodel', type=str, default='./models/BM1684X/qwen-7b_int4_1dev.bmodel', help='path of bmodel')
     parser.add_argument('--token', type=str, default='./python/token_config/', help='path of tokenizer')
     parser.add_argument('--dev_id', type=int, default=0, help='dev id')
+    parser.add_argument('--server', action='store_true', help='run an OpenAI compatible http server instead of the command line chat')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='server address, 0.0.0.0 to accept other hosts')
+    parser.add_argument('--port', type=int, default=8000, help='server port')
+    parser.add_argument('--max_sessions', type=int, default=4, help='conversations decoded together, each one owns a kv cache')
     args = parser.parse_args()
     return args
 
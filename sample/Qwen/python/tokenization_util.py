@@ -1,6 +1,28 @@
+import functools
 from typing import Tuple, List
 from transformers import PreTrainedTokenizer
 
+
+class CachedEncoder:
+    """
+    Tokenizer for make_context caching the ids of every role and message, so the turns of the
+    history are not tokenized again at every new question.
+    """
+    def __init__(self, tokenizer: PreTrainedTokenizer, maxsize: int = 1024):
+        self.tokenizer = tokenizer
+        self.im_start_id = tokenizer.im_start_id
+        self.im_end_id = tokenizer.im_end_id
+        self._encode = functools.lru_cache(maxsize=maxsize)(self._encode_text)
+
+    def _encode_text(self, text, allowed_special):
+        if allowed_special is None:
+            return tuple(self.tokenizer.encode(text))
+        return tuple(self.tokenizer.encode(text, allowed_special=set(allowed_special)))
+
+    def encode(self, text, allowed_special=None):
+        key = None if allowed_special is None else frozenset(allowed_special)
+        return list(self._encode(text, key))
+
 def make_context(
     tokenizer: PreTrainedTokenizer,
     query: str,
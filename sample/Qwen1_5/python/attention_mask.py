@@ -0,0 +1,94 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+# Each LLM sample keeps an identical copy of this file.
+import functools
+import numpy as np
+
+KV_ALIGNS = ('left', 'right')
+
+
+@functools.lru_cache(maxsize=None)
+def causal_template(seqlen, dtype, fill):
+    """
+    (seqlen, seqlen) causal mask, 0 where the key is not after the query and fill elsewhere.
+    Built once per sequence length, dtype and fill value and shared read only.
+    """
+    mask = np.triu(np.full((seqlen, seqlen), fill, dtype), 1)
+    mask.flags.writeable = False
+    return mask
+
+
+class AttentionMask:
+    """
+    Position ids and attention masks of forward_first and forward_next, built into host buffers
+    owned by the runner instead of being filled element by element for every call.
+
+    first() copies only the rows of the causal template between the previous and the new prompt
+    length. next() unmasks the single new cache entry when the context grows by one token and
+    rebuilds the mask with two slices otherwise (another conversation of llm_server.py, a new
+    prompt). The returned arrays are overwritten by the next call, pass them to update_data
+    before calling again.
+
+    kv_align: 'left' when the kv cache is written from position 0 (Qwen, Llama2, Baichuan2),
+              'right' when it is kept at the end of the cache (ChatGLM2, ChatGLM3).
+    """
+    def __init__(self, seqlen, dtype=np.float16, fill=-10000.0, pid_dtype=np.int32, kv_align='left'):
+        if kv_align not in KV_ALIGNS:
+            raise ValueError('kv_align must be one of {}, but got {}'.format(KV_ALIGNS, kv_align))
+        self.seqlen = seqlen
+        self.fill = fill
+        self.kv_align = kv_align
+        self.template = causal_template(seqlen, np.dtype(dtype), float(fill))
+        self.first_mask = np.full((seqlen, seqlen), fill, dtype)
+        self.first_pid = np.zeros(seqlen, pid_dtype)
+        self.first_length = 0
+        self.next_mask = np.zeros(seqlen + 1, dtype)
+        self.next_pid = np.zeros((), pid_dtype)
+        self.past_length = None
+
+    def first(self, token_length):
+        """
+        Returns: (seqlen,) position ids and (seqlen, seqlen) mask of a prompt of token_length tokens,
+        rows after the prompt are fully masked and their position id is 0
+        """
+        length = min(token_length, self.seqlen)
+        last = self.first_length
+        if length > last:
+            self.first_mask[last:length] = self.template[last:length]
+            self.first_pid[last:length] = np.arange(last, length)
+        elif length < last:
+            self.first_mask[length:last] = self.fill
+            self.first_pid[length:last] = 0
+        self.first_length = length
+        return self.first_pid, self.first_mask
+
+    def next(self, token_length, past_length=None):
+        """
+        Args:
+            token_length: context length including the token being decoded
+            past_length: valid entries of the kv cache, token_length - 1 by default
+
+        Returns: position id of the new token and (seqlen + 1,) mask over the kv cache followed by
+        the new token
+        """
+        if past_length is None:
+            past_length = token_length - 1
+        self.next_pid[...] = token_length - 1
+        cache = self.next_mask[:self.seqlen]
+        if self.past_length is not None and past_length == self.past_length + 1:
+            cache[past_length - 1 if self.kv_align == 'left' else self.seqlen - past_length] = 0
+        elif past_length != self.past_length:
+            if self.kv_align == 'left':
+                cache[:past_length] = 0
+                cache[past_length:] = self.fill
+            else:
+                cache[:self.seqlen - past_length] = self.fill
+                cache[self.seqlen - past_length:] = 0
+        self.past_length = past_length
+        return self.next_pid, self.next_mask
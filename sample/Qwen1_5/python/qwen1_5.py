@@ -10,8 +10,12 @@
 import sophon.sail as sail
 from transformers import AutoTokenizer
 import numpy as np
+import os
 import time
 import argparse
+from llm_server import serve
+from attention_mask import AttentionMask
+from prefix_cache import PrefixCache, SegmentTokenizer
 
 
 #convert sail_dtype to numpy dtype
@@ -81,6 +85,9 @@ class Qwen1_5:
         # forward_next: position_id_tensor and attention_mask_tensor
         self.next_pid = self.init_sail_tensor(self.name_blocks_cache[0], 1)
         self.next_attention = self.init_sail_tensor(self.name_blocks_cache[0], 2)
+        # position ids and attention masks of forward_first / forward_next
+        self.mask = AttentionMask(self.SEQLEN, type_convert(self.first_attention["dtype"]), -10000.0,
+                                  type_convert(self.first_pid["dtype"]))
 
         # forward_next: present_key / present_value (for update kv_cache)
         self.present_key = self.init_sail_tensor(self.name_blocks_cache[0], 1, None, False)
@@ -115,6 +122,11 @@ class Qwen1_5:
         self.sample_input = self.init_sail_tensor(self.name_sample, 0)
         self.sample_output = self.init_sail_tensor(self.name_sample, 0, None, False)
 
+        # tokens held in the kv cache, the next turn only runs the new ones
+        self.prefix_cache = PrefixCache(self)
+        # chat prompts are tokenized turn by turn, <|im_start|> starts every turn
+        self.encode_text = SegmentTokenizer(lambda text: self.tokenizer(text).input_ids, "<|im_start|>")
+
 
     def init_sail_tensor(self, name, tensor_idx, shape=None, is_input=True):
         """
@@ -149,15 +161,7 @@ class Qwen1_5:
         input_ids[:min(self.SEQLEN, len(token))] = token
         input_ids = input_ids.reshape(1, -1)
         self.token_length = len(token)
-        position_id = np.zeros(self.SEQLEN, type_convert(self.first_pid["dtype"])) 
-        for i in range(self.token_length):
-            position_id[i] = i
-            
-        attention_mask = np.ones(self.SEQLEN*self.SEQLEN, type_convert(self.first_attention["dtype"])) * (-10000.0)
-        for i in range(self.token_length):
-            for j in range(self.SEQLEN):
-                if (j <= i):
-                    attention_mask[i*self.SEQLEN + j] = 0
+        position_id, attention_mask = self.mask.first(self.token_length)
         
         # embedding
         self.first_embed_input["data"].update_data(input_ids)
@@ -201,10 +205,7 @@ class Qwen1_5:
 
     # The following tokens prediction
     def forward_next(self, ):
-        attention_mask = np.zeros(self.SEQLEN+1, type_convert(self.next_attention["dtype"]))
-        for i in range(self.token_length-1, self.SEQLEN):
-            attention_mask[i] = -10000.0
-        position_id = np.array(self.token_length - 1, type_convert(self.next_pid["dtype"]))
+        position_id, attention_mask = self.mask.next(self.token_length)
 
         # embedding
         self.next_embed_input["data"] = self.sample_output["data"]
@@ -255,32 +256,57 @@ class Qwen1_5:
         return int(self.sample_output["data"].asnumpy())
 
 
+    def new_kv_cache(self):
+        """
+        allocate the kv cache of one more conversation, swapped in by llm_server.py
+        return:
+            (past_key_output, past_value_output)
+        """
+        past_key_output = []
+        past_value_output = []
+        for _ in range(self.NUM_LAYERS):
+            past_key_output.append(self.init_sail_tensor(self.name_blocks[0], 1, None, False))
+            past_value_output.append(self.init_sail_tensor(self.name_blocks[0], 2, None, False))
+        return past_key_output, past_value_output
+
+    def set_next_token(self, token):
+        """
+        make forward_next continue from token, used when switching between conversations
+        """
+        data = self.sample_output["data"]
+        data.update_data(np.array(token, type_convert(self.sample_output["dtype"])).reshape(data.shape()))
+
+    def encode_messages(self, messages):
+        text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        return self.encode_text(text)
+
+    def decode_tokens(self, tokens):
+        return self.tokenizer.decode(tokens)
+
     def chat_stream(self, input, history):
         input_history = [{"role": "user", "content": input}]
         input_text = self.tokenizer.apply_chat_template(input_history, tokenize=False, add_generation_prompt=True)
-        input_tokens = self.tokenizer(input_text).input_ids
+        input_tokens = self.encode_text(input_text)
         if (len(input_tokens) > self.SEQLEN / 3):
             yield '##INPUT_TOO_LONG'
             return
 
-        history.append({"role": "user", "content": input})
+        history = history + [{"role": "user", "content": input}]
         text = self.tokenizer.apply_chat_template(history, tokenize=False, add_generation_prompt=True)
-        tokens = self.tokenizer(text).input_ids
+        tokens = self.encode_text(text)
         while (len(tokens) > self.SEQLEN / 2):
             history = history[1:]
             text = self.tokenizer.apply_chat_template(history, tokenize=False, add_generation_prompt=True)
-            tokens = self.tokenizer(text).input_ids
+            tokens = self.encode_text(text)
         tok_num = 0
         first_start = time.time()
-        token = self.forward_first(tokens)
+        token = self.prefix_cache.forward_first(tokens)
         first_end = time.time()
         while token != self.EOS and self.token_length < self.SEQLEN:
             diff = self.tokenizer.decode([token])
             yield diff
-            if self.token_length < self.SEQLEN:
-                self.token_length += 1
             tok_num += 1
-            token = self.forward_next()
+            token = self.prefix_cache.forward_next(token)
         
         if self.token_length >= self.SEQLEN:
             yield '##TOKEN_LENGTH_MAX'
@@ -303,7 +329,7 @@ def app(client):
         print("\nAnswer: ")
         assistant_msg = ''
         for response in client.chat_stream(input_str, history):
-            assistant_msg = response
+            assistant_msg += response
             print(response, flush=True, end='')
         history.append({"role": "user", "content": input_str})
         history.append({"role": "assistant", "content": assistant_msg})
@@ -313,13 +339,20 @@ def main(args):
     tokenizer = AutoTokenizer.from_pretrained(args.token, trust_remote_code=True)
     engine = sail.EngineLLM(args.bmodel, [args.dev_id])
     client = Qwen1_5(handle, engine, tokenizer)
-    app(client)
+    if args.server:
+        serve(client, args.host, args.port, args.max_sessions, os.path.basename(args.bmodel))
+    else:
+        app(client)
 
 def argsparser():
     parser = argparse.ArgumentParser(prog=__file__)
     parser.add_argument('--bmodel', type=str, default='./qwen1.5-7b_int4_1dev.bmodel', help='path of bmodel')
     parser.add_argument('--token', type=str, default='./python/token_config/', help='path of tokenizer')
     parser.add_argument('--dev_id', type=int, default=0, help='dev id')
+    parser.add_argument('--server', action='store_true', help='run an OpenAI compatible http server instead of the command line chat')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='server address, 0.0.0.0 to accept other hosts')
+    parser.add_argument('--port', type=int, default=8000, help='server port')
+    parser.add_argument('--max_sessions', type=int, default=4, help='conversations decoded together, each one owns a kv cache')
     args = parser.parse_args()
     return args
 
@@ -46,6 +46,10 @@ if "engine" not in st.session_state:
 if "tokenizer" not in st.session_state:
     st.session_state.tokenizer = get_tokenizer()
 
+# Initialize Qwen1_5, every session keeps its own kv cache so the next question reuses the history
+if "client" not in st.session_state:
+    st.session_state.client = Qwen1_5(st.session_state.handle, st.session_state.engine, st.session_state.tokenizer)
+
 # Display chat messages from history on app rerun
 for message in st.session_state.messages:
     with st.chat_message(message["role"]):
@@ -58,12 +62,12 @@ if prompt := st.chat_input("请输入您的问题 "):
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    client = Qwen1_5(st.session_state.handle, st.session_state.engine, st.session_state.tokenizer)
+    client = st.session_state.client
 
     # Display assistant response in chat message container
     with st.chat_message("assistant"):
     
-        stream = client.chat_stream(input = prompt,history = [{"role": m["role"], "content": m["content"]} for m in st.session_state.messages])
+        stream = client.chat_stream(input = prompt,history = [{"role": m["role"], "content": m["content"]} for m in st.session_state.messages[:-1]])
         response = st.write_stream(stream)
 
         # Add assistant message to chat history
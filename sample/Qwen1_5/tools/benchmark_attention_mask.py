@@ -0,0 +1,87 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+import os
+import sys
+import time
+import argparse
+import logging
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../python'))
+from attention_mask import AttentionMask
+logging.basicConfig(level=logging.INFO)
+
+
+def argsparser():
+    parser = argparse.ArgumentParser(prog=__file__)
+    parser.add_argument('--seqlens', type=str, default='512,1024,2048', help='comma separated SEQLEN of the bmodels')
+    parser.add_argument('--prompt_ratio', type=float, default=0.5, help='prompt length / SEQLEN')
+    parser.add_argument('--decode_steps', type=int, default=256, help='forward_next calls after the prompt')
+    args = parser.parse_args()
+    return args
+
+
+# reference implementation: the loops forward_first / forward_next of qwen1_5.py used before AttentionMask
+def legacy_first(seqlen, token_length):
+    position_id = np.zeros(seqlen, np.int32)
+    for i in range(token_length):
+        position_id[i] = i
+    attention_mask = np.ones(seqlen * seqlen, np.float16) * (-10000.0)
+    for i in range(token_length):
+        for j in range(seqlen):
+            if (j <= i):
+                attention_mask[i * seqlen + j] = 0
+    return position_id, attention_mask.reshape(seqlen, seqlen)
+
+
+def legacy_next(seqlen, token_length):
+    attention_mask = np.zeros(seqlen + 1, np.float16)
+    for i in range(token_length - 1, seqlen):
+        attention_mask[i] = -10000.0
+    position_id = np.array(token_length - 1, np.int32)
+    return position_id, attention_mask
+
+
+def main(args):
+    for seqlen in [int(n) for n in args.seqlens.split(',')]:
+        token_length = max(1, int(seqlen * args.prompt_ratio))
+        steps = min(args.decode_steps, seqlen - token_length)
+
+        start_time = time.time()
+        ref_first = legacy_first(seqlen, token_length)
+        legacy_first_time = time.time() - start_time
+        start_time = time.time()
+        ref_next = [legacy_next(seqlen, token_length + 1 + k) for k in range(steps)]
+        legacy_next_time = time.time() - start_time
+
+        mask = AttentionMask(seqlen, np.float16, -10000.0, np.int32)
+        start_time = time.time()
+        first = mask.first(token_length)
+        first_time = time.time() - start_time
+        exact = all(np.array_equal(a, b) for a, b in zip(first, ref_first))
+        start_time = time.time()
+        for k in range(steps):
+            mask.next(token_length + 1 + k)
+        next_time = time.time() - start_time
+        mask.first(token_length)
+        for k in range(steps):
+            exact &= all(np.array_equal(a, b) for a, b in zip(mask.next(token_length + 1 + k), ref_next[k]))
+
+        line = ("SEQLEN: {}, prompt: {} tokens, forward_first mask: {:.2f} ms -> {:.2f} ms, "
+                "forward_next mask: {:.1f} us -> {:.1f} us, identical to legacy: {}").format(
+                    seqlen, token_length, legacy_first_time * 1000, first_time * 1000,
+                    legacy_next_time / max(steps, 1) * 1e6, next_time / max(steps, 1) * 1e6, exact)
+        if not exact:
+            logging.error(line)
+            sys.exit(1)
+        logging.info(line)
+
+
+if __name__ == '__main__':
+    args = argsparser()
+    main(args)
@@ -0,0 +1,306 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+"""
+Checks and times python/llm_server.py without a TPU: sophon.sail is replaced by a stub whose
+EngineLLM has the graphs of a Qwen1.5 bmodel (embedding, embedding_cache, block_i,
+block_cache_i, lm_head, greedy_head). The stub blocks really read the kv cache and the
+attention mask, so the next token depends on the whole context of the conversation and a
+session decoded with the kv cache or the position of another one gives another answer.
+
+Several clients send a request at the same time, once to a server with a single kv cache slot
+(the conversations run one after the other like chat_stream) and once with --max_sessions
+slots. Every answer is compared with the one of the runner alone.
+"""
+import os
+import sys
+import json
+import time
+import types
+import argparse
+import logging
+import threading
+import urllib.request
+import numpy as np
+logging.basicConfig(level=logging.INFO)
+
+
+class Dtype:
+    BM_FLOAT32 = 0
+    BM_FLOAT16 = 1
+    BM_INT32 = 6
+    BM_BFLOAT16 = 11
+
+
+NP_DTYPES = {Dtype.BM_FLOAT32: np.float32, Dtype.BM_FLOAT16: np.float16,
+             Dtype.BM_INT32: np.int32, Dtype.BM_BFLOAT16: np.float16}
+
+
+class Handle:
+    def __init__(self, dev_id=0):
+        self.dev_id = dev_id
+
+
+class Tensor:
+    def __init__(self, handle, shape, dtype, own_sys_data=False, own_dev_data=True):
+        self.data = np.zeros(shape, NP_DTYPES[dtype])
+
+    def shape(self):
+        return list(self.data.shape)
+
+    def reshape(self, shape):
+        self.data = self.data.reshape(shape)
+
+    def update_data(self, arr):
+        arr = np.asarray(arr)
+        if self.data.dtype == np.float16 and arr.dtype == np.uint16:
+            arr = arr.view(np.float16)
+        if arr.dtype != self.data.dtype or arr.size != self.data.size:
+            raise TypeError('update_data got {} {} for a {} {} tensor'.format(
+                arr.dtype, arr.shape, self.data.dtype, self.data.shape))
+        self.data[...] = arr.reshape(self.data.shape)
+
+    def asnumpy(self):
+        # the runners call int() on one element outputs, numpy 2 only allows it for 0-d arrays
+        return self.data.reshape(()).copy() if self.data.size == 1 else self.data.copy()
+
+    def sync_d2d(self, src, src_offset, dst_offset, length):
+        self.data.reshape(-1)[dst_offset:dst_offset + length] = src.data.reshape(-1)[src_offset:src_offset + length]
+
+    def memory_set(self, value):
+        self.data[...] = value
+
+
+class StubEngineLLM:
+    """
+    Graph interface of sail.EngineLLM for a tiny model: hidden[..., 0] carries a hash of the
+    attended tokens, the key of a position is the hidden state entering the block.
+    """
+    MOD = 65521
+
+    def __init__(self, seqlen=256, num_layers=2, hidden=8, vocab=32, eos=2, prefill_ms=0.0, decode_ms=0.0):
+        self.seqlen, self.num_layers, self.hidden, self.vocab, self.eos = seqlen, num_layers, hidden, vocab, eos
+        self.prefill_s, self.decode_s = prefill_ms / 1000 / num_layers, decode_ms / 1000 / num_layers
+        kv = [1, seqlen, 1, hidden]
+        f32, f16, i32 = Dtype.BM_FLOAT32, Dtype.BM_FLOAT16, Dtype.BM_INT32
+        # name: (inputs, outputs) as lists of (shape, dtype)
+        self.graphs = {
+            "embedding": ([([1, seqlen], i32)], [([1, seqlen, hidden], f32)]),
+            "embedding_cache": ([([1, 1], i32)], [([1, hidden], f32)]),
+            "lm_head": ([([1, hidden], f32)], [([1, vocab], f32)]),
+            "greedy_head": ([([1, vocab], f32)], [([1], i32)]),
+            "penalty_sample_head": ([([1, vocab], f32)], [([1], i32)]),
+        }
+        for i in range(num_layers):
+            self.graphs["block_" + str(i)] = (
+                [([1, seqlen, hidden], f32), ([1, seqlen], i32), ([1, 1, seqlen, seqlen], f16)],
+                [([1, seqlen, hidden], f32), (kv, f32), (kv, f32)])
+            self.graphs["block_cache_" + str(i)] = (
+                [([1, 1, hidden], f32), ([1, 1], i32), ([1, 1, 1, seqlen + 1], f16), (kv, f32), (kv, f32)],
+                [([1, 1, hidden], f32), ([1, 1, 1, hidden], f32), ([1, 1, 1, hidden], f32)])
+
+    def get_graph_names(self):
+        return list(self.graphs)
+
+    def get_device_ids(self):
+        return [0]
+
+    def _io(self, name, idx, is_input):
+        io = self.graphs[name][0 if is_input else 1]
+        names = ["{}_{}_{}".format(name, 'in' if is_input else 'out', i) for i in range(len(io))]
+        return io[names.index(idx) if isinstance(idx, str) else idx], names
+
+    def get_input_names(self, name):
+        return self._io(name, 0, True)[1]
+
+    def get_output_names(self, name):
+        return self._io(name, 0, False)[1]
+
+    def get_input_shape(self, name, idx):
+        return list(self._io(name, idx, True)[0][0])
+
+    def get_output_shape(self, name, idx):
+        return list(self._io(name, idx, False)[0][0])
+
+    def get_input_dtype(self, name, idx):
+        return self._io(name, idx, True)[0][1]
+
+    def get_output_dtype(self, name, idx):
+        return self._io(name, idx, False)[0][1]
+
+    def process(self, name, inputs, outputs):
+        x = [inputs[i].data for i in range(len(inputs))]
+        y = [outputs[i] for i in range(len(outputs))]
+        if name in ("embedding", "embedding_cache"):
+            out = np.zeros(y[0].data.shape, np.float32).reshape(-1, self.hidden)
+            out[:, 0] = x[0].reshape(-1)
+            y[0].data[...] = out.reshape(y[0].data.shape)
+        elif name.startswith("block_cache_"):
+            time.sleep(self.decode_s)
+            layer = int(name.split('_')[-1])
+            cur = float(x[0].reshape(-1)[0])
+            pos = int(x[1].reshape(-1)[0])
+            valid = x[2].reshape(-1) == 0
+            past = x[3][0, :, 0, 0].astype(np.float64)
+            h = (past * np.arange(1, self.seqlen + 1))[valid[:-1]].sum() + (cur * (pos + 1) if valid[-1] else 0)
+            y[0].data[...] = 0
+            y[0].data.reshape(-1)[0] = (h + layer) % self.MOD
+            y[1].data[...] = 0
+            y[1].data.reshape(-1)[0] = cur
+            y[2].data[...] = y[1].data
+        elif name.startswith("block_"):
+            time.sleep(self.prefill_s)
+            layer = int(name.split('_')[-1])
+            hidden = x[0].reshape(self.seqlen, self.hidden)[:, 0].astype(np.float64)
+            valid = x[2].reshape(self.seqlen, self.seqlen) == 0
+            h = (valid * (hidden * np.arange(1, self.seqlen + 1))).sum(1)
+            for t in y[1:]:
+                t.data[...] = 0
+                t.data[0, :, 0, 0] = hidden
+            out = np.zeros((self.seqlen, self.hidden), np.float32)
+            out[:, 0] = (h + layer) % self.MOD
+            y[0].data[...] = out.reshape(y[0].data.shape)
+        elif name == "lm_head":
+            h = int(x[0].reshape(-1)[0])
+            logits = np.zeros(self.vocab, np.float32)
+            logits[self.eos if h % 23 == 0 else 3 + h % (self.vocab - 3)] = 1
+            y[0].data[...] = logits.reshape(y[0].data.shape)
+        else:
+            y[0].data[...] = np.argmax(x[0].reshape(-1))
+
+
+class StubTokenizer:
+    """
+    one token per character: 3 + letter index, 3 + 26 for everything else
+    """
+    eos_token_id = 2
+    CHARS = 'abcdefghijklmnopqrstuvwxyz '
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True):
+        text = ''.join("<|im_start|>{}\n{}<|im_end|>\n".format(m["role"], m["content"]) for m in messages)
+        return text + "<|im_start|>assistant\n" if add_generation_prompt else text
+
+    def __call__(self, text):
+        return types.SimpleNamespace(input_ids=[3 + self.CHARS.find(c) if c in self.CHARS[:-1] else 3 + 26
+                                                for c in text.lower()])
+
+    def decode(self, tokens):
+        return ''.join(self.CHARS[t - 3] if 3 <= t < 3 + len(self.CHARS) else '?' for t in tokens)
+
+
+def install_stub_sail():
+    sail = types.ModuleType('sophon.sail')
+    sail.Dtype, sail.Handle, sail.Tensor, sail.EngineLLM = Dtype, Handle, Tensor, StubEngineLLM
+    sophon = types.ModuleType('sophon')
+    sophon.sail = sail
+    sys.modules['sophon'] = sophon
+    sys.modules['sophon.sail'] = sail
+
+
+def argsparser():
+    parser = argparse.ArgumentParser(prog=__file__)
+    parser.add_argument('--clients', type=int, default=8, help='requests sent at the same time')
+    parser.add_argument('--max_sessions', type=int, default=4, help='kv cache slots of the server')
+    parser.add_argument('--max_tokens', type=int, default=64, help='max tokens per answer')
+    parser.add_argument('--seqlen', type=int, default=512, help='sequence length of the stub bmodel')
+    parser.add_argument('--prefill_ms', type=float, default=40.0, help='simulated forward_first time')
+    parser.add_argument('--decode_ms', type=float, default=10.0, help='simulated forward_next time')
+    parser.add_argument('--port', type=int, default=0, help='server port, 0 picks a free one')
+    args = parser.parse_args()
+    return args
+
+
+def reference(runner, messages, max_tokens):
+    # decode one conversation with the runner alone, the way chat_stream does
+    output = []
+    token = runner.forward_first(runner.encode_messages(messages))
+    while token != runner.EOS:
+        output.append(token)
+        if len(output) >= max_tokens or runner.token_length >= runner.SEQLEN:
+            break
+        runner.token_length += 1
+        token = runner.forward_next()
+    return runner.decode_tokens(output)
+
+
+def request(url, messages, max_tokens, result):
+    body = json.dumps({"messages": messages, "max_tokens": max_tokens, "stream": True}).encode('utf-8')
+    req = urllib.request.Request(url, body, {'Content-Type': 'application/json'})
+    start_time = time.time()
+    text, first_time, usage = '', None, None
+    with urllib.request.urlopen(req) as response:
+        for line in response:
+            line = line.decode('utf-8').strip()
+            if not line.startswith('data: ') or line == 'data: [DONE]':
+                continue
+            chunk = json.loads(line[len('data: '):])
+            content = chunk["choices"][0]["delta"].get("content")
+            if content:
+                first_time = first_time or time.time()
+                text += content
+            usage = chunk.get("usage", usage)
+    result.update(text=text, ftl=(first_time or time.time()) - start_time, duration=time.time() - start_time,
+                  usage=usage)
+
+
+def run_clients(runner, conversations, max_sessions, args):
+    from llm_server import make_server
+    server = make_server(runner, '127.0.0.1', args.port, max_sessions, 'stub')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/v1/chat/completions'.format(server.server_address[1])
+    results = [{} for _ in conversations]
+    threads = [threading.Thread(target=request, args=(url, messages, args.max_tokens, result))
+               for messages, result in zip(conversations, results)]
+    start_time = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall_time = time.time() - start_time
+    server.shutdown()
+    server.server_close()
+    server.scheduler.stop()
+    return results, wall_time
+
+
+def main(args):
+    install_stub_sail()
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../python'))
+    import sophon.sail as sail
+    from qwen1_5 import Qwen1_5
+    engine = sail.EngineLLM(args.seqlen, prefill_ms=args.prefill_ms, decode_ms=args.decode_ms)
+    runner = Qwen1_5(sail.Handle(0), engine, StubTokenizer())
+
+    rng = np.random.default_rng(0)
+    words = ['tpu', 'sophon', 'model', 'token', 'cache', 'server', 'stream', 'kernel']
+    conversations = []
+    for i in range(args.clients):
+        question = ' '.join(rng.choice(words, 3 + i % 4))
+        conversations.append([{"role": "user", "content": "hello"},
+                              {"role": "assistant", "content": "hi"},
+                              {"role": "user", "content": question}])
+    expected = [reference(runner, messages, args.max_tokens) for messages in conversations]
+
+    for max_sessions in (1, args.max_sessions):
+        results, wall_time = run_clients(runner, conversations, max_sessions, args)
+        ftl = np.array([r["ftl"] for r in results])
+        tps = np.array([r["usage"]["tokens_per_second"] for r in results])
+        tokens = sum(r["usage"]["completion_tokens"] for r in results)
+        logging.info("max_sessions: {}, clients: {}, first token latency avg/max: {:.3f}/{:.3f} s, "
+                     "per-request TPS avg: {:.1f} token/s, total: {:.1f} token/s".format(
+                         max_sessions, args.clients, ftl.mean(), ftl.max(), tps.mean(), tokens / wall_time))
+        mismatches = [i for i, r in enumerate(results) if r["text"] != expected[i]]
+        if mismatches:
+            logging.error("answers of requests {} differ from the runner alone".format(mismatches))
+            sys.exit(1)
+    logging.info("all answers identical to the runner alone")
+
+
+if __name__ == '__main__':
+    args = argsparser()
+    main(args)
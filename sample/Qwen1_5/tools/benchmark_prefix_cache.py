@@ -0,0 +1,90 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+"""
+Checks and times python/prefix_cache.py without a TPU, with the stub sophon.sail of
+benchmark_llm_server.py. A multi-turn conversation goes through Qwen1_5.chat_stream, which only
+runs the tokens after the prefix shared with the kv cache, and every answer is compared with the
+one of a second runner prefilling the whole history at every turn.
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+import numpy as np
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from benchmark_llm_server import install_stub_sail, StubTokenizer
+logging.basicConfig(level=logging.INFO)
+
+
+def argsparser():
+    parser = argparse.ArgumentParser(prog=__file__)
+    parser.add_argument('--turns', type=int, default=6, help='questions of the conversation')
+    parser.add_argument('--seqlen', type=int, default=1024, help='sequence length of the stub bmodel')
+    parser.add_argument('--prefill_ms', type=float, default=300.0, help='simulated forward_first time')
+    parser.add_argument('--decode_ms', type=float, default=2.0, help='simulated forward_next time')
+    args = parser.parse_args()
+    return args
+
+
+def full_prefill(runner, history, question):
+    # the answer of chat_stream without prefix reuse: forward_first on the whole history
+    tokens = runner.encode_messages(history + [{"role": "user", "content": question}])
+    output = []
+    start_time = time.time()
+    token = runner.forward_first(tokens)
+    ftl = time.time() - start_time
+    while token != runner.EOS and runner.token_length < runner.SEQLEN:
+        output.append(token)
+        runner.token_length += 1
+        token = runner.forward_next()
+    return runner.decode_tokens(output), ftl
+
+
+def main(args):
+    install_stub_sail()
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../python'))
+    import sophon.sail as sail
+    from qwen1_5 import Qwen1_5
+    engine = sail.EngineLLM(args.seqlen, prefill_ms=args.prefill_ms, decode_ms=args.decode_ms)
+    runner = Qwen1_5(sail.Handle(0), engine, StubTokenizer())
+    reference = Qwen1_5(sail.Handle(0), engine, StubTokenizer())
+
+    rng = np.random.default_rng(0)
+    words = ['tpu', 'sophon', 'model', 'token', 'cache', 'server', 'stream', 'kernel']
+    history = []
+    ftls, ref_ftls = [], []
+    for turn in range(args.turns):
+        question = ' '.join(rng.choice(words, 2 + turn % 3))
+        expected, ref_ftl = full_prefill(reference, history, question)
+
+        start_time = time.time()
+        ftl = None
+        answer = ''
+        for piece in runner.chat_stream(question, history):
+            ftl = ftl or time.time() - start_time
+            answer += piece
+        ftl = ftl or time.time() - start_time
+        if answer != expected:
+            logging.error("turn {}: answer {!r} differs from the full prefill {!r}".format(turn, answer, expected))
+            sys.exit(1)
+        logging.info("turn {}: {} prompt tokens, {} reused, first token latency: {:.3f} s -> {:.3f} s".format(
+            turn, len(reference.encode_messages(history + [{"role": "user", "content": question}])),
+            runner.prefix_cache.reused, ref_ftl, ftl))
+        ftls.append(ftl)
+        ref_ftls.append(ref_ftl)
+        history.append({"role": "user", "content": question})
+        history.append({"role": "assistant", "content": answer})
+    logging.info("average first token latency after the first turn: {:.3f} s -> {:.3f} s, answers identical".format(
+        np.mean(ref_ftls[1:]), np.mean(ftls[1:])))
+
+
+if __name__ == '__main__':
+    args = argsparser()
+    main(args)
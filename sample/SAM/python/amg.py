@@ -10,7 +10,7 @@ import torch
 import math
 from copy import deepcopy
 from itertools import product
-from typing import Any, Dict, Generator, ItemsView, List, Tuple
+from typing import Any, Dict, Generator, ItemsView, List, Optional, Tuple
 
 
 class MaskData:
@@ -22,14 +22,14 @@ class MaskData:
     def __init__(self, **kwargs) -> None:
         for v in kwargs.values():
             assert isinstance(
-                v, (list, np.ndarray, torch.Tensor)
-            ), "MaskData only supports list, numpy arrays, and torch tensors."
+                v, (list, np.ndarray, torch.Tensor, RleBatch)
+            ), "MaskData only supports list, numpy arrays, torch tensors and RleBatch."
         self._stats = dict(**kwargs)
 
     def __setitem__(self, key: str, item: Any) -> None:
         assert isinstance(
-            item, (list, np.ndarray, torch.Tensor)
-        ), "MaskData only supports list, numpy arrays, and torch tensors."
+            item, (list, np.ndarray, torch.Tensor, RleBatch)
+        ), "MaskData only supports list, numpy arrays, torch tensors and RleBatch."
         self._stats[key] = item
 
     def __delitem__(self, key: str) -> None:
@@ -48,7 +48,9 @@ class MaskData:
             elif isinstance(v, torch.Tensor):
                 self._stats[k] = v[torch.as_tensor(keep, device=v.device)]
             elif isinstance(v, np.ndarray):
-                self._stats[k] = v[keep.detach().cpu().numpy()]
+                self._stats[k] = v[_keep_to_numpy(keep)]
+            elif isinstance(v, RleBatch):
+                self._stats[k] = v.take(_keep_to_numpy(keep))
             elif isinstance(v, list) and keep.dtype == torch.bool:
                 self._stats[k] = [a for i, a in enumerate(v) if keep[i]]
             elif isinstance(v, list):
@@ -64,6 +66,8 @@ class MaskData:
                 self._stats[k] = torch.cat([self._stats[k], v], dim=0)
             elif isinstance(v, np.ndarray):
                 self._stats[k] = np.concatenate([self._stats[k], v], axis=0)
+            elif isinstance(v, RleBatch):
+                self._stats[k] = RleBatch.cat([self._stats[k], v])
             elif isinstance(v, list):
                 self._stats[k] = self._stats[k] + deepcopy(v)
             else:
@@ -75,6 +79,101 @@ class MaskData:
                 self._stats[k] = v.detach().cpu().numpy()
 
 
+def _keep_to_numpy(keep: Any) -> np.ndarray:
+    if isinstance(keep, torch.Tensor):
+        return keep.detach().cpu().numpy()
+    return np.asarray(keep)
+
+
+class RleBatch:
+    """
+    Uncompressed RLEs of a batch of masks with the same size, stored as one
+    array with the run lengths of all masks and the offsets of each mask's
+    runs in it. Runs are in column major order and start with a run of zeros,
+    as in pycocotools. Indexing with an int gives the usual RLE dict, indexing
+    with indices or a boolean mask gives a new RleBatch.
+    """
+
+    def __init__(self, counts: np.ndarray, offsets: np.ndarray, size: Tuple[int, int]) -> None:
+        self.counts = counts
+        self.offsets = offsets
+        self.size = [int(size[0]), int(size[1])]
+
+    @classmethod
+    def from_masks(cls, masks: np.ndarray) -> "RleBatch":
+        return mask_to_rle_numpy(masks)
+
+    @classmethod
+    def from_list(cls, rles: List[Dict[str, Any]], size: Optional[Tuple[int, int]] = None) -> "RleBatch":
+        if size is None:
+            size = rles[0]["size"]
+        lengths = np.array([len(rle["counts"]) for rle in rles], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        counts = np.concatenate([np.asarray(rle["counts"], dtype=np.int32) for rle in rles] + [np.zeros(0, np.int32)])
+        return cls(counts, offsets, size)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: Any) -> Any:
+        if isinstance(idx, (int, np.integer)):
+            idx = range(len(self))[idx]
+            counts = self.counts[self.offsets[idx] : self.offsets[idx + 1]]
+            return {"size": list(self.size), "counts": counts.tolist()}
+        if isinstance(idx, slice):
+            idx = np.arange(len(self))[idx]
+        return self.take(_keep_to_numpy(idx))
+
+    def __iter__(self) -> Generator[Dict[str, Any], None, None]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def take(self, idx: np.ndarray) -> "RleBatch":
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        lengths = self.lengths()[idx]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        src = np.arange(offsets[-1]) + np.repeat(self.offsets[idx] - offsets[:-1], lengths)
+        return RleBatch(self.counts[src], offsets, self.size)
+
+    @staticmethod
+    def cat(batches: List["RleBatch"]) -> "RleBatch":
+        counts = np.concatenate([b.counts for b in batches])
+        starts = np.cumsum([0] + [len(b.counts) for b in batches[:-1]])
+        offsets = np.concatenate([[0]] + [b.offsets[1:] + s for b, s in zip(batches, starts)])
+        return RleBatch(counts, offsets, batches[0].size)
+
+    def replace(self, idx: np.ndarray, other: "RleBatch") -> "RleBatch":
+        """Returns a copy with the RLEs at idx replaced by the RLEs of other."""
+        order = np.arange(len(self))
+        order[idx] = len(self) + np.arange(len(other))
+        return RleBatch.cat([self, other]).take(order)
+
+    def _parity(self) -> np.ndarray:
+        # Position of every run in its mask, odd runs are foreground
+        run_idx = np.arange(len(self.counts)) - np.repeat(self.offsets[:-1], self.lengths())
+        return (run_idx % 2).astype(bool)
+
+    def areas(self) -> np.ndarray:
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        fg = np.where(self._parity(), self.counts, 0).astype(np.int64)
+        return np.add.reduceat(fg, self.offsets[:-1])
+
+    def to_masks(self) -> np.ndarray:
+        """Decodes all RLEs to an NxHxW boolean array."""
+        h, w = self.size
+        mask = np.repeat(self._parity(), self.counts)
+        return mask.reshape(len(self), w, h).transpose(0, 2, 1)
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return list(self)
+
+
 def is_box_near_crop_edge(
     boxes: torch.Tensor, crop_box: List[int], orig_box: List[int], atol: float = 20.0
 ) -> torch.Tensor:
@@ -88,6 +187,19 @@ def is_box_near_crop_edge(
     return torch.any(near_crop_edge, dim=1)
 
 
+def is_box_near_crop_edge_numpy(
+    boxes: np.ndarray, crop_box: List[int], orig_box: List[int], atol: float = 20.0
+) -> np.ndarray:
+    """NumPy version of is_box_near_crop_edge."""
+    x0, y0, _, _ = crop_box
+    crop_box_np = np.asarray(crop_box, dtype=np.float32)
+    orig_box_np = np.asarray(orig_box, dtype=np.float32)
+    boxes = (boxes + np.array([x0, y0, x0, y0])).astype(np.float32)
+    near_crop_edge = np.abs(boxes - crop_box_np[None, :]) <= atol
+    near_image_edge = np.abs(boxes - orig_box_np[None, :]) <= atol
+    return np.any(near_crop_edge & ~near_image_edge, axis=1)
+
+
 def box_xyxy_to_xywh(box_xyxy: torch.Tensor) -> torch.Tensor:
     box_xywh = deepcopy(box_xyxy)
     box_xywh[2] = box_xywh[2] - box_xywh[0]
@@ -135,16 +247,45 @@ def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
     return out
 
 
+def mask_to_rle_numpy(masks: np.ndarray) -> RleBatch:
+    """
+    Encodes a BxHxW boolean array to uncompressed RLEs, all masks at once.
+    The runs are the same as mask_to_rle_pytorch.
+    """
+    b, h, w = masks.shape
+    # Put in fortran order and flatten h,w
+    flat = masks.transpose(0, 2, 1).reshape(b, h * w)
+    if b == 0:
+        return RleBatch(np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64), (h, w))
+
+    # Compute change indices, sorted by mask then position
+    mask_idx, change_idx = np.divmod(np.flatnonzero(flat[:, 1:] != flat[:, :-1]), h * w - 1)
+    n_changes = np.bincount(mask_idx, minlength=b)
+    starts_one = flat[:, 0].astype(np.int64)
+
+    # Run ends of each mask: the change indices + 1, then h * w
+    n_runs = n_changes + 1
+    run_offsets = np.concatenate([[0], np.cumsum(n_runs)])
+    change_offsets = np.concatenate([[0], np.cumsum(n_changes)])
+    ends = np.empty(run_offsets[-1], dtype=np.int64)
+    ends[run_offsets[:-1][mask_idx] + np.arange(len(mask_idx)) - change_offsets[:-1][mask_idx]] = change_idx + 1
+    ends[run_offsets[1:] - 1] = h * w
+    runs = np.diff(ends, prepend=0)
+    runs[run_offsets[:-1]] = ends[run_offsets[:-1]]
+
+    # Masks starting with a foreground pixel get a leading run of zero length
+    offsets = np.concatenate([[0], np.cumsum(n_runs + starts_one)])
+    counts = np.zeros(offsets[-1], dtype=np.int32)
+    run_mask = np.repeat(np.arange(b), n_runs)
+    counts[np.arange(len(runs)) - run_offsets[:-1][run_mask] + offsets[:-1][run_mask] + starts_one[run_mask]] = runs
+    return RleBatch(counts, offsets, (h, w))
+
+
 def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
     """Compute a binary mask from an uncompressed RLE."""
     h, w = rle["size"]
-    mask = np.empty(h * w, dtype=bool)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    mask = np.repeat(np.arange(len(counts)) % 2 == 1, counts)
     mask = mask.reshape(w, h)
     return mask.transpose()  # Put in C order
 
@@ -176,6 +317,16 @@ def calculate_stability_score(
     return intersections / unions
 
 
+def calculate_stability_score_numpy(
+    masks: np.ndarray, mask_threshold: float, threshold_offset: float
+) -> np.ndarray:
+    """NumPy version of calculate_stability_score."""
+    intersections = (masks > (mask_threshold + threshold_offset)).sum(axis=(-1, -2))
+    unions = (masks > (mask_threshold - threshold_offset)).sum(axis=(-1, -2))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (intersections / unions).astype(np.float32)
+
+
 def build_point_grid(n_per_side: int) -> np.ndarray:
     """Generates a 2D grid of points evenly spaced in [0,1]x[0,1]."""
     offset = 1 / (2 * n_per_side)
@@ -344,3 +495,21 @@ def batched_mask_to_box(masks: torch.Tensor) -> torch.Tensor:
         out = out[0]
 
     return out
+
+
+def batched_mask_to_box_numpy(masks: np.ndarray) -> np.ndarray:
+    """
+    NumPy version of batched_mask_to_box: boxes in XYXY format around masks,
+    [0,0,0,0] for an empty mask. For input shape C1xC2x...xHxW, the output
+    shape is C1xC2x...x4.
+    """
+    h, w = masks.shape[-2:]
+    in_height = masks.any(axis=-1)
+    in_width = masks.any(axis=-2)
+    top_edges = in_height.argmax(axis=-1)
+    bottom_edges = h - 1 - in_height[..., ::-1].argmax(axis=-1)
+    left_edges = in_width.argmax(axis=-1)
+    right_edges = w - 1 - in_width[..., ::-1].argmax(axis=-1)
+    out = np.stack([left_edges, top_edges, right_edges, bottom_edges], axis=-1)
+    # Replace the boxes of empty masks with [0, 0, 0, 0]
+    return out * in_height.any(axis=-1)[..., None]
@@ -14,20 +14,16 @@ from sam_model import Sam
 from predictor import SamPredictor
 from amg import (
     MaskData,
-    area_from_rle,
+    RleBatch,
     batch_iterator,
-    batched_mask_to_box,
-    box_xyxy_to_xywh,
+    batched_mask_to_box_numpy,
     build_all_layer_point_grids,
-    calculate_stability_score,
+    calculate_stability_score_numpy,
     coco_encode_rle,
     generate_crop_boxes,
-    is_box_near_crop_edge,
-    mask_to_rle_pytorch,
+    is_box_near_crop_edge_numpy,
     remove_small_regions,
-    rle_to_mask,
     uncrop_boxes_xyxy,
-    uncrop_masks,
     uncrop_points,
 )
 
@@ -171,25 +167,38 @@ class SamAutomaticMaskGenerator:
                 max(self.box_nms_thresh, self.crop_nms_thresh),
             )
 
-        # Encode masks
+        return self.write_records(mask_data)
+
+    def write_records(self, mask_data: MaskData) -> List[Dict[str, Any]]:
+        """Encodes the masks in the output mode and writes one record per mask."""
+        rles = mask_data["rles"]
+        if len(rles) == 0:
+            return []
         if self.output_mode == "coco_rle":
-            mask_data["segmentations"] = [coco_encode_rle(rle) for rle in mask_data["rles"]]
+            segmentations = [coco_encode_rle(rle) for rle in rles]
         elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
+            segmentations = list(rles.to_masks())
         else:
-            mask_data["segmentations"] = mask_data["rles"]
+            segmentations = rles.to_list()
+
+        # Box statistics of all masks at once, XYXY to XYWH
+        areas = rles.areas().tolist()
+        boxes = np.array(mask_data["boxes"])
+        boxes[:, 2:] -= boxes[:, :2]
+        crop_boxes = np.array(mask_data["crop_boxes"])
+        crop_boxes[:, 2:] -= crop_boxes[:, :2]
 
         # Write mask records
         curr_anns = []
-        for idx in range(len(mask_data["segmentations"])):
+        for idx in range(len(segmentations)):
             ann = {
-                "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
-                "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
+                "segmentation": segmentations[idx],
+                "area": areas[idx],
+                "bbox": boxes[idx].tolist(),
                 "predicted_iou": mask_data["iou_preds"][idx].item(),
                 "point_coords": [mask_data["points"][idx].tolist()],
                 "stability_score": mask_data["stability_score"][idx].item(),
-                "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
+                "crop_box": crop_boxes[idx].tolist(),
             }
             curr_anns.append(ann)
 
@@ -260,7 +269,7 @@ class SamAutomaticMaskGenerator:
         # Return to the original image frame
         data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
         data["points"] = uncrop_points(data["points"], crop_box)
-        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["rles"]))])
+        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["rles"]))]).reshape(-1, 4)
 
         return data
 
@@ -283,43 +292,74 @@ class SamAutomaticMaskGenerator:
             multimask_output=True,
             return_logits=True,
         )
-
-        # Serialize predictions and store in MaskData
-        data = MaskData(
-            masks=masks.flatten(0, 1),
-            iou_preds=iou_preds.flatten(0, 1),
-            points=torch.as_tensor(points.repeat(masks.shape[1], axis=0)),
+        return self.postprocess_batch(
+            masks.cpu().numpy(), iou_preds.cpu().numpy(), points, crop_box, orig_size
         )
-        del masks
+
+    def postprocess_batch(
+        self,
+        masks: np.ndarray,
+        iou_preds: np.ndarray,
+        points: np.ndarray,
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+    ) -> MaskData:
+        """
+        Filters the masks predicted for a batch of points and compresses them
+        to RLE. The mask statistics of the whole batch are computed in NumPy.
+
+        Arguments:
+          masks (np.ndarray): Mask logits in BxCxHxW format, at the crop size.
+          iou_preds (np.ndarray): The predicted mask quality, in BxC format.
+          points (np.ndarray): The B point prompts, in crop coordinates.
+          crop_box (list(int)): The crop, in XYXY format.
+          orig_size (tuple(int, int)): The size of the image, in (H, W) format.
+
+        Returns:
+          (MaskData): The kept masks, with the RLEs in an RleBatch.
+        """
+        orig_h, orig_w = orig_size
+        num_per_point = masks.shape[1]
+        masks = masks.reshape(-1, *masks.shape[-2:])
+        iou_preds = iou_preds.reshape(-1)
+        points = points.repeat(num_per_point, axis=0)
+        idx = np.arange(len(masks))
 
         # Filter by predicted IoU
         if self.pred_iou_thresh > 0.0:
-            keep_mask = data["iou_preds"] > self.pred_iou_thresh
-            data.filter(keep_mask)
+            idx = idx[iou_preds > self.pred_iou_thresh]
 
         # Calculate stability score
-        data["stability_score"] = calculate_stability_score(
-            data["masks"], self.predictor.model.mask_threshold, self.stability_score_offset
+        stability_score = calculate_stability_score_numpy(
+            masks[idx], self.predictor.model.mask_threshold, self.stability_score_offset
         )
         if self.stability_score_thresh > 0.0:
-            keep_mask = data["stability_score"] >= self.stability_score_thresh
-            data.filter(keep_mask)
+            keep_mask = stability_score >= self.stability_score_thresh
+            idx, stability_score = idx[keep_mask], stability_score[keep_mask]
 
         # Threshold masks and calculate boxes
-        data["masks"] = data["masks"] > self.predictor.model.mask_threshold
-        data["boxes"] = batched_mask_to_box(data["masks"])
+        binary_masks = masks[idx] > self.predictor.model.mask_threshold
+        boxes = batched_mask_to_box_numpy(binary_masks)
 
         # Filter boxes that touch crop boundaries
-        keep_mask = ~is_box_near_crop_edge(data["boxes"], crop_box, [0, 0, orig_w, orig_h])
-        if not torch.all(keep_mask):
-            data.filter(keep_mask)
+        keep_mask = ~is_box_near_crop_edge_numpy(boxes, crop_box, [0, 0, orig_w, orig_h])
+        if not np.all(keep_mask):
+            idx, stability_score, boxes = idx[keep_mask], stability_score[keep_mask], boxes[keep_mask]
+            binary_masks = binary_masks[keep_mask]
 
         # Compress to RLE
-        data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
-        data["rles"] = mask_to_rle_pytorch(data["masks"])
-        del data["masks"]
-
-        return data
+        x0, y0, x1, y1 = crop_box
+        if x0 != 0 or y0 != 0 or x1 != orig_w or y1 != orig_h:
+            pad_x, pad_y = orig_w - (x1 - x0), orig_h - (y1 - y0)
+            binary_masks = np.pad(binary_masks, ((0, 0), (y0, pad_y - y0), (x0, pad_x - x0)))
+
+        return MaskData(
+            iou_preds=torch.as_tensor(iou_preds[idx]),
+            points=torch.as_tensor(points[idx]),
+            stability_score=torch.as_tensor(stability_score),
+            boxes=torch.as_tensor(boxes),
+            rles=RleBatch.from_masks(binary_masks),
+        )
 
     @staticmethod
     def postprocess_small_regions(
@@ -337,37 +377,36 @@ class SamAutomaticMaskGenerator:
             return mask_data
 
         # Filter small disconnected regions and holes
+        rles = mask_data["rles"]
         new_masks = []
         scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
-
+        for mask in rles.to_masks():
             mask, changed = remove_small_regions(mask, min_area, mode="holes")
             unchanged = not changed
             mask, changed = remove_small_regions(mask, min_area, mode="islands")
             unchanged = unchanged and not changed
 
-            new_masks.append(torch.as_tensor(mask).unsqueeze(0))
+            new_masks.append(mask)
             # Give score=0 to changed masks and score=1 to unchanged masks
             # so NMS will prefer ones that didn't need postprocessing
             scores.append(float(unchanged))
 
         # Recalculate boxes and remove any new duplicates
-        masks = torch.cat(new_masks, dim=0)
-        boxes = batched_mask_to_box(masks)
+        masks = np.stack(new_masks)
+        boxes = batched_mask_to_box_numpy(masks)
         keep_by_nms = batched_nms(
-            boxes.float(),
+            torch.as_tensor(boxes).float(),
             torch.as_tensor(scores),
-            torch.zeros_like(boxes[:, 0]),  # categories
+            torch.zeros(len(boxes)),  # categories
             iou_threshold=nms_thresh,
         )
 
         # Only recalculate RLEs for masks that have changed
-        for i_mask in keep_by_nms:
-            if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
-                mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
+        keep = keep_by_nms.numpy()
+        changed = keep[np.asarray(scores)[keep] == 0.0]
+        if len(changed):
+            mask_data["rles"] = rles.replace(changed, RleBatch.from_masks(masks[changed]))
+            mask_data["boxes"][changed] = boxes[changed]  # update res directly
         mask_data.filter(keep_by_nms)
 
         return mask_data
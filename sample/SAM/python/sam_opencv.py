@@ -23,20 +23,9 @@ import matplotlib.pyplot as plt
 import logging
 from amg import (
     MaskData,
-    area_from_rle,
     batch_iterator,
-    batched_mask_to_box,
-    box_xyxy_to_xywh,
-    build_all_layer_point_grids,
-    calculate_stability_score,
-    coco_encode_rle,
     generate_crop_boxes,
-    is_box_near_crop_edge,
-    mask_to_rle_pytorch,
-    remove_small_regions,
-    rle_to_mask,
     uncrop_boxes_xyxy,
-    uncrop_masks,
     uncrop_points,
 )
 logging.basicConfig(level=logging.INFO)
@@ -298,50 +287,13 @@ class SAM_b(object):
                 iou_preds = output_mask[list(output_mask.keys())[2]]
                 low_res_logits = torch.from_numpy(low_res_logits)
 
-                input_image = predictor.transform.apply_image(image)
-                input_image_torch = torch.as_tensor(input_image, device=predictor.device)
-                input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
-                low_res_logits = sam.postprocess_masks(low_res_logits,tuple(input_image_torch.shape[-2:]),image.shape[:2] )
+                # masks at the crop size, the same as SamPredictor.predict_torch
+                masks = sam.postprocess_masks(low_res_logits, predictor.input_size, cropped_im_size)
 
-                masks = low_res_logits
-
-                iou_preds = torch.from_numpy(iou_preds)
-
-                # Serialize predictions and store in MaskData
-                data_batch = MaskData(
-                    masks=masks.flatten(0, 1),
-                    iou_preds=iou_preds.flatten(0, 1),
-                    points=torch.as_tensor(points.repeat(masks.shape[1], axis=0)),
-                )
-                del masks
-
-                # Filter by predicted IoU
-                if mask_generator.pred_iou_thresh > 0.0:
-                    keep_mask = data_batch["iou_preds"] > mask_generator.pred_iou_thresh
-                    data_batch.filter(keep_mask)
-
-                # Calculate stability score
-                data_batch["stability_score"] = calculate_stability_score(
-                    data_batch["masks"], mask_generator.predictor.model.mask_threshold, mask_generator.stability_score_offset
+                # Filter the masks and compress them to RLE, statistics of the whole batch in NumPy
+                data_batch = mask_generator.postprocess_batch(
+                    masks.numpy(), iou_preds, points, crop_box, orig_size
                 )
-                if mask_generator.stability_score_thresh > 0.0:
-                    keep_mask = data_batch["stability_score"] >= mask_generator.stability_score_thresh
-                    data_batch.filter(keep_mask)
-
-                # Threshold masks and calculate boxes
-                data_batch["masks"] = data_batch["masks"] > mask_generator.predictor.model.mask_threshold
-                data_batch["boxes"] = batched_mask_to_box(data_batch["masks"])
-
-                # Filter boxes that touch crop boundaries
-                orig_h, orig_w = orig_size
-                keep_mask = ~is_box_near_crop_edge(data_batch["boxes"], crop_box, [0, 0, orig_w, orig_h])
-                if not torch.all(keep_mask):
-                    data_batch.filter(keep_mask)
-
-                # Compress to RLE
-                data_batch["masks"] = uncrop_masks(data_batch["masks"], crop_box, orig_h, orig_w)
-                data_batch["rles"] = mask_to_rle_pytorch(data_batch["masks"])
-                del data_batch["masks"]
 
                 data_crop.cat(data_batch)
 
@@ -361,7 +313,7 @@ class SAM_b(object):
             # Return to the original image frame
             data_crop["boxes"] = uncrop_boxes_xyxy(data_crop["boxes"], crop_box)
             data_crop["points"] = uncrop_points(data_crop["points"], crop_box)
-            data_crop["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data_crop["rles"]))])
+            data_crop["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data_crop["rles"]))]).reshape(-1, 4)
             
             data_mask.cat(data_crop)   
             self.postprocess_time += time.time() - start_time
@@ -388,27 +340,8 @@ class SAM_b(object):
                 max(mask_generator.box_nms_thresh, mask_generator.crop_nms_thresh),
             )
 
-        # Encode masks
-        if mask_generator.output_mode == "coco_rle":
-            data_mask["segmentations"] = [coco_encode_rle(rle) for rle in data_mask["rles"]]
-        elif mask_generator.output_mode == "binary_mask":
-            data_mask["segmentations"] = [rle_to_mask(rle) for rle in data_mask["rles"]]
-        else:
-            data_mask["segmentations"] = data_mask["rles"]
-
-        # Write mask records
-        curr_anns = []
-        for idx in range(len(data_mask["segmentations"])):
-            ann = {
-                "segmentation": data_mask["segmentations"][idx],
-                "area": area_from_rle(data_mask["rles"][idx]),
-                "bbox": box_xyxy_to_xywh(data_mask["boxes"][idx]).tolist(),
-                "predicted_iou": data_mask["iou_preds"][idx].item(),
-                "point_coords": [data_mask["points"][idx].tolist()],
-                "stability_score": data_mask["stability_score"][idx].item(),
-                "crop_box": box_xyxy_to_xywh(data_mask["crop_boxes"][idx]).tolist(),
-            }
-            curr_anns.append(ann)
+        # Encode masks and write mask records
+        curr_anns = mask_generator.write_records(data_mask)
         self.postprocess_time += time.time() - start_time
         
         # Save result
@@ -0,0 +1,213 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+import os
+import sys
+import time
+import types
+import argparse
+import logging
+import numpy as np
+import torch
+from torchvision.ops.boxes import batched_nms, box_area
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../python'))
+from sam_model import Sam
+from automatic_mask_generator import SamAutomaticMaskGenerator
+from amg import (
+    MaskData,
+    area_from_rle,
+    batch_iterator,
+    batched_mask_to_box,
+    box_xyxy_to_xywh,
+    calculate_stability_score,
+    coco_encode_rle,
+    generate_crop_boxes,
+    is_box_near_crop_edge,
+    mask_to_rle_pytorch,
+    rle_to_mask,
+    uncrop_boxes_xyxy,
+    uncrop_masks,
+    uncrop_points,
+)
+logging.basicConfig(level=logging.INFO)
+
+
+def argsparser():
+    parser = argparse.ArgumentParser(prog=__file__)
+    parser.add_argument('--image_size', type=str, default='1200,1800', help='image height,width')
+    parser.add_argument('--points_per_side', type=int, default=32)
+    parser.add_argument('--points_per_batch', type=int, default=64)
+    parser.add_argument('--pred_iou_thresh', type=float, default=0.88)
+    parser.add_argument('--stability_score_thresh', type=float, default=0.95)
+    parser.add_argument('--crop_n_layers', type=int, default=0)
+    parser.add_argument('--min_mask_region_area', type=int, default=0)
+    parser.add_argument('--output_mode', type=str, default='binary_mask')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def synthetic_decoder_outputs(points, rng):
+    """low resolution logits (Bx3x256x256) of three nested ellipses around every point, and iou predictions"""
+    scale = 256 / 1024
+    grid = np.arange(256, dtype=np.float32) + 0.5
+    logits = np.empty((len(points), 3, 256, 256), dtype=np.float32)
+    for i, (x, y) in enumerate(points * scale):
+        for j, radius in enumerate(rng.uniform(4, 40) * np.array([1.0, 1.8, 3.0])):
+            rx, ry = radius, radius * rng.uniform(0.5, 1.5)
+            d = np.sqrt(((grid[None, :] - x) / rx) ** 2 + ((grid[:, None] - y) / ry) ** 2)
+            logits[i, j] = rng.uniform(3, 10) * min(rx, ry) * (1 - d) + rng.normal(0, 0.5, (256, 256))
+    iou_preds = rng.uniform(0.8, 1.0, (len(points), 3)).astype(np.float32)
+    return logits, iou_preds
+
+
+def legacy_postprocess_batch(gen, masks, iou_preds, points, crop_box, orig_size):
+    """the torch per batch post process used before postprocess_batch"""
+    orig_h, orig_w = orig_size
+    data = MaskData(
+        masks=masks.flatten(0, 1),
+        iou_preds=torch.from_numpy(iou_preds).flatten(0, 1),
+        points=torch.as_tensor(points.repeat(masks.shape[1], axis=0)),
+    )
+    if gen.pred_iou_thresh > 0.0:
+        data.filter(data["iou_preds"] > gen.pred_iou_thresh)
+    data["stability_score"] = calculate_stability_score(
+        data["masks"], gen.predictor.model.mask_threshold, gen.stability_score_offset
+    )
+    if gen.stability_score_thresh > 0.0:
+        data.filter(data["stability_score"] >= gen.stability_score_thresh)
+    data["masks"] = data["masks"] > gen.predictor.model.mask_threshold
+    data["boxes"] = batched_mask_to_box(data["masks"])
+    keep_mask = ~is_box_near_crop_edge(data["boxes"], crop_box, [0, 0, orig_w, orig_h])
+    if not torch.all(keep_mask):
+        data.filter(keep_mask)
+    data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
+    data["rles"] = mask_to_rle_pytorch(data["masks"])
+    del data["masks"]
+    return data
+
+
+def legacy_write_records(gen, mask_data):
+    if gen.output_mode == "coco_rle":
+        segmentations = [coco_encode_rle(rle) for rle in mask_data["rles"]]
+    elif gen.output_mode == "binary_mask":
+        segmentations = [rle_to_mask(rle) for rle in mask_data["rles"]]
+    else:
+        segmentations = mask_data["rles"]
+    curr_anns = []
+    for idx in range(len(segmentations)):
+        curr_anns.append({
+            "segmentation": segmentations[idx],
+            "area": area_from_rle(mask_data["rles"][idx]),
+            "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
+            "predicted_iou": mask_data["iou_preds"][idx].item(),
+            "point_coords": [mask_data["points"][idx].tolist()],
+            "stability_score": mask_data["stability_score"][idx].item(),
+            "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
+        })
+    return curr_anns
+
+
+def generate(gen, sam, orig_size, seed, legacy):
+    """generate() after the mask decoder: per batch filtering and RLE, NMS, small regions and records"""
+    timer = {"upscale": 0.0, "postprocess": 0.0}
+    data = MaskData()
+    crop_boxes, layer_idxs = generate_crop_boxes(orig_size, gen.crop_n_layers, gen.crop_overlap_ratio)
+    for crop_idx, (crop_box, layer_idx) in enumerate(zip(crop_boxes, layer_idxs)):
+        x0, y0, x1, y1 = crop_box
+        cropped_im_size = (y1 - y0, x1 - x0)
+        input_size = gen.predictor.transform.get_preprocess_shape(*cropped_im_size, 1024)
+        points_for_image = gen.point_grids[layer_idx] * np.array(cropped_im_size)[None, ::-1]
+        data_crop = MaskData()
+        for i, (points,) in enumerate(batch_iterator(gen.points_per_batch, points_for_image)):
+            # the same decoder outputs in both runs
+            rng = np.random.default_rng((seed, crop_idx, i))
+            low_res_logits, iou_preds = synthetic_decoder_outputs(
+                gen.predictor.transform.apply_coords(points, cropped_im_size), rng)
+            start_time = time.time()
+            masks = sam.postprocess_masks(torch.from_numpy(low_res_logits), input_size, cropped_im_size)
+            timer["upscale"] += time.time() - start_time
+
+            start_time = time.time()
+            if legacy:
+                data_batch = legacy_postprocess_batch(gen, masks, iou_preds, points, crop_box, orig_size)
+            else:
+                data_batch = gen.postprocess_batch(masks.numpy(), iou_preds, points, crop_box, orig_size)
+            data_crop.cat(data_batch)
+            timer["postprocess"] += time.time() - start_time
+
+        start_time = time.time()
+        keep_by_nms = batched_nms(
+            data_crop["boxes"].float(), data_crop["iou_preds"],
+            torch.zeros_like(data_crop["boxes"][:, 0]), iou_threshold=gen.box_nms_thresh)
+        data_crop.filter(keep_by_nms)
+        data_crop["boxes"] = uncrop_boxes_xyxy(data_crop["boxes"], crop_box)
+        data_crop["points"] = uncrop_points(data_crop["points"], crop_box)
+        data_crop["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data_crop["rles"]))]).reshape(-1, 4)
+        data.cat(data_crop)
+        timer["postprocess"] += time.time() - start_time
+
+    start_time = time.time()
+    if len(crop_boxes) > 1:
+        scores = 1 / box_area(data["crop_boxes"])
+        keep_by_nms = batched_nms(
+            data["boxes"].float(), scores, torch.zeros_like(data["boxes"][:, 0]), iou_threshold=gen.crop_nms_thresh)
+        data.filter(keep_by_nms)
+    data.to_numpy()
+    if gen.min_mask_region_area > 0 and not legacy:
+        data = gen.postprocess_small_regions(data, gen.min_mask_region_area, max(gen.box_nms_thresh, gen.crop_nms_thresh))
+    anns = legacy_write_records(gen, data) if legacy else gen.write_records(data)
+    timer["postprocess"] += time.time() - start_time
+    return anns, timer
+
+
+def main(args):
+    orig_size = tuple(int(v) for v in args.image_size.split(','))
+    sam = Sam()
+    # only the input size of the encoder is used, no embedding is computed
+    sam_encoder = types.SimpleNamespace(img_size=sam.img_size)
+    gen = SamAutomaticMaskGenerator(sam_encoder, sam, points_per_side=args.points_per_side,
+                                    points_per_batch=args.points_per_batch,
+                                    pred_iou_thresh=args.pred_iou_thresh,
+                                    stability_score_thresh=args.stability_score_thresh,
+                                    crop_n_layers=args.crop_n_layers,
+                                    min_mask_region_area=args.min_mask_region_area,
+                                    output_mode=args.output_mode)
+    if args.min_mask_region_area > 0:
+        logging.info("min_mask_region_area is only applied to the new path")
+
+    results = {}
+    for name, legacy in [("torch", True), ("numpy", False)]:
+        start_time = time.time()
+        anns, timer = generate(gen, sam, orig_size, args.seed, legacy)
+        total_time = time.time() - start_time
+        results[name] = anns
+        logging.info("{:<6} masks: {}, generate_time(ms): {:.2f}, upscale_time(ms): {:.2f}, postprocess_time(ms): {:.2f}".format(
+            name, len(anns), total_time * 1000, timer["upscale"] * 1000, timer["postprocess"] * 1000))
+
+    if args.min_mask_region_area == 0:
+        same = len(results["torch"]) == len(results["numpy"]) and all(
+            a["area"] == b["area"] and a["bbox"] == b["bbox"] and a["stability_score"] == b["stability_score"]
+            and np.array_equal(np.asarray(a["segmentation"] if args.output_mode == "binary_mask" else a["segmentation"]["counts"]),
+                               np.asarray(b["segmentation"] if args.output_mode == "binary_mask" else b["segmentation"]["counts"]))
+            for a, b in zip(results["torch"], results["numpy"]))
+        logging.info("same records: {}".format(same))
+
+    # no mask passes the thresholds: every path must return no records instead of failing on empty arrays
+    for crop_n_layers in (0, 1):
+        empty_gen = SamAutomaticMaskGenerator(sam_encoder, sam, points_per_side=4, pred_iou_thresh=2.0,
+                                              crop_n_layers=crop_n_layers,
+                                              min_mask_region_area=args.min_mask_region_area,
+                                              output_mode=args.output_mode)
+        empty = [generate(empty_gen, sam, orig_size, args.seed, legacy)[0] for legacy in (True, False)]
+        logging.info("zero masks, crop_n_layers {}: records {}".format(crop_n_layers, [len(anns) for anns in empty]))
+        assert empty == [[], []]
+
+
+if __name__ == '__main__':
+    args = argsparser()
+    main(args)
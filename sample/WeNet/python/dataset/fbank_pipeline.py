@@ -0,0 +1,372 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+"""
+Offline fbank feature pipeline without torch, for evaluating large data lists.
+
+The utterances are sorted and batched by length from their wav headers alone, then the batches
+are read and turned into Kaldi fbank features by a pool of worker processes, a few batches
+ahead of the consumer, so only the batches in flight are held in memory. The features of every
+batch are computed together and written into the padded batch array directly. With a cache
+directory, the features are stored under a hash of the audio samples and of the fbank options,
+and later runs load them instead of computing them again.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import time
+import wave
+
+import numpy as np
+
+from utils.file_utils import read_lists
+
+# same floor as torchaudio.compliance.kaldi (float32 epsilon)
+EPSILON = np.finfo(np.float32).eps
+# frames windowed and transformed at a time
+BLOCK_FRAMES = 2048
+
+
+def _mel_scale(freq):
+    return 1127.0 * np.log(1.0 + freq / 700.0)
+
+
+class KaldiFbank(object):
+    """NumPy version of processor.compute_fbank, i.e. torchaudio.compliance.kaldi.fbank with
+    energy_floor=0 and the other options at their default values: povey window, preemphasis
+    0.97, DC offset removed, snip_edges, power spectrum, log mel energies.
+
+    The window and the mel banks are built once, and the frames of a whole batch of
+    utterances go through the FFT by blocks of BLOCK_FRAMES.
+    """
+    def __init__(self, num_mel_bins=23, frame_length=25, frame_shift=10, dither=0.0,
+                 sample_rate=16000, low_freq=20.0, high_freq=0.0, preemphasis_coefficient=0.97):
+        self.num_mel_bins = num_mel_bins
+        self.dither = dither
+        self.sample_rate = sample_rate
+        self.preemphasis_coefficient = preemphasis_coefficient
+        self.window_size = int(sample_rate * frame_length * 0.001)
+        self.window_shift = int(sample_rate * frame_shift * 0.001)
+        self.padded_window_size = 1 << (self.window_size - 1).bit_length()
+
+        # povey window: symmetric hann window to the power of 0.85
+        n = np.arange(self.window_size)
+        hann = 0.5 - 0.5 * np.cos(2 * math.pi * n / (self.window_size - 1))
+        self.window = (hann ** 0.85).astype(np.float32)
+
+        # triangular mel banks, (padded_window_size // 2 + 1, num_mel_bins), the nyquist bin
+        # gets no weight like in kaldi
+        nyquist = 0.5 * sample_rate
+        if high_freq <= 0.0:
+            high_freq += nyquist
+        mel_low = _mel_scale(low_freq)
+        mel_delta = (_mel_scale(high_freq) - mel_low) / (num_mel_bins + 1)
+        left = mel_low + np.arange(num_mel_bins)[:, None] * mel_delta
+        center = left + mel_delta
+        right = center + mel_delta
+        num_fft_bins = self.padded_window_size // 2
+        mel = _mel_scale(sample_rate / self.padded_window_size * np.arange(num_fft_bins))[None, :]
+        banks = np.maximum(0.0, np.minimum((mel - left) / (center - left), (right - mel) / (right - center)))
+        self.mel_banks = np.zeros((num_fft_bins + 1, num_mel_bins), np.float32)
+        self.mel_banks[:num_fft_bins] = banks.T
+
+    def num_frames(self, num_samples):
+        if num_samples < self.window_size:
+            return 0
+        return 1 + (num_samples - self.window_size) // self.window_shift
+
+    def __call__(self, waveforms, outs=None):
+        """ Compute the fbank of a batch of waveforms
+
+            Args:
+                waveforms: List[np.ndarray], samples at the int16 scale
+                outs: List[np.ndarray], optional (num_frames, num_mel_bins) float32
+                      outputs, may be views of a padded batch array
+
+            Returns:
+                List[np.ndarray]: (num_frames, num_mel_bins) log mel energies
+        """
+        frames = []
+        for waveform in waveforms:
+            waveform = np.asarray(waveform, dtype=np.float32)
+            n = self.num_frames(len(waveform))
+            if n == 0:
+                frames.append(np.zeros((0, self.window_size), np.float32))
+                continue
+            strided = np.lib.stride_tricks.sliding_window_view(waveform, self.window_size)
+            frames.append(strided[::self.window_shift][:n])
+        if outs is None:
+            outs = [np.empty((len(f), self.num_mel_bins), np.float32) for f in frames]
+        total = sum(len(f) for f in frames)
+        if total == 0:
+            return outs
+
+        block = min(total, BLOCK_FRAMES)
+        buf = np.zeros((block, self.padded_window_size), np.float32)
+        energies = np.empty((block, self.num_mel_bins), np.float32)
+        spectrum = np.empty((block, self.padded_window_size // 2 + 1), np.float32)
+        pending = collections.deque((f, out) for f, out in zip(frames, outs) if len(f))
+        pos = 0
+        while pending:
+            # fill the block with the next frames of one or more utterances
+            parts = []
+            filled = 0
+            while pending and filled < block:
+                f, out = pending[0]
+                n = min(block - filled, len(f) - pos)
+                parts.append((filled, n, out, pos))
+                self._window(f[pos:pos + n], buf[filled:filled + n])
+                filled += n
+                pos += n
+                if pos == len(f):
+                    pending.popleft()
+                    pos = 0
+            stft = np.fft.rfft(buf[:filled], axis=-1)
+            np.square(stft.real, out=spectrum[:filled])
+            spectrum[:filled] += np.square(stft.imag)
+            np.matmul(spectrum[:filled], self.mel_banks, out=energies[:filled])
+            np.maximum(energies[:filled], EPSILON, out=energies[:filled])
+            np.log(energies[:filled], out=energies[:filled])
+            for start, n, out, first in parts:
+                out[first:first + n] = energies[start:start + n]
+        return outs
+
+    def _window(self, frames, out):
+        x = frames
+        if self.dither != 0.0:
+            x = x + np.random.standard_normal(x.shape).astype(np.float32) * self.dither
+        x = x - x.mean(axis=1, keepdims=True)
+        # preemphasis with the first sample replicated, then the window, zero padded on the right
+        c = self.preemphasis_coefficient
+        out[:, 1:self.window_size] = x[:, 1:] - c * x[:, :-1]
+        out[:, 0] = x[:, 0] - c * x[:, 0]
+        out[:, :self.window_size] *= self.window
+
+
+class FeatureCache(object):
+    """ Features on disk, one .npy file per utterance named after the sha1 of its int16
+        samples and of the fbank options, so a renamed or re-listed file is still found and
+        changed options never return stale features.
+    """
+    def __init__(self, cache_dir, fbank_conf):
+        self.cache_dir = cache_dir
+        self.signature = json.dumps(fbank_conf, sort_keys=True).encode()
+
+    def path(self, pcm):
+        digest = hashlib.sha1(self.signature)
+        digest.update(np.ascontiguousarray(pcm).data)
+        name = digest.hexdigest()
+        return os.path.join(self.cache_dir, name[:2], name + '.npy')
+
+    def load(self, path):
+        try:
+            return np.load(path)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, path, feat):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a temporary name first, a concurrent reader never sees a partial file
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, feat)
+        os.replace(tmp, path)
+
+
+def read_data_list(data_list):
+    """ Parse a raw data list and read the length of every utterance from its wav header
+
+        Returns:
+            List[{key, wav, start, end, txt}]: start and end are sample indexes, the
+            utterances whose wav cannot be opened are skipped with a warning
+    """
+    utts = []
+    for line in read_lists(data_list):
+        obj = json.loads(line)
+        try:
+            with wave.open(obj['wav'], 'rb') as f:
+                sample_rate = f.getframerate()
+                assert f.getnchannels() == 1 and f.getsampwidth() == 2, \
+                    'mono 16-bit wav expected'
+                num_samples = f.getnframes()
+        except (OSError, EOFError, wave.Error, AssertionError) as ex:
+            logging.warning('Failed to read {}: {}'.format(obj['wav'], ex))
+            continue
+        start, end = 0, num_samples
+        if 'start' in obj:
+            start = int(obj['start'] * sample_rate)
+            end = min(int(obj['end'] * sample_rate), num_samples)
+        utts.append(dict(key=obj['key'], wav=obj['wav'], txt=obj.get('txt', ''),
+                         sample_rate=sample_rate, start=start, end=end))
+    return utts
+
+
+def read_pcm(utt):
+    with wave.open(utt['wav'], 'rb') as f:
+        f.setpos(utt['start'])
+        return np.frombuffer(f.readframes(utt['end'] - utt['start']), np.int16)
+
+
+def length_buckets(lengths, batch_size, bucket_lengths=None):
+    """ Group utterances into batches of similar lengths
+
+        Args:
+            lengths: List[int], number of feature frames of every utterance
+            batch_size: utterances per batch
+            bucket_lengths: List[int], the frame lengths the encoder accepts (the input
+                shapes of a fixed-shape bmodel), None when the batch is padded to its
+                longest utterance
+
+        Returns:
+            (List[(length, List[int])], List[int]): the padded length and the utterance
+            indexes of every batch, and the indexes of the utterances too long for every
+            bucket
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    buckets = sorted(bucket_lengths) if bucket_lengths else None
+    batches = []
+    skipped = []
+    group = []
+    group_bucket = None
+    for i in order:
+        if buckets is None:
+            bucket = None
+        else:
+            fits = [b for b in buckets if b >= lengths[i]]
+            if not fits:
+                skipped.append(i)
+                continue
+            bucket = fits[0]
+        if group and (bucket != group_bucket or len(group) == batch_size):
+            batches.append((group_bucket, group))
+            group = []
+        group.append(i)
+        group_bucket = bucket
+    if group:
+        batches.append((group_bucket, group))
+    return [(bucket if bucket is not None else lengths[group[-1]], group) for bucket, group in batches], skipped
+
+
+# state of the worker processes, set by _init_worker
+_fbank = None
+_cache = None
+
+
+def _init_worker(fbank_conf, sample_rate, cache_dir):
+    global _fbank, _cache
+    _fbank = KaldiFbank(sample_rate=sample_rate, **fbank_conf)
+    _cache = FeatureCache(cache_dir, dict(fbank_conf, sample_rate=sample_rate)) if cache_dir else None
+
+
+def _compute_batch(utts, length):
+    """ Features of a batch padded with zeros to `length` frames
+
+        Returns:
+            (np.ndarray, np.ndarray, int, float): (batch, length, num_mel_bins) features,
+            frame lengths, number of cache hits and compute time
+    """
+    start_time = time.time()
+    feats = np.zeros((len(utts), length, _fbank.num_mel_bins), np.float32)
+    lengths = np.zeros(len(utts), np.int32)
+    hits = 0
+    todo, outs, paths = [], [], []
+    for i, utt in enumerate(utts):
+        pcm = read_pcm(utt)
+        lengths[i] = _fbank.num_frames(len(pcm))
+        path = _cache.path(pcm) if _cache else None
+        feat = _cache.load(path) if path else None
+        if feat is not None and feat.shape == (lengths[i], _fbank.num_mel_bins):
+            feats[i, :lengths[i]] = feat
+            hits += 1
+            continue
+        todo.append(pcm)
+        outs.append(feats[i, :lengths[i]])
+        paths.append(path)
+    _fbank(todo, outs)
+    if _cache:
+        for out, path in zip(outs, paths):
+            _cache.save(path, out)
+    return feats, lengths, hits, time.time() - start_time
+
+
+class FbankPipeline(object):
+    """ Batches of padded fbank features of a raw data list, in length bucketed order
+
+        Args:
+            data_list: raw data list, one json line with key/wav/txt per utterance
+            fbank_conf: dataset_conf['fbank_conf'] of the model config
+            batch_size: utterances per batch, the batch size of the encoder bmodel
+            bucket_lengths: input frame lengths of a fixed-shape encoder, see length_buckets
+            num_workers: worker processes, 0 computes the features in this process
+            cache_dir: feature cache directory, None to disable the cache
+            prefetch: batches computed ahead of the consumer, 2 * num_workers by default
+    """
+    def __init__(self, data_list, fbank_conf, batch_size=1, bucket_lengths=None, num_workers=4,
+                 cache_dir=None, prefetch=None, sample_rate=16000):
+        self.fbank_conf = dict(fbank_conf)
+        self.sample_rate = sample_rate
+        self.num_workers = num_workers
+        self.cache_dir = cache_dir
+        self.prefetch = prefetch or max(2 * num_workers, 1)
+        self.utts = read_data_list(data_list)
+        for utt in self.utts:
+            if utt['sample_rate'] != sample_rate:
+                raise ValueError('{}: {} Hz, the fbank pipeline only reads {} Hz wav, resample '
+                                 'the data or use the default dataset pipeline'.format(
+                                     utt['wav'], utt['sample_rate'], sample_rate))
+        fbank = KaldiFbank(sample_rate=sample_rate, **self.fbank_conf)
+        self.lengths = [fbank.num_frames(utt['end'] - utt['start']) for utt in self.utts]
+        self.batches, self.skipped = length_buckets(self.lengths, batch_size, bucket_lengths)
+        padded = sum(length * batch_size for length, _ in self.batches)
+        self.padding_ratio = 1.0 - sum(self.lengths[i] for _, b in self.batches for i in b) / max(padded, 1)
+        self.stats = dict(batches=0, utts=0, cache_hits=0, compute_time=0.0)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        """ Yields (keys, feats, feats_lengths): feats is a (n, length, num_mel_bins)
+            float32 array, n <= batch_size for the last batch of every bucket
+        """
+        args = (self.fbank_conf, self.sample_rate, self.cache_dir)
+        tasks = (([self.utts[i] for i in indexes], length) for length, indexes in self.batches)
+        keys = ([self.utts[i]['key'] for i in indexes] for _, indexes in self.batches)
+        if self.num_workers == 0:
+            _init_worker(*args)
+            for task, batch_keys in zip(tasks, keys):
+                yield self._collect(batch_keys, _compute_batch(*task))
+            return
+        pool = multiprocessing.Pool(self.num_workers, initializer=_init_worker, initargs=args)
+        try:
+            pending = collections.deque()
+            for task in tasks:
+                pending.append(pool.apply_async(_compute_batch, task))
+                if len(pending) >= self.prefetch:
+                    break
+            while pending:
+                result = pending.popleft()
+                for task in tasks:
+                    pending.append(pool.apply_async(_compute_batch, task))
+                    break
+                yield self._collect(next(keys), result.get())
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _collect(self, keys, result):
+        feats, lengths, hits, compute_time = result
+        self.stats['batches'] += 1
+        self.stats['utts'] += len(keys)
+        self.stats['cache_hits'] += hits
+        self.stats['compute_time'] += compute_time
+        return keys, feats, lengths
@@ -0,0 +1,332 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+"""
+Session based streaming recognition with the streaming encoder bmodel.
+
+Every session (one utterance, e.g. one client connection) is fed 16 kHz PCM chunks of any
+size and keeps its own state between them: the fbank samples not yet framed, the feature
+frames not yet encoded, the encoder att_cache/cnn_cache/cache_mask/offset and the PathTrie of
+the CTC prefix beam search, so each decoding chunk continues the search instead of starting a
+new one. The ready chunks of many sessions are encoded together, one session per batch row of
+the encoder bmodel, and decoded by one ctc_beam_search_decoder_batch call.
+
+It requires a python wrapped c++ ctc decoder.
+Please install it by following:
+https://github.com/Slyne/ctc_decoder.git
+"""
+import argparse
+import collections
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import wave
+arch_output = subprocess.check_output(["arch"])
+arch = arch_output.decode().strip()
+sys.dont_write_bytecode = True
+sys.path.append(os.getcwd() + "/swig_decoders_" + arch)
+
+import numpy as np
+import torch
+import torchaudio.compliance.kaldi as kaldi
+import yaml
+
+from swig_decoders import map_batch, ctc_beam_search_decoder_batch, TrieVector, PathTrie
+from utils.file_utils import read_lists
+from utils.sophon_inference import SophonInference
+logging.basicConfig(level=logging.INFO)
+
+SAMPLE_RATE = 16000
+
+
+class StreamingFbank(object):
+    """Kaldi fbank of a PCM stream, the same frames as processor.compute_fbank on the whole
+    utterance (snip_edges): every frame only depends on its own samples, so the samples are
+    framed as they arrive and only the ones of the next frames are kept.
+    """
+    def __init__(self, num_mel_bins=80, frame_length=25, frame_shift=10):
+        self.num_mel_bins = num_mel_bins
+        self.frame_length = frame_length
+        self.frame_shift = frame_shift
+        self.window_size = SAMPLE_RATE * frame_length // 1000
+        self.window_shift = SAMPLE_RATE * frame_shift // 1000
+        self.samples = np.zeros(0, np.float32)
+
+    def accept(self, pcm):
+        """
+        Args:
+            pcm (np.ndarray): int16 samples, or float samples in [-1, 1]
+
+        Returns:
+            np.ndarray: (n, num_mel_bins) new feature frames
+        """
+        if pcm.dtype == np.int16:
+            pcm = pcm.astype(np.float32)
+        else:
+            pcm = pcm.astype(np.float32) * (1 << 15)
+        self.samples = np.concatenate([self.samples, pcm.reshape(-1)])
+        if len(self.samples) < self.window_size:
+            return np.zeros((0, self.num_mel_bins), np.float32)
+        n = (len(self.samples) - self.window_size) // self.window_shift + 1
+        mat = kaldi.fbank(torch.from_numpy(self.samples[:(n - 1) * self.window_shift + self.window_size]).unsqueeze(0),
+                          num_mel_bins=self.num_mel_bins,
+                          frame_length=self.frame_length,
+                          frame_shift=self.frame_shift,
+                          dither=0.0,
+                          energy_floor=0.0,
+                          sample_frequency=SAMPLE_RATE)
+        self.samples = self.samples[n * self.window_shift:]
+        return mat.numpy()
+
+
+class Session(object):
+    """State of one utterance between its chunks."""
+    def __init__(self, session_id, fbank, cache_shapes):
+        self.id = session_id
+        self.fbank = fbank
+        # feature frames from the start of the next decoding window
+        self.feats = np.zeros((0, fbank.num_mel_bins), np.float32)
+        self.n_frames = 0
+        self.caches = {name: np.zeros(shape, dtype) for name, (shape, dtype) in cache_shapes.items()}
+        self.root = PathTrie()
+        self.start = True
+        self.final = False
+        self.hyp = ""
+        # arrival time of the audio completing each pending decoding window
+        self.arrivals = collections.deque()
+        self.latencies = []
+
+
+class StreamingRecognizer(object):
+    """
+    create_session() -> id, accept(id, pcm) as the audio arrives, step() to encode and decode
+    the ready chunks of all the sessions, partial(id) for the current hypothesis, finish(id)
+    once the utterance has ended to flush its last frames and get the final text.
+    """
+    def __init__(self, encoder, vocabulary, configs, decoding_chunk_size=16, num_decoding_left_chunks=5,
+                 subsampling=4, context=7):
+        self.encoder = encoder
+        self.vocabulary = vocabulary
+        self.fbank_conf = configs['dataset_conf']['fbank_conf']
+        self.stride = subsampling * decoding_chunk_size
+        self.decoding_window = (decoding_chunk_size - 1) * subsampling + context
+        self.context = context
+        required_cache_size = decoding_chunk_size * num_decoding_left_chunks
+        output_size = configs["encoder_conf"]["output_size"]
+        num_layers = configs["encoder_conf"]["num_blocks"]
+        cnn_module_kernel = configs["encoder_conf"].get("cnn_module_kernel", 1) - 1
+        head = configs["encoder_conf"]["attention_heads"]
+        d_k = output_size // head
+        self.batch_size = encoder.inputs_shapes[encoder.input_names.index("chunk_xs")][0]
+        # per session shapes, without the batch dimension
+        self.cache_shapes = {"att_cache": ((num_layers, head, required_cache_size, d_k * 2), np.float32),
+                             "cnn_cache": ((num_layers, output_size, cnn_module_kernel), np.float32),
+                             "cache_mask": ((1, required_cache_size), np.float32),
+                             "offset": ((1,), np.int32)}
+        # batched encoder inputs, reused by every step
+        self.inputs = {"chunk_xs": np.zeros((self.batch_size, self.decoding_window, self.fbank_conf['num_mel_bins']), np.float32),
+                       "chunk_lens": np.full(self.batch_size, self.decoding_window, np.int32)}
+        for name, (shape, dtype) in self.cache_shapes.items():
+            self.inputs[name] = np.zeros((self.batch_size, *shape), dtype)
+        self.sessions = collections.OrderedDict()
+        self.next_id = 0
+        self.encoder_time = 0.0
+        self.encoder_count = 0
+        self.decode_time = 0.0
+
+    def create_session(self):
+        session_id = self.next_id
+        self.next_id += 1
+        fbank = StreamingFbank(self.fbank_conf['num_mel_bins'], self.fbank_conf['frame_length'], self.fbank_conf['frame_shift'])
+        self.sessions[session_id] = Session(session_id, fbank, self.cache_shapes)
+        return session_id
+
+    def accept(self, session_id, pcm, final=False):
+        """Append audio to a session, final marks the end of the utterance."""
+        session = self.sessions[session_id]
+        feats = session.fbank.accept(pcm)
+        if len(feats):
+            session.feats = np.concatenate([session.feats, feats])
+            session.n_frames += len(feats)
+        session.final = session.final or final
+        now = time.time()
+        for _ in range(self._ready_chunks(session) - len(session.arrivals)):
+            session.arrivals.append(now)
+
+    def _ready_chunks(self, session):
+        n = len(session.feats)
+        if session.final:
+            # the last windows are zero padded, like wenet.py on the whole utterance
+            return len(range(0, n - self.context + 1, self.stride))
+        if n < self.decoding_window:
+            return 0
+        return (n - self.decoding_window) // self.stride + 1
+
+    def pending(self):
+        return [s for s in self.sessions.values() if self._ready_chunks(s) > 0]
+
+    def step(self):
+        """
+        Encode one decoding window of up to batch_size sessions having one ready, oldest
+        first, and continue their CTC prefix beam search. Returns the ids of the updated
+        sessions.
+        """
+        ready = sorted(self.pending(), key=lambda s: s.arrivals[0])[:self.batch_size]
+        if not ready:
+            return []
+        chunk_xs = self.inputs["chunk_xs"]
+        chunk_xs[:] = 0
+        for row, session in enumerate(ready):
+            window = session.feats[:self.decoding_window]
+            chunk_xs[row, :len(window)] = window
+            for name in self.cache_shapes:
+                self.inputs[name][row] = session.caches[name]
+
+        start_time = time.time()
+        out_dict_ = self.encoder.infer_numpy_dict(self.inputs)
+        self.encoder_time += time.time() - start_time
+        self.encoder_count += 1
+        out_dict = {key[:-len("_f32")] if "_f32" in key else key: value for key, value in out_dict_.items()}
+
+        log_probs = out_dict["log_probs_TopK"]
+        log_probs_idx = out_dict["log_probs_idx_TopK"].astype(np.int32)
+        out_lens = out_dict['/Div_output_0_Div_floor'].astype(np.int32)
+        outputs = {"offset": out_dict['r_offset_Unsqueeze'].astype(np.int32).reshape(self.batch_size, -1),
+                   "att_cache": out_dict['r_att_cache_Concat'],
+                   "cnn_cache": out_dict['r_cnn_cache_Concat'],
+                   "cache_mask": out_dict['r_cache_mask_Slice']}
+
+        start_time = time.time()
+        batch_log_probs_seq = []
+        batch_log_probs_ids = []
+        batch_root = TrieVector()
+        batch_start = []
+        for row, session in enumerate(ready):
+            for name in self.cache_shapes:
+                session.caches[name] = outputs[name][row].reshape(self.cache_shapes[name][0]).copy()
+            session.feats = session.feats[self.stride:]
+            batch_log_probs_seq.append(log_probs[row, :out_lens[row]].tolist())
+            batch_log_probs_ids.append(log_probs_idx[row, :out_lens[row]].tolist())
+            batch_root.append(session.root)
+            batch_start.append(session.start)
+            session.start = False
+        beam_size = log_probs.shape[-1]
+        num_processes = min(multiprocessing.cpu_count(), len(ready))
+        score_hyps = ctc_beam_search_decoder_batch(batch_log_probs_seq, batch_log_probs_ids, batch_root, batch_start,
+                                                   beam_size, num_processes, 0, -2, 0.99999)
+        hyps = map_batch([cand_hyps[0][1] if cand_hyps else [] for cand_hyps in score_hyps],
+                         self.vocabulary, num_processes, False, 0)
+        now = time.time()
+        self.decode_time += now - start_time
+        for session, hyp in zip(ready, hyps):
+            session.hyp = hyp
+            session.latencies.append(now - session.arrivals.popleft())
+        return [session.id for session in ready]
+
+    def partial(self, session_id):
+        return self.sessions[session_id].hyp
+
+    def finish(self, session_id):
+        """Flush the last frames of the session and return (final text, per chunk latencies)."""
+        session = self.sessions[session_id]
+        self.accept(session_id, np.zeros(0, np.int16), final=True)
+        while self._ready_chunks(session) > 0:
+            self.step()
+        del self.sessions[session_id]
+        return session.hyp, session.latencies
+
+
+def read_wav(path):
+    with wave.open(path, 'rb') as f:
+        assert f.getframerate() == SAMPLE_RATE and f.getnchannels() == 1 and f.getsampwidth() == 2, \
+            "{}: 16 kHz mono 16-bit wav expected".format(path)
+        return np.frombuffer(f.readframes(f.getnframes()), np.int16)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='streaming recognition of concurrent sessions')
+    parser.add_argument('--input', default='../datasets/aishell_S0764/aishell_S0764.list', help='path of input')
+    parser.add_argument('--encoder_bmodel', default='../models/BM1684/wenet_encoder_streaming_fp32.bmodel', help='path of streaming encoder bmodel')
+    parser.add_argument('--dev_id', type=int, default=0, help='dev id')
+    parser.add_argument('--result_file', default='./result.txt', help='asr result file')
+    parser.add_argument('--dict', default='../config/lang_char.txt', help='dict file')
+    parser.add_argument('--config', default='../config/train_u2++_conformer.yaml', help='config file')
+    parser.add_argument('--sessions', type=int, default=4, help='concurrent sessions')
+    parser.add_argument('--chunk_ms', type=int, default=160, help='duration of the PCM chunks sent by the sessions')
+    parser.add_argument('--realtime', action='store_true', help='send the chunks at the pace of the audio instead of as fast as possible')
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    with open(args.config, 'r') as fin:
+        configs = yaml.load(fin, Loader=yaml.FullLoader)
+    vocabulary = []
+    with open(args.dict, 'r') as fin:
+        for line in fin:
+            arr = line.strip().split()
+            assert len(arr) == 2
+            vocabulary.append(arr[0])
+    encoder = SophonInference(model_path=args.encoder_bmodel, device_id=args.dev_id, input_mode=0)
+    if len(encoder.inputs_shapes) == 2:
+        logging.error("{} is a non streaming encoder".format(args.encoder_bmodel))
+        sys.exit(1)
+    recognizer = StreamingRecognizer(encoder, vocabulary, configs)
+
+    utterances = collections.deque(eval(line) for line in read_lists(args.input))
+    chunk = SAMPLE_RATE * args.chunk_ms // 1000
+    clients = {}
+    latencies = []
+    total_audio = 0.0
+    start_time = time.time()
+    with open(args.result_file, 'w') as fout:
+        while utterances or clients:
+            # keep args.sessions utterances in flight
+            while utterances and len(clients) < args.sessions:
+                utt = utterances.popleft()
+                pcm = read_wav(utt["wav"])
+                total_audio += len(pcm) / SAMPLE_RATE
+                clients[recognizer.create_session()] = [utt["key"], pcm, 0, time.time()]
+            # every client sends its next chunk
+            for session_id, client in list(clients.items()):
+                key, pcm, pos, t0 = client
+                if args.realtime and time.time() < t0 + pos / SAMPLE_RATE:
+                    continue
+                if pos >= len(pcm):
+                    text, session_latencies = recognizer.finish(session_id)
+                    latencies.extend(session_latencies)
+                    logging.info('{} {}'.format(key, text))
+                    fout.write('{} {}\n'.format(key, text))
+                    del clients[session_id]
+                    continue
+                recognizer.accept(session_id, pcm[pos:pos + chunk])
+                client[2] = pos + chunk
+            for session_id in recognizer.step():
+                if session_id in clients:
+                    logging.debug('{} partial: {}'.format(clients[session_id][0], recognizer.partial(session_id)))
+            if args.realtime and not recognizer.pending():
+                time.sleep(0.005)
+    total_time = time.time() - start_time
+
+    latencies = np.array(latencies) * 1000
+    logging.info("------------------ Streaming Info ----------------------")
+    logging.info("sessions: {}, encoder batch size: {}, audio: {:.2f} s, total time: {:.2f} s, RTF: {:.4f}".format(
+        args.sessions, recognizer.batch_size, total_audio, total_time, total_time / max(total_audio, 1e-6)))
+    logging.info("encoder calls: {}, encoder time: {:.2f} s, ctc decode time: {:.2f} s".format(
+        recognizer.encoder_count, recognizer.encoder_time, recognizer.decode_time))
+    if len(latencies):
+        logging.info("partial result latency per chunk(ms): avg {:.2f}, p50 {:.2f}, p90 {:.2f}, max {:.2f}".format(
+            latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 90), latencies.max()))
+
+
+if __name__ == '__main__':
+    args = get_args()
+    main(args)
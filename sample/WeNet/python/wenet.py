@@ -30,6 +30,7 @@ import yaml
 from torch.utils.data import DataLoader
 
 from dataset.dataset import Dataset
+from dataset.fbank_pipeline import FbankPipeline
 from utils.common import IGNORE_ID
 from utils.file_utils import read_symbol_table
 from utils.file_utils import read_lists
@@ -141,6 +142,12 @@ def get_args():
                         type=int,
                         default=350,
                         help='maximum length supported by decoder')
+    parser.add_argument('--fbank_pipeline',
+                        default='torchaudio',
+                        choices=['torchaudio', 'numpy'],
+                        help='feature extraction: torchaudio dataset pipeline, or numpy fbank in worker processes with length bucketed batches (raw wav data only)')
+    parser.add_argument('--feat_workers', type=int, default=4, help='worker processes of the numpy fbank pipeline, 0 to compute in the main process')
+    parser.add_argument('--feat_cache', default='', help='feature cache directory of the numpy fbank pipeline, features are reused across runs')
     args = parser.parse_args()
     # print(args)
     return args
@@ -181,18 +188,38 @@ if __name__ == '__main__':
     test_conf['batch_conf']['batch_type'] = "static"
     test_conf['batch_conf']['batch_size'] = batch_size
     
-    start_time = time.time()
-    test_dataset = Dataset(args.data_type,
-                           args.input,
-                           symbol_table,
-                           test_conf,
-                           bpe_model=None,
-                           partition=False)
-    test_data_loader = DataLoader(test_dataset, batch_size=None, num_workers=0)
-    preprocess_time = time.time() - start_time
-
     # Init encoder and decoder
     encoder = SophonInference(model_path=args.encoder_bmodel, device_id=args.dev_id, input_mode=0)
+    streaming = len(encoder.inputs_shapes) != 2
+
+    start_time = time.time()
+    if args.fbank_pipeline == 'numpy':
+        assert args.data_type == 'raw', "numpy fbank pipeline only supports raw data lists"
+        sample_rate = test_conf.get('resample_conf', {}).get('resample_rate', 16000)
+        if streaming:
+            test_data_loader = FbankPipeline(args.input, test_conf['fbank_conf'], batch_size,
+                                             num_workers=args.feat_workers, cache_dir=args.feat_cache or None,
+                                             sample_rate=sample_rate)
+        else:
+            # batches of the encoder batch size, padded to the fixed input length of the bmodel
+            test_data_loader = FbankPipeline(args.input, test_conf['fbank_conf'], encoder.inputs_shapes[0][0],
+                                             bucket_lengths=[encoder.inputs_shapes[0][1]],
+                                             num_workers=args.feat_workers, cache_dir=args.feat_cache or None,
+                                             sample_rate=sample_rate)
+        for i in test_data_loader.skipped:
+            print("Skipping this audio, input feat length exceed bmodel's input shape: {} feat_length {} > bmodel_input_shape {}".format(
+                test_data_loader.utts[i]['key'], test_data_loader.lengths[i], encoder.inputs_shapes[0][1]))
+        logging.info("{} utterances in {} batches, padding {:.1%}".format(
+            len(test_data_loader.utts) - len(test_data_loader.skipped), len(test_data_loader), test_data_loader.padding_ratio))
+    else:
+        test_dataset = Dataset(args.data_type,
+                               args.input,
+                               symbol_table,
+                               test_conf,
+                               bpe_model=None,
+                               partition=False)
+        test_data_loader = DataLoader(test_dataset, batch_size=None, num_workers=0)
+    preprocess_time = time.time() - start_time
     decoder = None
     if(args.mode == 'attention_rescoring'):
         decoder = SophonInference(model_path=args.decoder_bmodel, device_id=args.dev_id, input_mode=0)
@@ -226,14 +253,21 @@ if __name__ == '__main__':
     with torch.no_grad(), open(args.result_file, 'w') as fout:
         start_enumerate = time.time()
         for _, batch in enumerate(test_data_loader):
-            keys, feats, _, feats_lengths, _ = batch
-            feats, feats_lengths = feats.numpy(), feats_lengths.numpy()
-            if len(encoder.inputs_shapes) == 2: # non streaming
+            if args.fbank_pipeline == 'numpy':
+                keys, feats, feats_lengths = batch
+            else:
+                keys, feats, _, feats_lengths, _ = batch
+                feats, feats_lengths = feats.numpy(), feats_lengths.numpy()
+            if not streaming:
                 if encoder.inputs_shapes[0][1] - feats.shape[1] < 0:
                     print("Skipping this audio, input feat length exceed bmodel's input shape: feat_length {} > bmodel_input_shape {}".format(feats.shape[1], encoder.inputs_shapes[0][1]))
                     continue
+                # a short batch is completed with copies of its last utterance, their results are dropped
+                num_utts = feats.shape[0]
                 speech = np.pad(feats, [(0, 0),(0, encoder.inputs_shapes[0][1] - feats.shape[1]), (0, 0)], mode='constant', constant_values=0)
-                encoder_input = {"speech": speech, "speech_lengths": feats_lengths}
+                speech = np.pad(speech, [(0, encoder.inputs_shapes[0][0] - num_utts), (0, 0), (0, 0)], mode='edge')
+                speech_lengths = np.pad(feats_lengths, (0, encoder.inputs_shapes[0][0] - num_utts), mode='edge')
+                encoder_input = {"speech": speech, "speech_lengths": speech_lengths}
                 preprocess_time += time.time() - start_enumerate
                 start_time = time.time()
                 out_dict_ = encoder.infer_numpy_dict(encoder_input)
@@ -243,15 +277,14 @@ if __name__ == '__main__':
                     key[:-len("_f32")] if "_f32" in key else key: value for key, value in out_dict_.items()  
                 }
 
-                encoder_out_lens = out_dict['/ReduceSum_output_0_ReduceSum'].astype(np.int32)
-                encoder_out = out_dict['encoder_out_LayerNormalization']
-                beam_log_probs = out_dict['beam_log_probs_TopK']
-                beam_log_probs_idx = out_dict['beam_log_probs_idx_TopK'].astype(np.int32)
+                encoder_out_lens = out_dict['/ReduceSum_output_0_ReduceSum'][:num_utts].astype(np.int32)
+                encoder_out = out_dict['encoder_out_LayerNormalization'][:num_utts]
+                beam_log_probs = out_dict['beam_log_probs_TopK'][:num_utts]
+                beam_log_probs_idx = out_dict['beam_log_probs_idx_TopK'][:num_utts].astype(np.int32)
 
                 # ctc decode
                 start_time = time.time()
                 results, _ = ctc_decoding(beam_log_probs, beam_log_probs_idx, encoder_out_lens, vocabulary)
-                result = results[0]
                 postprocess_time += time.time() - start_time
             else:
                 supplemental_batch_size = batch_size - feats.shape[0]
@@ -308,6 +341,7 @@ if __name__ == '__main__':
                     postprocess_time += time.time() - start_time
                     # print(chunk_hyps)
                     result += chunk_hyps[0]
+                results = [result]
             
                 encoder_out = np.concatenate(encoder_out, axis=1)
                 encoder_out_lens = np.full(batch_size, fill_value=encoder_out.shape[1], dtype=np.int32)
@@ -379,7 +413,7 @@ if __name__ == '__main__':
                 if args.mode == 'attention_rescoring':
                     content = hyps[i]
                 else:
-                    content = result
+                    content = results[i]
                 logging.info('{} {}'.format(key, content))
                 fout.write('{} {}\n'.format(key, content))
             start_enumerate = time.time()
@@ -391,3 +425,7 @@ if __name__ == '__main__':
     logging.info("encoder_inference_time(ms): {:.4f}".format((encoder_inference_time / total_data_time) * 1000))
     logging.info("decoder_inference_time(ms): {:.4f}".format((decoder_inference_time / total_data_time) * 1000))
     logging.info("postprocess_time(ms): {:.4f}".format((postprocess_time / total_data_time) * 1000))
+    if args.fbank_pipeline == 'numpy':
+        stats = test_data_loader.stats
+        logging.info("fbank pipeline: {} utterances, {} batches, {} cache hits, worker time {:.2f} s".format(
+            stats['utts'], stats['batches'], stats['cache_hits'], stats['compute_time']))
@@ -0,0 +1,240 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2024 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+import collections
+import os
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Optional, Tuple, Union
+
+import torch
+
+from .transcribe import EncoderRequest, MelWindows, _make_result, _transcribe_windows
+from .utils import N_SAMPLES, SAMPLE_RATE, load_audio, log_mel_spectrogram
+
+if TYPE_CHECKING:
+    from .model import Whisper
+
+# threads decoding audio files (ffmpeg) and computing their log-Mel spectrograms
+DECODE_WORKERS = 4
+
+
+def audio_files(paths: Union[str, Iterable[str]]) -> List[str]:
+    """
+    The audio files of a list of files and directories, directories are searched recursively
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(audio_files(sorted(os.path.join(path, f) for f in os.listdir(path))))
+        else:
+            files.append(path)
+    return files
+
+
+def _load_mel(file: str, n_mels: int) -> Tuple[torch.Tensor, float, float]:
+    start_time = time.time()
+    audio = load_audio(file)
+    # Pad 30-seconds of silence to the input audio, for slicing
+    mel = log_mel_spectrogram(audio, n_mels, padding=N_SAMPLES)
+    return mel, len(audio) / SAMPLE_RATE, time.time() - start_time
+
+
+def prefetch_mels(
+    files: Iterable[str], n_mels: int, workers: int = DECODE_WORKERS, prefetch: Optional[int] = None
+) -> Iterator[Tuple[str, Optional[torch.Tensor], float, float, Optional[Exception]]]:
+    """
+    Decode the audio files and compute their log-Mel spectrograms in a thread pool, `prefetch`
+    files ahead of the consumer (2 * workers by default).
+
+    Yields (file, mel, audio duration in seconds, load time in seconds, error) in the order of
+    `files`; mel is None and error is set when the file could not be loaded.
+    """
+    prefetch = prefetch or 2 * workers
+    files = iter(files)
+    pending = collections.deque()
+    pool = ThreadPoolExecutor(workers, thread_name_prefix="whisper_audio")
+    try:
+        for file in files:
+            pending.append((file, pool.submit(_load_mel, file, n_mels)))
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            file, future = pending.popleft()
+            for next_file in files:
+                pending.append((next_file, pool.submit(_load_mel, next_file, n_mels)))
+                break
+            try:
+                yield (file, *future.result(), None)
+            except Exception as e:
+                yield file, None, 0.0, 0.0, e
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+class _Job:
+    """
+    Decoding state of one recording: the suspended `_transcribe_windows` generator and the
+    encoder request it is waiting on.
+    """
+
+    def __init__(self, file: str, duration: float, generator: Iterator, decode_options: dict):
+        self.file = file
+        self.duration = duration
+        self.generator = generator
+        self.decode_options = decode_options
+        self.segments = []
+        self.request: Optional[EncoderRequest] = None
+
+    def resume(self, audio_features: Optional[torch.Tensor]) -> bool:
+        """
+        Run the decoding loop until its next encoder request, False once the recording is done
+        """
+        try:
+            item = self.generator.send(audio_features)
+            while not isinstance(item, EncoderRequest):
+                self.segments.append(item)
+                item = next(self.generator)
+        except StopIteration:
+            self.request = None
+            return False
+        self.request = item
+        return True
+
+
+def transcribe_batch(
+    model: "Whisper",
+    audio: Union[str, Iterable[str]],
+    *,
+    batch_files: Optional[int] = None,
+    workers: int = DECODE_WORKERS,
+    prefetch: Optional[int] = None,
+    verbose: Optional[bool] = None,
+    temperature: Union[float, Tuple[float, ...]] = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0),
+    compression_ratio_threshold: Optional[float] = 2.4,
+    logprob_threshold: Optional[float] = -1.0,
+    no_speech_threshold: Optional[float] = 0.6,
+    condition_on_previous_text: bool = True,
+    initial_prompt: Optional[str] = None,
+    word_timestamps: bool = False,
+    prepend_punctuations: str = "\"'“¿([{-",
+    append_punctuations: str = "\"'.。,，!！?？:：”)]}、",
+    **decode_options,
+) -> Iterator[Tuple[str, dict]]:
+    """
+    Transcribe many audio files, `batch_files` of them at a time
+
+    Every recording runs the decoding loop of `transcribe`, but the loops are suspended before
+    encoding a window: the next 30-second windows of all the recordings in progress are encoded
+    together, in batches of the encoder bmodel batch size, and each recording gets its audio
+    features back to decode its window. When a recording is finished, the next file takes its
+    place. The files are decoded by ffmpeg and turned into log-Mel spectrograms by a thread pool
+    ahead of the TPU.
+
+    Parameters
+    ----------
+    model: Whisper
+        The Whisper model instance
+
+    audio: Union[str, Iterable[str]]
+        Audio files and directories (searched recursively)
+
+    batch_files: int
+        Number of recordings decoded at the same time, the encoder batch size by default
+
+    workers: int
+        Threads loading the audio files
+
+    prefetch: int
+        Number of files loaded ahead, 2 * workers by default
+
+    verbose: bool
+        If True, print the segments of each recording once it is finished
+
+    The other parameters are the ones of `transcribe`, for every recording.
+
+    Yields
+    ------
+    (file, result) in the order the recordings are finished, result being the dictionary returned
+    by `transcribe`. Files that cannot be loaded are skipped with a warning. The generator returns
+    the statistics of the run: number of files, audio duration, wall time, real-time factor
+    (wall time / audio duration), encoder calls and windows.
+    """
+    batch_files = batch_files or model.encoder_batch_size
+    files = audio_files(audio)
+    loader = prefetch_mels(files, model.dims.n_mels, workers, prefetch)
+    stats = dict(files=0, failed=0, audio_duration=0.0, load_time=0.0, windows=0, encoder_calls=0)
+    start_time = time.time()
+    encoder_calls = model.call_encoder
+
+    def next_job() -> Optional[_Job]:
+        for file, mel, duration, load_time, error in loader:
+            if error is not None:
+                warnings.warn(f"Skipping {file}: {error}")
+                stats["failed"] += 1
+                continue
+            stats["audio_duration"] += duration
+            stats["load_time"] += load_time
+            options = dict(decode_options)
+            generator = _transcribe_windows(
+                model,
+                MelWindows(mel),
+                verbose=None,
+                temperature=temperature,
+                compression_ratio_threshold=compression_ratio_threshold,
+                logprob_threshold=logprob_threshold,
+                no_speech_threshold=no_speech_threshold,
+                condition_on_previous_text=condition_on_previous_text,
+                initial_prompt=initial_prompt,
+                word_timestamps=word_timestamps,
+                prepend_punctuations=prepend_punctuations,
+                append_punctuations=append_punctuations,
+                total_frames=None,
+                decode_options=options,
+                pack_windows=True,
+            )
+            return _Job(file, duration, generator, options)
+        return None
+
+    active: List[_Job] = []
+    finished: List[_Job] = []
+    try:
+        while True:
+            # fill the free places, a recording may also end before its first window (empty file)
+            while len(active) < batch_files:
+                job = next_job()
+                if job is None:
+                    break
+                (active if job.resume(None) else finished).append(job)
+
+            for job in finished:
+                result = _make_result(model, job.segments, job.decode_options)
+                stats["files"] += 1
+                if verbose:
+                    print(f"### {job.file} ({job.duration:.1f}s): {result['text']}")
+                yield job.file, result
+            finished = []
+            if not active:
+                break
+
+            audio_features = model.encode(torch.stack([job.request.mel for job in active]))
+            stats["windows"] += len(active)
+            running = []
+            for job, features in zip(active, audio_features):
+                (running if job.resume(features) else finished).append(job)
+            active = running
+    finally:
+        loader.close()
+
+    stats["encoder_calls"] = model.call_encoder - encoder_calls
+    stats["total_time"] = time.time() - start_time
+    stats["rtf"] = stats["total_time"] / stats["audio_duration"] if stats["audio_duration"] > 0 else 0.0
+    return stats
@@ -15,7 +15,7 @@ import torch.nn.functional as F
 from torch import Tensor
 from torch.distributions import Categorical
 
-from .utils import CHUNK_LENGTH
+from .mel import CHUNK_LENGTH
 from .tokenizer import Tokenizer, get_tokenizer
 from .utils import compression_ratio, fp16_cast, uint16_to_fp16
 
@@ -55,24 +55,16 @@ def detect_language(
 
     # skip encoder forward pass if already-encoded audio features were given
     if mel.shape[-2:] != (model.dims.n_audio_ctx, model.dims.n_audio_state):
-        mel = mel.numpy().astype(np.float16)
-        mel = mel if mel.flags.c_contiguous else np.ascontiguousarray(mel)
-        model.encoder_input_tensors_map[model.combined_whisper_engine.get_input_names(model.encoder_engine_graph_name)[0]].update_data(fp16_cast(mel));
-
-        start_time = time.time()
-        model.combined_whisper_engine.process(model.encoder_engine_graph_name,model.encoder_input_tensors_map,model.encoder_output_tensors_map)
-        model.inference_time += time.time() - start_time
-
-        mel_out_tensor = list(model.encoder_output_tensors_map.values())[0]
-        mel_out = torch.from_numpy(uint16_to_fp16(mel_out_tensor.asnumpy()))
-
-        model.call_encoder += 1
+        mel_out = model.encode(mel)
+    else:
+        mel_out = mel
 
     # forward pass using a single token, startoftranscript
     n_audio = mel_out.shape[0]
     x = torch.tensor([[tokenizer.sot]] * n_audio)  # [n_audio, 1]
     start_time = time.time()
     logits = model.logits(x, mel_out)[:, 0].float()
+    model.inference_time += time.time() - start_time
 
     # collect detected languages; suppress all non-language tokens
     mask = torch.ones(logits.shape[-1], dtype=torch.bool)
@@ -698,17 +690,7 @@ class DecodingTask:
             # encoded audio features are given; skip audio encoding
             audio_features = mel
         else:
-            mel = mel.numpy().astype(np.float16)
-            mel = mel if mel.flags.c_contiguous else np.ascontiguousarray(mel)
-            self.model.encoder_input_tensors_map[self.model.encoder_input_names[0]].update_data(fp16_cast(mel));
-
-            start_time = time.time()
-            self.model.combined_whisper_engine.process(self.model.encoder_engine_graph_name, self.model.encoder_input_tensors_map, self.model.encoder_output_tensors_map)
-            self.model.inference_time += time.time() - start_time
-            mel_out_tensor = list(self.model.encoder_output_tensors_map.values())[0]
-
-            audio_features = torch.from_numpy(uint16_to_fp16(mel_out_tensor.asnumpy()))
-            self.model.call_encoder +=1
+            audio_features = self.model.encode(mel)
 
         return audio_features
 
@@ -735,45 +717,30 @@ class DecodingTask:
         initial_tokens_length = len(self.initial_tokens)
         padding_num = self.padding_size
 
-        attention_mask_firstly = torch.empty(padding_num, padding_num).fill_(-10000).triu_(1)
-        attention_mask_with_kvcache_max = torch.empty(448, 448).fill_(-10000).triu_(1)
-        attention_mask_with_kvcache = attention_mask_with_kvcache_max[-padding_num:, -padding_num:]
-
+        # the masks and positional rows only depend on the offset, they are built by the model
+        # (see Whisper.build_decoder_inputs) and written as is into the input tensors
+        positional_embedding = self.model.positional_embedding_fp16
+        decoder_loop_masks = self.model.decoder_loop_masks
+        decoder_loop_inputs = [self.model.decoder_loop_input_tensors_map[name] for name in self.model.decoder_loop_input_names[:3]]
 
         try:
             for i in range(self.sample_len):
                 if i == 0:
-                    tokens_input = F.pad(tokens, (padding_num - tokens.shape[-1], 0, 0, 0), value=0)
-                    positional_embedding_input = F.pad(self.model.positional_embedding[:i+initial_tokens_length], (0, 0, padding_num - initial_tokens_length - i, 0), value=0)
-                    mask = F.pad(attention_mask_firstly[:tokens.shape[-1], :tokens.shape[-1]], (padding_num - tokens.shape[-1], 0, 0, 0), value=-10000)
-                    mask = F.pad(mask, (0, 0, padding_num - tokens.shape[-1], 0), value=0)
-                    mask = mask.reshape(1, 1, *mask.shape).repeat(n_batch, self.n_text_head, 1, 1).permute(0, 2, 1, 3).contiguous()
-                else:
-                    tokens_input = tokens[:, -1:]
-                    offset = i + initial_tokens_length - 1
-                    positional_embedding_input = self.model.positional_embedding[offset:offset+1]
-                    mask = attention_mask_with_kvcache[offset:offset+1].flip(1)
-                    mask = mask.reshape(1, 1, *mask.shape).repeat(n_batch, self.n_text_head, 1, 1).permute(0, 2, 1, 3).contiguous()
-
-                if i == 0:
-                    # type transform for decoder_main inputs
-                    tokens_input = tokens_input.numpy().astype(np.int32)
+                    # decoder_main inputs, the initial tokens are aligned to the end of the padding
+                    tokens_input = np.zeros((n_batch, padding_num), np.int32)
+                    tokens_input[:, padding_num - initial_tokens_length:] = tokens.numpy()
+                    positional_embedding_input = np.zeros((padding_num, positional_embedding.shape[-1]), positional_embedding.dtype)
+                    positional_embedding_input[padding_num - initial_tokens_length:] = positional_embedding[:initial_tokens_length]
                     audio_features = audio_features.numpy().astype(np.float16)
-                    positional_embedding_input = positional_embedding_input.numpy().astype(np.float16)
-                    mask = mask.numpy().astype(np.float16)
-
-                    tokens_input = tokens_input if tokens_input.flags.c_contiguous else np.ascontiguousarray(tokens_input)
                     audio_features = audio_features if audio_features.flags.c_contiguous else np.ascontiguousarray(audio_features)
-                    positional_embedding_input = positional_embedding_input if positional_embedding_input.flags.c_contiguous else np.ascontiguousarray(positional_embedding_input)
-                    mask = mask if mask.flags.c_contiguous else np.ascontiguousarray(mask)
 
                     self.model.decoder_main_input_tensors_map[self.model.decoder_main_input_names[0]].update_data(tokens_input)
 
                     self.model.decoder_main_input_tensors_map[self.model.decoder_main_input_names[1]].update_data(fp16_cast(audio_features))
 
-                    self.model.decoder_main_input_tensors_map[self.model.decoder_main_input_names[2]].update_data(fp16_cast(positional_embedding_input))
+                    self.model.decoder_main_input_tensors_map[self.model.decoder_main_input_names[2]].update_data(positional_embedding_input)
 
-                    self.model.decoder_main_input_tensors_map[self.model.decoder_main_input_names[3]].update_data(fp16_cast(mask))
+                    self.model.decoder_main_input_tensors_map[self.model.decoder_main_input_names[3]].update_data(self.model.get_decoder_main_mask(initial_tokens_length))
 
                     start_time = time.time()
                     self.model.combined_whisper_engine.process(self.model.decoder_main_graph_name, self.model.decoder_main_input_tensors_map,self.model.decoder_main_output_tensors_map)
@@ -803,22 +770,10 @@ class DecodingTask:
 
                     self.model.call_decoder_firstly += 1
                 else:
-                    # type transform for decoder_loop inputs
-                    tokens_input = tokens_input.numpy().astype(np.int32)
-                    positional_embedding_input = positional_embedding_input.numpy().astype(np.float16)
-                    mask = mask.numpy().astype(np.float16)
-
-                    tokens_input = tokens_input if tokens_input.flags.contiguous else np.ascontiguousarray(tokens_input)
-                    positional_embedding_input = positional_embedding_input if positional_embedding_input.flags.contiguous else np.ascontiguousarray(positional_embedding_input)
-                    mask = mask if mask.flags.contiguous else np.ascontiguousarray(mask)
-
-                    # sail
-                    self.model.decoder_loop_input_tensors_map[self.model.decoder_loop_input_names[0]].update_data(tokens_input)
-                    self.model.decoder_loop_input_tensors_map[self.model.decoder_loop_input_names[1]].update_data(fp16_cast(positional_embedding_input))
-                    self.model.decoder_loop_input_tensors_map[self.model.decoder_loop_input_names[1]]
-
-                    self.model.decoder_loop_input_tensors_map[self.model.decoder_loop_input_names[2]].update_data(fp16_cast(mask))
-                    self.model.decoder_loop_input_tensors_map[self.model.decoder_loop_input_names[2]]
+                    offset = i + initial_tokens_length - 1
+                    decoder_loop_inputs[0].update_data(np.ascontiguousarray(tokens.numpy()[:, -1:], dtype=np.int32))
+                    decoder_loop_inputs[1].update_data(positional_embedding[offset:offset + 1])
+                    decoder_loop_inputs[2].update_data(decoder_loop_masks[offset])
 
                     start_time = time.time()
                     self.model.combined_whisper_engine.process(self.model.decoder_loop_graph_name, self.model.decoder_loop_input_tensors_map, self.model.decoder_loop_output_tensors_map)
@@ -0,0 +1,147 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2024 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+"""
+Log-Mel front-end in NumPy, the same computation as torch.stft + mel filterbank without torch.
+
+The Hann window and the filterbanks are built once, numpy's pocketfft keeps the rfft plan of
+N_FFT between calls, and the frames are processed by blocks of MEL_BLOCK_FRAMES into the output
+array, so the temporary memory does not grow with the length of the recording.
+"""
+import os
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+
+# hard-coded audio hyperparameters
+SAMPLE_RATE = 16000
+N_FFT = 400
+N_MELS = [80, 128]
+HOP_LENGTH = 160
+CHUNK_LENGTH = 30
+N_SAMPLES = CHUNK_LENGTH * SAMPLE_RATE  # 480000 samples in a 30-second chunk
+N_FRAMES = N_SAMPLES // HOP_LENGTH  # 3000 frames in a mel spectrogram input
+
+# frames windowed and transformed at a time
+MEL_BLOCK_FRAMES = 1024
+
+
+@lru_cache(maxsize=None)
+def hann_window(n_fft: int = N_FFT) -> np.ndarray:
+    """
+    periodic Hann window, like torch.hann_window(n_fft)
+    """
+    window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n_fft) / n_fft)
+    window = window.astype(np.float32)
+    window.flags.writeable = False
+    return window
+
+
+@lru_cache(maxsize=None)
+def mel_filters_np(n_mels: int = N_MELS[0]) -> np.ndarray:
+    """
+    load the mel filterbank matrix for projecting STFT into a Mel spectrogram.
+    Allows decoupling librosa dependency; saved using:
+
+        np.savez_compressed(
+            "mel_filters.npz",
+            mel_80=librosa.filters.mel(sr=16000, n_fft=400, n_mels=80),
+        )
+    """
+    assert n_mels in N_MELS, f"Unsupported n_mels: {n_mels}"
+    with np.load(
+        os.path.join(os.path.dirname(__file__), "assets", "mel_filters.npz")
+    ) as f:
+        filters = np.ascontiguousarray(f[f"mel_{n_mels}"], dtype=np.float32)
+    filters.flags.writeable = False
+    return filters
+
+
+def n_mel_frames(n_samples: int) -> int:
+    """
+    number of frames of log_mel_frames for n_samples samples
+    """
+    return max(0, (n_samples - N_FFT) // HOP_LENGTH + 1)
+
+
+def log_mel_frames(
+    samples: np.ndarray,
+    n_mels: int = N_MELS[0],
+    n_frames: Optional[int] = None,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    log10 of the Mel spectrogram of the frames of `samples`, without padding (center=False):
+    frame i is samples[i * HOP_LENGTH : i * HOP_LENGTH + N_FFT].
+
+    Parameters
+    ----------
+    samples: np.ndarray, shape = (n_samples,)
+        16 kHz waveform, float32
+
+    n_frames: int
+        Number of frames to compute, all the complete frames (n_mel_frames) by default
+
+    out: np.ndarray, shape = (n_mels, n_frames)
+        Preallocated float32 output, may be a view of a larger array
+
+    Returns
+    -------
+    np.ndarray, shape = (n_mels, n_frames), out if it was given
+    """
+    samples = np.asarray(samples, dtype=np.float32)
+    if n_frames is None:
+        n_frames = n_mel_frames(len(samples))
+    assert n_frames <= n_mel_frames(len(samples)), "not enough samples"
+    if out is None:
+        out = np.empty((n_mels, n_frames), np.float32)
+    assert out.shape == (n_mels, n_frames), f"expected out of shape {(n_mels, n_frames)}, got {out.shape}"
+    if n_frames == 0:
+        return out
+
+    window = hann_window(N_FFT)
+    filters = mel_filters_np(n_mels)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, N_FFT)[::HOP_LENGTH]
+    block = min(n_frames, MEL_BLOCK_FRAMES)
+    windowed = np.empty((block, N_FFT), np.float32)
+    magnitudes = np.empty((block, N_FFT // 2 + 1), np.float32)
+    for start in range(0, n_frames, block):
+        n = min(block, n_frames - start)
+        np.multiply(frames[start:start + n], window, out=windowed[:n])
+        stft = np.fft.rfft(windowed[:n], axis=-1)
+        np.square(stft.real, out=magnitudes[:n])
+        magnitudes[:n] += np.square(stft.imag)
+        np.matmul(filters, magnitudes[:n].T, out=out[:, start:start + n])
+
+    np.maximum(out, 1e-10, out=out)
+    np.log10(out, out=out)
+    return out
+
+
+def log_mel_spectrogram_np(audio: np.ndarray, n_mels: int = N_MELS[0], padding: int = 0) -> np.ndarray:
+    """
+    Whisper log-Mel spectrogram of a 16 kHz waveform: reflect padding of N_FFT // 2 samples at
+    both ends like torch.stft(center=True), `padding` zero samples appended before it, the last
+    frame dropped, floor at (maximum - 8.0) and scaled to about [-1, 1].
+
+    Returns a float32 array of shape (n_mels, (len(audio) + padding) // HOP_LENGTH).
+    """
+    audio = np.asarray(audio, dtype=np.float32).reshape(-1)
+    n_samples = len(audio) + padding
+    samples = np.zeros(n_samples + N_FFT, np.float32)
+    samples[N_FFT // 2 : N_FFT // 2 + len(audio)] = audio
+    # reflect padding of the padded audio, made of zeros on the right when padding is given
+    samples[: N_FFT // 2] = samples[N_FFT : N_FFT // 2 : -1]
+    samples[n_samples + N_FFT // 2 :] = samples[n_samples + N_FFT // 2 - 2 : n_samples - 2 : -1]
+
+    log_spec = log_mel_frames(samples, n_mels, n_samples // HOP_LENGTH)
+    np.maximum(log_spec, log_spec.max() - 8.0, out=log_spec)
+    log_spec += 4.0
+    log_spec /= 4.0
+    return log_spec
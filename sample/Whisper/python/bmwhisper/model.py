@@ -80,6 +80,7 @@ class Whisper():
         self.encoder_input_names = self.combined_whisper_engine.get_input_names(self.encoder_engine_graph_name)
         self.encoder_input_tensors_map = self.combined_whisper_engine.create_input_tensors_map(self.encoder_engine_graph_name)
         self.encoder_output_tensors_map = self.combined_whisper_engine.create_output_tensors_map(self.encoder_engine_graph_name)
+        self.encoder_batch_size = self.combined_whisper_engine.get_input_shape(self.encoder_engine_graph_name, self.encoder_input_names[0])[0]
 
         # initial logits_decoder engine
         self.logits_decoder_graph_name = self.combined_whisper_engine.get_graph_names()[1]
@@ -136,6 +137,8 @@ class Whisper():
             self.kvcache_rearrange_input_list[i + 1][self.kvcache_rearrange_input_names[1]] = kvcache_rearrange_engine_base_input
 
 
+        self.build_decoder_inputs()
+
         model_init_time = time.time() - start_time
         print(f"\nTPU bmodel init time: {model_init_time}s")
 
@@ -151,6 +154,44 @@ class Whisper():
         self.call_kvcache_rearrange = 0
         self.max_ctx = 0
 
+    def build_decoder_inputs(self):
+        """
+        Decoder inputs depending only on the position, built once as fp16 arrays viewed as uint16,
+        ready for update_data:
+            positional_embedding_fp16[offset:offset + 1]: positional row of the token at offset
+            decoder_loop_masks[offset]: decoder_loop attention mask, (n_batch, 1, n_head, padding),
+                the last offset + 1 entries of the kv cache are visible
+        """
+        n_batch, _, n_head, padding = self.combined_whisper_engine.get_input_shape(
+            self.decoder_loop_graph_name, self.decoder_loop_input_names[2])
+        self.positional_embedding_fp16 = fp16_cast(
+            np.ascontiguousarray(self.positional_embedding.numpy().astype(np.float16)))
+
+        offsets = np.arange(padding)
+        rows = np.where(offsets[None, :] >= padding - 1 - offsets[:, None], 0, -10000).astype(np.float16)
+        self.decoder_loop_masks = fp16_cast(np.ascontiguousarray(
+            np.broadcast_to(rows[:, None, None, None, :], (padding, n_batch, 1, n_head, padding))))
+        self.decoder_main_mask_length = None
+        self.decoder_main_mask = None
+
+    def get_decoder_main_mask(self, length: int):
+        """
+        decoder_main attention mask, (n_batch, padding, n_head, padding), of `length` initial tokens
+        aligned to the end of the padding. Kept until the next call with another length, the initial
+        tokens only change with the prompt.
+        """
+        if length != self.decoder_main_mask_length:
+            n_batch, padding, n_head, _ = self.combined_whisper_engine.get_input_shape(
+                self.decoder_main_graph_name, self.decoder_main_input_names[3])
+            start = padding - length
+            mask = np.zeros((padding, padding), np.float16)
+            mask[start:, :start] = -10000
+            mask[start:, start:] = np.triu(np.full((length, length), -10000, np.float16), 1)
+            self.decoder_main_mask = fp16_cast(np.ascontiguousarray(
+                np.broadcast_to(mask[None, :, None, :], (n_batch, padding, n_head, padding))))
+            self.decoder_main_mask_length = length
+        return self.decoder_main_mask
+
     def init_time(self):
         self.inference_time = 0
         self.preprocess_time = 0
@@ -186,6 +227,33 @@ class Whisper():
     def embed_audio(self, mel: torch.Tensor):
         return self.encoder(mel)
 
+    def encode(self, mel: torch.Tensor) -> torch.Tensor:
+        """
+        Encoder forward pass of (n_audio, n_mels, N_FRAMES) windows, run encoder_batch_size windows
+        at a time, the last batch padded with zeros. Returns the (n_audio, n_audio_ctx, n_audio_state)
+        float16 audio features.
+        """
+        mel = mel.numpy().astype(np.float16)
+        n_audio = mel.shape[0]
+        batch_size = self.encoder_batch_size
+        audio_features = []
+        for start in range(0, n_audio, batch_size):
+            batch = mel[start:start + batch_size]
+            n = batch.shape[0]
+            if n < batch_size:
+                batch = np.concatenate([batch, np.zeros((batch_size - n, *batch.shape[1:]), np.float16)])
+            batch = batch if batch.flags.c_contiguous else np.ascontiguousarray(batch)
+            self.encoder_input_tensors_map[self.encoder_input_names[0]].update_data(fp16_cast(batch))
+
+            start_time = time.time()
+            self.combined_whisper_engine.process(self.encoder_engine_graph_name, self.encoder_input_tensors_map, self.encoder_output_tensors_map)
+            self.inference_time += time.time() - start_time
+
+            mel_out_tensor = list(self.encoder_output_tensors_map.values())[0]
+            audio_features.append(uint16_to_fp16(mel_out_tensor.asnumpy())[:n])
+            self.call_encoder += 1
+        return torch.from_numpy(np.concatenate(audio_features))
+
     def logits(self, tokens: torch.Tensor, audio_features: torch.Tensor):
         # hard code tokens type here
         tokens = tokens.numpy().astype(np.int32)
@@ -0,0 +1,229 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2024 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+import socket
+import subprocess
+import sys
+import wave
+from typing import Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+import torch
+
+from .mel import (
+    HOP_LENGTH,
+    N_FFT,
+    N_FRAMES,
+    N_MELS,
+    N_SAMPLES,
+    SAMPLE_RATE,
+    log_mel_frames,
+    n_mel_frames,
+)
+
+# seconds of audio read at a time by the chunk readers
+CHUNK_SECONDS = 5
+
+
+def pcm_chunks(stream, chunk_seconds: float = CHUNK_SECONDS) -> Iterator[np.ndarray]:
+    """
+    Read 16 kHz mono s16le PCM from a binary file object (pipe, socket, stdin)
+
+    Yields float32 waveforms of about `chunk_seconds` seconds until the end of the stream.
+    """
+    chunk_bytes = int(chunk_seconds * SAMPLE_RATE) * 2
+    pending = b""
+    while True:
+        data = stream.read(chunk_bytes)
+        if not data:
+            break
+        data = pending + data
+        usable = len(data) // 2 * 2
+        pending = data[usable:]
+        if usable:
+            yield np.frombuffer(data[:usable], np.int16).astype(np.float32) / 32768.0
+
+
+def ffmpeg_chunks(file: str, chunk_seconds: float = CHUNK_SECONDS) -> Iterator[np.ndarray]:
+    """
+    Decode an audio file with ffmpeg like `load_audio`, but read its output chunk by chunk
+    instead of waiting for the whole file.
+    """
+    # fmt: off
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-loglevel", "error",
+        "-threads", "0",
+        "-i", file,
+        "-f", "s16le",
+        "-ac", "1",
+        "-acodec", "pcm_s16le",
+        "-ar", str(SAMPLE_RATE),
+        "-"
+    ]
+    # fmt: on
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        yield from pcm_chunks(process.stdout, chunk_seconds)
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            # the consumer stopped early
+            process.kill()
+        _, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"Failed to load audio: {stderr.decode()}")
+
+
+def wav_chunks(file, chunk_seconds: float = CHUNK_SECONDS) -> Iterator[np.ndarray]:
+    """
+    Read a 16 kHz mono 16-bit WAV file or stream without ffmpeg
+    """
+    with wave.open(file, "rb") as f:
+        if f.getframerate() != SAMPLE_RATE or f.getnchannels() != 1 or f.getsampwidth() != 2:
+            raise ValueError(
+                f"expected 16 kHz mono 16-bit wav, got {f.getframerate()} Hz, "
+                f"{f.getnchannels()} channel(s), {8 * f.getsampwidth()}-bit; use ffmpeg_chunks instead"
+            )
+        frames = int(chunk_seconds * SAMPLE_RATE)
+        while True:
+            data = f.readframes(frames)
+            if not data:
+                break
+            yield np.frombuffer(data, np.int16).astype(np.float32) / 32768.0
+
+
+def socket_chunks(host: str, port: int, chunk_seconds: float = CHUNK_SECONDS) -> Iterator[np.ndarray]:
+    """
+    Receive 16 kHz mono s16le PCM from a tcp server until it closes the connection
+    """
+    with socket.create_connection((host, port)) as sock, sock.makefile("rb") as stream:
+        yield from pcm_chunks(stream, chunk_seconds)
+
+
+def audio_chunks(source: str, chunk_seconds: float = CHUNK_SECONDS) -> Iterator[np.ndarray]:
+    """
+    Chunk reader of an audio source:
+        "-"                  16 kHz mono s16le PCM on stdin
+        "tcp://host:port"    16 kHz mono s16le PCM sent by a tcp server
+        16 kHz mono .wav     read directly
+        any other file       decoded by ffmpeg
+    """
+    if source == "-":
+        return pcm_chunks(sys.stdin.buffer, chunk_seconds)
+    if source.startswith("tcp://"):
+        host, port = source[len("tcp://"):].rsplit(":", 1)
+        return socket_chunks(host, int(port), chunk_seconds)
+    if source.lower().endswith(".wav"):
+        try:
+            with wave.open(source, "rb") as f:
+                if (f.getframerate(), f.getnchannels(), f.getsampwidth()) == (SAMPLE_RATE, 1, 2):
+                    return wav_chunks(source, chunk_seconds)
+        except wave.Error:
+            pass
+    return ffmpeg_chunks(source, chunk_seconds)
+
+
+class StreamingMel:
+    """
+    Log-Mel spectrogram of an audio stream, computed as the chunks arrive.
+
+    The frames are the ones of `log_mel_spectrogram(audio, n_mels, padding=N_SAMPLES)` on the
+    whole recording: same reflect padding at the start, 30 seconds of silence appended at the
+    end of the stream. The only difference is the floor at (maximum - 8.0): it uses the maximum
+    of the frames computed so far, the maximum of the whole recording is not known yet.
+
+    Only the samples of the next frames and the frames from the current window on are kept, so
+    the memory does not grow with the length of the recording.
+    """
+
+    def __init__(self, chunks: Iterable[np.ndarray], n_mels: int = N_MELS[0]):
+        self.chunks = iter(chunks)
+        self.n_mels = n_mels
+        # reflect padded samples from the first one of the next frame
+        self.samples = np.zeros(0, np.float32)
+        # samples read before the reflect padding can be built
+        self.head = np.zeros(0, np.float32)
+        self.n_audio_samples = 0
+        self.finished = False
+        # log10 Mel frames from frame_offset to n_frames
+        self.frames = np.zeros((n_mels, 0), np.float32)
+        self.frame_offset = 0
+        self.n_frames = 0
+        self.total_frames = None
+        self.log_max = -np.inf
+
+    @property
+    def content_frames(self) -> Optional[int]:
+        """number of frames of the recording, known once the stream is finished"""
+        return None if self.total_frames is None else self.total_frames - N_FRAMES
+
+    def _append(self, audio: np.ndarray):
+        if self.head is not None:
+            self.head = np.concatenate([self.head, audio])
+            if len(self.head) <= N_FFT // 2:
+                return
+            # same reflect padding as torch.stft(center=True)
+            audio = np.concatenate([self.head[1 : N_FFT // 2 + 1][::-1], self.head])
+            self.head = None
+        self.samples = np.concatenate([self.samples, audio])
+
+    def _read(self) -> bool:
+        if self.finished:
+            return False
+        try:
+            audio = np.asarray(next(self.chunks), dtype=np.float32).reshape(-1)
+            self.n_audio_samples += len(audio)
+            self._append(audio)
+        except StopIteration:
+            self.finished = True
+            # 30 seconds of silence like padding=N_SAMPLES, then the reflect padding of the end,
+            # made of silence too
+            self._append(np.zeros(N_SAMPLES, np.float32))
+            self.samples = np.concatenate([self.samples, np.zeros(N_FFT // 2, np.float32)])
+            self.total_frames = (self.n_audio_samples + N_SAMPLES) // HOP_LENGTH
+        return True
+
+    def _compute(self):
+        n = n_mel_frames(len(self.samples))
+        if self.total_frames is not None:
+            n = min(n, self.total_frames - self.n_frames)
+        if n <= 0:
+            return
+        # the new frames are computed in place after the frames still needed
+        frames = np.empty((self.n_mels, self.frames.shape[1] + n), np.float32)
+        frames[:, : self.frames.shape[1]] = self.frames
+        log_spec = log_mel_frames(self.samples, self.n_mels, n, out=frames[:, self.frames.shape[1] :])
+        self.log_max = max(self.log_max, float(log_spec.max()))
+        self.frames = frames
+        self.samples = self.samples[n * HOP_LENGTH :]
+        self.n_frames += n
+
+    def window(self, seek: int) -> Tuple[torch.Tensor, int]:
+        """
+        Read the stream until the 30-second window starting at frame `seek` is complete, and
+        forget the frames before it.
+
+        Returns the (n_mels, N_FRAMES) log-Mel window and the number of frames of the recording
+        in it, 0 once `seek` is past the end of the recording.
+        """
+        while self.n_frames < seek + N_FRAMES and (self.total_frames is None or self.n_frames < self.total_frames):
+            if not self._read():
+                break
+            self._compute()
+
+        self.frames = self.frames[:, max(seek - self.frame_offset, 0) :]
+        self.frame_offset = max(seek, self.frame_offset)
+
+        segment = self.frames[:, :N_FRAMES]
+        segment = np.maximum(segment, self.log_max - 8.0)
+        segment = torch.from_numpy((segment + 4.0) / 4.0)
+        if self.content_frames is None:
+            return segment, N_FRAMES
+        return segment, max(0, min(N_FRAMES, self.content_frames - seek))
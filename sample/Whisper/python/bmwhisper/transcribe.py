@@ -9,22 +9,23 @@
 import argparse
 import os
 import warnings
-from typing import TYPE_CHECKING, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Iterable, Iterator, Optional, Tuple, Union
 import numpy as np
 import torch
 import tqdm
 import time
 
+from .mel import N_FRAMES
 from .utils import (
     FRAMES_PER_SECOND,
     HOP_LENGTH,
-    N_FRAMES,
     N_SAMPLES,
     SAMPLE_RATE,
     log_mel_spectrogram,
     pad_or_trim,
 )
 from .decoding import DecodingOptions, DecodingResult
+from .streaming import StreamingMel, audio_chunks
 from .tokenizer import LANGUAGES, TO_LANGUAGE_CODE, get_tokenizer
 from .utils import (
     exact_div,
@@ -41,6 +42,20 @@ if TYPE_CHECKING:
     from .model import Whisper
 
 
+class MelWindows:
+    """
+    30-second windows of the log-Mel spectrogram of a whole recording, padded with 30 seconds
+    of silence. Same interface as `StreamingMel`.
+    """
+
+    def __init__(self, mel: torch.Tensor):
+        self.mel = mel
+        self.content_frames = mel.shape[-1] - N_FRAMES
+
+    def window(self, seek: int) -> Tuple[torch.Tensor, int]:
+        return self.mel[:, seek : seek + N_FRAMES], max(0, min(N_FRAMES, self.content_frames - seek))
+
+
 def transcribe(
     model: "Whisper",
     audio: Union[str, np.ndarray, torch.Tensor],
@@ -114,14 +129,160 @@ def transcribe(
     A dictionary containing the resulting text ("text") and segment-level details ("segments"), and
     the spoken language ("language"), which is detected when `decode_options["language"]` is None.
     """
+    start_time = time.time()
+    # Pad 30-seconds of silence to the input audio, for slicing
+    mel = log_mel_spectrogram(audio, model.dims.n_mels, padding=N_SAMPLES)
+    windows = MelWindows(mel)
+    model.preprocess_time += time.time() - start_time
+
+    segments = list(
+        _transcribe_windows(
+            model,
+            windows,
+            verbose=verbose,
+            temperature=temperature,
+            compression_ratio_threshold=compression_ratio_threshold,
+            logprob_threshold=logprob_threshold,
+            no_speech_threshold=no_speech_threshold,
+            condition_on_previous_text=condition_on_previous_text,
+            initial_prompt=initial_prompt,
+            word_timestamps=word_timestamps,
+            prepend_punctuations=prepend_punctuations,
+            append_punctuations=append_punctuations,
+            total_frames=windows.content_frames,
+            decode_options=decode_options,
+        )
+    )
+    return _make_result(model, segments, decode_options)
+
+
+def transcribe_stream(
+    model: "Whisper",
+    chunks: Union[str, Iterable[np.ndarray]],
+    *,
+    verbose: Optional[bool] = None,
+    temperature: Union[float, Tuple[float, ...]] = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0),
+    compression_ratio_threshold: Optional[float] = 2.4,
+    logprob_threshold: Optional[float] = -1.0,
+    no_speech_threshold: Optional[float] = 0.6,
+    condition_on_previous_text: bool = True,
+    initial_prompt: Optional[str] = None,
+    word_timestamps: bool = False,
+    prepend_punctuations: str = "\"'“¿([{-",
+    append_punctuations: str = "\"'.。,，!！?？:：”)]}、",
+    **decode_options,
+) -> Iterator[dict]:
+    """
+    Transcribe an audio stream using Whisper, window by window as the audio arrives
+
+    The log-Mel frames are computed chunk by chunk, every 30-second window is decoded as soon as
+    it is filled, and its segments are yielded right away: they are final, the next windows
+    start after them. Only the current window is kept in memory, whatever the length of the
+    recording.
+
+    Parameters
+    ----------
+    model: Whisper
+        The Whisper model instance
+
+    chunks: Union[str, Iterable[np.ndarray]]
+        Float32 16 kHz waveform chunks of any length, e.g. from `streaming.audio_chunks`, or a
+        source understood by `audio_chunks` (file path, "-" for stdin, "tcp://host:port")
+
+    The other parameters are the ones of `transcribe`.
+
+    Yields
+    ------
+    The segment dictionaries of `transcribe()["segments"]`, in order. The generator returns the
+    dictionary `transcribe` would return (text, segments, language) once the stream ends.
+    """
+    if isinstance(chunks, str):
+        chunks = audio_chunks(chunks)
+    windows = StreamingMel(chunks, model.dims.n_mels)
+
+    segments = []
+    for segment in _transcribe_windows(
+        model,
+        windows,
+        verbose=verbose,
+        temperature=temperature,
+        compression_ratio_threshold=compression_ratio_threshold,
+        logprob_threshold=logprob_threshold,
+        no_speech_threshold=no_speech_threshold,
+        condition_on_previous_text=condition_on_previous_text,
+        initial_prompt=initial_prompt,
+        word_timestamps=word_timestamps,
+        prepend_punctuations=prepend_punctuations,
+        append_punctuations=append_punctuations,
+        total_frames=None,
+        decode_options=decode_options,
+    ):
+        segments.append(segment)
+        yield segment
+    return _make_result(model, segments, decode_options)
+
+
+class EncoderRequest:
+    """
+    Yielded by `_transcribe_windows(..., pack_windows=True)` instead of running the encoder: the
+    caller encodes the (n_mels, N_FRAMES) window together with the windows of other recordings
+    and sends the audio features back into the generator.
+    """
+
+    def __init__(self, mel: torch.Tensor):
+        self.mel = mel
+
+
+def _make_result(model: "Whisper", segments: list, decode_options: dict) -> dict:
+    tokenizer = get_tokenizer(
+        model.is_multilingual,
+        num_languages=model.num_languages,
+        language=decode_options["language"],
+        task=decode_options.get("task", "transcribe"),
+    )
+    return dict(
+        text=tokenizer.decode([token for segment in segments for token in segment["tokens"]]),
+        segments=segments,
+        language=decode_options["language"],
+    )
+
+
+def _transcribe_windows(
+    model: "Whisper",
+    windows: Union[MelWindows, StreamingMel],
+    *,
+    verbose: Optional[bool],
+    temperature: Union[float, Tuple[float, ...]],
+    compression_ratio_threshold: Optional[float],
+    logprob_threshold: Optional[float],
+    no_speech_threshold: Optional[float],
+    condition_on_previous_text: bool,
+    initial_prompt: Optional[str],
+    word_timestamps: bool,
+    prepend_punctuations: str,
+    append_punctuations: str,
+    total_frames: Optional[int],
+    decode_options: dict,
+    pack_windows: bool = False,
+) -> Iterator[Union[dict, EncoderRequest]]:
+    """
+    Decoding loop shared by `transcribe`, `transcribe_stream` and `batch.transcribe_batch`: yields
+    the segments of every 30-second window given by `windows.window(seek)`.
+    decode_options["language"] is set to the detected language.
+
+    With pack_windows, an `EncoderRequest` is yielded before decoding each window and the loop
+    waits for the audio features to be sent back, see `batch.transcribe_batch`.
+    """
     # only float16 now
     dtype = torch.float16
 
     start_time = time.time()
-    # Pad 30-seconds of silence to the input audio, for slicing
-    mel = log_mel_spectrogram(audio, model.dims.n_mels, padding=N_SAMPLES)
 
-    content_frames = mel.shape[-1] - N_FRAMES
+    def encode(mel_segment: torch.Tensor):
+        # with pack_windows the encoder runs outside, otherwise model.decode encodes the mel
+        if pack_windows:
+            return (yield EncoderRequest(mel_segment))
+        return mel_segment
 
     if decode_options.get("language", None) is None:
         if not model.is_multilingual:
@@ -131,8 +292,8 @@ def transcribe(
                 print(
                     "Detecting language using up to the first 30 seconds. Use `--language` to specify the language"
                 )
-            mel_segment = pad_or_trim(mel, N_FRAMES).to(dtype)
-            _, probs = model.detect_language(mel_segment)
+            mel_segment = pad_or_trim(windows.window(0)[0], N_FRAMES).to(dtype)
+            _, probs = model.detect_language((yield from encode(mel_segment)))
             decode_options["language"] = max(probs, key=probs.get)
             if verbose is not None:
                 print(
@@ -158,7 +319,7 @@ def transcribe(
         input_stride * HOP_LENGTH / SAMPLE_RATE
     )  # time per output token: 0.02 (seconds)
     all_tokens = []
-    all_segments = []
+    n_segments = 0
     prompt_reset_since = 0
 
     if initial_prompt is not None:
@@ -232,18 +393,23 @@ def transcribe(
 
     # show the progress bar when verbose is False (if True, transcribed text will be printed)
     with tqdm.tqdm(
-        total=content_frames, unit="frames", disable=verbose is not False
+        total=total_frames, unit="frames", disable=verbose is not False
     ) as pbar:
         last_speech_timestamp = 0.0
-        while seek < content_frames:
+        while True:
             time_offset = float(seek * HOP_LENGTH / SAMPLE_RATE)
-            mel_segment = mel[:, seek : seek + N_FRAMES]
-            segment_size = min(N_FRAMES, content_frames - seek)
+            start_time = time.time()
+            mel_segment, segment_size = windows.window(seek)
+            model.preprocess_time += time.time() - start_time
+            if segment_size <= 0:
+                break
             segment_duration = segment_size * HOP_LENGTH / SAMPLE_RATE
             mel_segment = pad_or_trim(mel_segment, N_FRAMES).to(dtype)
 
+            audio_features = yield from encode(mel_segment)
+
             decode_options["prompt"] = all_tokens[prompt_reset_since:]
-            result: DecodingResult = decode_with_fallback(mel_segment)
+            result: DecodingResult = decode_with_fallback(audio_features)
             tokens = torch.tensor(result.tokens)
             # print(f"result: {result}")
 
@@ -362,14 +528,6 @@ def transcribe(
                     segment["tokens"] = []
                     segment["words"] = []
 
-            all_segments.extend(
-                [
-                    {"id": i, **segment}
-                    for i, segment in enumerate(
-                        current_segments, start=len(all_segments)
-                    )
-                ]
-            )
             all_tokens.extend(
                 [token for segment in current_segments for token in segment["tokens"]]
             )
@@ -379,13 +537,20 @@ def transcribe(
                 prompt_reset_since = len(all_tokens)
 
             # update progress bar
-            pbar.update(min(content_frames, seek) - previous_seek)
+            pbar.update(min(previous_seek + segment_size, seek) - previous_seek)
+
+            for i, segment in enumerate(current_segments, start=n_segments):
+                yield {"id": i, **segment}
+            n_segments += len(current_segments)
+
+def _drain(stream: Iterator[dict]) -> dict:
+    # the segments are printed by the decoding loop as they come when verbose
+    while True:
+        try:
+            next(stream)
+        except StopIteration as e:
+            return e.value
 
-    return dict(
-        text=tokenizer.decode(all_tokens[len(initial_prompt_tokens) :]),
-        segments=all_segments,
-        language=language,
-    )
 
 def cli():
     start_time = time.time()
@@ -429,6 +594,9 @@ def cli():
     parser.add_argument("--threads", type=optional_int, default=0, help="number of threads used by torch for CPU inference; supercedes MKL_NUM_THREADS/OMP_NUM_THREADS")
     parser.add_argument("--padding_size", type=optional_int, default=448, help="max pre-allocation size for the key-value cache")
     parser.add_argument("--loop_profile", action="store_true", help="whether to print loop times")
+    parser.add_argument("--stream", action="store_true", help="read the audio chunk by chunk and output the segments of every 30-second window as soon as it is decoded; also accepts '-' (16 kHz s16le PCM on stdin) and tcp://host:port")
+    parser.add_argument("--batch_files", type=int, default=0, help="transcribe this many files at a time, their 30-second windows packed into encoder batches; 0 transcribes the files one by one")
+    parser.add_argument("--decode_workers", type=int, default=4, help="with --batch_files, threads decoding the audio files ahead of the TPU")
     # fmt: on
 
     args = parser.parse_args().__dict__
@@ -436,6 +604,11 @@ def cli():
     output_dir: str = args.pop("output_dir")
     output_format: str = args.pop("output_format")
     loop_profile = args.pop("loop_profile")
+    stream = args.pop("stream")
+    batch_files = args.pop("batch_files")
+    decode_workers = args.pop("decode_workers")
+    if stream and batch_files > 0:
+        parser.error("--stream and --batch_files can't be given together")
     os.makedirs(output_dir, exist_ok=True)
 
     model_name = args["model_name"]
@@ -472,6 +645,32 @@ def cli():
         warnings.warn("--max_line_count has no effect without --max_line_width")
     writer_args = {arg: args.pop(arg) for arg in word_options}
     audio_list=args.pop("audio")
+    if batch_files > 0:
+        from .batch import transcribe_batch
+
+        print("{:=^100}".format(f" Start "))
+        model.init_cnt()
+        model.init_time()
+        results = transcribe_batch(model, audio_list, batch_files=batch_files, workers=decode_workers, temperature=temperature, **args)
+        while True:
+            try:
+                audio_path, result = next(results)
+            except StopIteration as e:
+                stats = e.value
+                break
+            writer(result, audio_path, writer_args)
+        if loop_profile:
+            model.print_cnt()
+        print()
+        print(f"Audio duration: {stats['audio_duration']:.2f}s, {stats['files']} file(s), {stats['failed']} failed")
+        print(f"Windows: {stats['windows']}, encoder calls: {stats['encoder_calls']}")
+        print(f"Audio loading time (decode workers): {stats['load_time']}s")
+        print(f"Inference time: {model.inference_time}s")
+        print(f"Total time: {stats['total_time']}s")
+        print(f"RTF: {stats['rtf']:.4f}")
+        print("{:=^100}".format(f" End "))
+        return
+
     for audio_path in audio_list:
         if os.path.isdir(audio_path):
             all_files = [os.path.join(audio_path, f) for f in os.listdir(audio_path)]
@@ -483,7 +682,10 @@ def cli():
         audio_start_time = time.time()
         model.init_cnt()
         model.init_time()
-        result = transcribe(model, audio_path, temperature=temperature, **args)
+        if stream:
+            result = _drain(transcribe_stream(model, audio_path, temperature=temperature, **args))
+        else:
+            result = transcribe(model, audio_path, temperature=temperature, **args)
         writer(result, audio_path, writer_args)
         total_time = time.time() - audio_start_time
         preprocess_time = total_time - model.inference_time
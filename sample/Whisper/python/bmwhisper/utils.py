@@ -11,19 +11,32 @@ import os
 import re
 import sys
 import zlib
-from typing import Callable, Optional, TextIO, Union, List
+from typing import TYPE_CHECKING, Callable, Optional, TextIO, Union, List
 import numpy as np
-import torch
-import numba
 from dataclasses import dataclass
 import itertools
 import warnings
 from functools import lru_cache
 from subprocess import CalledProcessError, run, CalledProcessError
-import torch.nn.functional as F
 
+# CHUNK_LENGTH, N_FFT and N_FRAMES are re-exported for tools/export_whisper, whose utils.py links to this file
+from .mel import (
+    CHUNK_LENGTH,
+    HOP_LENGTH,
+    N_FFT,
+    N_FRAMES,
+    N_MELS,
+    N_SAMPLES,
+    SAMPLE_RATE,
+    log_mel_spectrogram_np,
+    mel_filters_np,
+)
 from .tokenizer import Tokenizer
 
+if TYPE_CHECKING:
+    # torch is slow to import, the helpers that need it import it on first use
+    import torch
+
 
 def exact_div(x, y):
     assert x % y == 0
@@ -43,15 +56,7 @@ def uint16_to_fp16(arr: np.ndarray):
     else:
         return arr
 
-# hard-coded audio hyperparameters
-SAMPLE_RATE = 16000
-N_FFT = 400
-N_MELS = [80, 128]
-HOP_LENGTH = 160
-CHUNK_LENGTH = 30
-N_SAMPLES = CHUNK_LENGTH * SAMPLE_RATE  # 480000 samples in a 30-second chunk
-N_FRAMES = exact_div(N_SAMPLES, HOP_LENGTH)  # 3000 frames in a mel spectrogram input
-
+# the audio hyperparameters are defined in mel.py
 N_SAMPLES_PER_TOKEN = HOP_LENGTH * 2  # the initial convolutions has stride 2
 FRAMES_PER_SECOND = exact_div(SAMPLE_RATE, HOP_LENGTH)  # 10ms per audio frame
 TOKENS_PER_SECOND = exact_div(SAMPLE_RATE, N_SAMPLES_PER_TOKEN)  # 20ms per audio token
@@ -97,11 +102,20 @@ def load_audio(file: str, sr: int = SAMPLE_RATE):
     return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
 
 
+def _is_tensor(x) -> bool:
+    # a tensor can only exist once torch has been imported by the caller
+    torch = sys.modules.get("torch")
+    return torch is not None and torch.is_tensor(x)
+
+
 def pad_or_trim(array, length: int = N_SAMPLES, *, axis: int = -1):
     """
     Pad or trim the audio array to N_SAMPLES, as expected by the encoder.
     """
-    if torch.is_tensor(array):
+    if _is_tensor(array):
+        import torch
+        import torch.nn.functional as F
+
         if array.shape[axis] > length:
             array = array.index_select(
                 dim=axis, index=torch.arange(length, device=array.device)
@@ -124,41 +138,20 @@ def pad_or_trim(array, length: int = N_SAMPLES, *, axis: int = -1):
 
 
 @lru_cache(maxsize=None)
-def mel_filters(device, n_mels: int = N_MELS[0]) -> torch.Tensor:
+def mel_filters(device, n_mels: int = N_MELS[0]) -> "torch.Tensor":
     """
-    load the mel filterbank matrix for projecting STFT into a Mel spectrogram.
-    Allows decoupling librosa dependency; saved using:
-
-        np.savez_compressed(
-            "mel_filters.npz",
-            mel_80=librosa.filters.mel(sr=16000, n_fft=400, n_mels=80),
-        )
+    the mel filterbank matrix of `mel_filters_np` as a tensor on `device`
     """
-    assert n_mels in N_MELS, f"Unsupported n_mels: {n_mels}"
-    with np.load(
-        os.path.join(os.path.dirname(__file__), "assets", "mel_filters.npz")
-    ) as f:
-        return torch.from_numpy(f[f"mel_{n_mels}"]).to(device)
+    import torch
 
-
-@lru_cache(maxsize=None)
-def mel_filters_np(n_mels: int = N_MELS[0]) -> np.ndarray:
-    """
-    load the mel filterbank matrix for projecting STFT into a Mel spectrogram.
-    Allows decoupling librosa dependency; saved using:
-    """
-    assert n_mels in N_MELS, f"Unsupported n_mels: {n_mels}"
-    with np.load(
-        os.path.join(os.path.dirname(__file__), "assets", "mel_filters.npz")
-    ) as f:
-        return f[f"mel_{n_mels}"]
+    return torch.from_numpy(mel_filters_np(n_mels).copy()).to(device)
 
 
 def log_mel_spectrogram(
-    audio: Union[str, np.ndarray, torch.Tensor],
+    audio: Union[str, np.ndarray, "torch.Tensor"],
     n_mels: int = N_MELS[0],
     padding: int = 0,
-    device: Optional[Union[str, torch.device]] = None,
+    device: Optional[Union[str, "torch.device"]] = None,
 ):
     """
     Compute the log-Mel spectrogram of
@@ -175,32 +168,23 @@ def log_mel_spectrogram(
         Number of zero samples to pad to the right
 
     device: Optional[Union[str, torch.device]]
-        If given, the audio tensor is moved to this device before STFT
+        If given, the Mel spectrogram is moved to this device
 
     Returns
     -------
     torch.Tensor, shape = (80, n_frames)
-        A Tensor that contains the Mel spectrogram
+        A Tensor that contains the Mel spectrogram, computed in NumPy by `mel.log_mel_spectrogram_np`
     """
-    if not torch.is_tensor(audio):
-        if isinstance(audio, str):
-            audio = load_audio(audio)
-        audio = torch.from_numpy(audio)
+    import torch
+
+    if torch.is_tensor(audio):
+        audio = audio.cpu().numpy()
+    elif isinstance(audio, str):
+        audio = load_audio(audio)
 
+    log_spec = torch.from_numpy(log_mel_spectrogram_np(audio, n_mels, padding))
     if device is not None:
-        audio = audio.to(device)
-    if padding > 0:
-        audio = F.pad(audio, (0, padding))
-    window = torch.hann_window(N_FFT).to(audio.device)
-    stft = torch.stft(audio, N_FFT, HOP_LENGTH, window=window, return_complex=True)
-    magnitudes = stft[..., :-1].abs() ** 2
-
-    filters = mel_filters(audio.device, n_mels)
-    mel_spec = filters @ magnitudes
-
-    log_spec = torch.clamp(mel_spec, min=1e-10).log10()
-    log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
-    log_spec = (log_spec + 4.0) / 4.0
+        log_spec = log_spec.to(device)
     return log_spec
 
 
@@ -452,7 +436,7 @@ def get_writer(
     return writers[output_format](output_dir)
 
 
-def median_filter(x: torch.Tensor, filter_width: int):
+def median_filter(x: "torch.Tensor", filter_width: int):
     """Apply a median filter of width `filter_width` along the last dimension of `x`"""
     pad_width = filter_width // 2
     if x.shape[-1] <= pad_width:
@@ -467,6 +451,8 @@ def median_filter(x: torch.Tensor, filter_width: int):
         filter_width > 0 and filter_width % 2 == 1
     ), "`filter_width` should be an odd number"
 
+    import torch.nn.functional as F
+
     result = None
     x = F.pad(x, (filter_width // 2, filter_width // 2, 0, 0), mode="reflect")
     if x.is_cuda:
@@ -490,8 +476,7 @@ def median_filter(x: torch.Tensor, filter_width: int):
     return result
 
 
-@numba.jit(nopython=True)
-def backtrace(trace: np.ndarray):
+def _backtrace(trace: np.ndarray):
     i = trace.shape[0] - 1
     j = trace.shape[1] - 1
     trace[0, :] = 2
@@ -515,8 +500,7 @@ def backtrace(trace: np.ndarray):
     return result[::-1, :].T
 
 
-@numba.jit(nopython=True, parallel=True)
-def dtw_cpu(x: np.ndarray):
+def _dtw_trace(x: np.ndarray):
     N, M = x.shape
     cost = np.ones((N + 1, M + 1), dtype=np.float32) * np.inf
     trace = -np.ones((N + 1, M + 1), dtype=np.float32)
@@ -538,10 +522,28 @@ def dtw_cpu(x: np.ndarray):
             cost[i, j] = x[i - 1, j - 1] + c
             trace[i, j] = t
 
-    return backtrace(trace)
+    return trace
+
+
+@lru_cache(maxsize=None)
+def _dtw_kernels():
+    # numba is slow to import and only needed for word timestamps, jit the kernels on first use
+    import numba
+
+    return numba.jit(nopython=True)(_backtrace), numba.jit(nopython=True, parallel=True)(_dtw_trace)
+
+
+def backtrace(trace: np.ndarray):
+    return _dtw_kernels()[0](trace)
+
+
+def dtw_cpu(x: np.ndarray):
+    return backtrace(_dtw_kernels()[1](x))
 
 
 def dtw_cuda(x, BLOCK_SIZE=1024):
+    import torch
+    import torch.nn.functional as F
     from .triton_ops import dtw_kernel
 
     M, N = x.shape
@@ -574,7 +576,7 @@ def dtw_cuda(x, BLOCK_SIZE=1024):
     return backtrace(trace.cpu().numpy())
 
 
-def dtw(x: torch.Tensor) -> np.ndarray:
+def dtw(x: "torch.Tensor") -> np.ndarray:
     if x.is_cuda:
         try:
             return dtw_cuda(x)
@@ -600,13 +602,15 @@ def find_alignment(
     model: "Whisper",
     tokenizer: Tokenizer,
     text_tokens: List[int],
-    mel: torch.Tensor,
+    mel: "torch.Tensor",
     num_frames: int,
     *,
     medfilt_width: int = 7,
     qk_scale: float = 1.0,
 ) -> List[WordTiming]:
     import pdb; pdb.set_trace()
+    import torch
+
     if len(text_tokens) == 0:
         return []
 
@@ -709,7 +713,7 @@ def add_word_timestamps(
     segments: List[dict],
     model: "Whisper",
     tokenizer: Tokenizer,
-    mel: torch.Tensor,
+    mel: "torch.Tensor",
     num_frames: int,
     prepend_punctuations: str = "\"'“¿([{-",
     append_punctuations: str = "\"'.。,，!！?？:：”)]}、",
@@ -4,6 +4,7 @@
 model="small"
 beam_size=5
 padding_size=448
+encoder_batch=1
 quant=true
 process=""
 
@@ -35,6 +36,10 @@ while [[ $# -gt 0 ]]; do
             process="$2"
             shift 2
             ;;
+        --encoder_batch)
+            encoder_batch="$2"
+            shift 2
+            ;;
         *)
             # Unknown option
             echo "Unknown option: $1"
@@ -70,7 +75,7 @@ function gen_bmodel() {
     echo "Transforming $process_name ..."
     case $process_name in
         encoder)
-            input_shapes="[[1,80,3000]]"
+            input_shapes="[[$encoder_batch,80,3000]]"
             ;;
         logits_decoder)
             input_shapes="[[1,1],[1,${n_audio_ctx},${n_text_state}]]"
@@ -0,0 +1 @@
+../../python/bmwhisper/mel.py
\ No newline at end of file
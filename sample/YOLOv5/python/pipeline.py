@@ -0,0 +1,116 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+import queue
+import threading
+import time
+import logging
+
+STOP = object()
+
+
+class Stage:
+    """
+    A pool of worker threads reading from one bounded queue and writing to the next one.
+    make_worker is called once in every worker thread and returns the function applied to
+    the items, so every thread can own its state (an engine, a postprocessor with buffers).
+    The function may return None to drop an item; the sequence number is still forwarded
+    so that the results can be put back in order.
+    """
+    def __init__(self, name, make_worker, num_workers=1):
+        self.name = name
+        self.make_worker = make_worker
+        self.num_workers = max(1, num_workers)
+        self.busy_time = 0.0
+        self.count = 0
+        self.in_queue = None
+        self.out_queue = None
+        self._lock = threading.Lock()
+        self._alive = 0
+        self._threads = []
+
+    def start(self, in_queue, out_queue):
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self._alive = self.num_workers
+        self._threads = [threading.Thread(target=self._run, name='{}_{}'.format(self.name, i), daemon=True)
+                         for i in range(self.num_workers)]
+        for t in self._threads:
+            t.start()
+
+    def _run(self):
+        fn = self.make_worker()
+        while True:
+            item = self.in_queue.get()
+            if item is STOP:
+                # let the other workers of this stage see it, the last one tells the next stage
+                self.in_queue.put(STOP)
+                with self._lock:
+                    self._alive -= 1
+                    last = self._alive == 0
+                if last:
+                    self.out_queue.put(STOP)
+                return
+            seq, data = item
+            if data is not None:
+                start_time = time.time()
+                try:
+                    data = fn(data)
+                except Exception as e:
+                    logging.error("{} stage failed on item {}: {}".format(self.name, seq, e))
+                    data = None
+                elapsed = time.time() - start_time
+                with self._lock:
+                    self.busy_time += elapsed
+                    self.count += 1
+            self.out_queue.put((seq, data))
+
+
+class Pipeline:
+    """
+    Runs stages concurrently, connected by bounded queues, and yields the results in the
+    order of the source items.
+    """
+    def __init__(self, queue_size=4):
+        self.queue_size = queue_size
+        self.stages = []
+
+    def add_stage(self, name, make_worker, num_workers=1):
+        self.stages.append(Stage(name, make_worker, num_workers))
+        return self
+
+    def run(self, source):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        for stage, in_queue, out_queue in zip(self.stages, queues[:-1], queues[1:]):
+            stage.start(in_queue, out_queue)
+
+        def feed():
+            try:
+                for seq, data in enumerate(source):
+                    queues[0].put((seq, data))
+            except Exception as e:
+                logging.error("pipeline source failed: {}".format(e))
+            finally:
+                queues[0].put(STOP)
+        feeder = threading.Thread(target=feed, name='feeder', daemon=True)
+        feeder.start()
+
+        pending = {}
+        next_seq = 0
+        while True:
+            item = queues[-1].get()
+            if item is STOP:
+                break
+            seq, data = item
+            pending[seq] = data
+            while next_seq in pending:
+                data = pending.pop(next_seq)
+                next_seq += 1
+                if data is not None:
+                    yield data
+        feeder.join()
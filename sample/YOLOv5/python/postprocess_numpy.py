@@ -8,6 +8,7 @@
 #===----------------------------------------------------------------------===#
 import numpy as np
 import cv2
+from nms_numpy import BatchedNMS
 
 class PostProcess:
     def __init__(self, conf_thresh=0.1, nms_thresh=0.5, agnostic=False, multi_label=True, max_det=1000):
@@ -16,33 +17,22 @@ class PostProcess:
         self.agnostic_nms = agnostic
         self.multi_label = multi_label
         self.max_det = max_det
-        self.nms = pseudo_torch_nms()
+        self.nms = BatchedNMS()
 
         self.nl = 3
         anchors = [[10, 13, 16, 30, 33, 23], [30, 61, 62, 45, 59, 119], [116, 90, 156, 198, 373, 326]]
         self.anchor_grid = np.asarray(anchors, dtype=np.float32).reshape(self.nl, 1, -1, 1, 1, 2)
-        self.grid = [np.zeros(1)] * self.nl
         self.stride = np.array([8., 16., 32.])
-
-    @staticmethod
-    def _make_grid(nx=20, ny=20):
-        xv, yv = np.meshgrid(np.arange(nx), np.arange(ny))
-        return np.stack((xv, yv), 2).reshape((1, 1, ny, nx, 2)).astype(np.float32)
+        self.decoders = {}
 
     def decode_for_3outputs(self, outputs):
-        z = []
-        for i, feat in enumerate(outputs):
-            bs, _, ny, nx, nc = feat.shape
-            if self.grid[i].shape[2:4] != feat.shape[2:4]:
-                self.grid[i] = self._make_grid(nx, ny)
-
-            y = 1 / (1 + np.exp(-feat))  # sigmoid
-            y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 +
-                           self.grid[i]) * int(self.stride[i])
-            y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
-            z.append(y.reshape(bs, -1, nc))
-        z = np.concatenate(z, axis=1)
-        return z
+        # one decoder per feature map shapes, i.e. per (net_w, net_h, batch)
+        shapes = tuple(feat.shape for feat in outputs)
+        decoder = self.decoders.get(shapes)
+        if decoder is None:
+            decoder = AnchorDecoder(shapes, self.stride, self.anchor_grid, self.conf_thresh)
+            self.decoders[shapes] = decoder
+        return decoder(outputs)
 
 
     def  __call__(self, preds_batch, org_size_batch, ratios_batch, txy_batch):
@@ -59,7 +49,7 @@ class PostProcess:
             dets = self.decode_for_3outputs(preds_batch)
         elif isinstance(preds_batch, list) and len(preds_batch) == 1:
             # 1 output
-            dets = np.concatenate(preds_batch)
+            dets = preds_batch[0]
         else:
             print('preds_batch type: '.format(type(preds_batch)))
             raise NotImplementedError
@@ -94,154 +84,60 @@ class PostProcess:
         return outs
 
 
-# numpy multiclass nms implementation from original yolov5 repo torch implementation
-class pseudo_torch_nms:
-    def nms_boxes(self, boxes, scores, iou_thres):
-        x = boxes[:, 0]
-        y = boxes[:, 1]
-        w = boxes[:, 2] - boxes[:, 0]
-        h = boxes[:, 3] - boxes[:, 1]
-
-        areas = w * h
-        order = scores.argsort()[::-1]
-
-        keep = []
-        while order.size > 0:
-            i = order[0]
-            keep.append(i)
-
-            xx1 = np.maximum(x[i], x[order[1:]])
-            yy1 = np.maximum(y[i], y[order[1:]])
-            xx2 = np.minimum(x[i] + w[i], x[order[1:]] + w[order[1:]])
-            yy2 = np.minimum(y[i] + h[i], y[order[1:]] + h[order[1:]])
-
-            w1 = np.maximum(0.0, xx2 - xx1 + 0.00001)
-            h1 = np.maximum(0.0, yy2 - yy1 + 0.00001)
-            inter = w1 * h1
-
-            ovr = inter / (areas[i] + areas[order[1:]] - inter)
-            inds = np.where(ovr <= iou_thres)[0]
-            order = order[inds + 1]
-        keep = np.array(keep)
-        return keep
-
-    def xywh2xyxy(self, x):
-        # Convert nx4 boxes from [x, y, w, h] to [x1, y1, x2, y2] where xy1=top-left, xy2=bottom-right
-        y = x.copy() if isinstance(x, np.ndarray) else np.copy(x)
-        y[:, 0] = x[:, 0] - x[:, 2] / 2  # top left x
-        y[:, 1] = x[:, 1] - x[:, 3] / 2  # top left y
-        y[:, 2] = x[:, 0] + x[:, 2] / 2  # bottom right x
-        y[:, 3] = x[:, 1] + x[:, 3] / 2  # bottom right y
-        return y
-
-    def box_area(self, box):
-        # box = xyxy(4,n)
-        return (box[2] - box[0]) * (box[3] - box[1])
-
-    def box_iou(self, box1, box2):
-        # https://github.com/pytorch/vision/blob/master/torchvision/ops/boxes.py
-        """
-        Return intersection-over-union (Jaccard index) of boxes.
-        Both sets of boxes are expected to be in (x1, y1, x2, y2) format.
-        Arguments:
-            box1 (Tensor[N, 4])
-            box2 (Tensor[M, 4])
-        Returns:
-            iou (Tensor[N, M]): the NxM matrix containing the pairwise
-                IoU values for every element in boxes1 and boxes2
-        """
-
-        # inter(N,M) = (rb(N,M,2) - lt(N,M,2)).clamp(0).prod(2)
-        (a1, a2), (b1, b2) = box1[:, None].chunk(2, 2), box2.chunk(2, 1)
-        # inter = (torch.min(a2, b2) - torch.max(a1, b1)).clamp(0).prod(2)
-        inter = (np.min([a2, b2], 0) - np.max([a1, b1], 0)).clip(min=0).prod(2)
-
-        # IoU = inter / (area1 + area2 - inter)
-        return inter / (self.box_area(box1.T)[:, None] + self.box_area(box2.T) - inter)
-
-    def nms(self, pred, conf_thres=0.25, iou_thres=0.5, agnostic=False, max_det=1000):
-        return self.non_max_suppression(pred, conf_thres, iou_thres,
-                                        classes=None,
-                                        agnostic=agnostic,
-                                        multi_label=True,
-                                        max_det=max_det)
-    
-    def non_max_suppression(self,
-                            prediction,
-                            conf_thres=0.25,
-                            iou_thres=0.5,
-                            classes=None,
-                            agnostic=False,
-                            multi_label=False,
-                            labels=(),
-                            max_det=300):
-        """Non-Maximum Suppression (NMS) on inference results to reject overlapping bounding boxes
-
-        Returns:
-             list of detections, on (n,6) tensor per image [xyxy, conf, cls]
-        """
-
-        bs = prediction.shape[0]  # batch size
-        nc = prediction.shape[2] - 5  # number of classes
-        xc = prediction[..., 4] > conf_thres  # candidates
-
-        # Checks
-        # assert 0 <= conf_thres <= 1, f'Invalid Confidence threshold {conf_thres}, valid values are between 0.0 and 1.0'
-        # assert 0 <= iou_thres <= 1, f'Invalid IoU {iou_thres}, valid values are between 0.0 and 1.0'
-
-        # Settings
-        max_wh = 7680  # (pixels) maximum box width and height
-        max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
-        multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-
-        # output = [torch.zeros((0, 6), device=prediction.device)] * bs
-        output = [np.zeros((0, 6))] * bs
-        for xi, x in enumerate(prediction):  # image index, image inference
-            # Apply constraints
-            # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
-            x = x[xc[xi]]  # confidence
-
-            # If none remain process next image
-            if not x.shape[0]:
-                continue
+class AnchorDecoder:
+    """
+    Decoder of the 3 output bmodels, built once per feature map shapes.
+    The grid * stride and anchor tables are computed here, and only the cells whose objectness
+    logit passes conf_thresh are decoded, so the sigmoid and the box decoding run on the
+    candidates only and are written into a preallocated output buffer.
+    """
+    def __init__(self, shapes, strides, anchor_grid, conf_thresh):
+        self.batch_size, _, _, _, no = shapes[0]
+        self.xy_scale = []
+        self.xy_offset = []
+        self.wh_scale = []
+        for (bs, na, ny, nx, _), stride, anchors in zip(shapes, strides, anchor_grid):
+            xv, yv = np.meshgrid(np.arange(nx), np.arange(ny))
+            grid = np.stack((xv, yv), 2).astype(np.float32)
+            # (sigmoid * 2 - 0.5 + grid) * stride = sigmoid * 2 * stride + (grid - 0.5) * stride
+            self.xy_scale.append(np.float32(2. * stride))
+            self.xy_offset.append((grid - 0.5) * np.float32(stride))
+            # (sigmoid * 2) ** 2 * anchor = sigmoid ** 2 * 4 * anchor
+            self.wh_scale.append(anchors.reshape(na, 2) * 4.)
+        num_cells = sum(na * ny * nx for _, na, ny, nx, _ in shapes)
+        self.output = np.zeros((self.batch_size, num_cells, no), dtype=np.float32)
+
+        # sigmoid(x) > conf  <=>  x > log(conf / (1 - conf)); kept slightly loose, nms checks the exact score
+        if 0 < conf_thresh < 1:
+            self.logit_thresh = np.log(conf_thresh / (1 - conf_thresh)) - 1e-6
+        else:
+            self.logit_thresh = -np.inf
 
-            # Compute conf
-            x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
-
-            # Box (center x, center y, width, height) to (x1, y1, x2, y2)
-            box = self.xywh2xyxy(x[:, :4])
-
-            # Detections matrix nx6 (xyxy, conf, cls)
-            if multi_label:
-                i, j = (x[:, 5:] > conf_thres).nonzero()
-                x = np.concatenate([box[i], x[i, j + 5, None], j[:, None].astype(np.float32)], 1)
-            else:  # best class only
-                conf = x[:, 5:].max(1, keepdims=True)
-                j_argmax = x[:, 5:].argmax(1)
-                j = j_argmax if j_argmax.shape == x[:, 5:].shape else \
-                    np.expand_dims(j_argmax, 1)  # for argmax(axis, keepdims=True)
-                x = np.concatenate([box, conf, j.astype(np.float32)], 1)[conf.reshape(-1) > conf_thres]
-
-            # Check shape
-            n = x.shape[0]  # number of boxes
-            if not n:  # no boxes
+    def __call__(self, outputs):
+        counts = np.zeros(self.batch_size, dtype=np.int64)
+        for feat, xy_scale, xy_offset, wh_scale in zip(outputs, self.xy_scale, self.xy_offset, self.wh_scale):
+            b, a, y, x = (feat[..., 4] > self.logit_thresh).nonzero()
+            if not b.shape[0]:
                 continue
-            elif n > max_nms:  # excess boxes
-                x_argsort = np.argsort(x[:, 4])[:max_nms] # sort by confidence
-                x = x[x_argsort]
-
-            # Batched NMS
-            c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-            boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-
-            #############################################
-            # i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-            i = self.nms_boxes(boxes, scores, iou_thres)
-            ############################################
-
-            if i.shape[0] > max_det:  # limit detections
-                i = i[:max_det]
-
-            output[xi] = x[i]
-
-        return output
+            cand = feat[b, a, y, x].astype(np.float32)
+
+            # in-place sigmoid
+            np.negative(cand, out=cand)
+            np.exp(cand, out=cand)
+            cand += 1.
+            np.reciprocal(cand, out=cand)
+
+            cand[:, 0:2] *= xy_scale
+            cand[:, 0:2] += xy_offset[y, x]
+            np.square(cand[:, 2:4], out=cand[:, 2:4])
+            cand[:, 2:4] *= wh_scale[a]
+
+            # append after the candidates of the previous levels, keeping the level/anchor/y/x order
+            rank = np.arange(b.shape[0]) - np.searchsorted(b, b)
+            self.output[b, counts[b] + rank] = cand
+            counts += np.bincount(b, minlength=self.batch_size)
+
+        # rows after the last candidate of an image are not candidates
+        num = max(int(counts.max()), 1)
+        self.output[:, :num, 4][np.arange(num)[None] >= counts[:, None]] = 0.
+        return self.output[:, :num]
@@ -7,6 +7,7 @@
 #
 #===----------------------------------------------------------------------===#
 import os
+import copy
 import json
 import time
 import cv2
@@ -14,6 +15,8 @@ import argparse
 import numpy as np
 import sophon.sail as sail
 from postprocess_numpy import PostProcess
+from preprocess_numpy import LetterboxPreprocess
+from pipeline import Pipeline
 from utils import COLORS, COCO_CLASSES
 import logging
 import ast
@@ -45,6 +48,7 @@ class YOLOv5:
         self.agnostic = False
         self.multi_label = True
         self.max_det = 1000
+        self.preprocessor = LetterboxPreprocess(self.input_shape)
         
         if self.use_cpu_opt:
             self.handle = sail.Handle(args.dev_id)
@@ -70,63 +74,6 @@ class YOLOv5:
         self.inference_time = 0.0
         self.postprocess_time = 0.0
             
-    def preprocess(self, ori_img):
-        """
-        pre-processing
-        Args:
-            img: numpy.ndarray -- (h,w,3)
-
-        Returns: (3,h,w) numpy.ndarray after pre-processing
-
-        """
-        letterbox_img, ratio, (tx1, ty1) = self.letterbox(
-            ori_img,
-            new_shape=(self.net_h, self.net_w),
-            color=(114, 114, 114),
-            auto=False,
-            scaleFill=False,
-            scaleup=True,
-            stride=32
-        )
-
-        img = letterbox_img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
-        img = img.astype(np.float32)
-        # input_data = np.expand_dims(input_data, 0)
-        img = np.ascontiguousarray(img / 255.0)
-        return img, ratio, (tx1, ty1) 
-    
-    def letterbox(self, im, new_shape=(640, 640), color=(114, 114, 114), auto=False, scaleFill=False, scaleup=True, stride=32):
-        # Resize and pad image while meeting stride-multiple constraints
-        shape = im.shape[:2]  # current shape [height, width]
-        if isinstance(new_shape, int):
-            new_shape = (new_shape, new_shape)
-
-        # Scale ratio (new / old)
-        r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
-        if not scaleup:  # only scale down, do not scale up (for better val mAP)
-            r = min(r, 1.0)
-
-        # Compute padding
-        ratio = r, r  # width, height ratios
-        new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
-        dw, dh = new_shape[1] - new_unpad[0], new_shape[0] - new_unpad[1]  # wh padding
-        if auto:  # minimum rectangle
-            dw, dh = np.mod(dw, stride), np.mod(dh, stride)  # wh padding
-        elif scaleFill:  # stretch
-            dw, dh = 0.0, 0.0
-            new_unpad = (new_shape[1], new_shape[0])
-            ratio = new_shape[1] / shape[1], new_shape[0] / shape[0]  # width, height ratios
-
-        dw /= 2  # divide padding into 2 sides
-        dh /= 2
-
-        if shape[::-1] != new_unpad:  # resize
-            im = cv2.resize(im, new_unpad, interpolation=cv2.INTER_LINEAR)
-        top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
-        left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
-        im = cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
-        return im, ratio, (dw, dh)
-    
     def predict(self, input_img, img_num):
         input_data = {self.input_name: input_img}
         outputs = self.net.process(self.graph_name, input_data)
@@ -148,38 +95,31 @@ class YOLOv5:
             out = [outputs[out_keys[i]][:img_num] for i in ord]
         return out
     
+    def preprocess_batch(self, img_list, preprocessor=None):
+        """
+        letterbox a list of images into one input batch
+        Returns: input batch, list of (ori_w, ori_h), list of ratios, list of (tx1, ty1)
+        """
+        if preprocessor is None:
+            preprocessor = self.preprocessor
+        ori_size_list = [(ori_img.shape[1], ori_img.shape[0]) for ori_img in img_list]
+        input_img, ratio_list, txy_list = preprocessor(img_list)
+        return input_img, ori_size_list, ratio_list, txy_list
+
     def __call__(self, img_list):
         img_num = len(img_list)
-        ori_size_list = []
-        ori_w_list = []
-        ori_h_list = []
-        preprocessed_img_list = []
-        ratio_list = []
-        txy_list = []
-        for ori_img in img_list:
-            ori_h, ori_w = ori_img.shape[:2]
-            ori_size_list.append((ori_w, ori_h))
-            ori_w_list.append(ori_w)
-            ori_h_list.append(ori_h)
-            start_time = time.time()
-            preprocessed_img, ratio, (tx1, ty1) = self.preprocess(ori_img)
-            self.preprocess_time += time.time() - start_time
-            preprocessed_img_list.append(preprocessed_img)
-            ratio_list.append(ratio)
-            txy_list.append([tx1, ty1])
-        
-        if img_num == self.batch_size:
-            input_img = np.stack(preprocessed_img_list)
-        else:
-            input_img = np.zeros(self.input_shape, dtype='float32')
-            input_img[:img_num] = np.stack(preprocessed_img_list)
-            
+        start_time = time.time()
+        input_img, ori_size_list, ratio_list, txy_list = self.preprocess_batch(img_list)
+        self.preprocess_time += time.time() - start_time
+
         start_time = time.time()
         outputs = self.predict(input_img, img_num)
         self.inference_time += time.time() - start_time
         
         start_time = time.time()
         if self.use_cpu_opt:
+            ori_w_list = [ori_w for ori_w, _ in ori_size_list]
+            ori_h_list = [ori_h for _, ori_h in ori_size_list]
             self.cpu_opt_process = sail.algo_yolov5_post_cpu_opt(self.output_shapes, self.net_w, self.net_h)
             results = self.cpu_opt_process.process(outputs, ori_w_list, ori_h_list, [self.conf_thresh]*self.batch_size, [self.nms_thresh]*self.batch_size, True, self.multi_label)
             results = [np.array(result) for result in results]
@@ -211,6 +151,172 @@ def draw_numpy(image, boxes, masks=None, classes_ids=None, conf_scores=None):
         
     return image
    
+def draw_result(image, det, use_cpu_opt):
+    if det.shape[0] < 1:
+        return image
+    if use_cpu_opt:
+        return draw_numpy(image, det[:,:4], masks=None, classes_ids=det[:, -2], conf_scores=det[:, -1])
+    return draw_numpy(image, det[:,:4], masks=None, classes_ids=det[:, -1], conf_scores=det[:, -2])
+
+def result_to_dict(filename, det, use_cpu_opt):
+    res_dict = dict()
+    res_dict['image_name'] = filename
+    res_dict['bboxes'] = []
+    for idx in range(det.shape[0]):
+        bbox_dict = dict()
+        if use_cpu_opt:
+            x1, y1, x2, y2, category_id, score = det[idx]
+        else:
+            x1, y1, x2, y2, score, category_id = det[idx]
+        bbox_dict['bbox'] = [float(round(x1, 3)), float(round(y1, 3)), float(round(x2 - x1,3)), float(round(y2 -y1, 3))]
+        bbox_dict['category_id'] = int(category_id)
+        bbox_dict['score'] = float(round(score,5))
+        res_dict['bboxes'].append(bbox_dict)
+    return res_dict
+
+def decode_image(img_file):
+    src_img = cv2.imdecode(np.fromfile(img_file, dtype=np.uint8), -1)
+    if src_img is None:
+        logging.error("{} imdecode is None.".format(img_file))
+        return None
+    if len(src_img.shape) != 3:
+        src_img = cv2.cvtColor(src_img, cv2.COLOR_GRAY2BGR)
+    return src_img
+
+def run_pipeline(args, output_dir, output_img_dir):
+    """
+    decode, preprocess, inference and postprocess run as concurrent stages connected by bounded
+    queues, with one inference thread per device; results are saved in input order
+    """
+    if args.use_cpu_opt:
+        raise ValueError('--pipeline only supports the numpy postprocess, do not set --use_cpu_opt')
+    dev_ids = [int(d) for d in args.dev_ids.split(',')] if args.dev_ids else [args.dev_id]
+    engines = []
+    for dev_id in dev_ids:
+        dev_args = copy.copy(args)
+        dev_args.dev_id = dev_id
+        engines.append(YOLOv5(dev_args))
+    yolov5 = engines[0]
+    batch_size = yolov5.batch_size
+    # the batches a preprocess worker produced may wait in the queue or be in inference while it fills the next one
+    num_buffers = args.queue_size + len(engines) + 1
+    decode_time = 0.0
+
+    def preprocess_worker():
+        preprocessor = LetterboxPreprocess(yolov5.input_shape, num_buffers=num_buffers)
+        def preprocess(item):
+            names, imgs = item
+            return (names, imgs) + yolov5.preprocess_batch(imgs, preprocessor)
+        return preprocess
+
+    def inference_worker():
+        net = engines.pop()
+        def inference(item):
+            names, imgs, input_img, ori_size_list, ratio_list, txy_list = item
+            outputs = net.predict(input_img, len(imgs))
+            return names, imgs, outputs, ori_size_list, ratio_list, txy_list
+        return inference
+
+    def postprocess_worker():
+        # every thread owns its postprocessor, whose decode buffers are reused between calls
+        postprocess = PostProcess(conf_thresh=yolov5.conf_thresh, nms_thresh=yolov5.nms_thresh,
+                                  agnostic=yolov5.agnostic, multi_label=yolov5.multi_label, max_det=yolov5.max_det)
+        def post(item):
+            names, imgs, outputs, ori_size_list, ratio_list, txy_list = item
+            return names, imgs, postprocess(outputs, ori_size_list, ratio_list, txy_list)
+        return post
+
+    pipeline = Pipeline(queue_size=args.queue_size)
+    is_video = not os.path.isdir(args.input)
+    if is_video:
+        cap = cv2.VideoCapture()
+        if not cap.open(args.input):
+            raise Exception("can not open the video")
+        def source():
+            # video frames can only be read in order, decode runs in the feeder thread
+            nonlocal decode_time
+            while True:
+                frames = []
+                start_time = time.time()
+                while len(frames) < batch_size:
+                    ret, frame = cap.read()
+                    if not ret or frame is None:
+                        break
+                    frames.append(frame)
+                decode_time += time.time() - start_time
+                if not frames:
+                    return
+                yield [None] * len(frames), frames
+    else:
+        img_files = []
+        for root, dirs, filenames in os.walk(args.input):
+            for filename in filenames:
+                if os.path.splitext(filename)[-1].lower() in ['.jpg','.png','.jpeg','.bmp','.webp']:
+                    img_files.append(os.path.join(root, filename))
+        def source():
+            for i in range(0, len(img_files), batch_size):
+                yield img_files[i:i + batch_size]
+        def decode_worker():
+            def decode(batch):
+                names, imgs = [], []
+                for img_file in batch:
+                    src_img = decode_image(img_file)
+                    if src_img is not None:
+                        names.append(os.path.basename(img_file))
+                        imgs.append(src_img)
+                return (names, imgs) if imgs else None
+            return decode
+        pipeline.add_stage('decode', decode_worker, args.decode_threads)
+    pipeline.add_stage('preprocess', preprocess_worker, args.preprocess_threads)
+    pipeline.add_stage('inference', inference_worker, len(engines))
+    pipeline.add_stage('postprocess', postprocess_worker, args.postprocess_threads)
+
+    cn = 0
+    results_list = []
+    out = None
+    if is_video:
+        fourcc = cv2.VideoWriter_fourcc(*'XVID')
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        save_video = os.path.join(output_dir, os.path.splitext(os.path.split(args.input)[1])[0] + '.avi')
+        out = cv2.VideoWriter(save_video, fourcc, fps, size)
+
+    start_time = time.time()
+    for names, imgs, results in pipeline.run(source()):
+        for filename, img, det in zip(names, imgs, results):
+            cn += 1
+            if is_video:
+                logging.info("{}, det nums: {}".format(cn, det.shape[0]))
+                if det.shape[0] > 0:
+                    out.write(draw_result(img, det, False))
+            else:
+                logging.info("{}, img_file: {}".format(cn, filename))
+                cv2.imwrite(os.path.join(output_img_dir, filename), draw_result(img, det, False))
+                results_list.append(result_to_dict(filename, det, False))
+    total_time = time.time() - start_time
+
+    if is_video:
+        cap.release()
+        out.release()
+        logging.info("result saved in {}".format(save_video))
+    else:
+        if args.input[-1] == '/':
+            args.input = args.input[:-1]
+        json_name = os.path.split(args.bmodel)[-1] + "_" + os.path.split(args.input)[-1] + "_opencv" + "_python_result.json"
+        with open(os.path.join(output_dir, json_name), 'w') as jf:
+            json.dump(results_list, jf, indent=4, ensure_ascii=False)
+        logging.info("result saved in {}".format(os.path.join(output_dir, json_name)))
+
+    # calculate speed, stage times are the busy time of all threads of a stage per image
+    cn = max(cn, 1)
+    stage_time = {stage.name: stage.busy_time for stage in pipeline.stages}
+    logging.info("------------------ Predict Time Info ----------------------")
+    logging.info("decode_time(ms): {:.2f}".format(stage_time.get('decode', decode_time) / cn * 1000))
+    logging.info("preprocess_time(ms): {:.2f}".format(stage_time['preprocess'] / cn * 1000))
+    logging.info("inference_time(ms): {:.2f}".format(stage_time['inference'] / cn * 1000))
+    logging.info("postprocess_time(ms): {:.2f}".format(stage_time['postprocess'] / cn * 1000))
+    logging.info("end-to-end fps: {:.2f}, total time(s): {:.2f}".format(cn / total_time, total_time))
+
 def main(args):
     # check params
     if not os.path.exists(args.input):
@@ -226,6 +332,10 @@ def main(args):
     if not os.path.exists(output_img_dir):
         os.mkdir(output_img_dir) 
     
+    if args.pipeline:
+        run_pipeline(args, output_dir, output_img_dir)
+        return
+
     # initialize net
     yolov5 = YOLOv5(args)
     batch_size = yolov5.batch_size
@@ -268,33 +378,11 @@ def main(args):
                     for i, filename in enumerate(filename_list):
                         det = results[i]
                         # save image
-                        if args.use_cpu_opt:
-                            if det.shape[0] >= 1:
-                                res_img = draw_numpy(img_list[i], det[:,:4], masks=None, classes_ids=det[:, -2], conf_scores=det[:, -1])
-                            else:
-                                res_img = img_list[i]
-                        else:
-                            if det.shape[0] >= 1:
-                                res_img = draw_numpy(img_list[i], det[:,:4], masks=None, classes_ids=det[:, -1], conf_scores=det[:, -2])
-                            else:
-                                res_img = img_list[i]
+                        res_img = draw_result(img_list[i], det, args.use_cpu_opt)
                         cv2.imwrite(os.path.join(output_img_dir, filename), res_img)
                         
                         # save result
-                        res_dict = dict()
-                        res_dict['image_name'] = filename
-                        res_dict['bboxes'] = []
-                        for idx in range(det.shape[0]):
-                            bbox_dict = dict()
-                            if args.use_cpu_opt:
-                                x1, y1, x2, y2, category_id, score = det[idx]
-                            else:
-                                x1, y1, x2, y2, score, category_id = det[idx]
-                            bbox_dict['bbox'] = [float(round(x1, 3)), float(round(y1, 3)), float(round(x2 - x1,3)), float(round(y2 -y1, 3))]
-                            bbox_dict['category_id'] = int(category_id)
-                            bbox_dict['score'] = float(round(score,5))
-                            res_dict['bboxes'].append(bbox_dict)
-                        results_list.append(res_dict)
+                        results_list.append(result_to_dict(filename, det, args.use_cpu_opt))
                         
                     img_list.clear()
                     filename_list.clear()
@@ -338,10 +426,7 @@ def main(args):
                     logging.info("{}, det nums: {}".format(cn, det.shape[0]))
                     if det.shape[0] <= 0:
                         continue
-                    if args.use_cpu_opt:
-                        res_frame = draw_numpy(frame_list[i], det[:,:4], masks=None, classes_ids=det[:, -2], conf_scores=det[:, -1])
-                    else:
-                        res_frame = draw_numpy(frame_list[i], det[:,:4], masks=None, classes_ids=det[:, -1], conf_scores=det[:, -2])
+                    res_frame = draw_result(frame_list[i], det, args.use_cpu_opt)
                     out.write(res_frame)
                 frame_list.clear()
         cap.release()
@@ -370,6 +455,12 @@ def argsparser():
     parser.add_argument('--conf_thresh', type=float, default=0.001, help='confidence threshold')
     parser.add_argument('--nms_thresh', type=float, default=0.6, help='nms threshold')
     parser.add_argument('--use_cpu_opt', action="store_true", default=False, help='accelerate cpu postprocess')
+    parser.add_argument('--pipeline', action="store_true", default=False, help='run decode, preprocess, inference and postprocess concurrently')
+    parser.add_argument('--dev_ids', type=str, default=None, help='comma separated dev ids used by --pipeline, one inference thread each, default dev_id')
+    parser.add_argument('--decode_threads', type=int, default=2, help='decode threads of --pipeline')
+    parser.add_argument('--preprocess_threads', type=int, default=2, help='preprocess threads of --pipeline')
+    parser.add_argument('--postprocess_threads', type=int, default=2, help='postprocess threads of --pipeline')
+    parser.add_argument('--queue_size', type=int, default=4, help='queue size between the stages of --pipeline')
     args = parser.parse_args()
     return args
 
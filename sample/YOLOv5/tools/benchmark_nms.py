@@ -0,0 +1,144 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+import argparse
+import os
+import sys
+import time
+import logging
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../python'))
+from nms_numpy import BatchedNMS, NMS_MODES, xywh2xyxy
+logging.basicConfig(level=logging.INFO)
+
+
+def argsparser():
+    parser = argparse.ArgumentParser(prog=__file__)
+    parser.add_argument('--batch_size', type=int, default=4, help='images per batch')
+    parser.add_argument('--num_anchors', type=int, default=25200, help='anchors per image, 25200 for 640x640 yolov5')
+    parser.add_argument('--num_classes', type=int, default=80, help='number of classes')
+    parser.add_argument('--num_objects', type=int, default=100, help='objects per image, anchors cluster around them')
+    parser.add_argument('--conf_thresh', type=float, default=0.001, help='confidence threshold')
+    parser.add_argument('--nms_thresh', type=float, default=0.6, help='nms threshold')
+    parser.add_argument('--max_det', type=int, default=1000, help='maximum detections per image')
+    parser.add_argument('--loops', type=int, default=5, help='timed loops')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    return args
+
+
+def make_predictions(bs, n, nc, num_objects, rng):
+    # crowded yolov5 style predictions (bs, n, 5 + nc): boxes jittered around a few objects
+    centers = rng.uniform(32, 608, (bs, num_objects, 2))
+    sizes = rng.uniform(16, 256, (bs, num_objects, 2))
+    owner = rng.integers(0, num_objects, (bs, n))
+    bidx = np.arange(bs)[:, None]
+    pred = np.empty((bs, n, 5 + nc), dtype=np.float32)
+    pred[..., 0:2] = centers[bidx, owner] + rng.normal(0, 8, (bs, n, 2))
+    pred[..., 2:4] = sizes[bidx, owner] * rng.uniform(0.7, 1.3, (bs, n, 2))
+    pred[..., 4] = rng.beta(0.03, 10, (bs, n))
+    pred[..., 5:] = rng.beta(0.05, 8, (bs, n, nc))
+    return pred
+
+
+# reference implementation: the per-image, per-box loop the postprocessors used before BatchedNMS
+def legacy_nms_boxes(boxes, scores, iou_thres):
+    x = boxes[:, 0]
+    y = boxes[:, 1]
+    w = boxes[:, 2] - boxes[:, 0]
+    h = boxes[:, 3] - boxes[:, 1]
+
+    areas = w * h
+    order = scores.argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+
+        xx1 = np.maximum(x[i], x[order[1:]])
+        yy1 = np.maximum(y[i], y[order[1:]])
+        xx2 = np.minimum(x[i] + w[i], x[order[1:]] + w[order[1:]])
+        yy2 = np.minimum(y[i] + h[i], y[order[1:]] + h[order[1:]])
+
+        w1 = np.maximum(0.0, xx2 - xx1 + 0.00001)
+        h1 = np.maximum(0.0, yy2 - yy1 + 0.00001)
+        inter = w1 * h1
+
+        ovr = inter / (areas[i] + areas[order[1:]] - inter)
+        inds = np.where(ovr <= iou_thres)[0]
+        order = order[inds + 1]
+    keep = np.array(keep, dtype=np.int64)
+    return keep
+
+
+def legacy_non_max_suppression(prediction, conf_thres, iou_thres, multi_label, max_det, max_wh=7680):
+    bs = prediction.shape[0]
+    nc = prediction.shape[2] - 5
+    xc = prediction[..., 4] > conf_thres
+    multi_label &= nc > 1
+    output = [np.zeros((0, 6))] * bs
+    for xi, x in enumerate(prediction):
+        x = x[xc[xi]]
+        if not x.shape[0]:
+            continue
+        x[:, 5:] *= x[:, 4:5]
+        box = xywh2xyxy(x[:, :4])
+        if multi_label:
+            i, j = (x[:, 5:] > conf_thres).nonzero()
+            x = np.concatenate([box[i], x[i, j + 5, None], j[:, None].astype(np.float32)], 1)
+        else:
+            conf = x[:, 5:].max(1, keepdims=True)
+            j = x[:, 5:].argmax(1)
+            x = np.concatenate([box, conf, j[:, None].astype(np.float32)], 1)[conf.reshape(-1) > conf_thres]
+        if not x.shape[0]:
+            continue
+        c = x[:, 5:6] * max_wh
+        i = legacy_nms_boxes(x[:, :4] + c, x[:, 4], iou_thres)
+        output[xi] = x[i[:max_det]]
+    return output
+
+
+def timeit(fn, loops):
+    fn()  # warm up
+    start = time.time()
+    for _ in range(loops):
+        out = fn()
+    return (time.time() - start) / loops * 1000, out
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    pred = make_predictions(args.batch_size, args.num_anchors, args.num_classes, args.num_objects, rng)
+    candidates = int((pred[..., 4] > args.conf_thresh).sum())
+    logging.info("batch_size: {}, anchors: {}, candidates over conf_thresh: {}".format(
+        args.batch_size, args.num_anchors, candidates))
+
+    for multi_label in (False, True):
+        legacy_ms, ref = timeit(lambda: legacy_non_max_suppression(pred.copy(), args.conf_thresh, args.nms_thresh,
+                                                                   multi_label, args.max_det), args.loops)
+        logging.info("multi_label={} legacy loop: {:.2f} ms/batch, {} detections".format(
+            multi_label, legacy_ms, sum(len(r) for r in ref)))
+        for mode in NMS_MODES:
+            nms = BatchedNMS(layout='yolov5', mode=mode)
+            ms, out = timeit(lambda: nms.non_max_suppression(pred.copy(), args.conf_thresh, args.nms_thresh,
+                                                             multi_label=multi_label, max_det=args.max_det), args.loops)
+            line = "multi_label={} BatchedNMS {:<6}: {:.2f} ms/batch, {:.1f}x, {} detections".format(
+                multi_label, mode, ms, legacy_ms / ms, sum(len(r) for r in out))
+            if mode == 'hard':
+                exact = all(r.shape == o.shape and np.array_equal(r, o) for r, o in zip(ref, out))
+                line += ", identical to legacy: {}".format(exact)
+                if not exact:
+                    logging.error(line)
+                    sys.exit(1)
+            logging.info(line)
+
+
+if __name__ == '__main__':
+    args = argsparser()
+    main(args)
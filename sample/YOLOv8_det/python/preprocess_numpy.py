@@ -0,0 +1,102 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+import cv2
+import numpy as np
+
+ALIGNS = ('center', 'topleft', 'stretch')
+
+
+class LetterboxPreprocess:
+    """
+    Letterbox a list of BGR images into a preallocated NCHW float32 batch. The YOLO opencv
+    samples each keep an identical copy of this file.
+    Every image is resized straight into the padded region of a reusable uint8 canvas, then
+    one numpy pass does the channel swap, the scaling and the HWC to CHW change while writing
+    into the batch tensor, so no intermediate array is allocated per frame.
+
+    align: 'center' pads both sides like yolov5, 'topleft' pads right and bottom like yolox,
+           'stretch' resizes to the input size without keeping the aspect ratio like ppyolov3.
+    num_buffers: number of batch tensors used in turn. The returned batch is overwritten by the
+                 num_buffers-th next call, so a producer thread must keep more buffers than the
+                 batches it can have in flight.
+    """
+    def __init__(self, input_shape, align='center', bgr2rgb=True, scale=1 / 255.0, pad_value=114, num_buffers=1):
+        if align not in ALIGNS:
+            raise ValueError('align must be one of {}, but got {}'.format(ALIGNS, align))
+        self.batch_size, _, self.net_h, self.net_w = input_shape
+        self.align = align
+        self.bgr2rgb = bgr2rgb
+        self.scale = scale
+        self.pad_value = pad_value
+        self.buffers = [np.zeros((self.batch_size, 3, self.net_h, self.net_w), dtype=np.float32)
+                        for _ in range(max(1, num_buffers))]
+        self.canvas = [np.full((self.net_h, self.net_w, 3), pad_value, dtype=np.uint8)
+                       for _ in range(self.batch_size)]
+        self.rois = [None] * self.batch_size
+        self.index = 0
+
+    def geometry(self, ori_h, ori_w):
+        """
+        Returns: (x, y, w, h) of the resized image in the input, ratio and the (tx1, ty1)
+        padding the postprocessors use to map the boxes back
+        """
+        if self.align == 'stretch':
+            return (0, 0, self.net_w, self.net_h), (self.net_w / ori_w, self.net_h / ori_h), (0, 0)
+        r = min(self.net_h / ori_h, self.net_w / ori_w)
+        new_w, new_h = int(round(ori_w * r)), int(round(ori_h * r))
+        dw, dh = self.net_w - new_w, self.net_h - new_h
+        if self.align == 'topleft':
+            return (0, 0, new_w, new_h), (r, r), (dw, dh)
+        dw /= 2
+        dh /= 2
+        left, top = int(round(dw - 0.1)), int(round(dh - 0.1))
+        return (left, top, new_w, new_h), (r, r), (dw, dh)
+
+    def __call__(self, img_list):
+        """
+        Args:
+            img_list: list of (h, w, 3) uint8 BGR images, at most batch_size
+
+        Returns: (batch_size, 3, net_h, net_w) float32 batch, list of ratios, list of [tx1, ty1]
+        """
+        img_num = len(img_list)
+        if img_num > self.batch_size:
+            raise ValueError('got {} images for a batch of {}'.format(img_num, self.batch_size))
+        batch = self.buffers[self.index]
+        self.index = (self.index + 1) % len(self.buffers)
+
+        ratio_list = []
+        txy_list = []
+        for i, ori_img in enumerate(img_list):
+            ori_h, ori_w = ori_img.shape[:2]
+            roi, ratio, (tx1, ty1) = self.geometry(ori_h, ori_w)
+            canvas = self.canvas[i]
+            if roi != self.rois[i]:
+                # the last image of this slot was placed elsewhere, its pixels are in the border now
+                canvas[...] = self.pad_value
+                self.rois[i] = roi
+            x, y, w, h = roi
+            dst = canvas[y:y + h, x:x + w]
+            if (ori_w, ori_h) == (w, h):
+                dst[...] = ori_img
+            else:
+                cv2.resize(ori_img, (w, h), dst=dst, interpolation=cv2.INTER_LINEAR)
+            chw = canvas.transpose((2, 0, 1))
+            if self.bgr2rgb:
+                chw = chw[::-1]
+            if self.scale == 1:
+                batch[i] = chw
+            else:
+                # divide rather than multiply by the reciprocal to keep the values of img / 255.0
+                np.divide(chw, np.float32(1 / self.scale), out=batch[i], dtype=np.float32, casting='unsafe')
+            ratio_list.append(ratio)
+            txy_list.append([tx1, ty1])
+        if img_num < self.batch_size:
+            batch[img_num:] = 0
+        return batch, ratio_list, txy_list
@@ -16,6 +16,7 @@ import sophon.sail as sail
 import logging
 
 from postprocess_numpy import PostProcess
+from preprocess_numpy import LetterboxPreprocess
 from utils import COCO_CLASSES, COLORS
 logging.basicConfig(level=logging.INFO)
 
@@ -46,6 +47,7 @@ class YOLOv8:
         self.agnostic = False
         self.multi_label = False
         self.max_det = 300
+        self.preprocessor = LetterboxPreprocess(self.input_shape)
 
         self.postprocess = PostProcess(
             conf_thresh=self.conf_thresh,
@@ -64,64 +66,6 @@ class YOLOv8:
         self.inference_time = 0.0
         self.postprocess_time = 0.0
 
-    def preprocess(self, ori_img):
-        """
-        pre-processing
-        Args:
-            img: numpy.ndarray -- (h,w,3)
-
-        Returns: (3,h,w) numpy.ndarray after pre-processing
-
-        """
-        letterbox_img, ratio, (tx1, ty1) = self.letterbox(
-            ori_img,
-            new_shape=(self.net_h, self.net_w),
-            color=(114, 114, 114),
-            auto=False,
-            scaleFill=False,
-            scaleup=True,
-            stride=32
-        )
-
-        img = letterbox_img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
-        img = img.astype(np.float32)
-        # input_data = np.expand_dims(input_data, 0)
-        img = np.ascontiguousarray(img / 255.0)
-        return img, ratio, (tx1, ty1) 
-
-    def letterbox(self, im, new_shape=(640, 640), color=(114, 114, 114), auto=False, scaleFill=False, scaleup=True, stride=32):
-        # Resize and pad image while meeting stride-multiple constraints
-        shape = im.shape[:2]  # current shape [height, width]
-        if isinstance(new_shape, int):
-            new_shape = (new_shape, new_shape)
-
-        # Scale ratio (new / old)
-        r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
-        if not scaleup:  # only scale down, do not scale up (for better val mAP)
-            r = min(r, 1.0)
-
-        # Compute padding
-        ratio = r, r  # width, height ratios
-        new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
-        dw, dh = new_shape[1] - new_unpad[0], new_shape[0] - new_unpad[1]  # wh padding
-        if auto:  # minimum rectangle
-            dw, dh = np.mod(dw, stride), np.mod(dh, stride)  # wh padding
-        elif scaleFill:  # stretch
-            dw, dh = 0.0, 0.0
-            new_unpad = (new_shape[1], new_shape[0])
-            ratio = new_shape[1] / shape[1], new_shape[0] / shape[0]  # width, height ratios
-
-        dw /= 2  # divide padding into 2 sides
-        dh /= 2
-
-        if shape[::-1] != new_unpad:  # resize
-            im = cv2.resize(im, new_unpad, interpolation=cv2.INTER_LINEAR)
-        top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
-        left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
-        im = cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
-
-        return im, ratio, (dw, dh)
-
     def predict(self, input_img, img_num):
         input_data = {self.input_name: input_img}
         outputs = self.net.process(self.graph_name, input_data)
@@ -139,26 +83,11 @@ class YOLOv8:
 
     def __call__(self, img_list):
         img_num = len(img_list)
-        ori_size_list = []
-        preprocessed_img_list = []
-        ratio_list = []
-        txy_list = []
-        for ori_img in img_list:
-            ori_h, ori_w = ori_img.shape[:2]
-            ori_size_list.append((ori_w, ori_h))
-            start_time = time.time()
-            preprocessed_img, ratio, (tx1, ty1) = self.preprocess(ori_img)
-            self.preprocess_time += time.time() - start_time
-            preprocessed_img_list.append(preprocessed_img)
-            ratio_list.append(ratio)
-            txy_list.append([tx1, ty1])
-        
-        if img_num == self.batch_size:
-            input_img = np.stack(preprocessed_img_list)
-        else:
-            input_img = np.zeros(self.input_shape, dtype='float32')
-            input_img[:img_num] = np.stack(preprocessed_img_list)
-        
+        ori_size_list = [(ori_img.shape[1], ori_img.shape[0]) for ori_img in img_list]
+        start_time = time.time()
+        input_img, ratio_list, txy_list = self.preprocessor(img_list)
+        self.preprocess_time += time.time() - start_time
+
         start_time = time.time()
         outputs = self.predict(input_img, img_num)
         self.inference_time += time.time() - start_time
@@ -0,0 +1,303 @@
+#===----------------------------------------------------------------------===#
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# SOPHON-DEMO is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+#===----------------------------------------------------------------------===#
+import numpy as np
+
+# prediction layouts of the YOLO python samples
+#   obj:       column 4 is the objectness score and class scores start at column 5
+#   filter:    'obj' keeps candidates by column 4, 'cls' by the best class score
+#   scale:     class scores are multiplied by the objectness score
+#   xywh:      boxes are (center x, center y, w, h) instead of (x1, y1, x2, y2)
+#   transpose: predictions are (batch, channels, anchors) instead of (batch, anchors, channels)
+LAYOUTS = {
+    'yolov5':  dict(obj=True,  filter='obj', scale=True,  xywh=True,  transpose=False),
+    'yolox':   dict(obj=True,  filter='cls', scale=True,  xywh=True,  transpose=False),
+    'yolov8':  dict(obj=False, filter='cls', scale=False, xywh=True,  transpose=True),
+    'ppyoloe': dict(obj=True,  filter='obj', scale=False, xywh=False, transpose=False),
+}
+
+NMS_MODES = ('hard', 'fast', 'matrix')
+
+
+def xywh2xyxy(x):
+    # Convert nx4 boxes from [x, y, w, h] to [x1, y1, x2, y2] where xy1=top-left, xy2=bottom-right
+    y = np.copy(x)
+    y[:, 0] = x[:, 0] - x[:, 2] / 2  # top left x
+    y[:, 1] = x[:, 1] - x[:, 3] / 2  # top left y
+    y[:, 2] = x[:, 0] + x[:, 2] / 2  # bottom right x
+    y[:, 3] = x[:, 1] + x[:, 3] / 2  # bottom right y
+    return y
+
+
+class BatchedNMS:
+    """
+    Vectorized multiclass NMS of the numpy postprocessors of the YOLO samples. Every sample
+    keeps its own identical copy of this file, so that it runs on its own.
+
+    The candidates of every image in a batch are suppressed in one pass: boxes are offset
+    by class, sorted by score inside their image and suppressed block by block with
+    matrix IoU, so there is no python loop over boxes.
+
+    :param layout:        prediction layout, one of LAYOUTS
+    :param mode:          'hard'   greedy NMS, same detections as the original while loop
+                          'fast'   Fast-NMS, a box is dropped by any higher scored box, kept or not
+                          'matrix' Matrix-NMS, scores are decayed by the overlaps instead
+    :param max_nms:       top-k candidates per image kept before suppression
+    :param block_size:    number of candidates compared with each other at once
+    :param max_wh:        class offset in pixels, larger than any box
+    :param matrix_kernel: 'gaussian' or 'linear' decay in matrix mode
+    :param matrix_sigma:  sigma of the gaussian decay
+    :param matrix_thresh: minimum decayed score kept in matrix mode
+    """
+    def __init__(self, layout='yolov5', mode='hard', max_nms=30000, block_size=128, max_wh=7680,
+                 matrix_kernel='gaussian', matrix_sigma=2.0, matrix_thresh=0.05):
+        if layout not in LAYOUTS:
+            raise ValueError('unknown prediction layout: {}'.format(layout))
+        if mode not in NMS_MODES:
+            raise ValueError('unknown nms mode: {}'.format(mode))
+        if matrix_kernel not in ('gaussian', 'linear'):
+            raise ValueError('unknown matrix nms kernel: {}'.format(matrix_kernel))
+        self.layout = LAYOUTS[layout]
+        self.mode = mode
+        self.max_nms = max_nms
+        self.block_size = block_size
+        self.max_wh = max_wh
+        self.matrix_kernel = matrix_kernel
+        self.matrix_sigma = matrix_sigma
+        self.matrix_thresh = matrix_thresh
+
+    def nms_boxes(self, boxes, scores, iou_thres, xywh=False):
+        """
+        Single image, class agnostic NMS.
+        :param boxes:  (n, 4) xyxy boxes, or top-left xywh boxes when xywh is True
+        :param scores: (n,) scores
+        :return:       indices of the kept boxes, highest score first
+        """
+        keep, _ = self.suppress(boxes, scores, None, iou_thres, max_det=None, max_nms=None, xywh=xywh)
+        return keep
+
+    def non_max_suppression(self,
+                            prediction,
+                            conf_thres=0.25,
+                            iou_thres=0.5,
+                            classes=None,
+                            agnostic=False,
+                            multi_label=False,
+                            labels=(),
+                            max_det=300,
+                            nm=0):
+        """Non-Maximum Suppression (NMS) on inference results to reject overlapping bounding boxes
+
+        Returns:
+             list of detections, on (n,6+nm) array per image [xyxy, conf, cls, mask coefficients]
+        """
+        layout = self.layout
+        if layout['transpose']:
+            prediction = prediction.transpose(0, 2, 1)
+        bs = prediction.shape[0]  # batch size
+        ci = 5 if layout['obj'] else 4  # first class column
+        nc = prediction.shape[2] - nm - ci  # number of classes
+        mi = ci + nc  # mask start index
+        multi_label &= nc > 1  # multiple labels per box
+
+        output = [np.zeros((0, 6 + nm))] * bs
+
+        # candidates of the whole batch at once
+        if layout['filter'] == 'obj':
+            xc = prediction[..., 4] > conf_thres
+        else:
+            xc = prediction[..., ci:mi].max(2) > conf_thres
+        bi, ai = xc.nonzero()
+        if not bi.shape[0]:
+            return output
+        x = prediction[bi, ai]
+
+        if layout['scale']:
+            x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+        box = xywh2xyxy(x[:, :4]) if layout['xywh'] else x[:, :4]
+
+        # Detections matrix nx6 (xyxy, conf, cls, masks)
+        if multi_label:
+            i, j = (x[:, ci:mi] > conf_thres).nonzero()
+            x = np.concatenate([box[i], x[i, j + ci, None], j[:, None].astype(np.float32), x[i, mi:]], 1)
+        else:  # best class only
+            conf = x[:, ci:mi].max(1, keepdims=True)
+            j = x[:, ci:mi].argmax(1)
+            i = (conf.reshape(-1) > conf_thres).nonzero()[0]
+            x = np.concatenate([box, conf, j[:, None].astype(np.float32), x[:, mi:]], 1)[i]
+        bi = bi[i]
+
+        if classes is not None:
+            i = np.isin(x[:, 5], classes).nonzero()[0]
+            x, bi = x[i], bi[i]
+        if not x.shape[0]:
+            return output
+
+        # Batched NMS
+        c = x[:, 5:6] * (0 if agnostic else self.max_wh)  # classes
+        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
+        keep, scores = self.suppress(boxes, scores, bi, iou_thres, max_det=max_det, max_nms=self.max_nms,
+                                     classes=None if agnostic else x[:, 5])
+        x, bi = x[keep], bi[keep]
+        if self.mode == 'matrix':
+            x[:, 4] = scores
+
+        bounds = np.searchsorted(bi, np.arange(bs + 1))
+        for xi in range(bs):
+            if bounds[xi + 1] > bounds[xi]:
+                output[xi] = x[bounds[xi]:bounds[xi + 1]]
+        return output
+
+    def suppress(self, boxes, scores, groups=None, iou_thres=0.5, max_det=None, max_nms=None, xywh=False,
+                 classes=None):
+        """
+        Suppress overlapping boxes inside each group.
+        :param boxes:    (n, 4) xyxy boxes, or top-left xywh boxes when xywh is True
+        :param scores:   (n,) scores
+        :param groups:   (n,) non-decreasing group index (image index in a batch), or None
+        :param max_det:  maximum kept boxes per group, or None
+        :param max_nms:  top-k candidates per group before suppression, or None
+        :param classes:  (n,) class index, lets the fast and matrix modes skip pairs of different classes
+        :return:         kept indices ordered by group then score, and their (decayed) scores
+        """
+        n = scores.shape[0]
+        if groups is None:
+            groups = np.zeros(n, dtype=np.int64)
+        if not n:
+            return np.zeros(0, dtype=np.int64), scores[:0]
+
+        # sort every group by score, keeping only its top-k candidates
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(groups)) + 1, [n]))
+        order = []
+        for s, e in zip(starts[:-1], starts[1:]):
+            seg = scores[s:e]
+            if max_nms is not None and e - s > max_nms:
+                top = np.argpartition(-seg, max_nms)[:max_nms]
+                order.append(top[seg[top].argsort()[::-1]] + s)
+            else:
+                order.append(seg.argsort()[::-1] + s)
+        order = np.concatenate(order)
+
+        boxes, groups, sorted_scores = boxes[order], groups[order], scores[order]
+        if xywh:
+            x1, y1, w, h = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+        else:
+            x1, y1 = boxes[:, 0], boxes[:, 1]
+            w, h = boxes[:, 2] - x1, boxes[:, 3] - y1
+        # x2, y2 follow the arithmetic of the original loop so that overlaps match bit for bit
+        geometry = (x1, y1, x1 + w, y1 + h, w * h)
+
+        if self.mode == 'hard':
+            keep = self._hard(geometry, groups, iou_thres, max_det)
+        else:
+            # Fast-NMS and Matrix-NMS compare all pairs, so only pairs of the same class are built
+            sub = groups
+            if classes is not None:
+                sub = groups * (int(classes.max()) + 1) + classes[order].astype(np.int64)
+            arrange = np.argsort(sub, kind='stable')
+            sub_geometry = tuple(g[arrange] for g in geometry)
+            if self.mode == 'fast':
+                keep = np.sort(arrange[self._fast(sub_geometry, sub[arrange], iou_thres)])
+            else:
+                keep, decayed = self._matrix(sub_geometry, sub[arrange], sorted_scores[arrange])
+                keep = arrange[keep]
+                sorted_scores = np.empty_like(decayed)
+                sorted_scores[arrange] = decayed
+                # decayed scores change the order inside each group
+                keep = keep[np.lexsort((-sorted_scores[keep], groups[keep]))]
+
+        if max_det is not None:
+            # rank of every kept box inside its group
+            kept_groups = groups[keep]
+            rank = np.arange(keep.shape[0]) - np.searchsorted(kept_groups, kept_groups)
+            keep = keep[rank < max_det]
+        return order[keep], sorted_scores[keep]
+
+    @staticmethod
+    def _overlap(geometry, rows, cols):
+        # IoU of boxes rows x cols, same formula as the original per-box loop
+        x1, y1, x2, y2, areas = geometry
+        xx1 = np.maximum(x1[rows, None], x1[None, cols])
+        yy1 = np.maximum(y1[rows, None], y1[None, cols])
+        xx2 = np.minimum(x2[rows, None], x2[None, cols])
+        yy2 = np.minimum(y2[rows, None], y2[None, cols])
+
+        w1 = np.maximum(0.0, xx2 - xx1 + 0.00001)
+        h1 = np.maximum(0.0, yy2 - yy1 + 0.00001)
+        inter = w1 * h1
+        return inter / (areas[rows, None] + areas[None, cols] - inter)
+
+    def _hard(self, geometry, groups, iou_thres, max_det):
+        n = groups.shape[0]
+        keep = np.zeros(n, dtype=bool)
+        count = np.zeros(groups[-1] + 1, dtype=np.int64)
+        for s in range(0, n, self.block_size):
+            e = min(s + self.block_size, n)
+            block = slice(s, e)
+            gb = groups[block]
+            alive = np.ones(e - s, dtype=bool) if max_det is None else count[gb] < max_det
+            if not alive.any():
+                continue
+
+            # boxes kept by earlier blocks of the same groups
+            lo = np.searchsorted(groups, gb[0])
+            prev = lo + np.flatnonzero(keep[lo:s])
+            if prev.shape[0]:
+                sup = ~(self._overlap(geometry, prev, block) <= iou_thres)
+                sup &= groups[prev, None] == gb[None]
+                alive &= ~sup.any(0)
+
+            # greedy order inside the block: iterate to the fixed point (Cluster-NMS),
+            # which is reached after at most block_size rounds and equals sequential NMS
+            sup = ~(self._overlap(geometry, block, block) <= iou_thres)
+            sup &= gb[:, None] == gb[None]
+            sup = np.triu(sup, 1)
+            k = alive
+            while True:
+                k_next = alive & ~sup[k].any(0)
+                if np.array_equal(k_next, k):
+                    break
+                k = k_next
+            keep[block] = k
+            count += np.bincount(gb[k], minlength=count.shape[0])
+        return np.flatnonzero(keep)
+
+    def _fast(self, geometry, groups, iou_thres):
+        n = groups.shape[0]
+        keep = np.zeros(n, dtype=bool)
+        for s in range(0, n, self.block_size):
+            e = min(s + self.block_size, n)
+            gb = groups[s:e]
+            lo = np.searchsorted(groups, gb[0])
+            sup = ~(self._overlap(geometry, slice(lo, e), slice(s, e)) <= iou_thres)
+            sup &= groups[lo:e, None] == gb[None]
+            sup &= np.arange(lo, e)[:, None] < np.arange(s, e)[None]
+            keep[s:e] = ~sup.any(0)
+        return np.flatnonzero(keep)
+
+    def _matrix(self, geometry, groups, scores):
+        n = groups.shape[0]
+        compensate = np.zeros(n, dtype=np.float64)
+        decay = np.ones(n, dtype=np.float64)
+        for s in range(0, n, self.block_size):
+            e = min(s + self.block_size, n)
+            gb = groups[s:e]
+            lo = np.searchsorted(groups, gb[0])
+            valid = groups[lo:e, None] == gb[None]
+            valid &= np.arange(lo, e)[:, None] < np.arange(s, e)[None]
+            iou = np.where(valid, self._overlap(geometry, slice(lo, e), slice(s, e)), 0.)
+            compensate[s:e] = iou.max(0)
+            comp = compensate[lo:e, None]
+            if self.matrix_kernel == 'gaussian':
+                d = np.exp(-self.matrix_sigma * (iou ** 2 - comp ** 2))
+            else:
+                d = (1. - iou) / np.maximum(1. - comp, 1e-6)
+            decay[s:e] = np.where(valid, d, 1.).min(0, initial=1.)
+        decayed = (scores * decay).astype(scores.dtype)
+        return np.flatnonzero(decayed >= self.matrix_thresh), decayed
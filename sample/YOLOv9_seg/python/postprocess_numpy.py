@@ -11,18 +11,47 @@ import math
 import time
 import cv2
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from pycocotools.mask import encode
 from utils import *
+from nms_numpy import BatchedNMS
 
 
 
+class RoiMasks:
+    """
+    Binary masks of one image stored as their box regions, masks[i] gives the full [h, w] mask.
+    """
+    def __init__(self, rois, boxes, shape):
+        self.rois = rois  # list of bool [y2 - y1, x2 - x1]
+        self.boxes = boxes  # [n, 4] int x1, y1, x2, y2
+        self.shape = shape
+
+    def __len__(self):
+        return len(self.rois)
+
+    def __getitem__(self, idx):
+        x1, y1, x2, y2 = self.boxes[idx]
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[y1:y2, x1:x2] = self.rois[idx]
+        return mask
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
 class PostProcess:
 
-    def __init__(self, conf_thres=0.7, iou_thres=0.5, num_masks=32):
+    def __init__(self, conf_thres=0.7, iou_thres=0.5, num_masks=32, contour_workers=4, mask_chunk=128):
         self.conf_threshold = conf_thres
         self.iou_threshold = iou_thres
         self.num_masks = num_masks
-        self.nms = pseudo_torch_nms()
+        self.nms = BatchedNMS(layout='yolov8')
+        # detections per proto matmul, bounds the memory on frames with many instances
+        self.mask_chunk = mask_chunk
+        # cv2.findContours releases the GIL
+        self.contour_pool = ThreadPoolExecutor(max_workers=contour_workers)
 
     def __call__(self, outputs,im0_shape,ratio, txy):
         results=[]
@@ -108,7 +137,7 @@ class PostProcess:
         Returns:
             boxes (List): list of bounding boxes.
             segments (List): list of segments.
-            masks (np.ndarray): [N, H, W], output masks.
+            masks (RoiMasks): N masks of shape [h, w], stored as their box regions.
         """
         x, protos = preds[0], preds[1]  # Two outputs: predictions and protos
 
@@ -124,17 +153,9 @@ class PostProcess:
 
         # NMS filtering
         if(x.shape[0]):
-            x = x[self.nms.nms_boxes(x[:, :4], x[:, 4], iou_threshold)]
-
-        ans1,ans2,ans3=[],[],[]
-        post_batch_size = 1
-        for i in range((int(x.shape[0]/post_batch_size)+1)):
-            X=x[i*post_batch_size:min((i+1)*post_batch_size,x.shape[0])]
-            X=self.get_mask_distrubute(X,im0_shape, ratio, pad_w, pad_h,protos)
-            ans1.extend(X[0])
-            ans2.extend(X[1])
-            ans3.extend(X[2])
-        return ans1,ans2,ans3
+            x = x[self.nms.nms_boxes(x[:, :4], x[:, 4], iou_threshold, xywh=True)]
+
+        return self.get_mask_distrubute(x, im0_shape, ratio, pad_w, pad_h, protos)
 
     def get_mask_distrubute(self,x,im0_shape, ratio, pad_w, pad_h,protos):
         if len(x) > 0:
@@ -151,66 +172,47 @@ class PostProcess:
             x[..., [0, 2]] = x[:, [0, 2]].clip(0, im0_shape[1])
             x[..., [1, 3]] = x[:, [1, 3]].clip(0, im0_shape[0])
 
-            # Process masks
+            # Process masks, all detections of the image at once
             masks = self.process_mask(protos[0], x[:, 6:], x[:, :4], im0_shape)
 
             # Masks -> Segments(contours)
             segments = self.masks2segments(masks)
-            return x[..., :6], segments, masks  # boxes, segments, masks
+            return list(x[..., :6]), segments, masks  # boxes, segments, masks
         else:
             return [], [], []
+
     @staticmethod
-    def masks2segments(masks):
+    def roi_segment(roi, offset):
+        """the longest external contour of a box region, in original image coordinates"""
+        # zero border, the contours are the same as on the full mask
+        roi = cv2.copyMakeBorder(roi.view(np.uint8), 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+        contours, _ = cv2.findContours(roi, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(offset[0] - 1, offset[1] - 1))
+        if(contours):
+            contours = np.array(contours[np.array([len(x) for x in contours]).argmax()])
+            return [contours.flatten().astype('float32')]
+        return []
+
+    def masks2segments(self, masks):
         """
-        It takes a list of masks(n,h,w) and returns a list of segments(n,xy) (Borrowed from
+        It takes the masks of an image and returns a list of segments(n,xy) (Borrowed from
         https://github.com/ultralytics/ultralytics/blob/465df3024f44fa97d4fad9986530d5a13cdabdca/ultralytics/utils/ops.py#L750)
+        Only the box region of every mask is searched, in a thread pool.
 
         Args:
-            masks (numpy.ndarray): the output of the model, which is a tensor of shape (batch_size, 160, 160).
+            masks (RoiMasks): the output of process_mask.
 
         Returns:
             segments (List): list of segment masks.
         """
-        segments = []
-        for x in masks.astype('uint8'):
-            # c = cv2.findContours(x, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]  # CHAIN_APPROX_SIMPLE
-            # if c:
-            #     c = np.array(c[np.array([len(x) for x in c]).argmax()]).reshape(-1, 2)
-            # else:
-            #     c = np.zeros((0, 2))  # no segments found
-            contours, _ = cv2.findContours(x, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-            if(contours):
-                contours = np.array(contours[np.array([len(x) for x in contours]).argmax()])
-                coco_segmentation = [contours.flatten().astype('float32')]
-                segments.append(coco_segmentation)
-            else:
-                segments.append([])
-
-        return segments
-
-    @staticmethod
-    def crop_mask(masks, boxes):
-        """
-        It takes a mask and a bounding box, and returns a mask that is cropped to the bounding box. (Borrowed from
-        https://github.com/ultralytics/ultralytics/blob/465df3024f44fa97d4fad9986530d5a13cdabdca/ultralytics/utils/ops.py#L599)
-
-        Args:
-            masks (Numpy.ndarray): [n, h, w] tensor of masks.
-            boxes (Numpy.ndarray): [n, 4] tensor of bbox coordinates in relative point form.
-
-        Returns:
-            (Numpy.ndarray): The masks are being cropped to the bounding box.
-        """
-        n, h, w = masks.shape
-        x1, y1, x2, y2 = np.split(boxes[:, :, None], 4, 1)
-        r = np.arange(w, dtype=x1.dtype)[None, None, :]
-        c = np.arange(h, dtype=x1.dtype)[None, :, None]
-        return masks * ((r >= x1) * (r < x2) * (c >= y1) * (c < y2))
+        return list(self.contour_pool.map(self.roi_segment, masks.rois, masks.boxes[:, :2].tolist()))
 
     def process_mask(self, protos, masks_in, bboxes, im0_shape):
         """
         Takes the output of the mask head, and applies the mask to the bounding boxes. This produces masks of higher quality
         but is slower. (Borrowed from https://github.com/ultralytics/ultralytics/blob/465df3024f44fa97d4fad9986530d5a13cdabdca/ultralytics/utils/ops.py#L618)
+        The masks are the same as resizing the whole proto masks to the image with cv2.resize(INTER_LINEAR) and cropping
+        them to the boxes, but only the pixels inside every box are upsampled, so the memory grows with the box areas
+        instead of N*h*w.
 
         Args:
             protos (numpy.ndarray): [mask_dim, mask_h, mask_w].
@@ -219,48 +221,63 @@ class PostProcess:
             im0_shape (tuple): the size of the input image (h,w,c).
 
         Returns:
-            (numpy.ndarray): The upsampled masks.
+            (RoiMasks): The upsampled masks.
         """
         c, mh, mw = protos.shape
-        masks = np.matmul(masks_in, protos.reshape((c, -1))).reshape((-1, mh, mw)).transpose(1, 2, 0)  # HWN
-        masks = np.ascontiguousarray(masks)
-        masks = self.scale_mask(masks, im0_shape)  # re-scale mask from P3 shape to original input image shape
-        masks = np.einsum('HWN -> NHW', masks)  # HWN -> NHW
-        masks = self.crop_mask(masks, bboxes)
-        return np.greater(masks, 0.5)
+        im_h, im_w = im0_shape[0], im0_shape[1]
+        top, left, bottom, right = self.mask_window((mh, mw), im0_shape)
+        protos = protos[:, top:bottom, left:right]
+        src_h, src_w = protos.shape[1:]
+        protos = protos.reshape((c, -1))
+        # source taps of cv2.resize(INTER_LINEAR) for every row and column of the original image
+        ys0, ys1, wy0, wy1 = self.linear_taps(src_h, im_h)
+        xs0, xs1, wx0, wx1 = self.linear_taps(src_w, im_w)
+
+        # pixels (col, row) with x1 <= col < x2 and y1 <= row < y2 of every box
+        rois = np.ceil(bboxes).astype(np.int64)
+        rois[:, [0, 2]] = rois[:, [0, 2]].clip(0, im_w)
+        rois[:, [1, 3]] = rois[:, [1, 3]].clip(0, im_h)
+        rois[:, 2:] = np.maximum(rois[:, 2:], rois[:, :2])
+
+        roi_masks = []
+        for beg in range(0, len(masks_in), self.mask_chunk):
+            # one (n, mask_dim) x (mask_dim, mask_h * mask_w) matmul per chunk of detections
+            masks = np.matmul(masks_in[beg:beg + self.mask_chunk], protos).reshape((-1, src_h, src_w))
+            for mask, (x1, y1, x2, y2) in zip(masks, rois[beg:beg + self.mask_chunk]):
+                if x2 == x1 or y2 == y1:
+                    roi_masks.append(np.zeros((y2 - y1, x2 - x1), dtype=bool))
+                    continue
+                # proto rows and columns under the box, then the horizontal and vertical linear passes
+                sy, ey = ys0[y1], ys1[y2 - 1] + 1
+                sx, ex = xs0[x1], xs1[x2 - 1] + 1
+                mask = mask[sy:ey, sx:ex]
+                mask = mask[:, xs0[x1:x2] - sx] * wx0[x1:x2] + mask[:, xs1[x1:x2] - sx] * wx1[x1:x2]
+                mask = mask[ys0[y1:y2] - sy] * wy0[y1:y2, None] + mask[ys1[y1:y2] - sy] * wy1[y1:y2, None]
+                roi_masks.append(np.greater(mask, 0.5))
+        return RoiMasks(roi_masks, rois, (im_h, im_w))
 
     @staticmethod
-    def scale_mask(masks, im0_shape, ratio_pad=None):
-        """
-        Takes a mask, and resizes it to the original image size. (Borrowed from
-        https://github.com/ultralytics/ultralytics/blob/465df3024f44fa97d4fad9986530d5a13cdabdca/ultralytics/utils/ops.py#L305)
-
-        Args:
-            masks (np.ndarray): resized and padded masks/images, [h, w, num]/[h, w, 3].
-            im0_shape (tuple): the original image shape.
-            ratio_pad (tuple): the ratio of the padding to the original image.
+    def linear_taps(src_size, dst_size):
+        """source indexes and weights of cv2.resize(INTER_LINEAR) along one axis"""
+        scale = 1. / (dst_size / src_size)
+        f = ((np.arange(dst_size) + 0.5) * scale - 0.5).astype(np.float32)
+        s0 = np.floor(f).astype(np.int64)
+        f = f - s0
+        f[s0 < 0] = 0
+        s0 = s0.clip(0, None)
+        f[s0 >= src_size - 1] = 0
+        s0 = s0.clip(None, src_size - 1)
+        s1 = np.minimum(s0 + 1, src_size - 1)
+        return s0, s1, 1.0 - f, f
 
-        Returns:
-            masks (np.ndarray): The masks that are being returned.
-        """
-        im1_shape = masks.shape[:2]
-        if ratio_pad is None:  # calculate from im0_shape
-            gain = min(im1_shape[0] / im0_shape[0], im1_shape[1] / im0_shape[1])  # gain  = old / new
-            pad = (im1_shape[1] - im0_shape[1] * gain) / 2, (im1_shape[0] - im0_shape[0] * gain) / 2  # wh padding
-        else:
-            pad = ratio_pad[1]
-
-        # Calculate tlbr of mask
+    @staticmethod
+    def mask_window(im1_shape, im0_shape):
+        """the (top, left, bottom, right) of the proto masks without the letterbox padding"""
+        gain = min(im1_shape[0] / im0_shape[0], im1_shape[1] / im0_shape[1])  # gain  = old / new
+        pad = (im1_shape[1] - im0_shape[1] * gain) / 2, (im1_shape[0] - im0_shape[0] * gain) / 2  # wh padding
         top, left = int(round(pad[1] - 0.1)), int(round(pad[0] - 0.1))  # y, x
         bottom, right = int(round(im1_shape[0] - pad[1] + 0.1)), int(round(im1_shape[1] - pad[0] + 0.1))
-        if len(masks.shape) < 2:
-            raise ValueError(f'"len of masks shape" should be 2 or 3, but got {len(masks.shape)}')
-        masks = masks[top:bottom, left:right]
-        masks = cv2.resize(masks, (im0_shape[1], im0_shape[0]))#,
-                           #interpolation=cv2.INTER_CUBIC)  # INTER_CUBIC would be better
-        if len(masks.shape) == 2:
-            masks = masks[:, :, None]
-        return masks
+        return top, left, bottom, right
 
     def draw_and_visualize(self, filename,im, bboxes, segments, vis=False, save=True):
         """
@@ -308,36 +325,6 @@ class PostProcess:
             cv2.imwrite(filename+".jpg", im)
         return im
 
-class pseudo_torch_nms:
-    def nms_boxes(self, boxes, scores, iou_thres):
-        x = boxes[:, 0]
-        y = boxes[:, 1]
-        w = boxes[:, 2]
-        h = boxes[:, 3]
-
-        areas = w * h
-        order = scores.argsort()[::-1]
-
-        keep = []
-        while order.size > 0:
-            i = order[0]
-            keep.append(i)
-
-            xx1 = np.maximum(x[i], x[order[1:]])
-            yy1 = np.maximum(y[i], y[order[1:]])
-            xx2 = np.minimum(x[i] + w[i], x[order[1:]] + w[order[1:]])
-            yy2 = np.minimum(y[i] + h[i], y[order[1:]] + h[order[1:]])
-
-            w1 = np.maximum(0.0, xx2 - xx1 + 0.00001)
-            h1 = np.maximum(0.0, yy2 - yy1 + 0.00001)
-            inter = w1 * h1
-
-            ovr = inter / (areas[i] + areas[order[1:]] - inter)
-            inds = np.where(ovr <= iou_thres)[0]
-            order = order[inds + 1]
-        keep = np.array(keep)
-        return keep
-
 if __name__ == '__main__':
 
     p=PostProcess(conf_thres=0.5, iou_thres=0.3)